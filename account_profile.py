@@ -0,0 +1,90 @@
+# account_profile.py
+import logging
+from typing import Dict, Optional, Tuple
+
+from sizing import MIN_BALANCE
+
+logger = logging.getLogger(__name__)
+
+POSITION_MODE_NAMES = {"hedge": "хедж (Long/Short)", "one_way": "односторонний"}
+
+_UPSERT_SQL = """
+    INSERT INTO account_profiles
+        (user_id, exchange, position_mode, margin_mode, can_trade, futures_enabled, balance, error, probed_at)
+    VALUES (%(user_id)s, %(exchange)s, %(position_mode)s, %(margin_mode)s, %(can_trade)s, %(futures_enabled)s,
+            %(balance)s, %(error)s, CURRENT_TIMESTAMP)
+    ON CONFLICT (user_id) DO UPDATE SET
+        exchange = EXCLUDED.exchange,
+        position_mode = EXCLUDED.position_mode,
+        margin_mode = EXCLUDED.margin_mode,
+        can_trade = EXCLUDED.can_trade,
+        futures_enabled = EXCLUDED.futures_enabled,
+        balance = EXCLUDED.balance,
+        error = EXCLUDED.error,
+        probed_at = EXCLUDED.probed_at
+"""
+
+
+def probe_account(exchange: str, api_key: str, secret_key: str, passphrase: str = None) -> Dict:
+    """Проверяет ключи и возвращает профиль аккаунта: position_mode, margin_mode,
+    can_trade, futures_enabled, balance. None в поле — биржа его не отдаёт.
+    Ошибку ключей пробрасывает как есть, с кодом биржи в тексте."""
+    if exchange == "bingx":
+        from bingx_api import get_account_profile
+        return get_account_profile(api_key, secret_key)
+    if exchange == "okx":
+        from okx_api import get_account_profile
+        return get_account_profile(api_key, secret_key, passphrase)
+    if exchange == "bybit":
+        from bybit_api import get_account_profile
+        return get_account_profile(api_key, secret_key)
+    if exchange == "bitget":
+        from bitget_api import get_account_profile
+        return get_account_profile(api_key, secret_key, passphrase)
+    raise ValueError(f"Неизвестная биржа: {exchange}")
+
+
+def profile_problem(profile: Dict) -> Optional[Tuple[str, str]]:
+    """(класс ошибки user_health, текст для пользователя), если с таким аккаунтом торговать нельзя"""
+    if profile.get("can_trade") is False:
+        return "auth", "у API-ключа нет права на торговлю фьючерсами"
+    if profile.get("futures_enabled") is False:
+        return "auth", "в аккаунте не включена торговля фьючерсами"
+    return None
+
+
+def profile_warnings(exchange: str, profile: Dict) -> list:
+    """Что стоит поправить, хотя торговать уже можно"""
+    warnings = []
+    if exchange in ("bingx", "bitget") and profile.get("position_mode") == "one_way":
+        warnings.append("включите режим хеджирования (Long/Short) в настройках фьючерсов")
+    balance = profile.get("balance")
+    if balance is not None and balance < MIN_BALANCE.get(exchange, 0.0):
+        warnings.append(f"пополните фьючерсный счёт: доступно {balance:.2f} USDT, нужно от {MIN_BALANCE[exchange]:g}")
+    return warnings
+
+
+def describe_profile(profile: Dict) -> str:
+    lines = []
+    if profile.get("position_mode"):
+        lines.append(f"Режим позиции: {POSITION_MODE_NAMES.get(profile['position_mode'], profile['position_mode'])}")
+    if profile.get("margin_mode"):
+        lines.append(f"Режим маржи: {profile['margin_mode']}")
+    if profile.get("balance") is not None:
+        lines.append(f"Доступно: {profile['balance']:.2f} USDT")
+    return "\n".join(lines)
+
+
+def save_profile(cursor, user_id: int, exchange: str, profile: Dict = None, error: str = None) -> None:
+    """Записывает профиль (или ошибку проверки) без commit — транзакцией управляет вызывающий"""
+    profile = profile or {}
+    cursor.execute(_UPSERT_SQL, {
+        "user_id": user_id,
+        "exchange": exchange,
+        "position_mode": profile.get("position_mode"),
+        "margin_mode": profile.get("margin_mode"),
+        "can_trade": profile.get("can_trade"),
+        "futures_enabled": profile.get("futures_enabled"),
+        "balance": profile.get("balance"),
+        "error": error,
+    })
@@ -0,0 +1,214 @@
+# analytics_export.py
+"""
+Инкрементальная выгрузка истории в Parquet для аналитики.
+
+Закрытые сделки (trades) и исходы рассылки сигналов (signal_dispatch_stats)
+дописываются в EXPORT_DIR/<набор>/month=YYYY-MM/part-<ключ>.parquet. Водяной знак
+набора лежит рядом, в _watermark.json: каждый запуск выгружает только строки после него.
+P&L по стратегиям, качество исполнения и статистику пользователей считают по этим
+файлам (pyarrow, DuckDB, polars), не нагружая рабочую БД.
+
+    python analytics_export.py
+    python analytics_export.py --dataset trades --dir /data/analytics
+"""
+import argparse
+import json
+import logging
+import os
+from datetime import datetime, timedelta
+from typing import Dict, List, Optional
+
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+from database import connect
+
+logging.basicConfig(
+    level=logging.INFO,
+    format="%(asctime)s - %(name)s - %(levelname)s - %(message)s"
+)
+logger = logging.getLogger(__name__)
+
+EXPORT_DIR = os.getenv("EXPORT_DIR", "analytics")
+# Строк в одном запросе и одном файле
+EXPORT_BATCH = int(os.getenv("EXPORT_BATCH", "50000"))
+# Строки моложе этого не выгружаются: транзакции, закрывшие сделки чуть раньше,
+# могут ещё не быть зафиксированы, и водяной знак проскочил бы мимо них
+EXPORT_LAG = float(os.getenv("EXPORT_LAG", "300"))
+
+# Ключ выгрузки сделок — (время закрытия, trade_id); у старых сделок closed_at нет
+_TRADES_SQL = """
+    SELECT trade_id, user_id, exchange, symbol, side, position_side, quantity, ct_val, entry_price,
+           stop_loss, take_profit_1, take_profit_2, take_profit_3, status, filled_legs,
+           remaining_quantity, created_at, COALESCE(closed_at, created_at) AS closed_at
+    FROM trades
+    WHERE status <> 'open'
+      AND (COALESCE(closed_at, created_at), trade_id) > (%s, %s)
+      AND COALESCE(closed_at, created_at) < %s
+    ORDER BY COALESCE(closed_at, created_at), trade_id
+    LIMIT %s
+"""
+
+_SIGNALS_SQL = """
+    SELECT id, signal_id, shard, symbol, action, dispatch_order, users, skipped, failed,
+           p50_ms, p95_ms, max_ms, spread_ms, stddev_ms, created_at
+    FROM signal_dispatch_stats
+    WHERE id > %s AND created_at < %s
+    ORDER BY id
+    LIMIT %s
+"""
+
+DATASETS = {
+    "trades": {
+        "sql": _TRADES_SQL,
+        "time_column": "closed_at",
+        "schema": pa.schema([
+            ("trade_id", pa.int64()),
+            ("user_id", pa.int64()),
+            ("exchange", pa.string()),
+            ("symbol", pa.string()),
+            ("side", pa.string()),
+            ("position_side", pa.string()),
+            ("quantity", pa.float64()),
+            # quantity OKX — в контрактах; в базовой валюте — quantity * ct_val (NULL у старых сделок OKX)
+            ("ct_val", pa.float64()),
+            ("entry_price", pa.float64()),
+            ("stop_loss", pa.float64()),
+            ("take_profit_1", pa.float64()),
+            ("take_profit_2", pa.float64()),
+            ("take_profit_3", pa.float64()),
+            ("status", pa.string()),
+            ("filled_legs", pa.list_(pa.string())),
+            ("remaining_quantity", pa.float64()),
+            ("created_at", pa.timestamp("us")),
+            ("closed_at", pa.timestamp("us")),
+        ]),
+    },
+    "signals": {
+        "sql": _SIGNALS_SQL,
+        "time_column": "created_at",
+        "schema": pa.schema([
+            ("id", pa.int64()),
+            ("signal_id", pa.string()),
+            ("shard", pa.int32()),
+            ("symbol", pa.string()),
+            ("action", pa.string()),
+            ("dispatch_order", pa.string()),
+            ("users", pa.int32()),
+            ("skipped", pa.int32()),
+            ("failed", pa.int32()),
+            ("p50_ms", pa.float64()),
+            ("p95_ms", pa.float64()),
+            ("max_ms", pa.float64()),
+            ("spread_ms", pa.float64()),
+            ("stddev_ms", pa.float64()),
+            ("created_at", pa.timestamp("us")),
+        ]),
+    },
+}
+
+
+def _write_atomic(path: str, write) -> None:
+    # Файлы на «.» и «_» читатели наборов Parquet пропускают — недописанный файл не попадёт в выборку
+    tmp_path = os.path.join(os.path.dirname(path), f".{os.path.basename(path)}.tmp")
+    write(tmp_path)
+    os.replace(tmp_path, path)
+
+
+def load_watermark(directory: str) -> Dict:
+    path = os.path.join(directory, "_watermark.json")
+    if not os.path.exists(path):
+        return {}
+    with open(path, encoding="utf-8") as f:
+        return json.load(f)
+
+
+def save_watermark(directory: str, watermark: Dict) -> None:
+    def write(tmp_path: str) -> None:
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(watermark, f)
+    _write_atomic(os.path.join(directory, "_watermark.json"), write)
+
+
+def _query_params(name: str, watermark: Dict, until: datetime) -> tuple:
+    if name == "trades":
+        return (datetime.fromisoformat(watermark.get("closed_at", datetime.min.isoformat())),
+                watermark.get("trade_id", 0), until, EXPORT_BATCH)
+    return watermark.get("id", 0), until, EXPORT_BATCH
+
+
+def _next_watermark(name: str, row: Dict) -> Dict:
+    if name == "trades":
+        return {"closed_at": row["closed_at"].isoformat(), "trade_id": row["trade_id"]}
+    return {"id": row["id"]}
+
+
+def _part_name(name: str, watermark: Dict) -> str:
+    """Имя файла — водяной знак перед пачкой: повторный запуск после сбоя
+    перезапишет тот же файл, а не продублирует строки"""
+    if name == "trades":
+        closed_at = watermark.get("closed_at", datetime.min.isoformat())
+        return f"part-{closed_at.replace(':', '').replace('-', '')}-{watermark.get('trade_id', 0)}.parquet"
+    return f"part-{watermark.get('id', 0):012d}.parquet"
+
+
+def write_batch(directory: str, dataset: Dict, rows: List[Dict], part_name: str) -> None:
+    """Пишет пачку по месячным разделам month=YYYY-MM"""
+    months: Dict[str, List[Dict]] = {}
+    for row in rows:
+        months.setdefault(f"{row[dataset['time_column']]:%Y-%m}", []).append(row)
+    for month, month_rows in months.items():
+        month_dir = os.path.join(directory, f"month={month}")
+        os.makedirs(month_dir, exist_ok=True)
+        table = pa.Table.from_pylist(month_rows, schema=dataset["schema"])
+        _write_atomic(os.path.join(month_dir, part_name),
+                      lambda tmp_path: pq.write_table(table, tmp_path, compression="zstd"))
+
+
+def export_dataset(connection, name: str, base_dir: str = EXPORT_DIR, until: Optional[datetime] = None) -> int:
+    """Дописывает новые строки набора после водяного знака; возвращает их число"""
+    dataset = DATASETS[name]
+    directory = os.path.join(base_dir, name)
+    os.makedirs(directory, exist_ok=True)
+    until = until or datetime.now() - timedelta(seconds=EXPORT_LAG)
+    watermark = load_watermark(directory)
+
+    exported = 0
+    cursor = connection.cursor()
+    try:
+        while True:
+            cursor.execute(dataset["sql"], _query_params(name, watermark, until))
+            rows = cursor.fetchall()
+            connection.commit()
+            if not rows:
+                break
+            write_batch(directory, dataset, rows, _part_name(name, watermark))
+            # Водяной знак двигается только после записи файлов пачки
+            watermark = _next_watermark(name, rows[-1])
+            save_watermark(directory, watermark)
+            exported += len(rows)
+            if len(rows) < EXPORT_BATCH:
+                break
+    finally:
+        cursor.close()
+
+    logger.info(f"Выгрузка {name}: {exported} строк, водяной знак {watermark or 'нет'}")
+    return exported
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Инкрементальная выгрузка истории в Parquet")
+    parser.add_argument("--dataset", nargs="+", choices=sorted(DATASETS), default=sorted(DATASETS))
+    parser.add_argument("--dir", default=EXPORT_DIR, help="каталог выгрузки")
+    args = parser.parse_args()
+
+    connection = connect()
+    try:
+        for name in args.dataset:
+            export_dataset(connection, name, args.dir)
+    finally:
+        connection.close()
+
+
+if __name__ == "__main__":
+    main()
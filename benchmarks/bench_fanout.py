@@ -0,0 +1,172 @@
+"""
+Бенчмарк рассылки сигнала по подписчикам на локальном симуляторе бирж.
+
+Поднимает benchmarks/exchange_simulator.py и main_rout.app как отдельные процессы,
+заполняет отдельную схему Postgres синтетическими пользователями, отправляет
+один BUY-сигнал в /webhook и по журналу исполнений симулятора считает время от
+сигнала до исполнения входного ордера каждого пользователя.
+
+    python benchmarks/bench_fanout.py --sizes 10 100 1000 10000 --latency-ms 30
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+import time
+import urllib.error
+import urllib.request
+from datetime import datetime, timedelta
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import psycopg2
+from psycopg2.extras import RealDictCursor, execute_values
+
+from benchmarks.exchange_simulator import SIM_PASSPHRASE, sim_secret_for
+from database import DB_HOST, DB_NAME, DB_PASSWORD, DB_PORT, DB_USER
+from migrations import run_migrations
+
+SCHEMA = "bench_fanout"
+EXCHANGES = ["bingx", "okx", "bybit", "bitget"]
+SIGNAL = {
+    "action": "BUY", "symbol": "BTCUSDT", "price": 60000,
+    "stop_loss": 58000, "take_profit_1": 61000, "take_profit_2": 62000, "take_profit_3": 63000,
+}
+
+
+def percentile(values: list, q: float) -> float:
+    if not values:
+        return float("nan")
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, max(0, int(round(q * (len(ordered) - 1)))))
+    return ordered[index]
+
+
+def http(method: str, url: str, payload: dict = None, timeout: float = 30.0) -> dict:
+    data = json.dumps(payload).encode() if payload is not None else None
+    request = urllib.request.Request(url, data=data, method=method, headers={"Content-Type": "application/json"})
+    try:
+        with urllib.request.urlopen(request, timeout=timeout) as response:
+            return json.loads(response.read() or b"{}")
+    except urllib.error.HTTPError as e:
+        return {"status": "error", "http_status": e.code, "body": e.read().decode(errors="replace")}
+
+
+def wait_until_up(url: str, timeout: float = 30.0):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            urllib.request.urlopen(url, timeout=1)
+            return
+        except Exception:
+            time.sleep(0.2)
+    raise RuntimeError(f"{url} не поднялся за {timeout} с")
+
+
+def seed_users(conn, count: int) -> set:
+    cursor = conn.cursor()
+    cursor.execute("TRUNCATE users, trades, payments CASCADE")
+    end = datetime.now() + timedelta(days=30)
+    rows, keys = [], set()
+    for i in range(count):
+        exchange = EXCHANGES[i % len(EXCHANGES)]
+        api_key = f"simkey-{exchange}-{i:06d}"
+        keys.add(api_key)
+        rows.append((10_000_000 + i, 10_000_000 + i, end, "regular", api_key, sim_secret_for(api_key),
+                     SIM_PASSPHRASE, exchange))
+    execute_values(
+        cursor,
+        "INSERT INTO users (user_id, chat_id, subscription_end, subscription_type, api_key, secret_key, passphrase, exchange) VALUES %s",
+        rows, page_size=5000,
+    )
+    conn.commit()
+    return keys
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Fan-out сигнала на симуляторе бирж")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[10, 100, 1000, 10000])
+    parser.add_argument("--sim-port", type=int, default=9000)
+    parser.add_argument("--app-port", type=int, default=5055)
+    parser.add_argument("--latency-ms", type=float, default=30.0)
+    parser.add_argument("--jitter-ms", type=float, default=20.0)
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    parser.add_argument("--rate-limit", type=float, default=0.0)
+    parser.add_argument("--timeout", type=float, default=3600.0, help="предел ожидания одного прогона, с")
+    args = parser.parse_args()
+
+    sim_url = f"http://127.0.0.1:{args.sim_port}"
+    app_url = f"http://127.0.0.1:{args.app_port}"
+
+    conn = psycopg2.connect(host=DB_HOST, port=DB_PORT, database=DB_NAME, user=DB_USER,
+                            password=DB_PASSWORD, cursor_factory=RealDictCursor)
+    cursor = conn.cursor()
+    cursor.execute(f"CREATE SCHEMA IF NOT EXISTS {SCHEMA}")
+    cursor.execute(f"SET search_path TO {SCHEMA}")
+    conn.commit()
+    run_migrations(conn)
+
+    env = dict(os.environ)
+    env.update({
+        "EXCHANGE_SIMULATOR_URL": sim_url,
+        "PGOPTIONS": f"-c search_path={SCHEMA}",
+        "BOT_TOKEN": env.get("BOT_TOKEN") or "123456:SIMULATED",
+        "GROUP_ID": env.get("GROUP_ID") or "0",
+        "MODERATOR_GROUP_ID": env.get("MODERATOR_GROUP_ID") or "0",
+        "TRADE_OUTBOX_PATH": os.path.join(ROOT, "bench_trade_outbox.ndjson"),
+        # Прогон должен мерить холодный кэш, а не снимок от прошлого запуска
+        "WARM_STATE_PATH": "",
+        # Один сигнал — склеивать нечего, окно лишь сдвинуло бы все замеры
+        "SIGNAL_COALESCE_WINDOW": "0",
+    })
+    simulator = subprocess.Popen(
+        [sys.executable, os.path.join(ROOT, "benchmarks", "exchange_simulator.py"), "--port", str(args.sim_port),
+         "--latency-ms", str(args.latency_ms), "--jitter-ms", str(args.jitter_ms),
+         "--error-rate", str(args.error_rate), "--rate-limit", str(args.rate_limit)],
+        cwd=ROOT, env=env,
+    )
+    app = subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", "main_rout:app", "--port", str(args.app_port), "--log-level", "warning"],
+        cwd=ROOT, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+    )
+
+    try:
+        wait_until_up(f"{sim_url}/__sim/stats")
+        wait_until_up(f"{app_url}/health")
+
+        print(f"{'users':>7} {'webhook s':>10} {'filled':>7} {'p50 ms':>9} {'p99 ms':>9} {'last fill ms':>13}")
+        for size in args.sizes:
+            keys = seed_users(conn, size)
+            http("POST", f"{sim_url}/__sim/reset", {})
+
+            started = time.time()
+            response = http("POST", f"{app_url}/webhook", SIGNAL, timeout=args.timeout)
+            webhook_seconds = time.time() - started
+
+            fills = http("GET", f"{sim_url}/__sim/fills?since={started}")["fills"]
+            first_entry = {}
+            for fill in fills:
+                if fill["opening"] and fill["api_key"] in keys:
+                    first_entry.setdefault(fill["api_key"], fill["ts"])
+            latencies = [(ts - started) * 1000 for ts in first_entry.values()]
+
+            print(f"{size:>7} {webhook_seconds:>10.2f} {len(latencies):>7} {percentile(latencies, 0.5):>9.1f} "
+                  f"{percentile(latencies, 0.99):>9.1f} {max(latencies, default=float('nan')):>13.1f}")
+            if response.get("status") == "error":
+                print(f"        webhook ответил ошибкой: {response}")
+
+        print("Статистика симулятора:", http("GET", f"{sim_url}/__sim/stats"))
+    finally:
+        app.terminate()
+        simulator.terminate()
+        app.wait(timeout=30)
+        simulator.wait(timeout=30)
+        cursor.execute(f"DROP SCHEMA IF EXISTS {SCHEMA} CASCADE")
+        conn.commit()
+        conn.close()
+
+
+if __name__ == "__main__":
+    main()
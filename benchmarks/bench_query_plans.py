@@ -0,0 +1,183 @@
+"""
+Проверка планов горячих запросов.
+
+Создаёт отдельную схему, накатывает в неё миграции, заполняет синтетическими
+пользователями и сделками, после чего выполняет EXPLAIN ANALYZE для запросов
+из webhook/services и проверяет, что используются нужные индексы.
+
+    python benchmarks/bench_query_plans.py --users 20000 --trades 500000
+"""
+import argparse
+import json
+import os
+import random
+import sys
+import time
+from datetime import datetime, timedelta
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import psycopg2
+from psycopg2.extras import RealDictCursor, execute_values
+
+from database import ACTIVE_USERS_QUERY, DB_HOST, DB_NAME, DB_PASSWORD, DB_PORT, DB_USER
+from migrations import run_migrations
+from trade_archive import archive_closed
+
+SCHEMA = "bench_query_plans"
+EXCHANGES = ["bingx", "okx", "bybit", "bitget"]
+SYMBOLS = ["BTC-USDT", "ETH-USDT", "SOL-USDT", "XRP-USDT", "DOGE-USDT", "TON-USDT"]
+
+HOT_QUERIES = [
+    (
+        "active_subscribers",
+        ACTIVE_USERS_QUERY,
+        lambda ctx: (datetime.now(),),
+        "idx_users_active_subscribers",
+    ),
+    (
+        "open_trades_for_user_symbol",
+        """
+        SELECT trade_id, order_id, sl_order_id, tp1_order_id, tp2_order_id, tp3_order_id, side
+        FROM trades
+        WHERE user_id = %s AND symbol = %s AND status = 'open' AND tier = 'hot'
+        """,
+        lambda ctx: (ctx["user_id"], ctx["symbol"]),
+        "idx_trades_open_user_symbol",
+    ),
+    (
+        "move_sl_by_user_id",
+        """
+        UPDATE trades SET stop_loss = stop_loss
+        WHERE user_id = COALESCE(%s, (SELECT user_id FROM users WHERE api_key = %s))
+        AND symbol = %s AND status = 'open' AND tier = 'hot'
+        """,
+        lambda ctx: (ctx["user_id"], ctx["api_key"], ctx["symbol"]),
+        "idx_trades_open_user_symbol",
+    ),
+    (
+        "move_sl_by_api_key",
+        """
+        UPDATE trades SET stop_loss = stop_loss
+        WHERE user_id = COALESCE(%s, (SELECT user_id FROM users WHERE api_key = %s))
+        AND symbol = %s AND status = 'open' AND tier = 'hot'
+        """,
+        lambda ctx: (None, ctx["api_key"], ctx["symbol"]),
+        "idx_users_api_key",
+    ),
+]
+
+
+def collect_nodes(plan: dict) -> list:
+    nodes = [plan]
+    for child in plan.get("Plans", []):
+        nodes.extend(collect_nodes(child))
+    return nodes
+
+
+def seed(cursor, users: int, trades: int):
+    now = datetime.now()
+    user_rows = []
+    for user_id in range(1, users + 1):
+        active = random.random() < 0.7
+        user_rows.append((
+            user_id,
+            now + timedelta(days=30) if active else now - timedelta(days=30),
+            random.choice(["regular", "referral_approved", "referral_pending"]),
+            f"key-{user_id:08d}" if random.random() < 0.9 else None,
+            f"secret-{user_id:08d}",
+            random.choice(EXCHANGES),
+        ))
+    execute_values(
+        cursor,
+        "INSERT INTO users (user_id, subscription_end, subscription_type, api_key, secret_key, exchange) VALUES %s",
+        user_rows,
+        page_size=5000,
+    )
+
+    trade_rows = []
+    for i in range(trades):
+        user_id = random.randint(1, users)
+        trade_rows.append((
+            user_id, random.choice(EXCHANGES), f"ord-{i}", random.choice(SYMBOLS), "BUY", "LONG",
+            1.0, 100.0, "open" if random.random() < 0.02 else "closed",
+            # История за два года: после archive_closed она уходит в месячные разделы архива
+            now - timedelta(days=random.uniform(0, 730)),
+        ))
+        if len(trade_rows) >= 10000:
+            execute_values(
+                cursor,
+                "INSERT INTO trades (user_id, exchange, order_id, symbol, side, position_side, quantity, entry_price, status, created_at) VALUES %s",
+                trade_rows,
+            )
+            trade_rows = []
+    if trade_rows:
+        execute_values(
+            cursor,
+            "INSERT INTO trades (user_id, exchange, order_id, symbol, side, position_side, quantity, entry_price, status, created_at) VALUES %s",
+            trade_rows,
+        )
+
+
+def main():
+    parser = argparse.ArgumentParser(description="EXPLAIN ANALYZE горячих запросов")
+    parser.add_argument("--users", type=int, default=10000)
+    parser.add_argument("--trades", type=int, default=200000)
+    parser.add_argument("--keep", action="store_true", help="не удалять схему после прогона")
+    args = parser.parse_args()
+
+    conn = psycopg2.connect(host=DB_HOST, port=DB_PORT, database=DB_NAME, user=DB_USER,
+                            password=DB_PASSWORD, cursor_factory=RealDictCursor)
+    cursor = conn.cursor()
+    cursor.execute(f"DROP SCHEMA IF EXISTS {SCHEMA} CASCADE")
+    cursor.execute(f"CREATE SCHEMA {SCHEMA}")
+    cursor.execute(f"SET search_path TO {SCHEMA}")
+    conn.commit()
+
+    failed = False
+    try:
+        run_migrations(conn)
+        started = time.perf_counter()
+        seed(cursor, args.users, args.trades)
+        conn.commit()
+        archived = archive_closed(conn, datetime.now() - timedelta(days=7))
+        cursor.execute("ANALYZE users")
+        cursor.execute("ANALYZE trades")
+        conn.commit()
+        print(f"Заполнено {args.users} пользователей и {args.trades} сделок за {time.perf_counter() - started:.1f} с, "
+              f"в архиве {archived}")
+
+        cursor.execute(
+            "SELECT t.user_id, t.symbol, u.api_key FROM trades t JOIN users u USING (user_id) "
+            "WHERE t.status = 'open' AND u.api_key IS NOT NULL LIMIT 1"
+        )
+        ctx = cursor.fetchone()
+
+        for name, sql, params, expected_index in HOT_QUERIES:
+            cursor.execute("EXPLAIN (ANALYZE, BUFFERS, FORMAT JSON) " + sql, params(ctx))
+            result = cursor.fetchone()["QUERY PLAN"]
+            if isinstance(result, str):
+                result = json.loads(result)
+            plan = result[0]
+            conn.rollback()
+
+            nodes = collect_nodes(plan["Plan"])
+            indexes = {node.get("Index Name") for node in nodes if node.get("Index Name")}
+            seq_scans = [node.get("Relation Name") for node in nodes if node["Node Type"] == "Seq Scan"]
+            ok = expected_index in indexes and not seq_scans
+            failed = failed or not ok
+            print(
+                f"{'OK  ' if ok else 'FAIL'} {name:<30} {plan['Execution Time']:>8.3f} ms  "
+                f"индексы={sorted(indexes)} seq_scan={seq_scans}"
+            )
+    finally:
+        if not args.keep:
+            cursor.execute(f"DROP SCHEMA IF EXISTS {SCHEMA} CASCADE")
+            conn.commit()
+        conn.close()
+
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
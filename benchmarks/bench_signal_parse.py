@@ -0,0 +1,83 @@
+"""
+Бенчмарк разбора и валидации сигнала на payload'ах из benchmarks/payloads.
+
+Сравнивает signal_parser.parse_signal (orjson по байтам + models.Signal) с прежним
+путём webhook(): decode в str, замена NaN строкой, json.loads и ручной разбор
+каждого SL/TP через float/math.isnan.
+
+    python benchmarks/bench_signal_parse.py --iterations 20000
+"""
+import argparse
+import json
+import math
+import os
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from benchmarks.load_webhook import DEFAULT_PAYLOADS, load_payloads
+from signal_parser import SignalValidationError, parse_signal
+
+
+def legacy_parse(body: bytes, content_type: str) -> dict:
+    """Прежний разбор из webhook() — только для сравнения"""
+    data_str = body.decode("utf-8")
+    if "application/json" not in content_type and "text/plain" not in content_type:
+        raise ValueError("content_type")
+    data = json.loads(data_str.replace(": NaN", ": null").replace(":NaN", ":null"))
+    if not data:
+        raise ValueError("empty")
+    action = data.get("action", "").upper()
+    if action not in ["BUY", "SELL", "LONG", "SHORT", "MOVE_SL"]:
+        raise ValueError("action")
+    if action == "MOVE_SL":
+        return data
+    if not data.get("symbol"):
+        raise ValueError("symbol")
+    price = float(data.get("price", 0))
+    if price <= 0:
+        raise ValueError("price")
+    levels = {}
+    for key in ("stop_loss", "take_profit_1", "take_profit_2", "take_profit_3"):
+        value = data.get(key)
+        try:
+            levels[key] = float(value) if value is not None and not math.isnan(float(value)) else None
+        except (TypeError, ValueError):
+            levels[key] = None
+    if not levels["stop_loss"] or not all([levels["take_profit_1"], levels["take_profit_2"], levels["take_profit_3"]]):
+        raise ValueError("sl_tp")
+    return dict(data, action=action, price=price, **levels)
+
+
+def bench(parse, payload, iterations: int):
+    _, content_type, body = payload
+    outcome = None
+    started = time.perf_counter()
+    for _ in range(iterations):
+        try:
+            parse(body, content_type)
+            outcome = "ok"
+        except SignalValidationError as e:
+            outcome = e.code
+        except Exception as e:
+            outcome = type(e).__name__
+    return (time.perf_counter() - started) / iterations * 1e6, outcome
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Стоимость разбора и валидации сигнала")
+    parser.add_argument("--payloads", default=DEFAULT_PAYLOADS)
+    parser.add_argument("--iterations", type=int, default=20000)
+    args = parser.parse_args()
+
+    print(f"{'payload':<18} {'new µs':>8} {'legacy µs':>10}  результат")
+    for payload in load_payloads(args.payloads):
+        new_us, outcome = bench(parse_signal, payload, args.iterations)
+        legacy_us, _ = bench(legacy_parse, payload, args.iterations)
+        print(f"{payload[0]:<18} {new_us:>8.2f} {legacy_us:>10.2f}  {outcome}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,132 @@
+"""
+Бенчмарк холодного старта процесса вебхука.
+
+1. В свежих интерпретаторах замеряет время `import main_rout` и проверяет,
+   что вместе с приложением не загружаются main.py, yoomoney и SDK бирж.
+2. С --first-signal поднимает симулятор бирж и main_rout.app и сравнивает
+   задержку первого сигнала после старта со вторым (прогретым).
+
+    python benchmarks/bench_startup.py --runs 10
+    python benchmarks/bench_startup.py --first-signal --users 100
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+# Модули, которым нечего делать в процессе вебхука до первого пользователя соответствующей биржи
+HEAVY_MODULES = ["main", "yoomoney", "okx", "pybit", "pybitget"]
+
+IMPORT_PROBE = """
+import json, sys, time
+started = time.perf_counter()
+import main_rout
+elapsed = time.perf_counter() - started
+print(json.dumps({"seconds": elapsed, "loaded": [m for m in %r if m in sys.modules]}))
+""" % (HEAVY_MODULES,)
+
+
+def bench_env() -> dict:
+    env = dict(os.environ)
+    env.setdefault("BOT_TOKEN", "123456:SIMULATED")
+    env.setdefault("GROUP_ID", "0")
+    env.setdefault("MODERATOR_GROUP_ID", "0")
+    return env
+
+
+def bench_import(runs: int) -> None:
+    timings, loaded = [], set()
+    for _ in range(runs):
+        output = subprocess.run([sys.executable, "-c", IMPORT_PROBE], cwd=ROOT, env=bench_env(),
+                                capture_output=True, text=True, check=True).stdout
+        result = json.loads(output.strip().splitlines()[-1])
+        timings.append(result["seconds"] * 1000)
+        loaded.update(result["loaded"])
+    timings.sort()
+    print(f"import main_rout: min {timings[0]:.1f} мс, медиана {timings[len(timings) // 2]:.1f} мс, "
+          f"max {timings[-1]:.1f} мс ({runs} запусков)")
+    if loaded:
+        print(f"  ВНИМАНИЕ: при импорте загружены {sorted(loaded)}")
+    else:
+        print(f"  тяжёлые модули не загружены: {HEAVY_MODULES}")
+
+
+def bench_first_signal(args) -> None:
+    import psycopg2
+    from psycopg2.extras import RealDictCursor
+
+    from benchmarks.bench_fanout import SIGNAL, http, seed_users, wait_until_up
+    from database import DB_HOST, DB_NAME, DB_PASSWORD, DB_PORT, DB_USER
+    from migrations import run_migrations
+
+    schema = "bench_startup"
+    sim_url = f"http://127.0.0.1:{args.sim_port}"
+    app_url = f"http://127.0.0.1:{args.app_port}"
+
+    conn = psycopg2.connect(host=DB_HOST, port=DB_PORT, database=DB_NAME, user=DB_USER,
+                            password=DB_PASSWORD, cursor_factory=RealDictCursor)
+    cursor = conn.cursor()
+    cursor.execute(f"CREATE SCHEMA IF NOT EXISTS {schema}")
+    cursor.execute(f"SET search_path TO {schema}")
+    conn.commit()
+    run_migrations(conn)
+    seed_users(conn, args.users)
+
+    env = bench_env()
+    env.update({
+        "EXCHANGE_SIMULATOR_URL": sim_url,
+        "PGOPTIONS": f"-c search_path={schema}",
+        "TRADE_OUTBOX_PATH": os.path.join(ROOT, "bench_trade_outbox.ndjson"),
+    })
+    simulator = subprocess.Popen(
+        [sys.executable, os.path.join(ROOT, "benchmarks", "exchange_simulator.py"), "--port", str(args.sim_port),
+         "--latency-ms", "0", "--jitter-ms", "0"],
+        cwd=ROOT, env=env,
+    )
+    app = None
+    try:
+        wait_until_up(f"{sim_url}/__sim/stats")
+        started = time.perf_counter()
+        app = subprocess.Popen(
+            [sys.executable, "-m", "uvicorn", "main_rout:app", "--port", str(args.app_port), "--log-level", "warning"],
+            cwd=ROOT, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+        )
+        wait_until_up(f"{app_url}/health")
+        print(f"Старт процесса до ответа /health: {(time.perf_counter() - started) * 1000:.0f} мс")
+
+        for label in ("первый сигнал", "второй сигнал"):
+            started = time.perf_counter()
+            response = http("POST", f"{app_url}/webhook", SIGNAL)
+            print(f"{label}: {(time.perf_counter() - started) * 1000:.0f} мс, статус {response.get('status')}")
+    finally:
+        if app:
+            app.terminate()
+            app.wait(timeout=30)
+        simulator.terminate()
+        simulator.wait(timeout=30)
+        cursor.execute(f"DROP SCHEMA IF EXISTS {schema} CASCADE")
+        conn.commit()
+        conn.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Холодный старт процесса вебхука")
+    parser.add_argument("--runs", type=int, default=10)
+    parser.add_argument("--first-signal", action="store_true", help="замерить первый сигнал после старта")
+    parser.add_argument("--users", type=int, default=100)
+    parser.add_argument("--sim-port", type=int, default=9000)
+    parser.add_argument("--app-port", type=int, default=5055)
+    args = parser.parse_args()
+
+    bench_import(args.runs)
+    if args.first_signal:
+        bench_first_signal(args)
+
+
+if __name__ == "__main__":
+    main()
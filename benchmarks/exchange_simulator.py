@@ -0,0 +1,616 @@
+"""
+Локальный симулятор бирж BingX, OKX, Bybit и Bitget для нагрузочных прогонов.
+
+Реализует подмножество эндпоинтов, которые вызывают *_api.py и SDK, с проверкой
+подписей, настраиваемой задержкой, инъекцией ошибок и rate limit. Каждая биржа
+живёт под своим префиксом (/bingx, /okx, /bybit, /bitget); бот переключается на
+симулятор переменной окружения EXCHANGE_SIMULATOR_URL=http://127.0.0.1:9000: если она
+задана, bingx_api.py, okx_api.py, bybit_api.py и bitget_api.py шлют запросы на
+$EXCHANGE_SIMULATOR_URL/<биржа> вместо боевых хостов.
+
+Секрет синтетического пользователя выводится из его API-ключа (sim_secret_for),
+поэтому симулятору не нужна база: подпись с чужим секретом будет отклонена.
+
+    python benchmarks/exchange_simulator.py --port 9000 --latency-ms 40 --error-rate 0.01 --rate-limit 10
+"""
+import argparse
+import asyncio
+import base64
+import hashlib
+import hmac
+import itertools
+import json
+import logging
+import random
+import time
+from collections import defaultdict
+from typing import Dict, Optional, Tuple
+
+import uvicorn
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse
+
+logger = logging.getLogger(__name__)
+
+SIM_MASTER_KEY = b"tlc-bot-exchange-simulator"
+SIM_PASSPHRASE = "sim-passphrase"
+
+# Базовые цены по активу; символы каждой биржи строятся из них
+BASE_PRICES = {
+    "BTC": 60000.0, "ETH": 3000.0, "SOL": 150.0, "XRP": 0.6, "DOGE": 0.15, "TON": 5.5,
+}
+
+
+def sim_secret_for(api_key: str) -> str:
+    return hmac.new(SIM_MASTER_KEY, api_key.encode("utf-8"), hashlib.sha256).hexdigest()
+
+
+def exchange_symbol(exchange: str, base: str) -> str:
+    return {
+        "bingx": f"{base}-USDT",
+        "okx": f"{base}-USDT-SWAP",
+        "bybit": f"{base}USDT",
+        "bitget": f"{base}USDT_UMCBL",
+    }[exchange]
+
+
+def base_asset(symbol: str) -> str:
+    return symbol.replace("_UMCBL", "").replace("-SWAP", "").replace("-USDT", "").replace("USDT", "")
+
+
+class SimConfig:
+    def __init__(self, latency_ms: float = 0.0, jitter_ms: float = 0.0, error_rate: float = 0.0,
+                 rate_limit: float = 0.0, starting_balance: float = 10000.0):
+        self.latency_ms = latency_ms
+        self.jitter_ms = jitter_ms
+        self.error_rate = error_rate
+        self.rate_limit = rate_limit
+        self.starting_balance = starting_balance
+
+
+class TokenBucket:
+    def __init__(self, rate: float):
+        self.rate = rate
+        self.tokens = rate
+        self.updated = time.monotonic()
+
+    def take(self) -> bool:
+        now = time.monotonic()
+        self.tokens = min(self.rate, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return True
+        return False
+
+
+class Account:
+    def __init__(self, balance: float):
+        self.balance = balance
+        self.leverage: Dict[str, int] = {}
+        # (symbol, "long"/"short") -> {"qty": float, "avg": float}
+        self.positions: Dict[Tuple[str, str], Dict] = {}
+        self.orders: Dict[str, Dict] = {}
+
+
+class SimState:
+    def __init__(self, config: SimConfig):
+        self.config = config
+        self.accounts: Dict[Tuple[str, str], Account] = {}
+        self.buckets: Dict[Tuple[str, str], TokenBucket] = {}
+        self.fills = []
+        self.requests = defaultdict(int)
+        self.rejections = defaultdict(int)
+        self._ids = itertools.count(1_000_000)
+
+    def reset(self):
+        self.accounts.clear()
+        self.buckets.clear()
+        self.fills.clear()
+        self.requests.clear()
+        self.rejections.clear()
+
+    def account(self, exchange: str, api_key: str) -> Account:
+        key = (exchange, api_key)
+        if key not in self.accounts:
+            self.accounts[key] = Account(self.config.starting_balance)
+        return self.accounts[key]
+
+    def allow(self, exchange: str, api_key: str) -> bool:
+        if self.config.rate_limit <= 0:
+            return True
+        key = (exchange, api_key)
+        if key not in self.buckets:
+            self.buckets[key] = TokenBucket(self.config.rate_limit)
+        return self.buckets[key].take()
+
+    def next_id(self) -> str:
+        return str(next(self._ids))
+
+    @staticmethod
+    def price(symbol: str) -> float:
+        return BASE_PRICES.get(base_asset(symbol), 100.0)
+
+    def place(self, exchange: str, api_key: str, symbol: str, side: str, qty: float, order_type: str,
+              pos_side: Optional[str] = None, trigger: Optional[float] = None, client_id: Optional[str] = None) -> Dict:
+        """Размещает ордер; рыночные исполняются сразу, условные остаются активными"""
+        account = self.account(exchange, api_key)
+        if client_id:
+            for order in account.orders.values():
+                if order.get("client_id") == client_id:
+                    return order
+        side = side.lower()
+        pos_side = (pos_side or "net").lower()
+        if pos_side == "net":
+            opposite = "short" if side == "buy" else "long"
+            pos_side = opposite if (symbol, opposite) in account.positions else ("long" if side == "buy" else "short")
+
+        order = {
+            "order_id": self.next_id(), "client_id": client_id, "symbol": symbol, "side": side,
+            "pos_side": pos_side, "qty": float(qty), "type": order_type, "trigger": trigger,
+            "status": "live", "avg_price": 0.0, "created": time.time(),
+        }
+        account.orders[order["order_id"]] = order
+        if order_type == "market":
+            self._fill(exchange, api_key, account, order)
+        return order
+
+    def _fill(self, exchange: str, api_key: str, account: Account, order: Dict):
+        price = self.price(order["symbol"])
+        key = (order["symbol"], order["pos_side"])
+        opening = (order["side"] == "buy") == (order["pos_side"] == "long")
+        position = account.positions.get(key)
+        if opening:
+            if position:
+                total = position["qty"] + order["qty"]
+                position["avg"] = (position["avg"] * position["qty"] + price * order["qty"]) / total
+                position["qty"] = total
+            else:
+                account.positions[key] = {"qty": order["qty"], "avg": price}
+        elif position:
+            position["qty"] = max(0.0, position["qty"] - order["qty"])
+            if position["qty"] <= 1e-12:
+                del account.positions[key]
+        order["status"] = "filled"
+        order["avg_price"] = price
+        self.fills.append({
+            "exchange": exchange, "api_key": api_key, "order_id": order["order_id"], "symbol": order["symbol"],
+            "side": order["side"], "pos_side": order["pos_side"], "qty": order["qty"], "price": price,
+            "opening": opening, "ts": time.time(),
+        })
+
+    def cancel(self, exchange: str, api_key: str, order_id: str) -> bool:
+        order = self.account(exchange, api_key).orders.get(str(order_id))
+        if not order or order["status"] != "live":
+            return False
+        order["status"] = "canceled"
+        return True
+
+    def close(self, exchange: str, api_key: str, symbol: str, pos_side: str):
+        account = self.account(exchange, api_key)
+        position = account.positions.get((symbol, pos_side.lower()))
+        if position:
+            side = "sell" if pos_side.lower() == "long" else "buy"
+            self.place(exchange, api_key, symbol, side, position["qty"], "market", pos_side)
+
+    def find(self, exchange: str, api_key: str, order_id: Optional[str], client_id: Optional[str]) -> Optional[Dict]:
+        """Ордер по id биржи или по клиентскому id — так бот ищет вход после потерянного ответа"""
+        account = self.account(exchange, api_key)
+        if order_id:
+            return account.orders.get(str(order_id))
+        return next((o for o in account.orders.values() if client_id and o.get("client_id") == client_id), None)
+
+    def live_orders(self, exchange: str, api_key: str, symbol: Optional[str] = None) -> list:
+        return [o for o in self.account(exchange, api_key).orders.values()
+                if o["status"] == "live" and (symbol is None or o["symbol"] == symbol)]
+
+
+def create_app(config: SimConfig) -> FastAPI:
+    state = SimState(config)
+    app = FastAPI(title="TLC exchange simulator")
+    app.state.sim = state
+
+    error_bodies = {
+        "bingx": lambda code, msg: {"code": code, "msg": msg},
+        "okx": lambda code, msg: {"code": str(code), "msg": msg, "data": []},
+        "bybit": lambda code, msg: {"retCode": code, "retMsg": msg, "result": {}, "time": int(time.time() * 1000)},
+        "bitget": lambda code, msg: {"code": str(code), "msg": msg, "data": None},
+    }
+    rate_limit_codes = {"bingx": 100410, "okx": 50011, "bybit": 10006, "bitget": 429}
+    auth_codes = {"bingx": 100001, "okx": 50113, "bybit": 10004, "bitget": 40009}
+    server_error_codes = {"bingx": 100500, "okx": 50001, "bybit": 10016, "bitget": 40010}
+
+    def error(exchange: str, kind: str, status: int = 200) -> JSONResponse:
+        code = {"rate_limit": rate_limit_codes, "auth": auth_codes, "server": server_error_codes}[kind][exchange]
+        state.rejections[(exchange, kind)] += 1
+        return JSONResponse(status_code=status, content=error_bodies[exchange](code, f"simulated {kind} error"))
+
+    # ------------------- Подписи -------------------
+    def verify_bingx(request: Request) -> Tuple[Optional[str], Optional[Dict]]:
+        api_key = request.headers.get("X-BX-APIKEY")
+        raw_query = request.url.query
+        if not api_key or "signature=" not in raw_query:
+            return None, None
+        # bingx_api подписывает строку параметров и дописывает &signature= в конец
+        payload, _, signature = raw_query.rpartition("signature=")
+        payload = payload[:-1] if payload.endswith("&") else payload
+        expected = hmac.new(sim_secret_for(api_key).encode(), payload.encode(), hashlib.sha256).hexdigest()
+        if not hmac.compare_digest(expected, signature):
+            return None, None
+        return api_key, dict(request.query_params)
+
+    async def verify_okx(request: Request, path: str) -> Tuple[Optional[str], Dict]:
+        api_key = request.headers.get("OK-ACCESS-KEY")
+        body = (await request.body()).decode()
+        request_path = path + (f"?{request.url.query}" if request.url.query else "")
+        if not api_key:
+            return None, {}
+        message = request.headers.get("OK-ACCESS-TIMESTAMP", "") + request.method + request_path + body
+        expected = base64.b64encode(
+            hmac.new(sim_secret_for(api_key).encode(), message.encode(), hashlib.sha256).digest()).decode()
+        if not hmac.compare_digest(expected, request.headers.get("OK-ACCESS-SIGN", "")) \
+                or request.headers.get("OK-ACCESS-PASSPHRASE") != SIM_PASSPHRASE:
+            return None, {}
+        params = dict(request.query_params)
+        params.update(json.loads(body) if body else {})
+        return api_key, params
+
+    async def verify_bybit(request: Request) -> Tuple[Optional[str], Dict]:
+        api_key = request.headers.get("X-BAPI-API-KEY")
+        body = (await request.body()).decode()
+        if not api_key:
+            return None, {}
+        payload = body if request.method == "POST" else request.url.query
+        message = (request.headers.get("X-BAPI-TIMESTAMP", "") + api_key
+                   + request.headers.get("X-BAPI-RECV-WINDOW", "") + payload)
+        expected = hmac.new(sim_secret_for(api_key).encode(), message.encode(), hashlib.sha256).hexdigest()
+        if not hmac.compare_digest(expected, request.headers.get("X-BAPI-SIGN", "")):
+            return None, {}
+        params = dict(request.query_params)
+        params.update(json.loads(body) if body else {})
+        return api_key, params
+
+    async def verify_bitget(request: Request, path: str) -> Tuple[Optional[str], Dict]:
+        api_key = request.headers.get("ACCESS-KEY")
+        body = (await request.body()).decode()
+        if not api_key:
+            return None, {}
+        request_path = path + (f"?{request.url.query}" if request.url.query else "")
+        message = request.headers.get("ACCESS-TIMESTAMP", "") + request.method.upper() + request_path + body
+        expected = base64.b64encode(
+            hmac.new(sim_secret_for(api_key).encode(), message.encode(), hashlib.sha256).digest()).decode()
+        if not hmac.compare_digest(expected, request.headers.get("ACCESS-SIGN", "")) \
+                or request.headers.get("ACCESS-PASSPHRASE") != SIM_PASSPHRASE:
+            return None, {}
+        params = dict(request.query_params)
+        params.update(json.loads(body) if body else {})
+        return api_key, params
+
+    async def pre_request(exchange: str, api_key: str) -> Optional[JSONResponse]:
+        state.requests[exchange] += 1
+        delay = config.latency_ms + random.uniform(0, config.jitter_ms)
+        if delay > 0:
+            await asyncio.sleep(delay / 1000)
+        if not state.allow(exchange, api_key):
+            return error(exchange, "rate_limit", status=429 if exchange != "bingx" else 200)
+        if config.error_rate and random.random() < config.error_rate:
+            return error(exchange, "server")
+        return None
+
+    # ------------------- BingX -------------------
+    def bingx_ok(data) -> Dict:
+        return {"code": 0, "msg": "", "data": data}
+
+    def bingx_order(order: Dict) -> Dict:
+        return {
+            "orderId": int(order["order_id"]), "symbol": order["symbol"], "side": order["side"].upper(),
+            "positionSide": order["pos_side"].upper(), "type": order["type"], "origQty": str(order["qty"]),
+            "stopPrice": str(order["trigger"] or ""), "status": order["status"].upper(),
+            "avgPrice": str(order["avg_price"]), "clientOrderID": order["client_id"] or "",
+        }
+
+    @app.api_route("/bingx/{path:path}", methods=["GET", "POST", "DELETE"])
+    async def bingx(path: str, request: Request):
+        path = "/" + path
+        if path == "/openApi/swap/v2/server/time":
+            return bingx_ok({"serverTime": int(time.time() * 1000)})
+        if path == "/openApi/swap/v2/quote/price":
+            return bingx_ok({"symbol": request.query_params.get("symbol"),
+                             "price": str(state.price(request.query_params.get("symbol", "")))})
+        if path == "/openApi/swap/v2/quote/contracts":
+            return bingx_ok([{"symbol": exchange_symbol("bingx", base), "minTradeVolume": 0.001,
+                              "volumePrecision": 3} for base in BASE_PRICES])
+
+        api_key, params = verify_bingx(request)
+        if not api_key:
+            return error("bingx", "auth")
+        rejected = await pre_request("bingx", api_key)
+        if rejected:
+            return rejected
+        account = state.account("bingx", api_key)
+        symbol = params.get("symbol")
+
+        if path == "/openApi/swap/v2/user/balance":
+            return bingx_ok({"balance": {"asset": "USDT", "balance": str(account.balance),
+                                         "availableMargin": str(account.balance)}})
+        if path == "/openApi/swap/v2/trade/leverage":
+            account.leverage[symbol] = int(params.get("leverage", 1))
+            return bingx_ok({"leverage": account.leverage[symbol], "symbol": symbol})
+        if path == "/openApi/swap/v2/trade/order" and request.method == "POST":
+            order_type = "market" if params.get("type") == "MARKET" else "conditional"
+            order = state.place("bingx", api_key, symbol, params["side"], float(params["quantity"]), order_type,
+                                params.get("positionSide"), float(params.get("stopPrice") or 0) or None,
+                                params.get("clientOrderID"))
+            return bingx_ok({"order": bingx_order(order)})
+        if path == "/openApi/swap/v2/trade/order" and request.method == "DELETE":
+            if not state.cancel("bingx", api_key, params.get("orderId")):
+                return {"code": 109414, "msg": "order not exist"}
+            return bingx_ok({"order": {"orderId": params.get("orderId")}})
+        if path == "/openApi/swap/v2/trade/order" and request.method == "GET":
+            order = state.find("bingx", api_key, params.get("orderId"), params.get("clientOrderID"))
+            if not order:
+                return {"code": 109414, "msg": "order not exist"}
+            return bingx_ok({"order": bingx_order(order)})
+        if path == "/openApi/swap/v2/trade/openOrders":
+            return bingx_ok({"orders": [bingx_order(o) for o in state.live_orders("bingx", api_key, symbol)]})
+        if path == "/openApi/swap/v2/user/positions":
+            return bingx_ok([
+                {"symbol": sym, "positionSide": side.upper(), "positionAmt": str(p["qty"]), "avgPrice": str(p["avg"])}
+                for (sym, side), p in account.positions.items() if symbol in (None, sym)
+            ])
+        return JSONResponse(status_code=404, content={"code": 100404, "msg": f"unknown path {path}"})
+
+    # ------------------- OKX -------------------
+    def okx_ok(data: list) -> Dict:
+        return {"code": "0", "msg": "", "data": data}
+
+    @app.api_route("/okx/{path:path}", methods=["GET", "POST"])
+    async def okx(path: str, request: Request):
+        path = "/" + path
+        query = request.query_params
+        if path == "/api/v5/public/instruments":
+            inst_id = query.get("instId")
+            return okx_ok([{"instId": exchange_symbol("okx", base), "lotSz": "0.01", "minSz": "0.01",
+                            "ctVal": "0.01", "lever": "100"} for base in BASE_PRICES
+                           if inst_id in (None, exchange_symbol("okx", base))])
+        if path == "/api/v5/market/ticker":
+            return okx_ok([{"instId": query.get("instId"), "last": str(state.price(query.get("instId", "")))}])
+        if path == "/api/v5/public/time":
+            return okx_ok([{"ts": str(int(time.time() * 1000))}])
+
+        api_key, params = await verify_okx(request, path)
+        if not api_key:
+            return error("okx", "auth", status=401)
+        rejected = await pre_request("okx", api_key)
+        if rejected:
+            return rejected
+        account = state.account("okx", api_key)
+        inst_id = params.get("instId")
+
+        if path == "/api/v5/account/balance":
+            return okx_ok([{"details": [{"ccy": "USDT", "availBal": str(account.balance),
+                                         "availEq": str(account.balance)}]}])
+        if path == "/api/v5/account/set-leverage":
+            account.leverage[inst_id or "*"] = int(params.get("lever", 1))
+            return okx_ok([{"lever": params.get("lever"), "mgnMode": params.get("mgnMode"), "instId": inst_id}])
+        if path == "/api/v5/trade/order" and request.method == "POST":
+            order = state.place("okx", api_key, inst_id, params["side"], float(params["sz"]), "market",
+                                params.get("posSide"), client_id=params.get("clOrdId"))
+            for algo in params.get("attachAlgoOrds") or []:
+                trigger = algo.get("slTriggerPx") or algo.get("tpTriggerPx")
+                state.place("okx", api_key, inst_id, algo["side"], float(algo["sz"]), "conditional",
+                            order["pos_side"], float(trigger) if trigger else None)
+            return okx_ok([{"ordId": order["order_id"], "clOrdId": params.get("clOrdId", ""), "sCode": "0",
+                            "sMsg": ""}])
+        if path == "/api/v5/trade/order-algo":
+            trigger = params.get("slTriggerPx") or params.get("tpTriggerPx")
+            order = state.place("okx", api_key, inst_id, params["side"], float(params["sz"]), "conditional",
+                                params.get("posSide"), float(trigger) if trigger else None)
+            return okx_ok([{"algoId": order["order_id"], "sCode": "0", "sMsg": ""}])
+        if path == "/api/v5/trade/cancel-order":
+            if not state.cancel("okx", api_key, params.get("ordId")):
+                return {"code": "51400", "msg": "Order does not exist", "data": []}
+            return okx_ok([{"ordId": params.get("ordId"), "sCode": "0"}])
+        if path == "/api/v5/trade/order" and request.method == "GET":
+            order = state.find("okx", api_key, params.get("ordId"), params.get("clOrdId"))
+            if not order:
+                return {"code": "51603", "msg": "Order does not exist", "data": []}
+            return okx_ok([{"ordId": order["order_id"], "clOrdId": order["client_id"] or "", "instId": order["symbol"],
+                            "state": order["status"], "posSide": order["pos_side"], "sz": str(order["qty"]),
+                            "avgPx": str(order["avg_price"]), "accFillSz": str(order["qty"])}])
+        if path == "/api/v5/trade/close-position":
+            state.close("okx", api_key, inst_id, params.get("posSide", "net"))
+            return okx_ok([{"instId": inst_id, "posSide": params.get("posSide")}])
+        if path == "/api/v5/account/positions":
+            return okx_ok([
+                {"instId": sym, "posSide": side, "pos": str(p["qty"]), "avgPx": str(p["avg"])}
+                for (sym, side), p in account.positions.items() if inst_id in (None, sym)
+            ])
+        if path in ("/api/v5/trade/orders-pending", "/api/v5/trade/orders-algo-pending"):
+            return okx_ok([{"ordId": o["order_id"], "algoId": o["order_id"], "instId": o["symbol"],
+                            "posSide": o["pos_side"], "slTriggerPx": str(o["trigger"] or "")}
+                           for o in state.live_orders("okx", api_key, inst_id)])
+        return JSONResponse(status_code=404, content={"code": "404", "msg": f"unknown path {path}", "data": []})
+
+    # ------------------- Bybit -------------------
+    def bybit_ok(result: Dict) -> Dict:
+        return {"retCode": 0, "retMsg": "OK", "result": result, "time": int(time.time() * 1000)}
+
+    @app.api_route("/bybit/{path:path}", methods=["GET", "POST"])
+    async def bybit(path: str, request: Request):
+        path = "/" + path
+        query = request.query_params
+        if path == "/v5/market/instruments-info":
+            symbol = query.get("symbol")
+            return bybit_ok({"category": "linear", "list": [
+                {"symbol": exchange_symbol("bybit", base),
+                 "lotSizeFilter": {"qtyStep": "0.001", "minOrderQty": "0.001"},
+                 "leverageFilter": {"maxLeverage": "100"}}
+                for base in BASE_PRICES if symbol in (None, exchange_symbol("bybit", base))
+            ]})
+        if path == "/v5/market/tickers":
+            return bybit_ok({"category": "linear", "list": [
+                {"symbol": query.get("symbol"), "lastPrice": str(state.price(query.get("symbol", "")))}]})
+        if path == "/v5/market/time":
+            return bybit_ok({"timeSecond": str(int(time.time())), "timeNano": str(time.time_ns())})
+
+        api_key, params = await verify_bybit(request)
+        if not api_key:
+            return error("bybit", "auth", status=401)
+        rejected = await pre_request("bybit", api_key)
+        if rejected:
+            return rejected
+        account = state.account("bybit", api_key)
+        symbol = params.get("symbol")
+
+        if path == "/v5/account/wallet-balance":
+            return bybit_ok({"list": [{"coin": [{"coin": "USDT", "availableToWithdraw": str(account.balance),
+                                                 "walletBalance": str(account.balance)}]}]})
+        if path == "/v5/position/set-leverage":
+            account.leverage[symbol] = int(float(params.get("buyLeverage", 1)))
+            return bybit_ok({})
+        if path == "/v5/order/create":
+            order_type = "conditional" if params.get("stopLoss") or params.get("orderType") == "Limit" else "market"
+            trigger = params.get("stopLoss") or params.get("price")
+            order = state.place("bybit", api_key, symbol, params["side"], float(params["qty"]), order_type,
+                                None, float(trigger) if trigger else None, params.get("orderLinkId"))
+            return bybit_ok({"orderId": order["order_id"], "orderLinkId": params.get("orderLinkId", "")})
+        if path == "/v5/order/cancel":
+            if not state.cancel("bybit", api_key, params.get("orderId")):
+                return {"retCode": 110001, "retMsg": "order not exists or too late to cancel", "result": {}}
+            return bybit_ok({"orderId": params.get("orderId")})
+        if path in ("/v5/order/history", "/v5/order/realtime"):
+            order_id, link_id = params.get("orderId"), params.get("orderLinkId")
+            orders = [o for o in account.orders.values()
+                      if (order_id is None or o["order_id"] == order_id) and symbol in (None, o["symbol"])
+                      and (link_id is None or o["client_id"] == link_id)
+                      and (path == "/v5/order/history" or o["status"] == "live")]
+            return bybit_ok({"list": [
+                {"orderId": o["order_id"], "symbol": o["symbol"], "side": o["side"].capitalize(),
+                 "orderStatus": {"live": "New", "filled": "Filled", "canceled": "Cancelled"}[o["status"]],
+                 "avgPrice": str(o["avg_price"]), "qty": str(o["qty"]),
+                 "stopLoss": str(o["trigger"] or "") if o["type"] == "conditional" else ""}
+                for o in orders]})
+        if path == "/v5/position/list":
+            return bybit_ok({"list": [
+                {"symbol": sym, "side": "Buy" if side == "long" else "Sell", "size": str(p["qty"]),
+                 "avgPrice": str(p["avg"])}
+                for (sym, side), p in account.positions.items() if symbol in (None, sym)
+            ]})
+        return JSONResponse(status_code=404, content={"retCode": 404, "retMsg": f"unknown path {path}"})
+
+    # ------------------- Bitget -------------------
+    def bitget_ok(data) -> Dict:
+        return {"code": "00000", "msg": "success", "data": data}
+
+    @app.api_route("/bitget/{path:path}", methods=["GET", "POST"])
+    async def bitget(path: str, request: Request):
+        path = "/" + path
+        query = request.query_params
+        if path == "/api/mix/v1/market/contracts":
+            return bitget_ok([{"symbol": exchange_symbol("bitget", base), "minTradeAmount": "0.001",
+                               "volumePlace": "3", "maxLeverage": "125"} for base in BASE_PRICES])
+        if path == "/api/mix/v1/market/ticker":
+            return bitget_ok([{"symbol": query.get("symbol"), "last": str(state.price(query.get("symbol", "")))}])
+
+        api_key, params = await verify_bitget(request, path)
+        if not api_key:
+            return error("bitget", "auth", status=401)
+        rejected = await pre_request("bitget", api_key)
+        if rejected:
+            return rejected
+        account = state.account("bitget", api_key)
+        symbol = params.get("symbol")
+
+        if path == "/api/mix/v1/account/account":
+            return bitget_ok({"marginCoin": "USDT", "available": str(account.balance)})
+        if path == "/api/mix/v1/account/setLeverage":
+            account.leverage[symbol] = int(params.get("leverage", 1))
+            return bitget_ok({"symbol": symbol})
+        if path == "/api/mix/v1/order/placeOrder":
+            side = params["side"].lower()
+            pos_side = params.get("posSide") or ("long" if "long" in side else "short")
+            order = state.place("bitget", api_key, symbol, "buy" if side.startswith(("buy", "open_long")) else "sell",
+                                float(params["size"]), "market", pos_side, client_id=params.get("clientOid"))
+            return bitget_ok({"orderId": order["order_id"], "clientOid": params.get("clientOid", "")})
+        if path == "/api/mix/v1/plan/placePlan":
+            order = state.place("bitget", api_key, symbol, params["side"], float(params["size"]), "conditional",
+                                params.get("posSide"), float(params.get("triggerPrice") or 0) or None)
+            return bitget_ok({"orderId": order["order_id"]})
+        if path in ("/api/mix/v1/order/cancel-order", "/api/mix/v1/plan/cancelPlan"):
+            if not state.cancel("bitget", api_key, params.get("orderId")):
+                return {"code": "40768", "msg": "Order does not exist", "data": None}
+            return bitget_ok({"orderId": params.get("orderId")})
+        if path == "/api/mix/v1/order/detail":
+            order = state.find("bitget", api_key, params.get("orderId"), params.get("clientOid"))
+            if not order:
+                return {"code": "40768", "msg": "Order does not exist", "data": None}
+            return bitget_ok({"orderId": order["order_id"], "clientOid": order["client_id"] or "",
+                              "state": order["status"], "posSide": order["pos_side"],
+                              "priceAvg": str(order["avg_price"]), "size": str(order["qty"])})
+        if path in ("/api/mix/v1/position/singlePosition-v2", "/api/mix/v1/position/allPosition-v2"):
+            return bitget_ok([
+                {"symbol": sym, "holdSide": side, "total": str(p["qty"]), "avgPrice": str(p["avg"])}
+                for (sym, side), p in account.positions.items() if symbol in (None, sym)
+            ])
+        if path == "/api/mix/v1/plan/currentPlan":
+            return bitget_ok([{"orderId": o["order_id"], "symbol": o["symbol"], "posSide": o["pos_side"],
+                               "triggerType": "fill_price", "triggerPrice": str(o["trigger"] or "")}
+                              for o in state.live_orders("bitget", api_key, symbol)])
+        return JSONResponse(status_code=404, content={"code": "40404", "msg": f"unknown path {path}"})
+
+    # ------------------- Telegram -------------------
+    @app.post("/telegram/bot{token}/{method}")
+    async def telegram(token: str, method: str, request: Request):
+        form = dict(await request.form()) if request.headers.get("content-type", "").startswith(
+            ("multipart/", "application/x-www-form-urlencoded")) else {}
+        chat_id = int(form.get("chat_id", 0) or 0)
+        return {"ok": True, "result": {"message_id": state.next_id(), "date": int(time.time()),
+                                       "chat": {"id": chat_id, "type": "private"}, "text": form.get("text", "")}}
+
+    # ------------------- Служебные -------------------
+    @app.get("/__sim/fills")
+    async def fills(since: float = 0.0):
+        return {"fills": [f for f in state.fills if f["ts"] >= since]}
+
+    @app.get("/__sim/stats")
+    async def stats():
+        return {
+            "requests": dict(state.requests),
+            "rejections": {f"{exchange}:{kind}": count for (exchange, kind), count in state.rejections.items()},
+            "fills": len(state.fills),
+            "accounts": len(state.accounts),
+        }
+
+    @app.post("/__sim/reset")
+    async def reset():
+        state.reset()
+        return {"status": "ok"}
+
+    @app.post("/__sim/config")
+    async def update_config(request: Request):
+        for key, value in (await request.json()).items():
+            if hasattr(config, key):
+                setattr(config, key, float(value))
+        return vars(config)
+
+    return app
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Симулятор бирж для нагрузочных прогонов")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=9000)
+    parser.add_argument("--latency-ms", type=float, default=30.0, help="базовая задержка ответа")
+    parser.add_argument("--jitter-ms", type=float, default=20.0, help="случайная добавка к задержке")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="доля запросов с ошибкой сервера")
+    parser.add_argument("--rate-limit", type=float, default=0.0, help="запросов в секунду на ключ (0 — без лимита)")
+    parser.add_argument("--balance", type=float, default=10000.0, help="стартовый баланс USDT")
+    args = parser.parse_args()
+
+    config = SimConfig(args.latency_ms, args.jitter_ms, args.error_rate, args.rate_limit, args.balance)
+    uvicorn.run(create_app(config), host=args.host, port=args.port, log_level="warning")
+
+
+if __name__ == "__main__":
+    main()
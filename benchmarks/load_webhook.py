@@ -0,0 +1,173 @@
+"""
+Нагрузочный прогон /webhook записанными payload'ами TradingView.
+
+Читает NDJSON (по одному payload на строку: name, content_type и body либо raw)
+и отправляет их в запущенный main_rout.app с заданной частотой и профилем
+всплесков. Считает задержку и долю ошибок на стороне клиента, а до и после
+прогона снимает из /control/metrics серверные метрики: время webhook(), путь
+security_middleware и задержку event loop. Маршрут требует токен FLATTEN_TOKEN
+(--token или переменная окружения).
+
+    python benchmarks/load_webhook.py --url http://127.0.0.1:5000 --rate 20 --duration 30
+    python benchmarks/load_webhook.py --pattern burst --burst-size 50 --burst-interval 5
+    python benchmarks/load_webhook.py --only buy sell move_sl --pattern poisson --rate 5
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import sys
+import time
+from collections import defaultdict
+
+import aiohttp
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+DEFAULT_PAYLOADS = os.path.join(ROOT, "benchmarks", "payloads", "tradingview.ndjson")
+
+
+def percentile(values: list, q: float) -> float:
+    if not values:
+        return float("nan")
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, max(0, int(round(q * (len(ordered) - 1)))))]
+
+
+def load_payloads(path: str, only: list = None) -> list:
+    payloads = []
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            item = json.loads(line)
+            if only and item["name"] not in only:
+                continue
+            # raw нужен для тел, которые не выразить валидным JSON (NaN, обрезанные, form-data)
+            data = item["raw"] if "raw" in item else json.dumps(item["body"])
+            payloads.append((item["name"], item.get("content_type", "application/json"), data.encode()))
+    if not payloads:
+        raise SystemExit(f"В {path} нет подходящих payload'ов")
+    return payloads
+
+
+def schedule(pattern: str, rate: float, duration: float, burst_size: int, burst_interval: float) -> list:
+    """Смещения отправки запросов от начала прогона, с"""
+    if pattern == "constant":
+        return [i / rate for i in range(int(rate * duration))]
+    if pattern == "poisson":
+        offsets, t = [], random.expovariate(rate)
+        while t < duration:
+            offsets.append(t)
+            t += random.expovariate(rate)
+        return offsets
+    # burst: пачка запросов одновременно раз в burst_interval — как кластер алертов на открытии сессии
+    offsets, t = [], 0.0
+    while t < duration:
+        offsets.extend([t] * burst_size)
+        t += burst_interval
+    return offsets
+
+
+async def fetch_metrics(session: aiohttp.ClientSession, url: str, token: str) -> dict:
+    try:
+        async with session.post(f"{url}/control/metrics", headers={"X-Flatten-Token": token or ""}) as response:
+            response.raise_for_status()
+            return (await response.json()).get("metrics", {})
+    except Exception as e:
+        print(f"Не удалось получить /control/metrics: {e}")
+        return {}
+
+
+async def send(session, url, payload, stats, semaphore):
+    name, content_type, data = payload
+    async with semaphore:
+        started = time.perf_counter()
+        try:
+            async with session.post(f"{url}/webhook", data=data, headers={"Content-Type": content_type}) as response:
+                await response.read()
+                status = response.status
+        except asyncio.TimeoutError:
+            status = "timeout"
+        except aiohttp.ClientError as e:
+            status = type(e).__name__
+        stats[name].append(((time.perf_counter() - started) * 1000, status))
+
+
+async def run(args) -> None:
+    payloads = load_payloads(args.payloads, args.only)
+    offsets = schedule(args.pattern, args.rate, args.duration, args.burst_size, args.burst_interval)
+    stats = defaultdict(list)
+    semaphore = asyncio.Semaphore(args.concurrency)
+    timeout = aiohttp.ClientTimeout(total=args.timeout)
+
+    async with aiohttp.ClientSession(timeout=timeout) as session:
+        before = await fetch_metrics(session, args.url, args.token)
+        print(f"{len(offsets)} запросов, профиль {args.pattern}, {len(payloads)} видов payload")
+
+        loop = asyncio.get_running_loop()
+        started = loop.time()
+        tasks = []
+        for i, offset in enumerate(offsets):
+            delay = started + offset - loop.time()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            payload = random.choice(payloads) if args.shuffle else payloads[i % len(payloads)]
+            tasks.append(asyncio.create_task(send(session, args.url, payload, stats, semaphore)))
+        await asyncio.gather(*tasks)
+        wall = loop.time() - started
+
+        after = await fetch_metrics(session, args.url, args.token)
+
+    print(f"\n{'payload':<18} {'sent':>6} {'2xx':>6} {'4xx':>6} {'5xx':>6} {'other':>6} {'p50 ms':>9} {'p99 ms':>9} {'max ms':>9}")
+    total = []
+    for name in sorted(stats):
+        rows = stats[name]
+        latencies = [latency for latency, _ in rows]
+        total.extend(latencies)
+        codes = [status for _, status in rows]
+        ok = sum(1 for c in codes if isinstance(c, int) and c < 300)
+        client = sum(1 for c in codes if isinstance(c, int) and 400 <= c < 500)
+        server = sum(1 for c in codes if isinstance(c, int) and c >= 500)
+        other = len(codes) - ok - client - server
+        print(f"{name:<18} {len(rows):>6} {ok:>6} {client:>6} {server:>6} {other:>6} "
+              f"{percentile(latencies, 0.5):>9.1f} {percentile(latencies, 0.99):>9.1f} {max(latencies):>9.1f}")
+    print(f"\nИтого {len(total)} запросов за {wall:.1f} с ({len(total) / wall:.1f} rps), "
+          f"p50 {percentile(total, 0.5):.1f} мс, p99 {percentile(total, 0.99):.1f} мс")
+
+    print("\nСерверные метрики (/control/metrics):")
+    for key in ("webhook", "security_middleware", "event_loop_lag"):
+        if key not in after:
+            print(f"  {key}: нет данных")
+            continue
+        delta = after[key]["count"] - before.get(key, {}).get("count", 0)
+        errors = after[key]["errors"] - before.get(key, {}).get("errors", 0)
+        # Перцентили считаются сервером по скользящему окну, поэтому относятся к последним замерам
+        print(f"  {key:<20} +{delta} замеров, +{errors} ошибок, p50 {after[key]['p50_ms']} мс, "
+              f"p99 {after[key]['p99_ms']} мс, max {after[key]['max_ms']} мс")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Нагрузочный прогон /webhook payload'ами TradingView")
+    parser.add_argument("--url", default="http://127.0.0.1:5000")
+    parser.add_argument("--token", default=os.getenv("FLATTEN_TOKEN"), help="токен /control/metrics")
+    parser.add_argument("--payloads", default=DEFAULT_PAYLOADS, help="NDJSON с payload'ами")
+    parser.add_argument("--only", nargs="+", help="отправлять только payload'ы с этими name")
+    parser.add_argument("--pattern", choices=["constant", "poisson", "burst"], default="constant")
+    parser.add_argument("--rate", type=float, default=10.0, help="запросов в секунду для constant/poisson")
+    parser.add_argument("--duration", type=float, default=30.0, help="длительность прогона, с")
+    parser.add_argument("--burst-size", type=int, default=20)
+    parser.add_argument("--burst-interval", type=float, default=5.0)
+    parser.add_argument("--concurrency", type=int, default=256, help="предел одновременных запросов")
+    parser.add_argument("--timeout", type=float, default=120.0)
+    parser.add_argument("--shuffle", action="store_true", help="брать payload случайно, а не по кругу")
+    parser.add_argument("--seed", type=int)
+    args = parser.parse_args()
+    if args.seed is not None:
+        random.seed(args.seed)
+    asyncio.run(run(args))
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,20 +1,33 @@
 import time
 import requests
+from requests.adapters import HTTPAdapter
 import hmac
 from hashlib import sha256
 import json
 import logging
+import os
+from cache import instrument_cache, leverage_cache, clock_offset_cache, account_key
+from deadline import request_timeout
+from exchange_errors import ExchangeError, NetworkError, NotFoundError, raise_for
+from retry import retry_blocking
+from bulkheads import workers
 
 logger = logging.getLogger(__name__)
 
-APIURL = "https://open-api.bingx.com"
+EXCHANGE_SIMULATOR_URL = os.getenv("EXCHANGE_SIMULATOR_URL")
+APIURL = f"{EXCHANGE_SIMULATOR_URL}/bingx" if EXCHANGE_SIMULATOR_URL else "https://open-api.bingx.com"
 TIME_OFFSET = 0
 
+# Свой пул соединений BingX размером с пул потоков её отсека (bulkheads.py)
+http_session = requests.Session()
+http_session.mount("https://", HTTPAdapter(pool_maxsize=workers("bingx")))
+http_session.mount("http://", HTTPAdapter(pool_maxsize=workers("bingx")))
+
 
 def get_server_time() -> int:
     try:
         url = f"{APIURL}/openApi/swap/v2/server/time"
-        response = requests.get(url)
+        response = http_session.get(url, timeout=request_timeout())
         data = response.json()
         if 'code' in data and data['code'] == 0:
             server_time = int(data['data']['serverTime'])
@@ -38,10 +51,31 @@ def get_balance(api_key: str, secret_key: str) -> str:
     return send_request(method, path, paramsStr, {}, api_key, secret_key)
 
 
+def get_position_mode(api_key: str, secret_key: str) -> str:
+    """hedge — раздельные LONG/SHORT (режим, под который написан бот), one_way — одна позиция на символ"""
+    path = '/openApi/swap/v1/positionSide/dual'
+    response_data = check_response(json.loads(send_request("GET", path, parseParam({}), {}, api_key, secret_key)),
+                                   "Ошибка получения режима позиции")
+    return "hedge" if str(response_data["data"]["dualSidePosition"]).lower() == "true" else "one_way"
+
+
+def get_account_profile(api_key: str, secret_key: str) -> dict:
+    """Возможности аккаунта для account_profile.probe_account"""
+    balance_data = check_response(json.loads(get_balance(api_key, secret_key)))
+    return {
+        "position_mode": get_position_mode(api_key, secret_key),
+        # Режим маржи BingX задаётся по символу, права ключа через swap API не отдаются
+        "margin_mode": None,
+        "can_trade": None,
+        "futures_enabled": True,
+        "balance": float(balance_data["data"]["balance"]["availableMargin"]),
+    }
+
+
 def get_current_price(symbol: str) -> float:
     try:
         url = f"{APIURL}/openApi/swap/v2/quote/price?symbol={symbol}"
-        response = requests.get(url)
+        response = http_session.get(url, timeout=request_timeout())
         data = response.json()
         if 'data' in data and 'price' in data['data']:
             return float(data['data']['price'])
@@ -54,18 +88,40 @@ def get_current_price(symbol: str) -> float:
         raise
 
 
+def list_symbols() -> list:
+    """Все USDT-контракты BingX; заодно кэширует их параметры для get_symbol_info"""
+    cached = instrument_cache.get(("symbols", "bingx"))
+    if cached is not None:
+        return cached
+    url = f"{APIURL}/openApi/swap/v2/quote/contracts"
+    response = http_session.get(url, timeout=request_timeout())
+    data = response.json()
+    if 'data' not in data:
+        raise ValueError(f"Не удалось получить список контрактов BingX: {data.get('msg')}")
+    symbols = []
+    for contract in data['data']:
+        instrument_cache.set(("bingx", contract['symbol']), {
+            "minQty": contract.get("minTradeVolume", 0.001),
+            # volumePrecision — число знаков после запятой, а не шаг
+            "stepSize": 10 ** -int(contract.get("volumePrecision", 3))
+        })
+        if contract['symbol'].endswith("-USDT"):
+            symbols.append(contract['symbol'])
+    instrument_cache.set(("symbols", "bingx"), symbols)
+    return symbols
+
+
 def get_symbol_info(symbol: str) -> dict:
+    cached = instrument_cache.get(("bingx", symbol))
+    if cached is not None:
+        return cached
     try:
-        url = f"{APIURL}/openApi/swap/v2/quote/contracts"
-        response = requests.get(url)
-        data = response.json()
-        if 'data' in data:
-            for contract in data['data']:
-                if contract['symbol'] == symbol:
-                    return {
-                        "minQty": contract.get("minTradeVolume", 0.001),
-                        "stepSize": contract.get("volumePrecision", 0.001)
-                    }
+        # Список контрактов приходит целиком — кэшируем все пары разом
+        instrument_cache.invalidate(("symbols", "bingx"))
+        list_symbols()
+        cached = instrument_cache.get(("bingx", symbol))
+        if cached is not None:
+            return cached
         raise ValueError(f"Пара {symbol} не найдена")
     except Exception as e:
         logger.error(f"Ошибка при получении информации о паре: {symbol}")
@@ -74,6 +130,10 @@ def get_symbol_info(symbol: str) -> dict:
 
 def set_leverage(symbol: str, leverage: int = 5, position_side: str = "LONG", api_key: str = None,
                  secret_key: str = None) -> bool:
+    cache_key = ("bingx", account_key(api_key), symbol, leverage, position_side)
+    if leverage_cache.get(cache_key):
+        logger.info(f"Плечо {leverage} для {symbol} side = {position_side} уже установлено")
+        return True
     try:
         path = '/openApi/swap/v2/trade/leverage'
         method = "POST"
@@ -84,10 +144,9 @@ def set_leverage(symbol: str, leverage: int = 5, position_side: str = "LONG", ap
         }
         paramsStr = parseParam(paramsMap)
         response = send_request(method, path, paramsStr, {}, api_key, secret_key)
-        response_data = json.loads(response)
-        if response_data.get("code") != 0:
-            raise ValueError(f"Ошибка установления плеча: {response_data.get('msg')}")
+        check_response(json.loads(response), "Ошибка установления плеча")
         logger.info(f"Плечо {leverage} установлено для {symbol} side = {position_side}")
+        leverage_cache.set(cache_key, True)
         return True
     except Exception as e:
         logger.error(f"Ошибка при установке плеча для {symbol} side={position_side}: {str(e)}")
@@ -128,9 +187,8 @@ def calculate_quantity(symbol: str, leverage: int = 5, risk_percent: float = 0.0
         raise
 
 
-def create_main_order(symbol: str, side: str, quantity: float, api_key: str, secret_key: str) -> str:
-    path = '/openApi/swap/v2/trade/order'
-    method = "POST"
+def create_main_order(symbol: str, side: str, quantity: float, api_key: str, secret_key: str,
+                      client_id: str = None) -> str:
     paramsMap = {
         "symbol": symbol,
         "side": side,
@@ -138,8 +196,25 @@ def create_main_order(symbol: str, side: str, quantity: float, api_key: str, sec
         "type": "MARKET",
         "quantity": quantity
     }
-    paramsStr = parseParam(paramsMap)
-    return send_request(method, path, paramsStr, {}, api_key, secret_key)
+    if client_id:
+        paramsMap["clientOrderID"] = client_id
+    return _post_order(paramsMap, api_key, secret_key, "Ошибка создания основного ордера")
+
+
+def _post_order(order: dict, api_key: str, secret_key: str, context: str = "Ошибка создания ордера") -> str:
+    response = send_request("POST", '/openApi/swap/v2/trade/order', parseParam(order), {}, api_key, secret_key)
+    check_response(json.loads(response), context)
+    return response
+
+
+def find_order(symbol: str, client_order_id: str, api_key: str, secret_key: str):
+    """Ордер по clientOrderID в формате ответа на его создание; None — биржа такого ордера не знает"""
+    paramsStr = parseParam({"symbol": symbol, "clientOrderID": client_order_id})
+    response_data = json.loads(send_request("GET", '/openApi/swap/v2/trade/order', paramsStr, {}, api_key, secret_key))
+    if response_data.get("code") != 0 or not (response_data.get("data") or {}).get("order"):
+        return None
+    logger.info(f"Ордер {client_order_id} для {symbol} уже на бирже: {response_data['data']['order'].get('orderId')}")
+    return json.dumps({"code": 0, "msg": "", "data": {"order": response_data["data"]["order"]}})
 
 
 def calculate_tp_quantities(total_quantity: float, symbol: str) -> list:
@@ -200,7 +275,10 @@ def calculate_tp_quantities(total_quantity: float, symbol: str) -> list:
 
 
 def create_tp_sl_orders(symbol: str, side: str, quantity: float, stop_loss: float, take_profits: list, api_key: str,
-                        secret_key: str):
+                        secret_key: str, tp_quantities: list = None, client_ids: dict = None):
+    """SL и TP ордера позиции. client_ids — клиентские id по ногам (sl, tp1…): с ними повтор
+    после обрыва связи не выставит ордер дважды."""
+    client_ids = client_ids or {}
     orders = []
 
     # SL ордер на всю позицию
@@ -212,6 +290,8 @@ def create_tp_sl_orders(symbol: str, side: str, quantity: float, stop_loss: floa
         "quantity": round(quantity, 3),
         "stopPrice": stop_loss
     }
+    if client_ids.get("sl"):
+        stop_order["clientOrderID"] = client_ids["sl"]
     orders.append(stop_order)
 
     current_price = get_current_price(symbol)
@@ -220,9 +300,10 @@ def create_tp_sl_orders(symbol: str, side: str, quantity: float, stop_loss: floa
     valid_take_profits = [tp for tp in take_profits if tp is not None]
     sorted_take_profits = sorted(valid_take_profits) if side == "BUY" else sorted(valid_take_profits, reverse=True)
 
-    # Рассчитываем количества для TP
-    tp_quantities = []
-    if len(sorted_take_profits) > 0:
+    # Рассчитываем количества для TP, если их не посчитал заранее sizing.size_cohort
+    if tp_quantities is not None:
+        sorted_take_profits = sorted_take_profits[:len(tp_quantities)]
+    elif len(sorted_take_profits) > 0:
         tp_quantities = calculate_tp_quantities(quantity, symbol)
 
         # Если TP меньше чем 3, корректируем количества
@@ -233,6 +314,8 @@ def create_tp_sl_orders(symbol: str, side: str, quantity: float, stop_loss: floa
             if total_tp_qty > 0:
                 scale_factor = quantity / total_tp_qty
                 tp_quantities = [round(qty * scale_factor, 6) for qty in tp_quantities]
+    else:
+        tp_quantities = []
 
     for i, tp_price in enumerate(sorted_take_profits):
         if side == "BUY" and tp_price <= current_price:
@@ -260,24 +343,31 @@ def create_tp_sl_orders(symbol: str, side: str, quantity: float, stop_loss: floa
             "quantity": round(tp_qty, 3),
             "stopPrice": tp_price
         }
+        if client_ids.get(f"tp{i + 1}"):
+            tp_order["clientOrderID"] = client_ids[f"tp{i + 1}"]
         orders.append(tp_order)
 
     results = []
     order_ids = []
 
-    # Создаем все ордера с задержками
-    for order in orders:
-        time.sleep(0.5)
-        paramsStr = parseParam(order)
-        response = send_request("POST", '/openApi/swap/v2/trade/order', paramsStr, {}, api_key, secret_key)
-        response_data = json.loads(response)
-        if response_data.get("code") == 0:
-            order_id = response_data["data"]["order"]["orderId"]
-            order_ids.append(order_id)
-            order_type = "SL" if order.get("type") == "STOP_MARKET" else "TP"
-            logger.info(f"{order_type} ордер создан: {order_id}, количество: {order['quantity']}")
-        else:
-            logger.error(f"Ошибка создания ордера: {response_data.get('msg')}")
+    # SL уходит сразу, следующие ордера — с паузой из-за лимита запросов BingX
+    for i, order in enumerate(orders):
+        if i:
+            time.sleep(0.5)
+        client_id = order.get("clientOrderID")
+        try:
+            response = retry_blocking(
+                _post_order, order, api_key, secret_key,
+                recover=(lambda: find_order(symbol, client_id, api_key, secret_key)) if client_id else None
+            )
+        except ExchangeError as e:
+            logger.error(f"Ошибка создания ордера: {e}")
+            results.append(json.dumps({"code": e.code, "msg": e.message}))
+            continue
+        order_id = json.loads(response)["data"]["order"]["orderId"]
+        order_ids.append(order_id)
+        order_type = "SL" if order.get("type") == "STOP_MARKET" else "TP"
+        logger.info(f"{order_type} ордер создан: {order_id}, количество: {order['quantity']}")
         results.append(response)
 
     return results, sorted_take_profits, order_ids
@@ -297,6 +387,23 @@ def get_open_orders(symbol: str, api_key: str, secret_key: str) -> dict:
         raise
 
 
+def get_order_status(symbol: str, order_id: str, api_key: str, secret_key: str) -> dict:
+    try:
+        path = '/openApi/swap/v2/trade/order'
+        method = "GET"
+        paramsMap = {
+            "symbol": symbol,
+            "orderId": order_id
+        }
+        paramsStr = parseParam(paramsMap)
+        response = send_request(method, path, paramsStr, {}, api_key, secret_key)
+        response_data = check_response(json.loads(response), "Ошибка получения статуса ордера")
+        return response_data["data"]["order"]
+    except Exception as e:
+        logger.error(f"Ошибка при получении статуса ордера {order_id} для {symbol}: {str(e)}")
+        raise
+
+
 def cancel_order(symbol: str, order_id: str, api_key: str, secret_key: str) -> bool:
     try:
         path = '/openApi/swap/v2/trade/order'
@@ -307,9 +414,7 @@ def cancel_order(symbol: str, order_id: str, api_key: str, secret_key: str) -> b
         }
         paramsStr = parseParam(paramsMap)
         response = send_request(method, path, paramsStr, {}, api_key, secret_key)
-        response_data = json.loads(response)
-        if response_data.get("code") != 0:
-            raise ValueError(f"Ошибка отмены ордера: {response_data.get('msg')}")
+        check_response(json.loads(response), "Ошибка отмены ордера")
         logger.info(f"Ордер {order_id} для {symbol} успешно отменён")
         return True
     except Exception as e:
@@ -344,15 +449,13 @@ def close_position(symbol: str, position_side: str, api_key: str, secret_key: st
         }
         paramsStr = parseParam(paramsMap)
         response = send_request(method, path, paramsStr, {}, api_key, secret_key)
-        response_data = json.loads(response)
-        if response_data.get("code") != 0:
-            raise ValueError(f"Ошибка закрытия позиции: {response_data.get('msg')}")
+        check_response(json.loads(response), "Ошибка закрытия позиции")
         logger.info(f"Позиция {position_side} для {symbol} успешно закрыта")
         return True
+    except NotFoundError:
+        logger.info(f"Позиция {position_side} для {symbol} уже не существует")
+        return True
     except Exception as e:
-        if "position not exist" in str(e).lower() or "order not exist" in str(e).lower():
-            logger.info(f"Позиция {position_side} для {symbol} уже не существует")
-            return True
         logger.error(f"Ошибка при закрытии позиции {position_side} для {symbol}: {str(e)}")
         raise
 
@@ -366,15 +469,14 @@ def get_open_positions(symbol: str, api_key: str, secret_key: str) -> list:
         response = send_request(method, path, paramsStr, {}, api_key, secret_key)
         response_data = json.loads(response)
         logger.info(f"Open positions response: {response}")
-        if response_data.get("code") != 0:
-            raise ValueError(f"Ошибка получения позиций: {response_data.get('msg')}")
+        check_response(response_data, "Ошибка получения позиций")
         return response_data.get("data", [])
     except Exception as e:
         logger.error(f"Ошибка при получении открытых позиций для {symbol}: {str(e)}")
         raise
 
 
-def move_sl_to_breakeven(symbol: str, api_key: str, secret_key: str) -> bool:
+def move_sl_to_breakeven(symbol: str, api_key: str, secret_key: str, user_id: int = None) -> bool:
     """
     Перемещает стоп-лосс к цене входа для открытой позиции
     """
@@ -431,23 +533,22 @@ def move_sl_to_breakeven(symbol: str, api_key: str, secret_key: str) -> bool:
                     new_sl_order_id = response_data["data"]["order"]["orderId"]
                     logger.info(f"Новый SL ордер {new_sl_order_id} создан по цене {new_sl_price}")
 
-                    # Обновляем базу данных
-                    from database import get_cursor, commit
-                    cursor = get_cursor()
-                    cursor.execute(
-                        """
-                        UPDATE trades 
-                        SET stop_loss = %s, sl_order_id = %s 
-                        WHERE user_id = (SELECT user_id FROM users WHERE api_key = %s) 
-                        AND symbol = %s AND status = 'open'
-                        """,
-                        (new_sl_price, new_sl_order_id, api_key, symbol)
-                    )
-                    commit()
+                    # Обновляем базу данных на своём соединении из пула: вызов идёт из потока отсека
+                    from database import transaction
+                    with transaction() as cursor:
+                        cursor.execute(
+                            """
+                            UPDATE trades 
+                            SET stop_loss = %s, sl_order_id = %s 
+                            WHERE user_id = COALESCE(%s, (SELECT user_id FROM users WHERE api_key = %s))
+                            AND symbol = %s AND status = 'open' AND tier = 'hot'
+                            """,
+                            (new_sl_price, new_sl_order_id, user_id, api_key, symbol)
+                        )
 
                     return True
                 else:
-                    raise ValueError(f"Ошибка создания нового SL ордера: {response_data.get('msg')}")
+                    check_response(response_data, "Ошибка создания нового SL ордера")
 
         logger.info(f"Нет открытых позиций для {symbol} или позиция уже закрыта")
         return True
@@ -457,48 +558,102 @@ def move_sl_to_breakeven(symbol: str, api_key: str, secret_key: str) -> bool:
         raise
 
 
+def flatten(api_key: str, secret_key: str, symbols: list = None) -> dict:
+    """Отменяет все ордера и закрывает все позиции по symbols (None — по всему аккаунту). Для flatten.py"""
+    canceled = 0
+    for symbol in symbols or [None]:
+        response_data = check_response(json.loads(send_request(
+            "DELETE", '/openApi/swap/v2/trade/allOpenOrders', parseParam({"symbol": symbol} if symbol else {}), {},
+            api_key, secret_key
+        )), "Ошибка отмены ордеров")
+        canceled += len((response_data.get("data") or {}).get("success") or [])
+
+    positions = check_response(json.loads(send_request(
+        "GET", '/openApi/swap/v2/user/positions', parseParam({}), {}, api_key, secret_key
+    )), "Ошибка получения позиций").get("data") or []
+    closed = []
+    for position in positions:
+        if float(position.get("positionAmt", 0)) and (not symbols or position["symbol"] in symbols):
+            close_position(position["symbol"], position["positionSide"], api_key, secret_key)
+            closed.append(f"{position['symbol']} {position['positionSide'].lower()}")
+    return {"canceled": canceled, "closed": closed}
+
+
+def get_live_state(api_key: str, secret_key: str, symbols: list = (), since_ms: int = None) -> dict:
+    """Позиции, живые ордера и ордера, исполненные с since_ms, по всему аккаунту (для reconciler.py)"""
+    def call(path: str, params: dict):
+        response_data = check_response(json.loads(send_request("GET", path, parseParam(params), {}, api_key, secret_key)))
+        return response_data.get("data") or {}
+
+    now_ms = int(time.time() * 1000) + TIME_OFFSET
+    positions = {}
+    for position in call('/openApi/swap/v2/user/positions', {}) or []:
+        amount = float(position.get("positionAmt", 0))
+        if amount:
+            side = position.get("positionSide", "BOTH").lower()
+            if side == "both":
+                side = "long" if amount > 0 else "short"
+            positions[(position["symbol"], side)] = abs(amount)
+
+    live = {str(order["orderId"]) for order in call('/openApi/swap/v2/trade/openOrders', {}).get("orders", [])}
+
+    history = call('/openApi/swap/v2/trade/allOrders', {
+        "startTime": since_ms or now_ms - 24 * 3600 * 1000, "endTime": now_ms, "limit": 500
+    })
+    filled = {str(order["orderId"]) for order in history.get("orders", []) if order.get("status") == "FILLED"}
+    return {"positions": positions, "live_order_ids": live, "filled_order_ids": filled, "cursor": now_ms}
+
+
 def get_sign(api_secret: str, payload: str) -> str:
     signature = hmac.new(api_secret.encode("utf-8"), payload.encode("utf-8"), digestmod=sha256).hexdigest()
     logger.info("sign=%s", signature)
     return signature
 
 
-def send_request(method: str, path: str, urlpa: str, payload: dict, api_key: str, secret_key: str,
-                 retries: int = 3) -> str:
+def check_response(response_data: dict, context: str = "") -> dict:
+    """Ответ BingX с code != 0 поднимается типизированной ошибкой (exchange_errors.py)"""
+    if response_data.get("code") != 0:
+        raise_for("bingx", response_data.get("code"), response_data.get("msg"), context)
+    return response_data
+
+
+def send_request(method: str, path: str, urlpa: str, payload: dict, api_key: str, secret_key: str) -> str:
+    """Один подписанный запрос к BingX.
+
+    Вслепую запрос не повторяем: POST без ответа мог создать ордер. Обрыв поднимается
+    как NetworkError, повторы с тем же clientOrderID делает retry.py. Здесь повторяется
+    только запрос, отвергнутый по timestamp, — его биржа точно не исполнила.
+    """
     global TIME_OFFSET
-    attempt = 0
-    while attempt < retries:
+    for attempt in range(2):
+        url = f"{APIURL}{path}?{urlpa}&signature={get_sign(secret_key, urlpa)}"
+        logger.info("Request URL: %s", url)
+        headers = {'X-BX-APIKEY': api_key}
         try:
-            url = f"{APIURL}{path}?{urlpa}&signature={get_sign(secret_key, urlpa)}"
-            logger.info("Request URL: %s", url)
-            headers = {'X-BX-APIKEY': api_key}
-            response = requests.request(method, url, headers=headers, data=payload)
+            response = http_session.request(method, url, headers=headers, data=payload, timeout=request_timeout())
             response_data = response.json()
-            if response_data.get("code") in [109414, 109500] and "timestamp is invalid" in response_data.get("msg",
-                                                                                                             "").lower():
-                logger.warning(
-                    f"Недопустимый timestamp, попытка {attempt + 1}/{retries}. Повторная синхронизация времени...")
-                TIME_OFFSET = get_server_time()
-                urlpa = urlpa.split("&timestamp=")[0] + "&timestamp=" + str(int(time.time() * 1000) + TIME_OFFSET)
-                attempt += 1
-                time.sleep(1)
-                continue
-            return response.text
         except Exception as e:
-            logger.error(f"Ошибка запроса (попытка {attempt + 1}/{retries}): {str(e)}")
-            if attempt < retries - 1:
-                TIME_OFFSET = get_server_time()
-                urlpa = urlpa.split("&timestamp=")[0] + "&timestamp=" + str(int(time.time() * 1000) + TIME_OFFSET)
-                time.sleep(1)
-            attempt += 1
-    raise ValueError(f"Не удалось выполнить запрос после {retries} попыток")
+            raise NetworkError("bingx", None, str(e), f"Ошибка запроса {method} {path}") from e
+        if (not attempt and response_data.get("code") in [109414, 109500]
+                and "timestamp is invalid" in response_data.get("msg", "").lower()):
+            logger.warning("Недопустимый timestamp, повторная синхронизация времени...")
+            TIME_OFFSET = sync_time_offset()
+            urlpa = urlpa.split("&timestamp=")[0] + "&timestamp=" + str(int(time.time() * 1000) + TIME_OFFSET)
+            continue
+        return response.text
+
+
+def sync_time_offset() -> int:
+    global TIME_OFFSET
+    TIME_OFFSET = get_server_time()
+    clock_offset_cache.set("bingx", TIME_OFFSET)
+    return TIME_OFFSET
 
 
 def parseParam(paramsMap: dict) -> str:
     global TIME_OFFSET
-    if not hasattr(parseParam, 'TIME_OFFSET'):
-        parseParam.TIME_OFFSET = get_server_time()
-        TIME_OFFSET = parseParam.TIME_OFFSET
+    offset = clock_offset_cache.get("bingx")
+    TIME_OFFSET = offset if offset is not None else sync_time_offset()
     sortedKeys = sorted(paramsMap)
     paramsStr = "&".join(["%s=%s" % (x, paramsMap[x]) for x in sortedKeys])
     timestamp = int(time.time() * 1000) + TIME_OFFSET
@@ -1,36 +1,62 @@
 import logging
+import os
 import time
 from typing import Dict, List, Optional
-import pybitget
-from database import get_cursor, commit
+from database import transaction
+from cache import instrument_cache, leverage_cache, account_key
+from exchange_errors import ExchangeError, NetworkError, raise_for
+from concurrency import is_transient
 
 logger = logging.getLogger(__name__)
 
+EXCHANGE_SIMULATOR_URL = os.getenv("EXCHANGE_SIMULATOR_URL")
+APIURL = f"{EXCHANGE_SIMULATOR_URL}/bitget" if EXCHANGE_SIMULATOR_URL else "https://api.bitget.com"
+
 
 class BitgetAPI:
     def __init__(self, api_key: str, secret_key: str, passphrase: str, testnet: bool = False):
+        # pybitget загружается только когда есть пользователи Bitget
+        import pybitget
         self.client = pybitget.Bitget(
             api_key=api_key,
             api_secret=secret_key,
             passphrase=passphrase,
-            base_url="https://api.bitget.com" if not testnet else "https://capi.bitget.com"
+            base_url=APIURL if not testnet else "https://capi.bitget.com"
         )
         self.api_key = api_key
 
+    def list_symbols(self) -> List[str]:
+        """Все USDT-M контракты Bitget; заодно кэширует их параметры для get_symbol_info"""
+        cached = instrument_cache.get(("symbols", "bitget"))
+        if cached is not None:
+            return cached
+        response = self.client.mix_get_symbols("umcbl")  # umcbl для USDT-M фьючерсов
+        if response.get("code") != "00000":
+            raise_for("bitget", response.get("code"), response.get("msg"), "Ошибка API")
+        symbols = []
+        for contract in response["data"]:
+            instrument_cache.set(("bitget", contract["symbol"]), {
+                "minQty": float(contract.get("minTradeAmount", 0.001)),
+                # volumePlace — число знаков после запятой, а не шаг
+                "qtyStep": 10 ** -int(contract.get("volumePlace", 3)),
+                "maxLeverage": int(float(contract.get("maxLeverage", 125)))
+            })
+            symbols.append(contract["symbol"])
+        instrument_cache.set(("symbols", "bitget"), symbols)
+        return symbols
+
     def get_symbol_info(self, symbol: str) -> Dict:
         """Получает информацию о торговой паре"""
+        cached = instrument_cache.get(("bitget", symbol))
+        if cached is not None:
+            return cached
         try:
-            response = self.client.mix_get_symbols("umcbl")  # umcbl для USDT-M фьючерсов
-            if response.get("code") != "00000":
-                raise ValueError(f"Ошибка API: {response.get('msg')}")
-
-            for contract in response["data"]:
-                if contract["symbol"] == symbol:
-                    return {
-                        "minQty": float(contract.get("minTradeAmount", 0.001)),
-                        "qtyStep": float(contract.get("volumePlace", 0.001)),
-                        "maxLeverage": int(float(contract.get("maxLeverage", 125)))
-                    }
+            # Список контрактов приходит целиком — кэшируем все пары разом
+            instrument_cache.invalidate(("symbols", "bitget"))
+            self.list_symbols()
+            cached = instrument_cache.get(("bitget", symbol))
+            if cached is not None:
+                return cached
             raise ValueError(f"Пара {symbol} не найдена")
         except Exception as e:
             logger.error(f"Ошибка при получении информации о символе {symbol}: {str(e)}")
@@ -41,7 +67,7 @@ class BitgetAPI:
         try:
             response = self.client.mix_get_ticker(symbol)
             if response.get("code") != "00000":
-                raise ValueError(f"Ошибка API: {response.get('msg')}")
+                raise_for("bitget", response.get("code"), response.get("msg"), "Ошибка API")
             return float(response["data"][0]["last"])
         except Exception as e:
             logger.error(f"Ошибка при получении цены для {symbol}: {str(e)}")
@@ -52,27 +78,45 @@ class BitgetAPI:
         try:
             response = self.client.mix_get_account("umcbl", "USDT")
             if response.get("code") != "00000":
-                raise ValueError(f"Ошибка API: {response.get('msg')}")
+                raise_for("bitget", response.get("code"), response.get("msg"), "Ошибка API")
             return float(response["data"].get("available", 0))
         except Exception as e:
             logger.error(f"Ошибка при получении баланса Bitget: {str(e)}")
             raise
 
-    def set_leverage(self, symbol: str, leverage: int = 5, tdMode: str = "isolated") -> bool:
+    def get_account_profile(self) -> Dict:
+        """Возможности аккаунта для account_profile.probe_account"""
+        response = self.client.mix_get_account("umcbl", "USDT")
+        if response.get("code") != "00000":
+            raise_for("bitget", response.get("code"), response.get("msg"), "Ошибка API")
+        data = response["data"]
+        return {
+            "position_mode": {"double_hold": "hedge", "single_hold": "one_way"}.get(data.get("holdMode")),
+            "margin_mode": {"fixed": "isolated", "crossed": "cross"}.get(data.get("marginMode"), data.get("marginMode")),
+            "can_trade": None,
+            "futures_enabled": True,
+            "balance": float(data.get("available", 0)),
+        }
+
+    def set_leverage(self, symbol: str, leverage: int = 5, tdMode: str = "isolated",
+                     position_mode: str = None) -> bool:
         """Устанавливает плечо для торговой пары"""
+        cache_key = ("bitget", account_key(self.api_key), symbol, leverage, tdMode)
+        if leverage_cache.get(cache_key):
+            logger.info(f"Плечо {leverage}x для {symbol} ({tdMode}) уже установлено")
+            return True
         try:
             margin_mode = "isolated" if tdMode == "isolated" else "cross"
-            response = self.client.mix_set_leverage(
-                symbol=symbol,
-                marginCoin="USDT",
-                leverage=leverage,
-                marginMode=margin_mode,
-                holdSide="long"  # Для хедж-режима
-            )
+            params = {"symbol": symbol, "marginCoin": "USDT", "leverage": leverage, "marginMode": margin_mode}
+            # holdSide нужен только в хедж-режиме; без профиля считаем аккаунт хеджевым, как раньше
+            if position_mode != "one_way":
+                params["holdSide"] = "long"
+            response = self.client.mix_set_leverage(**params)
             if response.get("code") != "00000":
                 logger.warning(f"Ошибка установки плеча для {symbol}: {response.get('msg')}")
                 return True  # Продолжаем, если плечо уже установлено
             logger.info(f"Плечо {leverage}x установлено для {symbol} ({tdMode})")
+            leverage_cache.set(cache_key, True)
             return True
         except Exception as e:
             logger.error(f"Ошибка при установке плеча для {symbol}: {str(e)}")
@@ -117,7 +161,9 @@ class BitgetAPI:
             quantity: float,
             stop_loss: float,
             take_profits: List[Optional[float]],
-            tdMode: str = "isolated"
+            tdMode: str = "isolated",
+            tp_quantities: List[float] = None,
+            client_id: str = None
     ) -> tuple:
         """Создает основной ордер с SL/TP"""
         try:
@@ -127,22 +173,83 @@ class BitgetAPI:
 
             side = side.upper()
             pos_side = "long" if side == "BUY" else "short"
-            sl_side = "sell" if side == "BUY" else "buy"
 
             # Создаем основной ордер
-            main_response = self.client.mix_place_order(
+            main_response = self._place_entry(
                 symbol=symbol,
                 marginCoin="USDT",
                 size=quantity,
                 side=side.lower(),
                 orderType="market",
-                posSide=pos_side
+                posSide=pos_side,
+                clientOrderId=client_id or ""
             )
-            if main_response.get("code") != "00000":
-                raise ValueError(f"Ошибка создания ордера: {main_response.get('msg')}")
             order_id = main_response["data"]["orderId"]
 
-            # Распределяем количество для TP ордеров
+            valid_take_profits, algo_order_ids = self._place_protection(
+                symbol, side, quantity, qty_step, stop_loss, take_profits, tp_quantities, pos_side
+            )
+
+            logger.info(f"Основной ордер создан: {order_id}, TP/SL ордера: {algo_order_ids}")
+            return main_response, valid_take_profits, order_id, algo_order_ids, pos_side
+
+        except Exception as e:
+            logger.error(f"Ошибка при создании основного ордера для {symbol}: {str(e)}")
+            raise
+
+    def recover_main_order(
+            self,
+            symbol: str,
+            side: str,
+            quantity: float,
+            stop_loss: float,
+            take_profits: List[Optional[float]],
+            tdMode: str = "isolated",
+            tp_quantities: List[float] = None,
+            client_id: str = None
+    ) -> Optional[tuple]:
+        """Вход, ответ на который потерян: ищет ордер по clientOid и ставит к нему SL/TP,
+        возвращая то же, что create_main_order. None — биржа такого ордера не знает"""
+        if not client_id:
+            return None
+        response = self.client.mix_get_order_details(symbol, clientOrderId=client_id)
+        if response.get("code") != "00000" or not response.get("data"):
+            return None
+        order = response["data"]
+        order_id = order["orderId"]
+        logger.info(f"Вход {client_id} для {symbol} уже на бирже: {order_id}")
+
+        side = side.upper()
+        pos_side = order.get("posSide") or ("long" if side == "BUY" else "short")
+        qty_step = self.get_symbol_info(symbol)["qtyStep"]
+        valid_take_profits, algo_order_ids = self._place_protection(
+            symbol, side, float(order["size"]), qty_step, stop_loss, take_profits, tp_quantities, pos_side
+        )
+        main_response = {"code": "00000", "msg": "success", "data": {"orderId": order_id, "clientOid": client_id}}
+        return main_response, valid_take_profits, order_id, algo_order_ids, pos_side
+
+    def _place_entry(self, **params) -> Dict:
+        """Вход. Обрыв ответа поднимается как NetworkError, отказ — типизированной ошибкой
+        (дубль clientOid — DuplicateOrderError): retry_call найдёт дошедший вход по clientOid"""
+        try:
+            response = self.client.mix_place_order(**params)
+        except Exception as e:
+            if is_transient(e) and not isinstance(e, ExchangeError):
+                raise NetworkError("bitget", None, str(e), "Ответ на вход не получен") from e
+            raise
+        if response.get("code") != "00000":
+            raise_for("bitget", response.get("code"), response.get("msg"), "Ошибка создания ордера")
+        return response
+
+    def _place_protection(self, symbol: str, side: str, quantity: float, qty_step: float, stop_loss: float,
+                          take_profits: List[Optional[float]], tp_quantities: Optional[List[float]],
+                          pos_side: str) -> tuple:
+        """SL и TP плановыми ордерами к принятому входу. Сбой одной ноги не отменяет остальные"""
+        sl_side = "sell" if side == "BUY" else "buy"
+
+        # Распределяем количество для TP ордеров
+        # Если объёмы TP не посчитаны заранее sizing.size_cohort
+        if tp_quantities is None:
             total_lots = int(quantity / qty_step)
             tp_lots_base = total_lots // 3
             tp_lots_remainder = total_lots % 3
@@ -157,58 +264,41 @@ class BitgetAPI:
                 correction = quantity - total_tp_size
                 tp_quantities[-1] = tp_quantities[-1] + correction
 
-            sorted_take_profits = sorted(take_profits) if side == "BUY" else sorted(take_profits, reverse=True)
-            valid_take_profits = [tp for tp in sorted_take_profits if tp is not None]
-
-            algo_order_ids = []
-
-            # Создаем SL ордер
-            sl_response = self.client.mix_place_plan_order(
-                symbol=symbol,
-                marginCoin="USDT",
-                size=quantity,
-                triggerPrice=stop_loss,
-                side=sl_side,
-                orderType="market",
-                triggerType="fill_price",
-                posSide=pos_side
-            )
-            if sl_response.get("code") != "00000":
-                logger.error(f"Ошибка создания SL ордера: {sl_response.get('msg')}")
+        sorted_take_profits = sorted(take_profits) if side == "BUY" else sorted(take_profits, reverse=True)
+        valid_take_profits = [tp for tp in sorted_take_profits if tp is not None]
+
+        # SL первым, затем TP — в этом порядке id разбирает services.py
+        legs = [("SL", stop_loss, quantity)] + [("TP", tp_price, tp_qty)
+                                                for tp_price, tp_qty in zip(valid_take_profits, tp_quantities)]
+        algo_order_ids = []
+        for leg, trigger_price, size in legs:
+            try:
+                leg_response = self.client.mix_place_plan_order(
+                    symbol=symbol,
+                    marginCoin="USDT",
+                    size=size,
+                    triggerPrice=trigger_price,
+                    side=sl_side,
+                    orderType="market",
+                    triggerType="fill_price",
+                    posSide=pos_side
+                )
+            except Exception as e:
+                logger.error(f"Ошибка создания {leg} ордера: {e}")
+                continue
+            if leg_response.get("code") != "00000":
+                logger.error(f"Ошибка создания {leg} ордера: {leg_response.get('msg')}")
             else:
-                algo_order_ids.append(sl_response["data"]["orderId"])
-
-            # Создаем TP ордера
-            for tp_price, tp_qty in zip(valid_take_profits, tp_quantities):
-                if tp_price is not None:
-                    tp_response = self.client.mix_place_plan_order(
-                        symbol=symbol,
-                        marginCoin="USDT",
-                        size=tp_qty,
-                        triggerPrice=tp_price,
-                        side=sl_side,
-                        orderType="market",
-                        triggerType="fill_price",
-                        posSide=pos_side
-                    )
-                    if tp_response.get("code") != "00000":
-                        logger.error(f"Ошибка создания TP ордера: {tp_response.get('msg')}")
-                    else:
-                        algo_order_ids.append(tp_response["data"]["orderId"])
-
-            logger.info(f"Основной ордер создан: {order_id}, TP/SL ордера: {algo_order_ids}")
-            return main_response, valid_take_profits, order_id, algo_order_ids, pos_side
+                algo_order_ids.append(leg_response["data"]["orderId"])
 
-        except Exception as e:
-            logger.error(f"Ошибка при создании основного ордера для {symbol}: {str(e)}")
-            raise
+        return valid_take_profits, algo_order_ids
 
     def get_order_status(self, symbol: str, order_id: str) -> Dict:
         """Получает статус ордера"""
         try:
             response = self.client.mix_get_order_details(symbol, order_id)
             if response.get("code") != "00000":
-                raise ValueError(f"Ошибка API: {response.get('msg')}")
+                raise_for("bitget", response.get("code"), response.get("msg"), "Ошибка API")
             return response["data"]
         except Exception as e:
             logger.error(f"Ошибка при получении статуса ордера {order_id} для {symbol}: {str(e)}")
@@ -219,7 +309,7 @@ class BitgetAPI:
         try:
             response = self.client.mix_get_position(symbol, "USDT")
             if response.get("code") != "00000":
-                raise ValueError(f"Ошибка API: {response.get('msg')}")
+                raise_for("bitget", response.get("code"), response.get("msg"), "Ошибка API")
 
             for pos in response["data"]:
                 if pos["holdSide"] == posSide.lower():
@@ -234,7 +324,7 @@ class BitgetAPI:
                         posSide=posSide.lower()
                     )
                     if close_response.get("code") != "00000":
-                        raise ValueError(f"Ошибка закрытия позиции: {close_response.get('msg')}")
+                        raise_for("bitget", close_response.get("code"), close_response.get("msg"), "Ошибка закрытия позиции")
                     logger.info(f"Позиция {posSide} для {symbol} закрыта")
                     return True
             logger.info(f"Нет открытых позиций для {symbol} на стороне {posSide}")
@@ -248,19 +338,60 @@ class BitgetAPI:
         try:
             response = self.client.mix_cancel_order(symbol, order_id, "USDT")
             if response.get("code") != "00000":
-                raise ValueError(f"Ошибка API: {response.get('msg')}")
+                raise_for("bitget", response.get("code"), response.get("msg"), "Ошибка API")
             logger.info(f"Ордер {order_id} для {symbol} отменён")
             return True
         except Exception as e:
             logger.error(f"Ошибка при отмене ордера {order_id} для {symbol}: {str(e)}")
             raise
 
-    def move_sl_to_breakeven(self, symbol: str) -> bool:
+    def get_live_state(self, symbols: list = (), since_ms: int = None) -> Dict:
+        """Позиции и живые ордера по символам открытых сделок (для reconciler.py).
+        Истории исполнений по всему аккаунту v1 API не отдаёт: filled_order_ids = None,
+        и reconciler считает исчезнувшие SL/TP сработавшими."""
+        positions, live = {}, set()
+        for symbol in symbols:
+            response = self.client.mix_get_position(symbol, "USDT")
+            if response.get("code") != "00000":
+                raise_for("bitget", response.get("code"), response.get("msg"), "Ошибка API")
+            for position in response["data"] or []:
+                if float(position.get("total") or 0):
+                    positions[(symbol, position["holdSide"])] = float(position["total"])
+            for method in (self.client.mix_get_plan_orders, self.client.mix_get_open_order):
+                response = method(symbol)
+                if response.get("code") != "00000":
+                    raise_for("bitget", response.get("code"), response.get("msg"), "Ошибка API")
+                live |= {str(order["orderId"]) for order in response["data"] or []}
+        return {"positions": positions, "live_order_ids": live, "filled_order_ids": None,
+                "cursor": int(time.time() * 1000)}
+
+    def flatten(self, symbols: list) -> Dict:
+        """Отменяет все ордера (вместе с плановыми SL/TP) и закрывает все позиции по symbols. Для flatten.py.
+        v1 API отдаёт ордера и позиции только по символу, поэтому symbols обязательны."""
+        canceled, closed = 0, []
+        for symbol in symbols:
+            for method in (self.client.mix_get_plan_orders, self.client.mix_get_open_order):
+                response = method(symbol)
+                if response.get("code") != "00000":
+                    raise_for("bitget", response.get("code"), response.get("msg"), "Ошибка API")
+                for order in response["data"] or []:
+                    self.cancel_order(symbol, order["orderId"])
+                    canceled += 1
+            response = self.client.mix_get_position(symbol, "USDT")
+            if response.get("code") != "00000":
+                raise_for("bitget", response.get("code"), response.get("msg"), "Ошибка API")
+            for position in response["data"] or []:
+                if float(position.get("total") or 0):
+                    self.close_position(symbol, position["holdSide"])
+                    closed.append(f"{symbol} {position['holdSide']}")
+        return {"canceled": canceled, "closed": closed}
+
+    def move_sl_to_breakeven(self, symbol: str, user_id: int = None) -> bool:
         """Перемещает стоп-лосс к цене входа"""
         try:
             response = self.client.mix_get_position(symbol, "USDT")
             if response.get("code") != "00000":
-                raise ValueError(f"Ошибка API: {response.get('msg')}")
+                raise_for("bitget", response.get("code"), response.get("msg"), "Ошибка API")
 
             positions = response["data"]
             for position in positions:
@@ -271,7 +402,7 @@ class BitgetAPI:
                 if qty > 0 and avg_price > 0:
                     orders_response = self.client.mix_get_plan_orders(symbol)
                     if orders_response.get("code") != "00000":
-                        raise ValueError(f"Ошибка API: {orders_response.get('msg')}")
+                        raise_for("bitget", orders_response.get("code"), orders_response.get("msg"), "Ошибка API")
 
                     sl_orders = [order for order in orders_response["data"]
                                  if order.get("triggerType") == "fill_price" and order.get("posSide") == pos_side]
@@ -293,20 +424,20 @@ class BitgetAPI:
                         posSide=pos_side
                     )
                     if sl_response.get("code") != "00000":
-                        raise ValueError(f"Ошибка создания SL: {sl_response.get('msg')}")
+                        raise_for("bitget", sl_response.get("code"), sl_response.get("msg"), "Ошибка создания SL")
                     new_sl_order_id = sl_response["data"]["orderId"]
 
-                    cursor = get_cursor()
-                    cursor.execute(
-                        """
-                        UPDATE trades 
-                        SET stop_loss = %s, sl_order_id = %s 
-                        WHERE user_id = (SELECT user_id FROM users WHERE api_key = %s) 
-                        AND symbol = %s AND status = 'open'
-                        """,
-                        (new_sl_price, new_sl_order_id, self.api_key, symbol)
-                    )
-                    commit()
+                    # Своё соединение из пула: вызов идёт из потока отсека
+                    with transaction() as cursor:
+                        cursor.execute(
+                            """
+                            UPDATE trades 
+                            SET stop_loss = %s, sl_order_id = %s 
+                            WHERE user_id = COALESCE(%s, (SELECT user_id FROM users WHERE api_key = %s))
+                            AND symbol = %s AND status = 'open' AND tier = 'hot'
+                            """,
+                            (new_sl_price, new_sl_order_id, user_id, self.api_key, symbol)
+                        )
                     logger.info(f"SL перемещён к {new_sl_price} для {symbol}")
                     return True
 
@@ -318,6 +449,11 @@ class BitgetAPI:
 
 
 # Совместимость с другими модулями
+def list_symbols() -> List[str]:
+    # Публичный эндпоинт, ключи не нужны
+    return BitgetAPI("", "", "").list_symbols()
+
+
 def get_symbol_info(symbol: str, api_key: str, secret_key: str, passphrase: str = None) -> Dict:
     return BitgetAPI(api_key, secret_key, passphrase).get_symbol_info(symbol)
 
@@ -330,9 +466,13 @@ def get_balance(api_key: str, secret_key: str, passphrase: str = None) -> float:
     return BitgetAPI(api_key, secret_key, passphrase).get_balance()
 
 
+def get_account_profile(api_key: str, secret_key: str, passphrase: str = None) -> Dict:
+    return BitgetAPI(api_key, secret_key, passphrase).get_account_profile()
+
+
 def set_leverage(symbol: str, leverage: int = 5, tdMode: str = "isolated", api_key: str = None,
-                 secret_key: str = None, passphrase: str = None) -> bool:
-    return BitgetAPI(api_key, secret_key, passphrase).set_leverage(symbol, leverage, tdMode)
+                 secret_key: str = None, passphrase: str = None, position_mode: str = None) -> bool:
+    return BitgetAPI(api_key, secret_key, passphrase).set_leverage(symbol, leverage, tdMode, position_mode)
 
 
 def calculate_quantity(symbol: str, leverage: int = 5, risk_percent: float = 0.05, api_key: str = None,
@@ -341,9 +481,17 @@ def calculate_quantity(symbol: str, leverage: int = 5, risk_percent: float = 0.0
 
 
 def create_main_order(symbol: str, side: str, quantity: float, stop_loss: float, take_profits: List[Optional[float]],
-                      tdMode: str = "isolated", api_key: str = None, secret_key: str = None, passphrase: str = None):
+                      tdMode: str = "isolated", api_key: str = None, secret_key: str = None, passphrase: str = None,
+                      tp_quantities: List[float] = None, client_id: str = None):
     return BitgetAPI(api_key, secret_key, passphrase).create_main_order(symbol, side, quantity, stop_loss, take_profits,
-                                                                        tdMode)
+                                                                        tdMode, tp_quantities, client_id)
+
+
+def recover_main_order(symbol: str, side: str, quantity: float, stop_loss: float, take_profits: List[Optional[float]],
+                       tdMode: str = "isolated", api_key: str = None, secret_key: str = None, passphrase: str = None,
+                       tp_quantities: List[float] = None, client_id: str = None):
+    return BitgetAPI(api_key, secret_key, passphrase).recover_main_order(symbol, side, quantity, stop_loss,
+                                                                         take_profits, tdMode, tp_quantities, client_id)
 
 
 def get_order_status(symbol: str, order_id: str, api_key: str, secret_key: str, passphrase: str = None) -> Dict:
@@ -358,5 +506,15 @@ def cancel_order(symbol: str, order_id: str, api_key: str, secret_key: str, pass
     return BitgetAPI(api_key, secret_key, passphrase).cancel_order(symbol, order_id)
 
 
-def move_sl_to_breakeven(symbol: str, api_key: str, secret_key: str, passphrase: str = None) -> bool:
-    return BitgetAPI(api_key, secret_key, passphrase).move_sl_to_breakeven(symbol)
\ No newline at end of file
+def get_live_state(api_key: str, secret_key: str, passphrase: str = None, symbols: list = (),
+                   since_ms: int = None) -> Dict:
+    return BitgetAPI(api_key, secret_key, passphrase).get_live_state(symbols, since_ms)
+
+
+def flatten(api_key: str, secret_key: str, passphrase: str = None, symbols: list = None) -> Dict:
+    return BitgetAPI(api_key, secret_key, passphrase).flatten(symbols or [])
+
+
+def move_sl_to_breakeven(symbol: str, api_key: str, secret_key: str, passphrase: str = None,
+                         user_id: int = None) -> bool:
+    return BitgetAPI(api_key, secret_key, passphrase).move_sl_to_breakeven(symbol, user_id)
\ No newline at end of file
@@ -0,0 +1,146 @@
+# bulkheads.py
+import asyncio
+import contextvars
+import functools
+import logging
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager
+from typing import Callable, Dict
+
+import metrics
+from concurrency import AIMDController
+
+logger = logging.getLogger(__name__)
+
+EXCHANGES = ("bingx", "okx", "bybit", "bitget")
+# Потоков под синхронные вызовы API одной биржи; BULKHEAD_WORKERS_OKX и т.п. — для отдельной биржи
+BULKHEAD_WORKERS = int(os.getenv("BULKHEAD_WORKERS", "16"))
+# Начальный лимит пользователей одной биржи, обрабатываемых одновременно; дальше его ведёт AIMDController
+BULKHEAD_CONCURRENCY = int(os.getenv("BULKHEAD_CONCURRENCY", "16"))
+
+
+def _setting(name: str, exchange: str, default: int) -> int:
+    return int(os.getenv(f"{name}_{exchange.upper()}", default))
+
+
+def workers(exchange: str) -> int:
+    return _setting("BULKHEAD_WORKERS", exchange, BULKHEAD_WORKERS)
+
+
+class Bulkhead:
+    """Отсек одной биржи: свой пул потоков и свои адаптивные лимиты по группам эндпоинтов.
+
+    Зависшие запросы к деградировавшей бирже занимают только её потоки и её места,
+    пользователи остальных бирж обрабатываются без очереди за ней.
+
+    Группа order (вход, SL/TP, отмены, закрытия) ограничивает число пользователей
+    рассылки, одновременно выставляющих ордера; её вызовы идут внутри места slot().
+    Группа account (баланс, плечо, позиции, статусы ордеров, сверка) ограничивает
+    сами запросы.
+    """
+
+    def __init__(self, exchange: str, max_workers: int, concurrency: int):
+        self.exchange = exchange
+        self.max_workers = max_workers
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix=f"bulkhead-{exchange}")
+        self.controllers = {
+            "order": AIMDController(f"{exchange}_order", initial=concurrency),
+            "account": AIMDController(f"{exchange}_account", initial=max_workers, maximum=max_workers),
+        }
+        self.active_users = 0
+        self.waiting_users = 0
+        self.active_calls = 0
+        self.peak_calls = 0
+
+    @asynccontextmanager
+    async def slot(self):
+        """Место для обработки одного пользователя; ожидание места пишется в bulkhead_wait_{exchange}"""
+        started = time.perf_counter()
+        self.waiting_users += 1
+        try:
+            await self.controllers["order"].acquire()
+        finally:
+            self.waiting_users -= 1
+        metrics.record(f"bulkhead_wait_{self.exchange}", time.perf_counter() - started)
+        self.active_users += 1
+        try:
+            yield
+        finally:
+            self.active_users -= 1
+            self.controllers["order"].release()
+
+    async def run(self, group: str, fn: Callable, *args, **kwargs):
+        """Синхронный вызов API в пуле потоков биржи — как asyncio.to_thread, но в своём пуле.
+        Контекст (дедлайн сигнала из deadline.py) переносится в поток. Длительность и ошибка
+        вызова уходят в AIMDController группы."""
+        controller = self.controllers[group]
+        if group == "account":
+            await controller.acquire()
+        call = functools.partial(contextvars.copy_context().run, fn, *args, **kwargs)
+        self.active_calls += 1
+        self.peak_calls = max(self.peak_calls, self.active_calls)
+        started = time.perf_counter()
+        error = None
+        try:
+            return await asyncio.get_running_loop().run_in_executor(self.executor, call)
+        except Exception as e:
+            error = e
+            raise
+        finally:
+            elapsed = time.perf_counter() - started
+            self.active_calls -= 1
+            if group == "account":
+                controller.release()
+            controller.observe(elapsed, error)
+            metrics.record(f"bulkhead_call_{self.exchange}", elapsed, error=error is not None)
+
+    def stats(self) -> Dict:
+        """Насыщение отсека: вызовов сверх max_workers ждут свободного потока"""
+        return {
+            "workers": self.max_workers,
+            "limits": {group: controller.stats() for group, controller in self.controllers.items()},
+            "active_users": self.active_users,
+            "waiting_users": self.waiting_users,
+            "active_calls": self.active_calls,
+            "queued_calls": max(0, self.active_calls - self.max_workers),
+            "peak_calls": self.peak_calls,
+            "saturation": round(min(self.active_calls, self.max_workers) / self.max_workers, 3),
+        }
+
+    def shutdown(self) -> None:
+        self.executor.shutdown(wait=False, cancel_futures=True)
+
+
+bulkheads: Dict[str, Bulkhead] = {
+    exchange: Bulkhead(exchange, workers(exchange), _setting("BULKHEAD_CONCURRENCY", exchange, BULKHEAD_CONCURRENCY))
+    for exchange in EXCHANGES
+}
+
+
+def bulkhead(exchange: str) -> Bulkhead:
+    return bulkheads[exchange]
+
+
+async def run_on(exchange: str, fn: Callable, *args, **kwargs):
+    """Запрос группы account в отсеке биржи; для неизвестной биржи — в общем пуле asyncio.to_thread"""
+    if exchange not in bulkheads:
+        return await asyncio.to_thread(fn, *args, **kwargs)
+    return await bulkheads[exchange].run("account", fn, *args, **kwargs)
+
+
+async def run_order(exchange: str, fn: Callable, *args, **kwargs):
+    """Запрос группы order: вызывается пользователем, уже занявшим место slot() своей биржи"""
+    if exchange not in bulkheads:
+        return await asyncio.to_thread(fn, *args, **kwargs)
+    return await bulkheads[exchange].run("order", fn, *args, **kwargs)
+
+
+def snapshot() -> Dict:
+    return {exchange: bulkhead.stats() for exchange, bulkhead in bulkheads.items()}
+
+
+def shutdown() -> None:
+    for bulkhead in bulkheads.values():
+        bulkhead.shutdown()
@@ -1,26 +1,107 @@
 import logging
+import os
+import time
 from typing import Dict, List, Optional
-from pybit.unified_trading import HTTP
-from database import get_cursor, commit
+from database import transaction
+from cache import instrument_cache, leverage_cache, account_key
+from ws_trading import WSTimeout, WSUnavailable, client_order_id, ws_trading
+from deadline import request_timeout
+from exchange_errors import ExchangeError, NetworkError, raise_for
+from concurrency import is_transient
 
 logger = logging.getLogger(__name__)
 
+EXCHANGE_SIMULATOR_URL = os.getenv("EXCHANGE_SIMULATOR_URL")
+
 class BybitAPI:
     def __init__(self, api_key: str, secret_key: str, testnet: bool = False):
+        # pybit загружается только когда есть пользователи Bybit
+        from pybit.unified_trading import HTTP
         self.session = HTTP(
             testnet=testnet,
             api_key=api_key,
-            api_secret=secret_key
+            api_secret=secret_key,
+            # Экземпляр живёт один вызов API-функции — таймаут из остатка бюджета сигнала
+            timeout=request_timeout()
         )
+        if EXCHANGE_SIMULATOR_URL:
+            self.session.endpoint = f"{EXCHANGE_SIMULATOR_URL}/bybit"
         self.api_key = api_key
+        self.secret_key = secret_key
+
+    def _place_order(self, **params) -> Dict:
+        """Ордер через WS-сессию аккаунта (ws_trading), при недоступности канала — через REST.
+        После таймаута WS ищем ордер по orderLinkId, чтобы не выставить его дважды."""
+        params.setdefault("orderLinkId", client_order_id())
+        try:
+            response = ws_trading.request("bybit", self.api_key, self.secret_key, None, "order.create", params)
+            return {"retCode": response.get("retCode"), "retMsg": response.get("retMsg"),
+                    "result": response.get("data") or {}}
+        except WSTimeout as e:
+            logger.warning(f"{e}; проверяем ордер {params['orderLinkId']} через REST")
+            order = self._find_order(params["symbol"], params["orderLinkId"])
+            if order is not None:
+                return {"retCode": 0, "retMsg": "OK",
+                        "result": {"orderId": order["orderId"], "orderLinkId": params["orderLinkId"]}}
+        except WSUnavailable as e:
+            logger.info(f"WS Bybit недоступен ({e}), ордер через REST")
+        return self.session.place_order(**params)
+
+    def _find_order(self, symbol: str, order_link_id: str) -> Optional[Dict]:
+        """Ордер по orderLinkId среди открытых, затем в истории; None — биржа такого ордера не знает"""
+        existing = self.session.get_open_orders(category="linear", symbol=symbol, orderLinkId=order_link_id)
+        if existing["retCode"] == 0 and not existing["result"]["list"]:
+            existing = self.session.get_order_history(category="linear", symbol=symbol, orderLinkId=order_link_id)
+        if existing["retCode"] == 0 and existing["result"]["list"]:
+            return existing["result"]["list"][0]
+        return None
+
+    def _place_entry(self, **params) -> Dict:
+        """Вход через _place_order. Обрыв ответа поднимается как NetworkError, отказ — типизированной
+        ошибкой (дубль orderLinkId — DuplicateOrderError): retry_call найдёт дошедший вход по orderLinkId"""
+        try:
+            response = self._place_order(**params)
+        except Exception as e:
+            if is_transient(e) and not isinstance(e, ExchangeError):
+                raise NetworkError("bybit", None, str(e), "Ответ на вход не получен") from e
+            # pybit сам поднимает InvalidRequestError на retCode != 0, код — в status_code
+            if getattr(e, "status_code", None) is not None and not isinstance(e, ExchangeError):
+                raise_for("bybit", e.status_code, getattr(e, "message", str(e)), "Ошибка создания ордера")
+            raise
+        if response["retCode"] != 0:
+            raise_for("bybit", response["retCode"], response["retMsg"], "Ошибка создания ордера")
+        return response
+
+    def list_symbols(self) -> List[str]:
+        """Все линейные USDT-контракты Bybit, с постраничной выборкой"""
+        cached = instrument_cache.get(("symbols", "bybit"))
+        if cached is not None:
+            return cached
+        symbols, cursor = [], None
+        while True:
+            params = {"category": "linear", "limit": 1000}
+            if cursor:
+                params["cursor"] = cursor
+            response = self.session.get_instruments_info(**params)
+            if response["retCode"] != 0:
+                raise_for("bybit", response["retCode"], response["retMsg"], "Ошибка API")
+            symbols += [item["symbol"] for item in response["result"]["list"] if item["symbol"].endswith("USDT")]
+            cursor = response["result"].get("nextPageCursor")
+            if not cursor:
+                break
+        instrument_cache.set(("symbols", "bybit"), symbols)
+        return symbols
 
     def get_symbol_info(self, symbol: str) -> Dict:
+        cached = instrument_cache.get(("bybit", symbol))
+        if cached is not None:
+            return cached
         try:
             response = self.session.get_instruments_info(category="linear", symbol=symbol)
             if response["retCode"] != 0:
-                raise ValueError(f"Ошибка API: {response['retMsg']}")
+                raise_for("bybit", response["retCode"], response["retMsg"], "Ошибка API")
             instrument = response["result"]["list"][0]
-            return {
+            info = {
                 "lotSizeFilter": {
                     "qtyStep": float(instrument["lotSizeFilter"]["qtyStep"]),
                     "minOrderQty": float(instrument["lotSizeFilter"]["minOrderQty"])
@@ -29,6 +110,8 @@ class BybitAPI:
                     "maxLeverage": int(float(instrument["leverageFilter"]["maxLeverage"]))
                 }
             }
+            instrument_cache.set(("bybit", symbol), info)
+            return info
         except Exception as e:
             logger.error(f"Ошибка при получении информации о символе {symbol}: {str(e)}")
             raise
@@ -37,7 +120,7 @@ class BybitAPI:
         try:
             response = self.session.get_tickers(category="linear", symbol=symbol)
             if response["retCode"] != 0:
-                raise ValueError(f"Ошибка API: {response['retMsg']}")
+                raise_for("bybit", response["retCode"], response["retMsg"], "Ошибка API")
             return float(response["result"]["list"][0]["lastPrice"])
         except Exception as e:
             logger.error(f"Ошибка при получении цены для {symbol}: {str(e)}")
@@ -47,7 +130,7 @@ class BybitAPI:
         try:
             response = self.session.get_wallet_balance(accountType="UNIFIED")
             if response["retCode"] != 0:
-                raise ValueError(f"Ошибка API: {response['retMsg']}")
+                raise_for("bybit", response["retCode"], response["retMsg"], "Ошибка API")
             for coin in response["result"]["list"][0]["coin"]:
                 if coin["coin"] == "USDT":
                     return float(coin["availableToWithdraw"])
@@ -56,7 +139,42 @@ class BybitAPI:
             logger.error(f"Ошибка при получении баланса Bybit: {str(e)}")
             raise
 
+    def get_account_profile(self) -> Dict:
+        """Возможности аккаунта для account_profile.probe_account"""
+        key_response = self.session.get_api_key_information()
+        if key_response["retCode"] != 0:
+            raise_for("bybit", key_response["retCode"], key_response["retMsg"], "Ошибка получения прав ключа")
+        key_info = key_response["result"]
+        contract_permissions = (key_info.get("permissions") or {}).get("ContractTrade") or []
+
+        account_response = self.session.get_account_info()
+        if account_response["retCode"] != 0:
+            raise_for("bybit", account_response["retCode"], account_response["retMsg"], "Ошибка получения аккаунта")
+        margin_mode = account_response["result"].get("marginMode")
+
+        # Отдельного запроса режима позиции у Bybit нет: определяем по открытым позициям, если они есть
+        position_mode = None
+        positions_response = self.session.get_positions(category="linear", settleCoin="USDT")
+        if positions_response["retCode"] == 0:
+            indexes = {int(pos.get("positionIdx", 0)) for pos in positions_response["result"]["list"]}
+            if indexes & {1, 2}:
+                position_mode = "hedge"
+            elif indexes:
+                position_mode = "one_way"
+
+        return {
+            "position_mode": position_mode,
+            "margin_mode": margin_mode.lower() if margin_mode else None,
+            "can_trade": int(key_info.get("readOnly", 0)) == 0 and bool(contract_permissions),
+            "futures_enabled": bool(contract_permissions),
+            "balance": self.get_balance(),
+        }
+
     def set_leverage(self, symbol: str, leverage: int = 5, tdMode: str = "isolated") -> bool:
+        cache_key = ("bybit", account_key(self.api_key), symbol, leverage, tdMode)
+        if leverage_cache.get(cache_key):
+            logger.info(f"Плечо {leverage}x для {symbol} уже установлено")
+            return True
         try:
             response = self.session.set_leverage(
                 category="linear",
@@ -68,6 +186,7 @@ class BybitAPI:
                 logger.warning(f"Ошибка установки плеча для {symbol}: {response['retMsg']}")
                 return True  # Продолжаем, если плечо уже установлено
             logger.info(f"Плечо {leverage}x установлено для {symbol}")
+            leverage_cache.set(cache_key, True)
             return True
         except Exception as e:
             logger.error(f"Ошибка при установке плеча для {symbol}: {str(e)}")
@@ -111,32 +230,85 @@ class BybitAPI:
         quantity: float,
         stop_loss: float,
         take_profits: List[Optional[float]],
-        tdMode: str = "isolated"
+        tdMode: str = "isolated",
+        tp_quantities: List[float] = None,
+        position_mode: str = None,
+        client_id: str = None
     ) -> tuple:
         try:
+            # В хедж-режиме Bybit требует positionIdx 1 (long) / 2 (short), в одностороннем — 0
+            position_idx = (1 if side == "BUY" else 2) if position_mode == "hedge" else 0
+
             symbol_info = self.get_symbol_info(symbol)
             qty_step = symbol_info["lotSizeFilter"]["qtyStep"]
             quantity = round(quantity / qty_step) * qty_step
 
             # Создаем основной ордер
-            main_response = self.session.place_order(
+            main_response = self._place_entry(
                 category="linear",
                 symbol=symbol,
                 side=side.capitalize(),
                 orderType="Market",
                 qty=str(quantity),
                 timeInForce="GTC",
-                positionIdx=0  # Хедж-режим, односторонняя позиция
+                positionIdx=position_idx,
+                **({"orderLinkId": client_id} if client_id else {})
             )
-            if main_response["retCode"] != 0:
-                raise ValueError(f"Ошибка создания ордера: {main_response['retMsg']}")
             order_id = main_response["result"]["orderId"]
 
-            algo_orders = []
-            sl_side = "Sell" if side == "BUY" else "Buy"
-            sorted_take_profits = sorted(take_profits) if side == "BUY" else sorted(take_profits, reverse=True)
-            valid_take_profits = [tp for tp in sorted_take_profits if tp is not None]
+            valid_take_profits, algo_order_ids = self._place_protection(
+                symbol, side, quantity, qty_step, stop_loss, take_profits, tp_quantities, position_idx
+            )
+
+            logger.info(f"Основной ордер создан: {order_id}, TP/SL ордера: {algo_order_ids}")
+            position_side = ("long" if side == "BUY" else "short") if position_mode == "hedge" else "net"
+            return main_response, valid_take_profits, order_id, algo_order_ids, position_side
+
+        except Exception as e:
+            logger.error(f"Ошибка при создании основного ордера для {symbol}: {str(e)}")
+            raise
 
+    def recover_main_order(
+        self,
+        symbol: str,
+        side: str,
+        quantity: float,
+        stop_loss: float,
+        take_profits: List[Optional[float]],
+        tdMode: str = "isolated",
+        tp_quantities: List[float] = None,
+        position_mode: str = None,
+        client_id: str = None
+    ) -> Optional[tuple]:
+        """Вход, ответ на который потерян: ищет ордер по orderLinkId и ставит к нему SL/TP,
+        возвращая то же, что create_main_order. None — биржа такого ордера не знает"""
+        if not client_id:
+            return None
+        order = self._find_order(symbol, client_id)
+        if order is None:
+            return None
+        order_id = order["orderId"]
+        logger.info(f"Вход {client_id} для {symbol} уже на бирже: {order_id}")
+
+        position_idx = int(order.get("positionIdx") or 0)
+        qty_step = self.get_symbol_info(symbol)["lotSizeFilter"]["qtyStep"]
+        valid_take_profits, algo_order_ids = self._place_protection(
+            symbol, side, float(order["qty"]), qty_step, stop_loss, take_profits, tp_quantities, position_idx
+        )
+        main_response = {"retCode": 0, "retMsg": "OK", "result": {"orderId": order_id, "orderLinkId": client_id}}
+        position_side = ("long" if side == "BUY" else "short") if position_mode == "hedge" else "net"
+        return main_response, valid_take_profits, order_id, algo_order_ids, position_side
+
+    def _place_protection(self, symbol: str, side: str, quantity: float, qty_step: float, stop_loss: float,
+                          take_profits: List[Optional[float]], tp_quantities: Optional[List[float]],
+                          position_idx: int) -> tuple:
+        """SL и TP к принятому входу. Сбой одной ноги не отменяет остальные: вход уже на бирже"""
+        sl_side = "Sell" if side == "BUY" else "Buy"
+        sorted_take_profits = sorted(take_profits) if side == "BUY" else sorted(take_profits, reverse=True)
+        valid_take_profits = [tp for tp in sorted_take_profits if tp is not None]
+
+        # Если объёмы TP не посчитаны заранее sizing.size_cohort
+        if tp_quantities is None:
             total_lots = int(quantity / qty_step)
             tp_lots_base = total_lots // 3
             tp_lots_remainder = total_lots % 3
@@ -151,7 +323,8 @@ class BybitAPI:
                 correction = quantity - total_tp_size
                 tp_quantities[-1] = tp_quantities[-1] + correction
 
-            algo_orders.append(self.session.place_order(
+        try:
+            self._place_order(
                 category="linear",
                 symbol=symbol,
                 side=sl_side,
@@ -159,40 +332,40 @@ class BybitAPI:
                 qty=str(quantity),
                 stopLoss=str(round(stop_loss, 4)),
                 timeInForce="GTC",
-                positionIdx=0,
+                positionIdx=position_idx,
                 triggerDirection=1 if side == "BUY" else 2
-            ))
-
-            algo_order_ids = [order_id]
-            for tp_price, tp_qty in zip(valid_take_profits, tp_quantities):
-                if tp_price is not None:
-                    tp_response = self.session.place_order(
-                        category="linear",
-                        symbol=symbol,
-                        side=sl_side,
-                        orderType="Limit",
-                        qty=str(tp_qty),
-                        price=str(round(tp_price, 4)),
-                        timeInForce="GTC",
-                        positionIdx=0
-                    )
-                    if tp_response["retCode"] != 0:
-                        logger.error(f"Ошибка создания TP ордера: {tp_response['retMsg']}")
-                        continue
-                    algo_order_ids.append(tp_response["result"]["orderId"])
-
-            logger.info(f"Основной ордер создан: {order_id}, TP/SL ордера: {algo_order_ids[1:]}")
-            return main_response, valid_take_profits, order_id, algo_order_ids[1:], "net"
-
+            )
         except Exception as e:
-            logger.error(f"Ошибка при создании основного ордера для {symbol}: {str(e)}")
-            raise
+            logger.error(f"Ошибка создания SL ордера: {e}")
+
+        algo_order_ids = []
+        for tp_price, tp_qty in zip(valid_take_profits, tp_quantities):
+            try:
+                tp_response = self._place_order(
+                    category="linear",
+                    symbol=symbol,
+                    side=sl_side,
+                    orderType="Limit",
+                    qty=str(tp_qty),
+                    price=str(round(tp_price, 4)),
+                    timeInForce="GTC",
+                    positionIdx=position_idx
+                )
+            except Exception as e:
+                logger.error(f"Ошибка создания TP ордера: {e}")
+                continue
+            if tp_response["retCode"] != 0:
+                logger.error(f"Ошибка создания TP ордера: {tp_response['retMsg']}")
+                continue
+            algo_order_ids.append(tp_response["result"]["orderId"])
+
+        return valid_take_profits, algo_order_ids
 
     def get_order_status(self, symbol: str, order_id: str) -> Dict:
         try:
             response = self.session.get_order_history(category="linear", symbol=symbol, orderId=order_id)
             if response["retCode"] != 0:
-                raise ValueError(f"Ошибка API: {response['retMsg']}")
+                raise_for("bybit", response["retCode"], response["retMsg"], "Ошибка API")
             return response["result"]["list"][0]
         except Exception as e:
             logger.error(f"Ошибка при получении статуса ордера {order_id} для {symbol}: {str(e)}")
@@ -202,20 +375,20 @@ class BybitAPI:
         try:
             response = self.session.get_positions(category="linear", symbol=symbol)
             if response["retCode"] != 0:
-                raise ValueError(f"Ошибка API: {response['retMsg']}")
+                raise_for("bybit", response["retCode"], response["retMsg"], "Ошибка API")
             positions = response["result"]["list"]
             for pos in positions:
                 qty = float(pos["size"])
                 side = "Sell" if pos["side"] == "Buy" else "Buy"
                 if qty > 0:
-                    self.session.place_order(
+                    self._place_order(
                         category="linear",
                         symbol=symbol,
                         side=side,
                         orderType="Market",
                         qty=str(qty),
                         timeInForce="GTC",
-                        positionIdx=0
+                        positionIdx=int(pos.get("positionIdx", 0))
                     )
                     logger.info(f"Позиция для {symbol} закрыта")
             return True
@@ -225,20 +398,98 @@ class BybitAPI:
 
     def cancel_order(self, symbol: str, order_id: str) -> bool:
         try:
-            response = self.session.cancel_order(category="linear", symbol=symbol, orderId=order_id)
+            params = {"category": "linear", "symbol": symbol, "orderId": order_id}
+            try:
+                response = ws_trading.request("bybit", self.api_key, self.secret_key, None, "order.cancel", params)
+            except WSUnavailable as e:
+                logger.info(f"WS Bybit недоступен ({e}), отмена через REST")
+                response = self.session.cancel_order(**params)
             if response["retCode"] != 0:
-                raise ValueError(f"Ошибка API: {response['retMsg']}")
+                raise_for("bybit", response["retCode"], response["retMsg"], "Ошибка API")
             logger.info(f"Ордер {order_id} для {symbol} отменён")
             return True
         except Exception as e:
             logger.error(f"Ошибка при отмене ордера {order_id} для {symbol}: {str(e)}")
             raise
 
-    def move_sl_to_breakeven(self, symbol: str) -> bool:
+    def amend_order(self, symbol: str, order_id: str, new_size: float = None, new_price: float = None) -> bool:
+        params = {"category": "linear", "symbol": symbol, "orderId": order_id}
+        if new_size is not None:
+            params["qty"] = str(new_size)
+        if new_price is not None:
+            params["price"] = str(new_price)
+        try:
+            try:
+                response = ws_trading.request("bybit", self.api_key, self.secret_key, None, "order.amend", params)
+            except WSUnavailable as e:
+                # Повтор изменения безопасен: биржа применит те же значения
+                logger.info(f"WS Bybit недоступен ({e}), изменение ордера через REST")
+                response = self.session.amend_order(**params)
+            if response["retCode"] != 0:
+                raise_for("bybit", response["retCode"], response["retMsg"], "Ошибка API")
+            logger.info(f"Ордер {order_id} для {symbol} изменён: {params}")
+            return True
+        except Exception as e:
+            logger.error(f"Ошибка при изменении ордера {order_id} для {symbol}: {str(e)}")
+            raise
+
+    def _paged(self, method, **params) -> List[Dict]:
+        items, cursor = [], None
+        while True:
+            response = method(category="linear", limit=50, **params, **({"cursor": cursor} if cursor else {}))
+            if response["retCode"] != 0:
+                raise_for("bybit", response["retCode"], response["retMsg"], "Ошибка API")
+            items += response["result"]["list"]
+            cursor = response["result"].get("nextPageCursor")
+            if not cursor or not response["result"]["list"]:
+                return items
+
+    def get_live_state(self, symbols: list = (), since_ms: int = None) -> Dict:
+        """Позиции, живые ордера и ордера, исполненные с since_ms, по всему аккаунту (для reconciler.py)"""
+        now_ms = int(time.time() * 1000)
+        positions = {}
+        for position in self._paged(self.session.get_positions, settleCoin="USDT"):
+            size = float(position.get("size") or 0)
+            if size:
+                positions[(position["symbol"], "long" if position["side"] == "Buy" else "short")] = size
+        live = {order["orderId"] for order in self._paged(self.session.get_open_orders, settleCoin="USDT")}
+        history = self._paged(self.session.get_order_history,
+                              startTime=since_ms or now_ms - 24 * 3600 * 1000, endTime=now_ms)
+        filled = {order["orderId"] for order in history if order.get("orderStatus") == "Filled"}
+        return {"positions": positions, "live_order_ids": live, "filled_order_ids": filled, "cursor": now_ms}
+
+    def flatten(self, symbols: list = None) -> Dict:
+        """Отменяет все ордера и закрывает все позиции по symbols (None — по всему аккаунту). Для flatten.py"""
+        canceled = 0
+        for params in ([{"symbol": symbol} for symbol in symbols] if symbols else [{"settleCoin": "USDT"}]):
+            response = self.session.cancel_all_orders(category="linear", **params)
+            if response["retCode"] != 0:
+                raise_for("bybit", response["retCode"], response["retMsg"], "Ошибка отмены ордеров")
+            canceled += len(response["result"]["list"])
+
+        closed = []
+        for position in self._paged(self.session.get_positions, settleCoin="USDT"):
+            if not float(position.get("size") or 0) or (symbols and position["symbol"] not in symbols):
+                continue
+            response = self._place_order(
+                category="linear",
+                symbol=position["symbol"],
+                side="Sell" if position["side"] == "Buy" else "Buy",
+                orderType="Market",
+                qty=position["size"],
+                reduceOnly=True,
+                positionIdx=int(position.get("positionIdx", 0))
+            )
+            if response["retCode"] != 0:
+                raise_for("bybit", response["retCode"], response["retMsg"], "Ошибка закрытия позиции")
+            closed.append(f"{position['symbol']} {'long' if position['side'] == 'Buy' else 'short'}")
+        return {"canceled": canceled, "closed": closed}
+
+    def move_sl_to_breakeven(self, symbol: str, user_id: int = None) -> bool:
         try:
             response = self.session.get_positions(category="linear", symbol=symbol)
             if response["retCode"] != 0:
-                raise ValueError(f"Ошибка API: {response['retMsg']}")
+                raise_for("bybit", response["retCode"], response["retMsg"], "Ошибка API")
             positions = response["result"]["list"]
 
             for position in positions:
@@ -249,7 +500,7 @@ class BybitAPI:
                 if qty > 0 and avg_price > 0:
                     orders_response = self.session.get_open_orders(category="linear", symbol=symbol)
                     if orders_response["retCode"] != 0:
-                        raise ValueError(f"Ошибка API: {orders_response['retMsg']}")
+                        raise_for("bybit", orders_response["retCode"], orders_response["retMsg"], "Ошибка API")
                     sl_orders = [order for order in orders_response["result"]["list"]
                                  if order.get("stopLoss")]
 
@@ -257,7 +508,7 @@ class BybitAPI:
                         self.cancel_order(symbol, order["orderId"])
 
                     new_sl_price = avg_price * (0.999 if side == "Buy" else 1.001)
-                    sl_response = self.session.place_order(
+                    sl_response = self._place_order(
                         category="linear",
                         symbol=symbol,
                         side="Sell" if side == "Buy" else "Buy",
@@ -265,24 +516,24 @@ class BybitAPI:
                         qty=str(qty),
                         stopLoss=str(round(new_sl_price, 4)),
                         timeInForce="GTC",
-                        positionIdx=0,
+                        positionIdx=int(position.get("positionIdx", 0)),
                         triggerDirection=1 if side == "Buy" else 2
                     )
                     if sl_response["retCode"] != 0:
-                        raise ValueError(f"Ошибка создания SL: {sl_response['retMsg']}")
+                        raise_for("bybit", sl_response["retCode"], sl_response["retMsg"], "Ошибка создания SL")
                     new_sl_order_id = sl_response["result"]["orderId"]
 
-                    cursor = get_cursor()
-                    cursor.execute(
-                        """
-                        UPDATE trades 
-                        SET stop_loss = %s, sl_order_id = %s 
-                        WHERE user_id = (SELECT user_id FROM users WHERE api_key = %s) 
-                        AND symbol = %s AND status = 'open'
-                        """,
-                        (new_sl_price, new_sl_order_id, self.api_key, symbol)
-                    )
-                    commit()
+                    # Своё соединение из пула: вызов идёт из потока отсека
+                    with transaction() as cursor:
+                        cursor.execute(
+                            """
+                            UPDATE trades 
+                            SET stop_loss = %s, sl_order_id = %s 
+                            WHERE user_id = COALESCE(%s, (SELECT user_id FROM users WHERE api_key = %s))
+                            AND symbol = %s AND status = 'open' AND tier = 'hot'
+                            """,
+                            (new_sl_price, new_sl_order_id, user_id, self.api_key, symbol)
+                        )
                     logger.info(f"SL перемещён к {new_sl_price} для {symbol}")
                     return True
 
@@ -292,6 +543,10 @@ class BybitAPI:
             logger.error(f"Ошибка при перемещении SL для {symbol} на Bybit: {str(e)}")
             raise
 
+def list_symbols() -> List[str]:
+    # Публичный эндпоинт, ключи не нужны
+    return BybitAPI(None, None).list_symbols()
+
 def get_symbol_info(symbol: str, api_key: str, secret_key: str, passphrase: str = None) -> Dict:
     return BybitAPI(api_key, secret_key).get_symbol_info(symbol)
 
@@ -301,6 +556,9 @@ def get_current_price(symbol: str, api_key: str, secret_key: str, passphrase: st
 def get_balance(api_key: str, secret_key: str, passphrase: str = None) -> float:
     return BybitAPI(api_key, secret_key).get_balance()
 
+def get_account_profile(api_key: str, secret_key: str, passphrase: str = None) -> Dict:
+    return BybitAPI(api_key, secret_key).get_account_profile()
+
 def set_leverage(symbol: str, leverage: int = 5, tdMode: str = "isolated", api_key: str = None,
                  secret_key: str = None, passphrase: str = None) -> bool:
     return BybitAPI(api_key, secret_key).set_leverage(symbol, leverage, tdMode)
@@ -310,8 +568,16 @@ def calculate_quantity(symbol: str, leverage: int = 5, risk_percent: float = 0.0
     return BybitAPI(api_key, secret_key).calculate_quantity(symbol, leverage, risk_percent)
 
 def create_main_order(symbol: str, side: str, quantity: float, stop_loss: float, take_profits: List[Optional[float]],
-                     tdMode: str = "isolated", api_key: str = None, secret_key: str = None, passphrase: str = None):
-    return BybitAPI(api_key, secret_key).create_main_order(symbol, side, quantity, stop_loss, take_profits, tdMode)
+                     tdMode: str = "isolated", api_key: str = None, secret_key: str = None, passphrase: str = None,
+                     tp_quantities: List[float] = None, position_mode: str = None, client_id: str = None):
+    return BybitAPI(api_key, secret_key).create_main_order(symbol, side, quantity, stop_loss, take_profits, tdMode,
+                                                           tp_quantities, position_mode, client_id)
+
+def recover_main_order(symbol: str, side: str, quantity: float, stop_loss: float, take_profits: List[Optional[float]],
+                       tdMode: str = "isolated", api_key: str = None, secret_key: str = None, passphrase: str = None,
+                       tp_quantities: List[float] = None, position_mode: str = None, client_id: str = None):
+    return BybitAPI(api_key, secret_key).recover_main_order(symbol, side, quantity, stop_loss, take_profits, tdMode,
+                                                            tp_quantities, position_mode, client_id)
 
 def get_order_status(symbol: str, order_id: str, api_key: str, secret_key: str, passphrase: str = None) -> Dict:
     return BybitAPI(api_key, secret_key).get_order_status(symbol, order_id)
@@ -322,5 +588,17 @@ def close_position(symbol: str, posSide: str, api_key: str, secret_key: str, pas
 def cancel_order(symbol: str, order_id: str, api_key: str, secret_key: str, passphrase: str = None) -> bool:
     return BybitAPI(api_key, secret_key).cancel_order(symbol, order_id)
 
-def move_sl_to_breakeven(symbol: str, api_key: str, secret_key: str, passphrase: str = None) -> bool:
-    return BybitAPI(api_key, secret_key).move_sl_to_breakeven(symbol)
\ No newline at end of file
+def amend_order(symbol: str, order_id: str, api_key: str, secret_key: str, passphrase: str = None,
+                new_size: float = None, new_price: float = None) -> bool:
+    return BybitAPI(api_key, secret_key).amend_order(symbol, order_id, new_size, new_price)
+
+def get_live_state(api_key: str, secret_key: str, passphrase: str = None, symbols: list = (),
+                   since_ms: int = None) -> Dict:
+    return BybitAPI(api_key, secret_key).get_live_state(symbols, since_ms)
+
+def flatten(api_key: str, secret_key: str, passphrase: str = None, symbols: list = None) -> Dict:
+    return BybitAPI(api_key, secret_key).flatten(symbols)
+
+def move_sl_to_breakeven(symbol: str, api_key: str, secret_key: str, passphrase: str = None,
+                         user_id: int = None) -> bool:
+    return BybitAPI(api_key, secret_key).move_sl_to_breakeven(symbol, user_id)
\ No newline at end of file
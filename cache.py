@@ -0,0 +1,101 @@
+# cache.py
+import hashlib
+import logging
+import os
+import threading
+import time
+from typing import Any, Dict, Hashable, Optional
+
+logger = logging.getLogger(__name__)
+
+INSTRUMENT_CACHE_TTL = float(os.getenv("INSTRUMENT_CACHE_TTL", "3600"))
+LEVERAGE_CACHE_TTL = float(os.getenv("LEVERAGE_CACHE_TTL", "3600"))
+CLOCK_OFFSET_CACHE_TTL = float(os.getenv("CLOCK_OFFSET_CACHE_TTL", "600"))
+SUBSCRIBERS_CACHE_TTL = float(os.getenv("SUBSCRIBERS_CACHE_TTL", "30"))
+PRICE_CACHE_TTL = float(os.getenv("PRICE_CACHE_TTL", "2"))
+
+
+class TTLCache:
+    """Словарь с временем жизни записей.
+
+    Срок хранится в wall-clock (time.time()), чтобы записи можно было сохранить
+    в снимок warm_state и после перезапуска проверить, не устарели ли они.
+    """
+
+    def __init__(self, name: str, ttl: float, persistent: bool = True):
+        self.name = name
+        self.ttl = ttl
+        # persistent=False — кэш не попадает в снимок на диске (например, содержит ключи API)
+        self.persistent = persistent
+        self._lock = threading.Lock()
+        self._data: Dict[Hashable, tuple] = {}
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key: Hashable) -> Optional[Any]:
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None or entry[0] <= time.time():
+                self._data.pop(key, None)
+                self.misses += 1
+                return None
+            self.hits += 1
+            return entry[1]
+
+    def set(self, key: Hashable, value: Any, ttl: float = None) -> None:
+        with self._lock:
+            self._data[key] = (time.time() + (self.ttl if ttl is None else ttl), value)
+
+    def invalidate(self, key: Hashable = None) -> None:
+        with self._lock:
+            if key is None:
+                self._data.clear()
+            else:
+                self._data.pop(key, None)
+
+    def dump(self) -> Dict[Hashable, tuple]:
+        """Непросроченные записи в виде {key: (expires_at, value)}"""
+        now = time.time()
+        with self._lock:
+            return {key: entry for key, entry in self._data.items() if entry[0] > now}
+
+    def load(self, entries: Dict[Hashable, tuple]) -> int:
+        """Загружает записи из снимка, пропуская просроченные; возвращает число загруженных"""
+        now = time.time()
+        loaded = 0
+        with self._lock:
+            for key, (expires_at, value) in entries.items():
+                if expires_at > now:
+                    self._data[key] = (expires_at, value)
+                    loaded += 1
+        return loaded
+
+    def __len__(self) -> int:
+        with self._lock:
+            return len(self._data)
+
+
+CACHES: Dict[str, TTLCache] = {}
+
+
+def account_key(api_key: str) -> str:
+    """Ключ аккаунта для кэшей, которые попадают в снимок: сам api_key на диск не пишем"""
+    return hashlib.sha256((api_key or "").encode()).hexdigest()[:16]
+
+
+def get_cache(name: str, ttl: float, persistent: bool = True) -> TTLCache:
+    if name not in CACHES:
+        CACHES[name] = TTLCache(name, ttl, persistent)
+    return CACHES[name]
+
+
+# Метаданные инструментов (шаг лота, минимальный объём) по (биржа, символ)
+instrument_cache = get_cache("instruments", INSTRUMENT_CACHE_TTL)
+# Плечо, уже выставленное на бирже, по (биржа, account_key, символ, плечо, сторона)
+leverage_cache = get_cache("leverage", LEVERAGE_CACHE_TTL)
+# Смещение часов биржи относительно локальных, мс
+clock_offset_cache = get_cache("clock_offsets", CLOCK_OFFSET_CACHE_TTL)
+# Список подписчиков с секретами: в снимок не пишется, прогревается запросом к БД
+subscribers_cache = get_cache("subscribers", SUBSCRIBERS_CACHE_TTL, persistent=False)
+# Последняя цена по (биржа, символ) для проверки ухода цены от сигнала во время рассылки
+price_cache = get_cache("prices", PRICE_CACHE_TTL, persistent=False)
@@ -0,0 +1,96 @@
+# coalescer.py
+import asyncio
+import logging
+import os
+from collections import defaultdict
+from typing import Awaitable, Callable, Dict, List
+
+from models import Signal
+
+logger = logging.getLogger(__name__)
+
+# Окно склейки сигналов по символу, секунды; 0 — сигналы не ждут окна, но рассылки по символу по-прежнему идут по очереди
+SIGNAL_COALESCE_WINDOW = float(os.getenv("SIGNAL_COALESCE_WINDOW", "0.3"))
+
+
+def merge_signals(signals: List[Signal]) -> List[List[Signal]]:
+    """Пачка сигналов -> группы в порядке прихода: первый сигнал группы рассылается, остальные — его точные
+    повторы подряд (TradingView повторяет алерт при сбое доставки). Разные сигналы не вытесняют друг друга:
+    каждый вход открывает свою позицию, и выбросить его значило бы потерять сделку."""
+    groups = []
+    for signal in signals:
+        if groups and signal == groups[-1][0]:
+            groups[-1].append(signal)
+        else:
+            groups.append([signal])
+    return groups
+
+
+class SignalCoalescer:
+    """Упорядочивает и склеивает всплески сигналов по одному символу перед рассылкой.
+
+    Первый сигнал символа открывает окно; всё, что пришло за окно (и пока по символу
+    идёт предыдущая рассылка), рассылается одной пачкой по порядку прихода, а точные
+    повторы — один раз. MOVE_SL не ждёт окна, но при открытой пачке или идущей рассылке
+    встаёт за ними: перенос SL не должен обогнать вход, позицию которого он двигает.
+    """
+
+    def __init__(self, window: float = SIGNAL_COALESCE_WINDOW):
+        self.window = window
+        self._bursts: Dict[str, List[Dict]] = {}
+        # Рассылки по одному символу не пересекаются
+        self._locks: Dict[str, asyncio.Lock] = defaultdict(asyncio.Lock)
+
+    async def submit(self, signal: Signal, dispatch: Callable[[Signal], Awaitable[Dict]]) -> Dict:
+        """Добавляет сигнал в очередь символа и ждёт его рассылки.
+
+        Вызвавший с разосланным сигналом получает результат dispatch, повтор —
+        ответ со status=superseded и signal_id рассылки оригинала.
+        """
+        key = signal.symbol.upper()
+        burst = self._bursts.get(key)
+        if burst is None and (self.window <= 0 or signal.action == "MOVE_SL"):
+            async with self._locks[key]:
+                return await dispatch(signal)
+
+        item = {"signal": signal, "dispatch": dispatch, "future": asyncio.get_running_loop().create_future()}
+        if burst is None:
+            burst = self._bursts[key] = []
+            asyncio.create_task(self._flush(key, burst))
+        burst.append(item)
+        return await asyncio.shield(item["future"])
+
+    @staticmethod
+    def _superseded(signal: Signal, signal_id) -> Dict:
+        return {
+            "status": "superseded",
+            "message": "Сигнал повторяет уже разосланный сигнал по тому же символу",
+            "symbol": signal.symbol,
+            "superseded_by": signal_id,
+        }
+
+    async def _flush(self, key: str, burst: List[Dict]) -> None:
+        await asyncio.sleep(self.window)
+        async with self._locks[key]:
+            # Сигналы, пришедшие с этого момента, откроют следующую пачку
+            self._bursts.pop(key, None)
+            items = {id(item["signal"]): item for item in burst}
+            groups = merge_signals([item["signal"] for item in burst])
+            if len(groups) < len(burst):
+                logger.info(f"Склеено {len(burst)} сигналов по {key}: "
+                            f"{' → '.join(item['signal'].action for item in burst)} ⇒ "
+                            f"{' → '.join(group[0].action for group in groups)}")
+            for group in groups:
+                first = items[id(group[0])]
+                try:
+                    result = await first["dispatch"](group[0])
+                except Exception as e:
+                    first["future"].set_exception(e)
+                    result = {}
+                else:
+                    first["future"].set_result({**result, "coalesced": len(group)} if len(group) > 1 else result)
+                for duplicate in group[1:]:
+                    items[id(duplicate)]["future"].set_result(self._superseded(duplicate, result.get("signal_id")))
+
+
+signal_coalescer = SignalCoalescer()
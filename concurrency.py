@@ -0,0 +1,186 @@
+# concurrency.py
+import asyncio
+import logging
+import os
+import time
+from collections import deque
+from contextlib import asynccontextmanager
+from typing import Dict, Optional
+
+import requests
+
+from exchange_errors import ExchangeError, NetworkError, RateLimitError, ServerError
+from metrics import percentile
+
+logger = logging.getLogger(__name__)
+
+# Как часто пересматривается лимит, с
+AIMD_INTERVAL = float(os.getenv("AIMD_INTERVAL", "1"))
+# Во сколько раз лимит падает при rate limit, росте p99 или всплеске ошибок
+AIMD_BACKOFF = float(os.getenv("AIMD_BACKOFF", "0.5"))
+AIMD_MAX_CONCURRENCY = int(os.getenv("AIMD_MAX_CONCURRENCY", "64"))
+# p99 за интервал выше базового во столько раз — биржа перегружена
+AIMD_P99_TOLERANCE = float(os.getenv("AIMD_P99_TOLERANCE", "2"))
+# Доля временных сбоев (5xx, обрывы) за интервал, при которой лимит снижается
+AIMD_ERROR_RATE = float(os.getenv("AIMD_ERROR_RATE", "0.2"))
+# Меньше замеров за интервал — p99 и доле ошибок не доверяем
+AIMD_MIN_SAMPLES = 5
+
+RATE_LIMIT_TEXT = ("429", "too many requests", "rate limit")
+
+
+def is_rate_limited(error: Optional[Exception]) -> bool:
+    if error is None:
+        return False
+    if isinstance(error, ExchangeError):
+        return isinstance(error, RateLimitError)
+    # Исключения SDK бирж без типизации (exchange_errors.py) — по тексту
+    text = str(error).lower()
+    return any(fragment in text for fragment in RATE_LIMIT_TEXT)
+
+
+# Таймауты и обрывы соединения клиентов SDK, не разобранные в exchange_errors.py
+TRANSIENT_ERRORS = (
+    NetworkError, ServerError, TimeoutError, asyncio.TimeoutError, ConnectionError,
+    requests.exceptions.Timeout, requests.exceptions.ConnectionError,
+)
+try:
+    # httpx — клиент SDK OKX; без него OKX недоступен, и его ошибок не будет
+    import httpx
+    TRANSIENT_ERRORS += (httpx.TimeoutException, httpx.NetworkError)
+except ImportError:
+    pass
+
+
+def is_transient(error: Optional[Exception]) -> bool:
+    """Сбой, говорящий о здоровье биржи: 5xx, таймаут, обрыв соединения. Отказы по конкретному
+    запросу (нет средств, нет ордера) и неизвестные исключения — ошибки кода — не считаются"""
+    return isinstance(error, TRANSIENT_ERRORS)
+
+
+class AIMDController:
+    """Адаптивный лимит одновременных запросов к группе эндпоинтов одной биржи.
+
+    Пока задержки и доля ошибок в норме, а лимит выбирается целиком, он растёт на 1
+    за интервал; на rate limit, рост p99 выше базового или всплеск сбоев — падает
+    в AIMD_BACKOFF раз. Базовый p99 — лучший наблюдавшийся, медленно подтягивается вверх.
+    """
+
+    def __init__(self, name: str, initial: int, minimum: int = 1, maximum: int = AIMD_MAX_CONCURRENCY):
+        self.name = name
+        self.minimum = minimum
+        self.maximum = max(minimum, maximum)
+        self.limit = float(min(max(initial, minimum), self.maximum))
+        self.in_flight = 0
+        self.peak_in_flight = 0
+        self.baseline_p99: Optional[float] = None
+        self.last_p99: Optional[float] = None
+        self.increases = 0
+        self.decreases = 0
+        self.rate_limited = 0
+        self._waiters: deque = deque()
+        self._samples: list = []
+        self._errors = 0
+        self._throttled = False
+        self._adjusted_at = time.monotonic()
+
+    @property
+    def current(self) -> int:
+        return max(self.minimum, int(self.limit))
+
+    async def acquire(self) -> None:
+        while self._waiters or self.in_flight >= self.current:
+            waiter = asyncio.get_running_loop().create_future()
+            self._waiters.append(waiter)
+            try:
+                await waiter
+            except asyncio.CancelledError:
+                if waiter.done() and not waiter.cancelled():
+                    # Пробуждение досталось отменённой задаче — передаём его следующей
+                    self._wake()
+                elif waiter in self._waiters:
+                    self._waiters.remove(waiter)
+                raise
+            if self.in_flight < self.current:
+                break
+        self.in_flight += 1
+        self.peak_in_flight = max(self.peak_in_flight, self.in_flight)
+
+    def release(self) -> None:
+        self.in_flight -= 1
+        self._wake()
+
+    def _wake(self) -> None:
+        free = self.current - self.in_flight
+        while free > 0 and self._waiters:
+            waiter = self._waiters.popleft()
+            if not waiter.done():
+                waiter.set_result(None)
+                free -= 1
+
+    @asynccontextmanager
+    async def slot(self):
+        await self.acquire()
+        try:
+            yield
+        finally:
+            self.release()
+
+    def observe(self, seconds: float, error: Optional[Exception] = None) -> None:
+        """Итог одного запроса группы: длительность и ошибка, если была"""
+        if is_rate_limited(error):
+            self.rate_limited += 1
+            # Волна 429 от одной пачки запросов снижает лимит один раз за интервал
+            if not self._throttled:
+                self._throttled = True
+                self._decrease("rate limit")
+        else:
+            self._samples.append(seconds)
+            if is_transient(error):
+                self._errors += 1
+        if time.monotonic() - self._adjusted_at >= AIMD_INTERVAL:
+            self._adjust()
+
+    def _adjust(self) -> None:
+        samples, errors, throttled = sorted(self._samples), self._errors, self._throttled
+        saturated = self.peak_in_flight >= self.current
+        self._samples, self._errors, self._throttled = [], 0, False
+        self.peak_in_flight = self.in_flight
+        self._adjusted_at = time.monotonic()
+        if throttled or len(samples) < AIMD_MIN_SAMPLES:
+            return
+
+        p99 = percentile(samples, 0.99)
+        self.last_p99 = p99
+        if errors / len(samples) >= AIMD_ERROR_RATE:
+            self._decrease(f"сбоев {errors} из {len(samples)}")
+        elif self.baseline_p99 and p99 > self.baseline_p99 * AIMD_P99_TOLERANCE:
+            self._decrease(f"p99 {p99 * 1000:.0f} мс при базовом {self.baseline_p99 * 1000:.0f} мс")
+        elif saturated and self.limit < self.maximum:
+            self.limit = min(self.maximum, self.limit + 1)
+            self.increases += 1
+            self._wake()
+
+        if self.baseline_p99 is None or p99 < self.baseline_p99:
+            self.baseline_p99 = p99
+        else:
+            self.baseline_p99 += (p99 - self.baseline_p99) * 0.05
+
+    def _decrease(self, reason: str) -> None:
+        previous = self.current
+        self.limit = max(float(self.minimum), self.limit * AIMD_BACKOFF)
+        self.decreases += 1
+        if self.current < previous:
+            logger.warning(f"Лимит {self.name}: {previous} → {self.current} ({reason})")
+
+    def stats(self) -> Dict:
+        return {
+            "limit": self.current,
+            "in_flight": self.in_flight,
+            "waiting": len(self._waiters),
+            "p99_ms": round(self.last_p99 * 1000, 3) if self.last_p99 is not None else None,
+            "baseline_p99_ms": round(self.baseline_p99 * 1000, 3) if self.baseline_p99 is not None else None,
+            "increases": self.increases,
+            "decreases": self.decreases,
+            "rate_limited": self.rate_limited,
+        }
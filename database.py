@@ -1,8 +1,13 @@
 import psycopg2
 from psycopg2.extras import RealDictCursor
+from psycopg2.pool import ThreadedConnectionPool
 from dotenv import load_dotenv
 import os
 import logging
+import threading
+from contextlib import contextmanager
+from migrations import run_migrations
+from cache import subscribers_cache
 
 logger = logging.getLogger(__name__)
 load_dotenv()
@@ -11,61 +16,142 @@ DB_NAME = os.getenv("DB_NAME")
 DB_USER = os.getenv("DB_USER")
 DB_PASSWORD = os.getenv("DB_PASSWORD")
 DB_PORT = os.getenv("DB_PORT")
+# Предел одного запроса к БД, с: зависший запрос не должен держать рассылку сигнала
+DB_STATEMENT_TIMEOUT = float(os.getenv("DB_STATEMENT_TIMEOUT", "10"))
+# Соединений в пуле transaction(): записи из потоков отсеков бирж и фоновых задач
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", "8"))
 
 conn = None
 cursor = None
+pool = None
+_pool_lock = threading.Lock()
+_pool_slots = threading.BoundedSemaphore(DB_POOL_SIZE)
+
+# Профиль аккаунта берётся, только если снят для текущей биржи пользователя
+ACTIVE_USERS_QUERY = """
+    SELECT u.user_id, u.api_key, u.secret_key, u.passphrase, u.exchange, u.subscription_end,
+           u.key_status, u.key_failures, u.priority_tier, p.position_mode, p.margin_mode
+    FROM users u
+    LEFT JOIN account_profiles p ON p.user_id = u.user_id AND p.exchange = u.exchange
+    WHERE u.subscription_end > %s
+      AND u.api_key IS NOT NULL
+      AND u.secret_key IS NOT NULL
+      AND u.subscription_type IN ('referral_approved', 'regular')
+"""
 
 def init_db():
     global conn, cursor
     try:
-        conn=psycopg2.connect(
-            host=DB_HOST,
-            port=DB_PORT,
-            database=DB_NAME,
-            user=DB_USER,
-            password=DB_PASSWORD,
-            cursor_factory=RealDictCursor
-        )
+        conn = connect()
         cursor = conn.cursor()
         logger.info("DataBase connected")
 
-        cursor.execute("""
-                CREATE TABLE IF NOT EXISTS trades (
-                    trade_id SERIAL PRIMARY KEY,
-                    user_id BIGINT NOT NULL,
-                    exchange VARCHAR(20) NOT NULL,
-                    order_id VARCHAR(255) NOT NULL,
-                    symbol TEXT NOT NULL,
-                    side TEXT NOT NULL,
-                    position_side TEXT NOT NULL,
-                    quantity REAL NOT NULL,
-                    entry_price REAL NOT NULL,
-                    stop_loss REAL,
-                    take_profit_1 REAL,
-                    take_profit_2 REAL,
-                    take_profit_3 REAL,
-                    sl_order_id VARCHAR(255),
-                    tp1_order_id VARCHAR(255),
-                    tp2_order_id VARCHAR(255),
-                    tp3_order_id VARCHAR(255),
-                    status TEXT NOT NULL,
-                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                    FOREIGN KEY (user_id) REFERENCES users (user_id) ON DELETE CASCADE
-                )
-                """)
-        conn.commit()
+        # Миграции (CREATE INDEX, ожидание advisory lock) идут дольше обычного запроса
+        set_statement_timeout(conn, 0)
+        schema_version = run_migrations(conn)
+        set_statement_timeout(conn, DB_STATEMENT_TIMEOUT)
+        logger.info(f"Схема БД актуальна, версия {schema_version}")
     except Exception as e:
         logger.error(f"DataBase connection failed: {e}")
         raise
 
+def get_active_users(now, shard: int = None, shards: int = None) -> list:
+    """Подписчики с ключами; при shards — только доля шарда user_id % shards = shard"""
+    cache_key = (shard, shards) if shards and shards > 1 else None
+    cached = subscribers_cache.get(cache_key)
+    if cached is not None:
+        # Кэш живёт секунды, но подписка могла истечь внутри этого окна
+        return [user for user in cached if user["subscription_end"] > now]
+    if cache_key:
+        cursor.execute(ACTIVE_USERS_QUERY + " AND u.user_id %% %s = %s", (now, shards, shard))
+    else:
+        cursor.execute(ACTIVE_USERS_QUERY, (now,))
+    users = cursor.fetchall()
+    subscribers_cache.set(cache_key, users)
+    return users
+
+def connect(**kwargs):
+    """Отдельное соединение с БД (очередь сигналов, LISTEN), не трогая общее"""
+    connection = psycopg2.connect(
+        host=DB_HOST,
+        port=DB_PORT,
+        database=DB_NAME,
+        user=DB_USER,
+        password=DB_PASSWORD,
+        cursor_factory=RealDictCursor,
+        connect_timeout=int(max(1, DB_STATEMENT_TIMEOUT)),
+        **kwargs
+    )
+    set_statement_timeout(connection, DB_STATEMENT_TIMEOUT)
+    return connection
+
+def set_statement_timeout(connection, seconds: float) -> None:
+    """statement_timeout сессии; 0 — без ограничения.
+    SET, а не options=: options перекрыл бы PGOPTIONS (search_path бенчмарков)"""
+    with connection.cursor() as session_cursor:
+        session_cursor.execute("SET statement_timeout = %s", (int(seconds * 1000),))
+    connection.commit()
+
+def get_open_trade_user_ids(exchange: str, symbol: str) -> set:
+    cursor.execute(
+        "SELECT DISTINCT user_id FROM trades WHERE exchange = %s AND symbol = %s AND status = 'open' AND tier = 'hot'",
+        (exchange, symbol)
+    )
+    return {row["user_id"] for row in cursor.fetchall()}
+
 def get_cursor():
     return cursor
 
 def commit():
     conn.commit()
 
+class _Pool(ThreadedConnectionPool):
+    def _connect(self, key=None):
+        connection = super()._connect(key)
+        set_statement_timeout(connection, DB_STATEMENT_TIMEOUT)
+        return connection
+
+def _get_pool() -> ThreadedConnectionPool:
+    global pool
+    with _pool_lock:
+        if pool is None:
+            pool = _Pool(
+                0, DB_POOL_SIZE,
+                host=DB_HOST, port=DB_PORT, database=DB_NAME, user=DB_USER, password=DB_PASSWORD,
+                cursor_factory=RealDictCursor, connect_timeout=int(max(1, DB_STATEMENT_TIMEOUT)),
+            )
+        return pool
+
+@contextmanager
+def transaction():
+    """Курсор на соединении из пула: commit на выходе, rollback при ошибке.
+    Для потоков и задач, которые не должны делить транзакцию общего соединения:
+    их rollback не откатывает чужую незафиксированную работу. Блокирует —
+    из event loop вызывается через asyncio.to_thread или run_on."""
+    _pool_slots.acquire()
+    try:
+        connections = _get_pool()
+        connection = connections.getconn()
+        try:
+            with connection.cursor() as pooled_cursor:
+                yield pooled_cursor
+            connection.commit()
+        except Exception:
+            if not connection.closed:
+                connection.rollback()
+            raise
+        finally:
+            connections.putconn(connection, close=bool(connection.closed))
+    finally:
+        _pool_slots.release()
+
 def close_db():
+    global pool
     if cursor:
         cursor.close()
     if conn:
-        conn.close()
\ No newline at end of file
+        conn.close()
+    with _pool_lock:
+        if pool is not None:
+            pool.closeall()
+            pool = None
\ No newline at end of file
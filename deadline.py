@@ -0,0 +1,55 @@
+# deadline.py
+import os
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Optional
+
+# Бюджет сигнала от прихода webhook: позже вход уже не открываем — цена ушла
+SIGNAL_DEADLINE = float(os.getenv("SIGNAL_DEADLINE", "30"))
+# Таймаут одного запроса к бирже, если бюджета с запасом или он не задан
+EXCHANGE_REQUEST_TIMEOUT = float(os.getenv("EXCHANGE_REQUEST_TIMEOUT", "10"))
+# Нижняя граница таймаута: SL/TP и закрытия после входа ставятся, даже когда бюджет исчерпан
+MIN_REQUEST_TIMEOUT = float(os.getenv("MIN_REQUEST_TIMEOUT", "3"))
+# Допустимое отклонение текущей цены от цены сигнала, доля
+PRICE_DRIFT_LIMIT = float(os.getenv("PRICE_DRIFT_LIMIT", "0.01"))
+
+# Момент (time.time()), после которого вход по текущему сигналу не начинается.
+# ContextVar доходит и до задач, созданных из обработчика, и до asyncio.to_thread.
+_deadline: ContextVar[Optional[float]] = ContextVar("signal_deadline", default=None)
+
+
+@contextmanager
+def signal_deadline(arrived_at: float = None, budget: float = SIGNAL_DEADLINE):
+    """Задаёт дедлайн сигнала для всего, что выполняется внутри блока"""
+    token = _deadline.set((arrived_at or time.time()) + budget)
+    try:
+        yield
+    finally:
+        _deadline.reset(token)
+
+
+def remaining() -> Optional[float]:
+    """Сколько секунд осталось до дедлайна; None — дедлайн не задан"""
+    deadline = _deadline.get()
+    return None if deadline is None else deadline - time.time()
+
+
+def expired() -> bool:
+    left = remaining()
+    return left is not None and left <= 0
+
+
+def request_timeout(default: float = EXCHANGE_REQUEST_TIMEOUT) -> float:
+    """Таймаут очередного запроса: остаток бюджета, но не больше default и не меньше MIN_REQUEST_TIMEOUT"""
+    left = remaining()
+    if left is None:
+        return default
+    return max(MIN_REQUEST_TIMEOUT, min(default, left))
+
+
+def price_drift(signal_price: Optional[float], current_price: Optional[float]) -> Optional[float]:
+    """Относительное отклонение текущей цены от цены сигнала; None — сравнивать не с чем"""
+    if not signal_price or not current_price:
+        return None
+    return abs(current_price - signal_price) / signal_price
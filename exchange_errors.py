@@ -0,0 +1,135 @@
+# exchange_errors.py
+from typing import Optional
+
+
+class ExchangeError(Exception):
+    """Ошибка биржи с кодом ответа. Класс ошибки задаёт реакцию бота:
+    retry — повторить запрос, skip — пропустить пользователя на этом сигнале,
+    quarantine — ключи или счёт неисправны, пользователь уходит в карантин (user_health)."""
+
+    kind = "other"
+    action = "skip"
+
+    def __init__(self, exchange: str, code, message: str, context: str = "", kind: str = None):
+        self.exchange = exchange
+        self.code = None if code is None else str(code)
+        self.message = message
+        if kind:
+            self.kind = kind
+        text = f"{context}: {message}" if context else str(message)
+        super().__init__(f"{self.code} {text}" if self.code else text)
+
+    @property
+    def retryable(self) -> bool:
+        return self.action == "retry"
+
+
+class RetryableError(ExchangeError):
+    """Временный сбой: запрос можно повторить"""
+    action = "retry"
+
+
+class RateLimitError(RetryableError):
+    kind = "rate_limit"
+
+
+class ClockSkewError(RetryableError):
+    """Биржа отвергла timestamp запроса — запрос точно не исполнен"""
+    kind = "clock"
+
+
+class ServerError(RetryableError):
+    kind = "server"
+
+
+class NetworkError(RetryableError):
+    """Ответа нет: запрос мог дойти до биржи. Ордер после такой ошибки повторяем
+    только с тем же клиентским id, предварительно поискав его на бирже"""
+    kind = "network"
+
+
+class NotFoundError(ExchangeError):
+    """Ордера или позиции уже нет — для отмены и закрытия это не ошибка"""
+    kind = "not_found"
+
+
+class DuplicateOrderError(ExchangeError):
+    """Ордер с таким клиентским id уже выставлен — прошлая попытка дошла до биржи"""
+    kind = "duplicate"
+
+
+class AccountError(ExchangeError):
+    """Ключи (auth), белый список IP (ip) или средства (funds) — повтор не поможет"""
+    action = "quarantine"
+
+
+class RejectedError(ExchangeError):
+    """Прочие отказы биржи по конкретному запросу"""
+    kind = "rejected"
+
+
+KIND_CLASSES = {
+    "rate_limit": RateLimitError,
+    "clock": ClockSkewError,
+    "server": ServerError,
+    "network": NetworkError,
+    "not_found": NotFoundError,
+    "duplicate": DuplicateOrderError,
+    "auth": AccountError,
+    "ip": AccountError,
+    "funds": AccountError,
+}
+
+# Коды ответов бирж по классам ошибок
+ERROR_CODES = {
+    "bingx": {
+        "100410": "rate_limit", "100500": "server", "80012": "server", "80016": "not_found",
+        "100001": "auth", "100413": "auth", "100419": "ip", "101204": "funds",
+    },
+    "okx": {
+        "50011": "rate_limit", "50061": "rate_limit", "50013": "server", "50026": "server", "50102": "clock",
+        "51603": "not_found", "51400": "not_found", "51016": "duplicate",
+        "50111": "auth", "50113": "auth", "50119": "auth", "50110": "ip", "51008": "funds",
+    },
+    "bybit": {
+        "10006": "rate_limit", "10016": "server", "10002": "clock",
+        "110001": "not_found", "110072": "duplicate",
+        "10003": "auth", "10004": "auth", "10005": "auth", "10010": "ip", "110007": "funds",
+    },
+    "bitget": {
+        "429": "rate_limit", "40010": "server", "40008": "clock",
+        "40768": "not_found", "43001": "not_found", "40757": "not_found", "40786": "duplicate",
+        "40006": "auth", "40014": "auth", "40037": "auth", "40018": "ip", "40762": "funds",
+    },
+}
+
+# Фрагменты текста ошибок (в нижнем регистре), если кода нет в таблице
+ERROR_TEXT = [
+    ("timestamp", "clock"),
+    ("too many requests", "rate_limit"),
+    ("rate limit", "rate_limit"),
+    ("not exist", "not_found"),
+    ("not found", "not_found"),
+    ("duplicate", "duplicate"),
+    ("system error", "server"),
+    ("service unavailable", "server"),
+]
+
+
+def classify(exchange: str, code, message: str, context: str = "") -> ExchangeError:
+    """Типизированная ошибка по коду и тексту ответа биржи"""
+    kind = ERROR_CODES.get(exchange, {}).get(str(code))
+    if kind is None:
+        text = str(message).lower()
+        kind = next((kind for fragment, kind in ERROR_TEXT if fragment in text), None)
+    error_class = KIND_CLASSES.get(kind, RejectedError)
+    return error_class(exchange, code, message, context, kind=kind)
+
+
+def raise_for(exchange: str, code, message: str, context: str = "") -> None:
+    raise classify(exchange, code, message, context)
+
+
+def error_action(error: Exception) -> Optional[str]:
+    """retry, skip или quarantine; None — ошибка не от биржи"""
+    return error.action if isinstance(error, ExchangeError) else None
@@ -0,0 +1,199 @@
+# fanout.py
+import asyncio
+import logging
+import uuid
+from typing import Awaitable, Callable, Dict, List, Optional
+
+from services import (
+    process_bingx_signal, process_okx_signal, process_bybit_signal, process_bitget_signal,
+    process_bingx_move_sl, process_okx_move_sl, process_bybit_move_sl, process_bitget_move_sl,
+)
+from bulkheads import bulkhead
+from database import get_open_trade_user_ids
+import deadline
+from models import Signal
+from scheduler import DispatchStats, dispatch_order
+from sizing import current_price, size_cohort
+from symbols import SUPPORTED_EXCHANGES, resolve_symbol
+from trade_journal import trade_journal
+from user_health import is_quarantined
+
+logger = logging.getLogger(__name__)
+
+
+async def resolve_for_users(users: List[Dict], symbol: str) -> Dict[str, Optional[str]]:
+    """Один раз на биржу переводит символ сигнала в символ биржи"""
+    exchanges = {user.get('exchange', 'bingx') for user in users} & set(SUPPORTED_EXCHANGES)
+    resolved = await resolve_symbol(symbol, exchanges)
+    for exchange, exchange_symbol in resolved.items():
+        if exchange_symbol is None:
+            logger.warning(f"Инструмента {symbol} нет на {exchange}, пользователи этой биржи пропущены")
+    return resolved
+
+
+async def entry_blocker(exchange: str, signal: Signal) -> Optional[str]:
+    """Причина не открывать вход: дедлайн сигнала истёк или цена ушла от цены сигнала дальше PRICE_DRIFT_LIMIT"""
+    if deadline.expired():
+        return "deadline"
+    try:
+        drift = deadline.price_drift(signal.price, await current_price(exchange, signal.symbol))
+    except Exception as e:
+        logger.warning(f"Не удалось проверить цену {exchange} {signal.symbol}: {e}")
+        return None
+    if drift is not None and drift > deadline.PRICE_DRIFT_LIMIT:
+        return "price_drift"
+    return None
+
+
+async def presize(users: List[Dict], signals: Dict[str, Signal]) -> Dict[int, Dict]:
+    """Объёмы входа и TP для всех пользователей сигнала, одним расчётом на биржу.
+
+    Биржи считаются параллельно, каждая в своём отсеке: медленная биржа не задерживает вход
+    на остальных. Пользователи с открытой сделкой по символу считают объём сами после её закрытия:
+    закрытие освобождает маржу, и баланс до него занизил бы позицию.
+    """
+    async def size_exchange(exchange: str, symbol: str, cohort: List[Dict]) -> Dict[int, Dict]:
+        try:
+            return await size_cohort(exchange, symbol, cohort)
+        except Exception as e:
+            logger.error(f"Ошибка пакетного расчёта объёмов {exchange} {symbol}, считаем по пользователям: {e}")
+            return {}
+
+    cohorts = []
+    for exchange, exchange_signal in signals.items():
+        symbol = exchange_signal.symbol
+        busy = get_open_trade_user_ids(exchange, symbol) | trade_journal.pending_user_ids(exchange, symbol)
+        cohort = [user for user in users
+                  if user.get('exchange', 'bingx') == exchange and user['user_id'] not in busy]
+        if cohort:
+            cohorts.append(size_exchange(exchange, symbol, cohort))
+
+    sizes = {}
+    for cohort_sizes in await asyncio.gather(*cohorts):
+        sizes.update(cohort_sizes)
+    return sizes
+
+
+async def dispatch_signal(users: List[Dict], signal: Signal, signal_id: str = None,
+                          shard: Optional[int] = None,
+                          on_user_start: Callable[[int], Awaitable[None]] = None) -> List[Dict]:
+    """Исполняет торговый сигнал для каждого пользователя на его бирже.
+
+    Порядок обхода задаёт scheduler.dispatch_order, разброс латентности входа
+    пишется в signal_dispatch_stats. Пользователи в карантине (user_health)
+    пропускаются до успешной повторной проверки ключей. Если вход уже не успевает
+    до дедлайна сигнала или цена ушла (entry_blocker), пользователь получает
+    в результатах outcome=skipped с причиной, а не ордер.
+
+    Биржи обрабатываются параллельно, каждая в своём отсеке (bulkheads.py):
+    зависшая биржа не задерживает пользователей остальных.
+
+    on_user_start вызывается перед входом пользователя (worker.py отмечает его в задании);
+    если он упал, пользователь не обрабатывается.
+    """
+    signal_id = signal_id or uuid.uuid4().hex
+    quarantined = sum(1 for user in users if is_quarantined(user))
+    if quarantined:
+        logger.info(f"Пропущено пользователей в карантине: {quarantined}")
+        users = [user for user in users if not is_quarantined(user)]
+    symbols = await resolve_for_users(users, signal.symbol)
+    signals = {
+        exchange: signal.model_copy(update={"symbol": exchange_symbol})
+        for exchange, exchange_symbol in symbols.items() if exchange_symbol
+    }
+    sizes = await presize(users, signals)
+    stats = DispatchStats(signal_id, shard=shard, symbol=signal.symbol, action=signal.action)
+
+    processors = {
+        'bingx': process_bingx_signal,
+        'okx': process_okx_signal,
+        'bybit': process_bybit_signal,
+        'bitget': process_bitget_signal,
+    }
+
+    async def process_user(user: Dict, exchange: str, user_signal: Signal) -> Optional[Dict]:
+        user_id = user['user_id']
+        async with bulkhead(exchange).slot():
+            # Проверяем уже заняв место: пока ждали отсек, дедлайн мог истечь
+            reason = await entry_blocker(exchange, user_signal) if user_signal else None
+            if reason:
+                stats.record_outcome("skipped")
+                return {"user_id": user_id, "exchange": exchange, "outcome": "skipped", "reason": reason}
+            try:
+                if on_user_start:
+                    await on_user_start(user_id)
+                result = await processors[exchange](user, user_signal, sizes.get(user_id), signal_id)
+            except Exception as e:
+                logger.error(f"Ошибка обработки сигнала для пользователя {user_id} на бирже {exchange}: {str(e)}")
+                result = None
+        if result:
+            stats.record(user_id)
+            logger.info(f"Сигнал обработан для пользователя {user_id} на бирже {exchange}")
+        else:
+            stats.record_outcome("failed")
+        return result
+
+    tasks = []
+    for user in dispatch_order(users, signal_id):
+        user_id = user['user_id']
+        exchange = user.get('exchange', 'bingx')
+        if exchange in symbols and not symbols[exchange]:
+            continue
+        if exchange not in processors:
+            logger.error(f"Неизвестная биржа: {exchange} для пользователя {user_id}")
+            continue
+        # Задачи создаются в порядке dispatch_order — в нём же пользователи занимают места отсека
+        tasks.append(asyncio.create_task(process_user(user, exchange, signals.get(exchange))))
+
+    results = [result for result in await asyncio.gather(*tasks) if result]
+
+    skipped = {}
+    for result in results:
+        if result.get("outcome") == "skipped":
+            skipped[result["reason"]] = skipped.get(result["reason"], 0) + 1
+    if skipped:
+        logger.warning(f"Сигнал {signal_id}: вход пропущен для пользователей {skipped}")
+    await asyncio.to_thread(stats.save)
+    return results
+
+
+async def dispatch_move_sl(users: List[Dict], symbol: str, signal_id: str = None) -> List[Dict]:
+    """Переносит SL в безубыток для каждого пользователя на его бирже.
+
+    Карантин здесь не учитывается: у пользователя без средств уже открытая позиция
+    всё равно должна получить безубыток. Как и вход, пользователи обрабатываются
+    параллельно в отсеке своей биржи (bulkheads.py).
+    """
+    symbols = await resolve_for_users(users, symbol)
+
+    processors = {
+        'bingx': process_bingx_move_sl,
+        'okx': process_okx_move_sl,
+        'bybit': process_bybit_move_sl,
+        'bitget': process_bitget_move_sl,
+    }
+
+    async def move_user(user: Dict, exchange: str) -> Optional[Dict]:
+        user_id = user['user_id']
+        async with bulkhead(exchange).slot():
+            try:
+                result = await processors[exchange](user, symbols.get(exchange))
+            except Exception as e:
+                logger.error(f"Ошибка обработки MOVE_SL для пользователя {user_id} на бирже {exchange}: {str(e)}")
+                return None
+        if result:
+            logger.info(f"MOVE_SL обработан для пользователя {user_id} на бирже {exchange}")
+        return result
+
+    tasks = []
+    for user in dispatch_order(users, signal_id or uuid.uuid4().hex):
+        user_id = user['user_id']
+        exchange = user.get('exchange', 'bingx')
+        if exchange in symbols and not symbols[exchange]:
+            continue
+        if exchange not in processors:
+            logger.error(f"Неизвестная биржа: {exchange} для пользователя {user_id}")
+            continue
+        tasks.append(asyncio.create_task(move_user(user, exchange)))
+
+    return [result for result in await asyncio.gather(*tasks) if result]
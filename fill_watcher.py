@@ -0,0 +1,134 @@
+# fill_watcher.py
+import asyncio
+import logging
+import os
+import time
+from typing import Callable, Dict, Iterator, Optional
+
+import metrics
+from bulkheads import run_on
+from trade_journal import trade_journal
+
+logger = logging.getLogger(__name__)
+
+# Первый опрос почти сразу: рыночный ордер обычно исполняется за десятки миллисекунд
+FILL_POLL_INITIAL = float(os.getenv("FILL_POLL_INITIAL", "0.05"))
+FILL_POLL_MAX = float(os.getenv("FILL_POLL_MAX", "1.0"))
+FILL_TIMEOUT = float(os.getenv("FILL_TIMEOUT", "10"))
+
+# Поля статуса, средней цены и исполненного объёма в ответах get_order_status
+ORDER_FIELDS = {
+    "bingx": ("status", "avgPrice", "executedQty"),
+    "okx": ("state", "avgPx", "accFillSz"),
+    "bybit": ("orderStatus", "avgPrice", "cumExecQty"),
+    "bitget": ("state", "priceAvg", "filledQty"),
+}
+FILLED_STATES = {"FILLED", "filled", "Filled", "full_fill"}
+DEAD_STATES = {
+    "CANCELED", "CANCELLED", "EXPIRED", "REJECTED",
+    "canceled", "mmp_canceled", "cancelled",
+    "Cancelled", "Rejected", "Deactivated",
+}
+
+
+def _float(value) -> Optional[float]:
+    try:
+        value = float(value)
+    except (TypeError, ValueError):
+        return None
+    return value if value > 0 else None
+
+
+def parse_fill(exchange: str, order: Dict) -> Dict:
+    """Состояние ордера: filled, dead (отменён/отклонён) или open, плюс средняя цена и объём исполнения"""
+    status_field, price_field, qty_field = ORDER_FIELDS[exchange]
+    status = order.get(status_field)
+    if status in FILLED_STATES:
+        state = "filled"
+    elif status in DEAD_STATES:
+        state = "dead"
+    else:
+        state = "open"
+    return {"state": state, "status": status, "avg_price": _float(order.get(price_field)),
+            "filled_qty": _float(order.get(qty_field))}
+
+
+def order_status_fetcher(exchange: str, symbol: str, order_id: str, user: Dict) -> Callable[[], Dict]:
+    api_key, secret_key, passphrase = user['api_key'], user['secret_key'], user.get('passphrase')
+    if exchange == "bingx":
+        from bingx_api import get_order_status
+        return lambda: get_order_status(symbol, order_id, api_key, secret_key)
+    if exchange == "okx":
+        from okx_api import get_order_status
+    elif exchange == "bybit":
+        from bybit_api import get_order_status
+    elif exchange == "bitget":
+        from bitget_api import get_order_status
+    else:
+        raise ValueError(f"Неизвестная биржа: {exchange}")
+    return lambda: get_order_status(symbol, order_id, api_key, secret_key, passphrase)
+
+
+def poll_delays(timeout: float = FILL_TIMEOUT) -> Iterator[float]:
+    """Паузы между опросами: удваиваются от FILL_POLL_INITIAL до FILL_POLL_MAX, в сумме не больше timeout"""
+    delay, total = FILL_POLL_INITIAL, 0.0
+    while total < timeout:
+        delay = min(delay, timeout - total)
+        yield delay
+        total += delay
+        delay = min(delay * 2, FILL_POLL_MAX)
+
+
+def _check(exchange: str, fetch: Callable[[], Dict]) -> Optional[Dict]:
+    try:
+        return parse_fill(exchange, fetch())
+    except Exception as e:
+        # Сразу после размещения биржа может ещё не отдавать ордер
+        logger.debug(f"Статус ордера {exchange} пока недоступен: {e}")
+        return None
+
+
+def _finish(exchange: str, fill: Optional[Dict], started: float) -> Optional[Dict]:
+    elapsed = time.perf_counter() - started
+    confirmed = bool(fill) and fill["state"] == "filled"
+    metrics.record(f"fill_wait_{exchange}", elapsed, error=not confirmed)
+    if not confirmed:
+        logger.warning(f"Исполнение ордера {exchange} не подтверждено за {elapsed:.2f} с: {fill}")
+    return fill
+
+
+def wait_for_fill_blocking(exchange: str, fetch: Callable[[], Dict], timeout: float = FILL_TIMEOUT) -> Optional[Dict]:
+    """Опрашивает fetch до исполнения или отмены ордера. Для синхронного кода API-модулей."""
+    started = time.perf_counter()
+    fill = _check(exchange, fetch)
+    for delay in poll_delays(timeout):
+        if fill and fill["state"] != "open":
+            break
+        time.sleep(delay)
+        fill = _check(exchange, fetch)
+    return _finish(exchange, fill, started)
+
+
+async def wait_for_fill(exchange: str, symbol: str, order_id: str, user: Dict,
+                        timeout: float = FILL_TIMEOUT) -> Optional[Dict]:
+    """Ждёт исполнения ордера, не блокируя цикл событий.
+
+    Возвращает последнее известное состояние (parse_fill) или None, если биржа
+    так и не отдала ордер за timeout.
+    """
+    fetch = order_status_fetcher(exchange, symbol, order_id, user)
+    started = time.perf_counter()
+    fill = await run_on(exchange, _check, exchange, fetch)
+    for delay in poll_delays(timeout):
+        if fill and fill["state"] != "open":
+            break
+        await asyncio.sleep(delay)
+        fill = await run_on(exchange, _check, exchange, fetch)
+    return _finish(exchange, fill, started)
+
+
+async def record_fill_price(exchange: str, symbol: str, order_id: str, user: Dict) -> None:
+    """Записывает в сделку фактическую среднюю цену входа вместо цены из сигнала"""
+    fill = await wait_for_fill(exchange, symbol, order_id, user)
+    if fill and fill["avg_price"]:
+        await trade_journal.update_trade(exchange, order_id, entry_price=fill["avg_price"])
@@ -0,0 +1,139 @@
+# flatten.py
+import asyncio
+import hmac
+import logging
+import os
+import time
+from typing import Dict, List, Optional
+
+from psycopg2.extras import execute_values
+
+from bulkheads import bulkhead, run_order
+from database import transaction
+from symbols import resolve_symbol
+from trade_journal import trade_journal
+from user_stats import record_closed
+import metrics
+
+logger = logging.getLogger(__name__)
+
+# Токен для /control/flatten; без него аварийное закрытие выключено
+FLATTEN_TOKEN = os.getenv("FLATTEN_TOKEN")
+
+# Ключи всех пользователей, без фильтра подписки: закрывать нужно и у истёкших.
+# open_symbols — символы открытых сделок; нужны Bitget, который отдаёт ордера только по символу
+_TARGETS_SQL = """
+    SELECT u.user_id, u.exchange, u.api_key, u.secret_key, u.passphrase,
+           ARRAY(SELECT DISTINCT t.symbol FROM trades t
+                 WHERE t.user_id = u.user_id AND t.exchange = u.exchange AND t.status = 'open'
+                   AND t.tier = 'hot') AS open_symbols
+    FROM users u
+    WHERE u.api_key IS NOT NULL
+      AND u.secret_key IS NOT NULL
+      AND (%(user_ids)s::bigint[] IS NULL OR u.user_id = ANY(%(user_ids)s::bigint[]))
+      AND (%(exchanges)s::text[] IS NULL OR u.exchange = ANY(%(exchanges)s::text[]))
+    ORDER BY u.exchange, u.user_id
+"""
+
+# symbol NULL — все сделки пользователя на бирже
+_CLOSE_SQL = """
+    UPDATE trades SET status = 'closed', closed_at = CURRENT_TIMESTAMP
+    FROM (VALUES %s) AS v (user_id, exchange, symbol)
+    WHERE trades.user_id = v.user_id AND trades.exchange = v.exchange
+      AND trades.status = 'open' AND trades.tier = 'hot'
+      AND (v.symbol IS NULL OR trades.symbol = v.symbol)
+    RETURNING trades.trade_id
+"""
+_CLOSE_TEMPLATE = "(%s::bigint, %s::text, %s::text)"
+
+
+def authorized(token: Optional[str]) -> bool:
+    return bool(FLATTEN_TOKEN) and hmac.compare_digest(token or "", FLATTEN_TOKEN)
+
+
+def flatten_account(exchange: str, user: Dict, symbols: Optional[List[str]]) -> Dict:
+    """Отменяет ордера и закрывает позиции аккаунта; symbols None — все символы"""
+    api_key, secret_key, passphrase = user['api_key'], user['secret_key'], user.get('passphrase')
+    if exchange == "bingx":
+        from bingx_api import flatten
+        return flatten(api_key, secret_key, symbols)
+    if exchange == "okx":
+        from okx_api import flatten
+    elif exchange == "bybit":
+        from bybit_api import flatten
+    elif exchange == "bitget":
+        from bitget_api import flatten
+        symbols = symbols or user['open_symbols']
+    else:
+        raise ValueError(f"Неизвестная биржа: {exchange}")
+    return flatten(api_key, secret_key, passphrase, symbols)
+
+
+async def flatten_user(user: Dict, symbols: Optional[List[str]]) -> Dict:
+    exchange = user['exchange']
+    result = {"user_id": user['user_id'], "exchange": exchange}
+    # Место в отсеке биржи: тысячи пользователей идут в пределах лимита AIMD группы order
+    async with bulkhead(exchange).slot():
+        try:
+            done = await run_order(exchange, flatten_account, exchange, user, symbols)
+        except Exception as e:
+            logger.error(f"Аварийное закрытие {exchange} для пользователя {user['user_id']} не удалось: {e}")
+            return {**result, "status": "error", "error": str(e)}
+    return {**result, "status": "flattened", **done}
+
+
+def _targets(user_ids: Optional[List[int]], exchanges: Optional[List[str]]) -> List[Dict]:
+    with transaction() as cursor:
+        cursor.execute(_TARGETS_SQL, {"user_ids": user_ids, "exchanges": exchanges})
+        return cursor.fetchall()
+
+
+def _close_trades(rows: List[tuple]) -> List[Dict]:
+    """Помечает сделки closed транзакцией на соединении пула (database.transaction)"""
+    with transaction() as cursor:
+        closed_trades = execute_values(cursor, _CLOSE_SQL, rows, template=_CLOSE_TEMPLATE, page_size=1000, fetch=True)
+        record_closed(cursor, [row['trade_id'] for row in closed_trades])
+    return closed_trades
+
+
+async def flatten(user_ids: Optional[List[int]] = None, exchanges: Optional[List[str]] = None,
+                  symbols: Optional[List[str]] = None) -> Dict:
+    """Аварийно отменяет все ордера и закрывает все позиции выбранных пользователей, бирж и символов
+    (None — без ограничения), параллельно по пользователям. Сделки успешно закрытых аккаунтов
+    помечаются closed одним запросом."""
+    started = time.perf_counter()
+    # Несохранённые сделки журнала должны попасть в trades до массового закрытия
+    await asyncio.to_thread(trade_journal.flush)
+
+    users = await asyncio.to_thread(_targets, user_ids, exchanges)
+
+    scopes = {}
+    for user in users:
+        exchange = user['exchange']
+        if symbols is None:
+            scopes[exchange] = None
+        elif exchange not in scopes:
+            resolved = [(await resolve_symbol(symbol, [exchange]))[exchange] for symbol in symbols]
+            scopes[exchange] = sorted({exchange_symbol for exchange_symbol in resolved if exchange_symbol})
+    # Символов нет на бирже — её пользователей не трогаем
+    users = [user for user in users if scopes[user['exchange']] is None or scopes[user['exchange']]]
+
+    results = await asyncio.gather(*(flatten_user(user, scopes[user['exchange']]) for user in users))
+
+    rows = [(result['user_id'], result['exchange'], symbol)
+            for result in results if result['status'] == "flattened"
+            for symbol in (scopes[result['exchange']] or [None])]
+    closed_trades = await asyncio.to_thread(_close_trades, rows) if rows else []
+
+    errors = sum(1 for result in results if result['status'] == "error")
+    elapsed = time.perf_counter() - started
+    metrics.record("flatten", elapsed, error=errors > 0)
+    logger.warning(f"Аварийное закрытие: пользователей {len(results)}, ошибок {errors}, "
+                   f"сделок закрыто {len(closed_trades)} за {elapsed:.2f} с")
+    return {
+        "users": len(results),
+        "errors": errors,
+        "trades_closed": len(closed_trades),
+        "seconds": round(elapsed, 3),
+        "results": results,
+    }
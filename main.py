@@ -6,7 +6,7 @@ from dotenv import load_dotenv
 import os
 import psycopg2
 from psycopg2.extras import RealDictCursor
-from aiogram import Bot, Dispatcher, types, Router, F
+from aiogram import Dispatcher, types, Router, F
 from aiogram.fsm.context import FSMContext
 from aiogram.fsm.storage.memory import MemoryStorage
 from aiogram.fsm.state import State, StatesGroup
@@ -15,12 +15,16 @@ from aiogram.exceptions import TelegramBadRequest, TelegramForbiddenError
 from aiogram.enums.chat_member_status import ChatMemberStatus
 import aiohttp
 from yoomoney import Client, Quickpay
+from migrations import run_migrations
+from notifier import bot
+from account_profile import describe_profile, probe_account, profile_problem, profile_warnings, save_profile
+from user_health import FAILURE_MESSAGES, QUARANTINE_THRESHOLD, classify_failure, probe_delay
+from user_stats import format_user_stats, get_user_stats
 
 logging.basicConfig(level=logging.INFO)
 load_dotenv()
 
 # ------------------- Настройки -------------------
-BOT_TOKEN = os.getenv("BOT_TOKEN")
 YOOMONEY_ACCESS_TOKEN = os.getenv("YOOMONEY_ACCESS_TOKEN")
 YOOMONEY_RECEIVER = os.getenv("YOOMONEY_RECEIVER")
 GROUP_ID = int(os.getenv("GROUP_ID"))
@@ -32,7 +36,6 @@ DB_USER = os.getenv("DB_USER")
 DB_PASSWORD = os.getenv("DB_PASSWORD")
 DB_PORT = os.getenv("DB_PORT", "5432")
 
-bot = Bot(token=BOT_TOKEN)
 storage = MemoryStorage()
 dp = Dispatcher(storage=storage)
 router = Router()
@@ -53,66 +56,13 @@ except Exception as e:
     logging.error(f"Database connection error: {e}")
     raise
 
-# Создание таблиц
-cursor.execute("""
-    CREATE TABLE IF NOT EXISTS users (
-        user_id BIGINT PRIMARY KEY,
-        chat_id BIGINT,
-        subscription_end TIMESTAMP,
-        subscription_type TEXT,
-        referral_uuid TEXT,
-        api_key TEXT,
-        secret_key TEXT,
-        passphrase TEXT,
-        exchange TEXT,
-        email TEXT,
-        affirmate_username TEXT,
-        terms_accepted BOOLEAN DEFAULT FALSE,
-        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-    )
-""")
-cursor.execute("""
-    CREATE TABLE IF NOT EXISTS payments (
-        invoice_id TEXT PRIMARY KEY,
-        user_id BIGINT,
-        amount REAL,
-        currency TEXT,
-        status TEXT,
-        tariff_id TEXT,
-        payment_method TEXT DEFAULT 'yoomoney',
-        yoomoney_label TEXT,
-        affirmate_username TEXT,
-        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-        FOREIGN KEY (user_id) REFERENCES users (user_id)
-    )
-""")
-
-# Добавление недостающих полей
-for col, sql in [
-    ("email", "ALTER TABLE users ADD COLUMN email TEXT;"),
-    ("affirmate_username", "ALTER TABLE users ADD COLUMN affirmate_username TEXT;"),
-    ("terms_accepted", "ALTER TABLE users ADD COLUMN terms_accepted BOOLEAN DEFAULT FALSE;")
-]:
-    cursor.execute(f"""
-        SELECT column_name FROM information_schema.columns 
-        WHERE table_name = 'users' AND column_name = %s;
-    """, (col,))
-    if not cursor.fetchone():
-        cursor.execute(sql)
-        conn.commit()
+# Схема БД накатывается версионными миграциями (см. migrations.py)
+run_migrations(conn)
 
-for col, sql in [
-    ("affirmate_username", "ALTER TABLE payments ADD COLUMN affirmate_username TEXT;")
-]:
-    cursor.execute(f"""
-        SELECT column_name FROM information_schema.columns 
-        WHERE table_name = 'payments' AND column_name = %s;
-    """, (col,))
-    if not cursor.fetchone():
-        cursor.execute(sql)
-        conn.commit()
-
-conn.commit()
+# Новые ключи снимают карантин (см. user_health.py): их проверит первый же сигнал
+RESET_KEY_HEALTH_SQL = (
+    "key_status = 'ok', key_failures = 0, key_failure_class = NULL, key_quarantine_level = 0, key_probe_at = NULL"
+)
 
 # ------------------- Тарифы -------------------
 TARIFFS = {
@@ -197,23 +147,40 @@ def get_exchange_keyboard():
 
 
 def get_main_menu(user_id):
-    cursor.execute("SELECT subscription_end, api_key FROM users WHERE user_id = %s", (user_id,))
+    cursor.execute("SELECT subscription_end, api_key, key_status FROM users WHERE user_id = %s", (user_id,))
     res = cursor.fetchone()
 
     buttons = []
 
-    # Кнопка "Подключить API" показывается всегда, если API не подключен
-    if not res or not res['api_key']:
+    # Кнопка "Подключить API" показывается всегда, если API не подключен или ключи в карантине
+    if not res or not res['api_key'] or res['key_status'] == 'quarantined':
         buttons.append([types.KeyboardButton(text="Подключить API")])
 
     # Кнопка "Информация о подписке" показывается только при активной подписке
     if res and res['subscription_end'] and res['subscription_end'] > datetime.datetime.now():
         buttons.append([types.KeyboardButton(text="Информация о подписке")])
 
+    # Кнопка "Моя статистика" — когда бот уже торговал через ключи пользователя
+    if res and res['api_key']:
+        buttons.append([types.KeyboardButton(text="Моя статистика")])
+
     buttons.append([types.KeyboardButton(text="Поддержка")])
 
     return types.ReplyKeyboardMarkup(keyboard=buttons, resize_keyboard=True)
 
+def get_fix_keys_keyboard():
+    return types.InlineKeyboardMarkup(inline_keyboard=[
+        [types.InlineKeyboardButton(text="🔑 Обновить API-ключи", callback_data="fix_keys")],
+        [types.InlineKeyboardButton(text="Поддержка", url=f"https://t.me/{SUPPORT_CONTACT.lstrip('@')}")]
+    ])
+
+def get_api_status(res) -> str:
+    if not res['api_key']:
+        return "Не подключён"
+    if res['key_status'] == 'quarantined':
+        return "Требует обновления (сигналы приостановлены)"
+    return "Подключён"
+
 def get_support_kb():
     return types.InlineKeyboardMarkup(inline_keyboard=[[
         types.InlineKeyboardButton(text="Поддержка", url=f"https://t.me/{SUPPORT_CONTACT.lstrip('@')}")
@@ -270,7 +237,7 @@ async def cmd_start(message: types.Message, state: FSMContext):
 
     # Проверяем есть ли пользователь в базе и активна ли подписка
     cursor.execute("""
-        SELECT terms_accepted, subscription_end, api_key, exchange 
+        SELECT terms_accepted, subscription_end, api_key, exchange, key_status
         FROM users WHERE user_id = %s
     """, (user_id,))
     res = cursor.fetchone()
@@ -280,7 +247,7 @@ async def cmd_start(message: types.Message, state: FSMContext):
         # Показываем информацию о подписке и главное меню
         sub_type = "Активная"
         end_date = res['subscription_end'].strftime('%d.%m.%Y %H:%M')
-        api_status = "Подключён" if res['api_key'] else "Не подключён"
+        api_status = get_api_status(res)
         exchange_name = res['exchange'].upper() if res['exchange'] else "Не выбрана"
 
         await message.answer(
@@ -293,6 +260,12 @@ async def cmd_start(message: types.Message, state: FSMContext):
             parse_mode="Markdown",
             reply_markup=get_main_menu(user_id)
         )
+        if res['key_status'] == 'quarantined':
+            await message.answer(
+                "Биржа отклоняет ваши API-ключи или на счёте не хватает средств, поэтому сигналы приостановлены. "
+                "Обновите ключи или пополните счёт — торговля возобновится автоматически.",
+                reply_markup=get_fix_keys_keyboard()
+            )
         await state.clear()
         return
 
@@ -690,8 +663,18 @@ async def reject_referral(callback_query: types.CallbackQuery):
 
 @router.message(F.text == "Подключить API")
 async def connect_api(message: types.Message, state: FSMContext):
-    user_id = message.from_user.id
-    cursor.execute("SELECT subscription_type, subscription_end, api_key, exchange FROM users WHERE user_id = %s", (user_id,))
+    await request_api_keys(message, state, message.from_user.id)
+
+@router.callback_query(F.data == "fix_keys")
+async def fix_keys(callback_query: types.CallbackQuery, state: FSMContext):
+    await callback_query.answer()
+    await request_api_keys(callback_query.message, state, callback_query.from_user.id)
+
+async def request_api_keys(message: types.Message, state: FSMContext, user_id: int):
+    cursor.execute(
+        "SELECT subscription_type, subscription_end, api_key, exchange, key_status FROM users WHERE user_id = %s",
+        (user_id,)
+    )
     res = cursor.fetchone()
 
     if not res:
@@ -703,7 +686,7 @@ async def connect_api(message: types.Message, state: FSMContext):
         await state.set_state(PaymentStates.waiting_for_subscription_type)
         return
 
-    if res['api_key']:
+    if res['api_key'] and res['key_status'] != 'quarantined':
         await message.answer("API уже подключён.", reply_markup=get_main_menu(user_id))
         return
 
@@ -717,7 +700,10 @@ async def connect_api(message: types.Message, state: FSMContext):
 @router.message(F.text == "Информация о подписке")
 async def subscription_info(message: types.Message):
     user_id = message.from_user.id
-    cursor.execute("SELECT subscription_end, subscription_type, api_key, exchange FROM users WHERE user_id = %s", (user_id,))
+    cursor.execute(
+        "SELECT subscription_end, subscription_type, api_key, exchange, key_status FROM users WHERE user_id = %s",
+        (user_id,)
+    )
     res = cursor.fetchone()
 
     if not res:
@@ -731,7 +717,7 @@ async def subscription_info(message: types.Message):
     sub_type = res['subscription_type']
     sub_name = {"regular": "Обычная (оплачена)", "referral_approved": "Реферальная"}.get(sub_type, sub_type)
     end_date = res['subscription_end'].strftime('%d.%m.%Y %H:%M')
-    api_status = "Подключён" if res['api_key'] else "Не подключён"
+    api_status = get_api_status(res)
     exchange_name = res['exchange'].upper() if res['exchange'] else "Не выбрана"
 
     await message.answer(
@@ -745,6 +731,14 @@ async def subscription_info(message: types.Message):
     )
 
 
+@router.message(F.text == "Моя статистика")
+async def user_statistics(message: types.Message):
+    user_id = message.from_user.id
+    # Готовая строка user_stats по ключу — история сделок не читается
+    stats = get_user_stats(cursor, user_id)
+    await message.answer(format_user_stats(stats), parse_mode="Markdown", reply_markup=get_main_menu(user_id))
+
+
 @router.message(F.text == "Поддержка")
 async def contact_support(message: types.Message):
     support_kb = types.InlineKeyboardMarkup(inline_keyboard=[
@@ -791,12 +785,13 @@ async def process_secret_key(message: types.Message, state: FSMContext):
     if exchange in no_passphrase_exchanges:
         # Сохраняем данные без passphrase
         cursor.execute(
-            "UPDATE users SET api_key = %s, secret_key = %s, exchange = %s WHERE user_id = %s",
+            "UPDATE users SET api_key = %s, secret_key = %s, exchange = %s, " + RESET_KEY_HEALTH_SQL + " WHERE user_id = %s",
             (api_key, secret, exchange, user_id)
         )
         conn.commit()
-        await message.answer("API подключён!", reply_markup=get_main_menu(user_id))
+        await message.answer("API подключён! Проверяем ключи на бирже...", reply_markup=get_main_menu(user_id))
         await state.clear()
+        asyncio.create_task(onboard_account(user_id, exchange, api_key, secret))
     else:
         # Для остальных бирж запрашиваем passphrase
         await state.update_data(secret_key=secret)
@@ -815,12 +810,14 @@ async def process_passphrase(message: types.Message, state: FSMContext):
     user_id = message.from_user.id
 
     cursor.execute(
-        "UPDATE users SET api_key = %s, secret_key = %s, passphrase = %s, exchange = %s WHERE user_id = %s",
+        "UPDATE users SET api_key = %s, secret_key = %s, passphrase = %s, exchange = %s, " + RESET_KEY_HEALTH_SQL +
+        " WHERE user_id = %s",
         (data['api_key'], data['secret_key'], passphrase, data['exchange'], user_id)
     )
     conn.commit()
-    await message.answer("API и Passphrase сохранены!", reply_markup=get_main_menu(user_id))
+    await message.answer("API и Passphrase сохранены! Проверяем ключи на бирже...", reply_markup=get_main_menu(user_id))
     await state.clear()
+    asyncio.create_task(onboard_account(user_id, data['exchange'], data['api_key'], data['secret_key'], passphrase))
 
 @router.callback_query(F.data == "cancel")
 async def cancel_action(callback_query: types.CallbackQuery, state: FSMContext):
@@ -828,6 +825,59 @@ async def cancel_action(callback_query: types.CallbackQuery, state: FSMContext):
     await bot.send_message(callback_query.from_user.id, "Отменено.", reply_markup=get_main_menu(callback_query.from_user.id))
     await state.clear()
 
+async def onboard_account(user_id: int, exchange: str, api_key: str, secret_key: str, passphrase: str = None):
+    """Проверяет только что подключённые ключи и сохраняет профиль аккаунта (account_profiles),
+    чтобы первый сигнал не выяснял режим позиции и права ключа на ходу"""
+    profile, error, problem = None, None, None
+    try:
+        profile = await asyncio.to_thread(probe_account, exchange, api_key, secret_key, passphrase)
+        problem = profile_problem(profile)
+    except Exception as e:
+        logging.error(f"Проверка ключей {exchange} пользователя {user_id} не прошла: {e}")
+        error = str(e)
+        failure_class = classify_failure(e)
+        if failure_class in FAILURE_MESSAGES:
+            problem = (failure_class, FAILURE_MESSAGES[failure_class])
+
+    try:
+        save_profile(cursor, user_id, exchange, profile, error)
+        if problem and problem[0] in QUARANTINE_THRESHOLD:
+            # Сразу в карантин: фоновая проверка в main_rout снимет его, когда ключи заработают
+            cursor.execute(
+                "UPDATE users SET key_status = 'quarantined', key_failure_class = %s, key_probe_at = %s "
+                "WHERE user_id = %s",
+                (problem[0], datetime.datetime.now() + datetime.timedelta(seconds=probe_delay(0)), user_id)
+            )
+        conn.commit()
+    except Exception as e:
+        conn.rollback()
+        logging.error(f"Не удалось сохранить профиль аккаунта пользователя {user_id}: {e}")
+
+    try:
+        if problem:
+            await bot.send_message(
+                user_id,
+                f"❌ Ключи не прошли проверку: {problem[1]}.\n\n"
+                f"Сигналы не будут исполняться, пока это не исправлено.",
+                reply_markup=get_fix_keys_keyboard()
+            )
+        elif error:
+            await bot.send_message(
+                user_id,
+                "⚠️ Не удалось проверить ключи на бирже. Ключи сохранены, их проверит первый сигнал.",
+                reply_markup=get_support_kb()
+            )
+        else:
+            text = f"✅ Ключи проверены.\n\n{describe_profile(profile)}"
+            warnings = profile_warnings(exchange, profile)
+            if warnings:
+                text += "\n\nРекомендуем:\n" + "\n".join(f"• {warning}" for warning in warnings)
+            await bot.send_message(user_id, text)
+    except TelegramForbiddenError:
+        logging.error(f"Cannot send message to user {user_id}: Forbidden")
+    except Exception as e:
+        logging.error(f"Ошибка отправки результата проверки ключей пользователю {user_id}: {e}")
+
 # ------------------- Фоновые задачи -------------------
 async def check_subscriptions():
     while True:
@@ -1,10 +1,19 @@
 import logging
+import time
 import uvicorn
 from fastapi import FastAPI, Request
 from fastapi.responses import JSONResponse
 from contextlib import asynccontextmanager
 from database import init_db, close_db
 from webhook import router
+from trade_journal import trade_journal
+from warm_state import warm_state
+from user_health import key_health_probe
+from reconciler import reconciler
+from trade_archive import trade_archiver
+from ws_trading import ws_trading
+import bulkheads
+import metrics
 
 logging.basicConfig(
     level=logging.INFO,
@@ -38,6 +47,7 @@ BLOCKED_PATHS = [
 ]
 
 async def security_middleware(request: Request, call_next):
+    started = time.perf_counter()
     try:
         client_ip = request.client.host if request.client else "unknown"
     except Exception:
@@ -48,6 +58,7 @@ async def security_middleware(request: Request, call_next):
 
     if any(blocked in path.lower() for blocked in BLOCKED_PATHS):
         logger.warning(f"Блокирован запрос от {client_ip}: {method} {path}")
+        metrics.record("security_middleware", time.perf_counter() - started)
         return JSONResponse(
             status_code=404,
             content={"status": "error", "message": "Not Found"}
@@ -55,6 +66,7 @@ async def security_middleware(request: Request, call_next):
 
     if method == "GET" and path not in ["/", "/health"]:
         logger.warning(f"Блокирован GET запрос от {client_ip}: {path}")
+        metrics.record("security_middleware", time.perf_counter() - started)
         return JSONResponse(
             status_code=404,
             content={"status": "error", "message": "Not Found"}
@@ -63,11 +75,17 @@ async def security_middleware(request: Request, call_next):
     if method == "POST" and path == "/webhook":
         logger.info(f"Webhook запрос от {client_ip}")
 
+    metrics.record("security_middleware", time.perf_counter() - started)
+    handler_started = time.perf_counter()
     try:
         response = await call_next(request)
+        if method == "POST" and path == "/webhook":
+            metrics.record("webhook", time.perf_counter() - handler_started, error=response.status_code >= 400)
         return response
     except Exception as e:
         logger.error(f"Ошибка обработки запроса от {client_ip}: {str(e)}")
+        if method == "POST" and path == "/webhook":
+            metrics.record("webhook", time.perf_counter() - handler_started, error=True)
         return JSONResponse(
             status_code=500,
             content={"status": "error", "message": "Internal Server Error"}
@@ -78,9 +96,24 @@ async def lifespan(app: FastAPI):
     logger.info("Запуск универсального обработчика сигналов...")
     init_db()
     logger.info("База данных инициализирована")
+    await trade_journal.start()
+    # До yield: uvicorn не принимает запросы, пока lifespan не стартовал
+    await warm_state.start()
+    metrics.loop_lag.start()
+    key_health_probe.start()
+    reconciler.start()
+    trade_archiver.start()
     try:
         yield
     finally:
+        await trade_archiver.stop()
+        await reconciler.stop()
+        await key_health_probe.stop()
+        await metrics.loop_lag.stop()
+        await warm_state.stop()
+        ws_trading.stop()
+        bulkheads.shutdown()
+        await trade_journal.stop()
         close_db()
         logger.info("Обработчик остановлен")
 
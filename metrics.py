@@ -0,0 +1,102 @@
+# metrics.py
+import asyncio
+import logging
+import time
+from collections import deque
+from typing import Dict, Optional
+
+logger = logging.getLogger(__name__)
+
+SAMPLE_WINDOW = 2048
+
+
+def percentile(ordered: list, q: float) -> float:
+    if not ordered:
+        return 0.0
+    return ordered[min(len(ordered) - 1, int(q * (len(ordered) - 1) + 0.5))]
+
+
+class LatencyRecorder:
+    """Скользящее окно замеров длительности с подсчётом ошибок"""
+
+    def __init__(self, window: int = SAMPLE_WINDOW):
+        self.samples = deque(maxlen=window)
+        self.count = 0
+        self.errors = 0
+
+    def record(self, seconds: float, error: bool = False) -> None:
+        self.samples.append(seconds)
+        self.count += 1
+        if error:
+            self.errors += 1
+
+    def summary(self) -> Dict:
+        ordered = sorted(self.samples)
+        return {
+            "count": self.count,
+            "errors": self.errors,
+            "p50_ms": round(percentile(ordered, 0.50) * 1000, 3),
+            "p95_ms": round(percentile(ordered, 0.95) * 1000, 3),
+            "p99_ms": round(percentile(ordered, 0.99) * 1000, 3),
+            "max_ms": round((ordered[-1] if ordered else 0.0) * 1000, 3),
+        }
+
+
+class LoopLagMonitor:
+    """Замеряет, насколько позже запланированного просыпается event loop"""
+
+    def __init__(self, interval: float = 0.1):
+        self.interval = interval
+        self.lag = LatencyRecorder()
+        self._task: Optional[asyncio.Task] = None
+
+    async def _run(self) -> None:
+        loop = asyncio.get_running_loop()
+        while True:
+            expected = loop.time() + self.interval
+            await asyncio.sleep(self.interval)
+            self.lag.record(max(0.0, loop.time() - expected))
+
+    def start(self) -> None:
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self) -> None:
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+
+_recorders: Dict[str, LatencyRecorder] = {}
+loop_lag = LoopLagMonitor()
+
+
+def record(name: str, seconds: float, error: bool = False) -> None:
+    if name not in _recorders:
+        _recorders[name] = LatencyRecorder()
+    _recorders[name].record(seconds, error)
+
+
+class timer:
+    """Контекстный менеджер: with metrics.timer("webhook"): ..."""
+
+    def __init__(self, name: str):
+        self.name = name
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        record(self.name, time.perf_counter() - self.started, error=exc_type is not None)
+        return False
+
+
+def snapshot() -> Dict:
+    data = {name: recorder.summary() for name, recorder in _recorders.items()}
+    data["event_loop_lag"] = loop_lag.lag.summary()
+    return data
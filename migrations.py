@@ -0,0 +1,426 @@
+# migrations.py
+import logging
+
+logger = logging.getLogger(__name__)
+
+# Ключ advisory lock, чтобы бот и роутер не накатывали схему одновременно
+MIGRATIONS_LOCK_ID = 7_310_026
+
+# (версия, имя, список SQL-выражений). Применённые миграции не меняются —
+# любые изменения схемы добавляются новой версией в конец списка.
+MIGRATIONS = [
+    (1, "base_schema", [
+        """
+        CREATE TABLE IF NOT EXISTS users (
+            user_id BIGINT PRIMARY KEY,
+            chat_id BIGINT,
+            subscription_end TIMESTAMP,
+            subscription_type TEXT,
+            referral_uuid TEXT,
+            api_key TEXT,
+            secret_key TEXT,
+            passphrase TEXT,
+            exchange TEXT,
+            email TEXT,
+            affirmate_username TEXT,
+            terms_accepted BOOLEAN DEFAULT FALSE,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+        """,
+        "ALTER TABLE users ADD COLUMN IF NOT EXISTS email TEXT",
+        "ALTER TABLE users ADD COLUMN IF NOT EXISTS affirmate_username TEXT",
+        "ALTER TABLE users ADD COLUMN IF NOT EXISTS terms_accepted BOOLEAN DEFAULT FALSE",
+        """
+        CREATE TABLE IF NOT EXISTS payments (
+            invoice_id TEXT PRIMARY KEY,
+            user_id BIGINT,
+            amount REAL,
+            currency TEXT,
+            status TEXT,
+            tariff_id TEXT,
+            payment_method TEXT DEFAULT 'yoomoney',
+            yoomoney_label TEXT,
+            affirmate_username TEXT,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            FOREIGN KEY (user_id) REFERENCES users (user_id)
+        )
+        """,
+        "ALTER TABLE payments ADD COLUMN IF NOT EXISTS affirmate_username TEXT",
+        """
+        CREATE TABLE IF NOT EXISTS trades (
+            trade_id SERIAL PRIMARY KEY,
+            user_id BIGINT NOT NULL,
+            exchange VARCHAR(20) NOT NULL,
+            order_id VARCHAR(255) NOT NULL,
+            symbol TEXT NOT NULL,
+            side TEXT NOT NULL,
+            position_side TEXT NOT NULL,
+            quantity REAL NOT NULL,
+            entry_price REAL NOT NULL,
+            stop_loss REAL,
+            take_profit_1 REAL,
+            take_profit_2 REAL,
+            take_profit_3 REAL,
+            sl_order_id VARCHAR(255),
+            tp1_order_id VARCHAR(255),
+            tp2_order_id VARCHAR(255),
+            tp3_order_id VARCHAR(255),
+            status TEXT NOT NULL,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            FOREIGN KEY (user_id) REFERENCES users (user_id) ON DELETE CASCADE
+        )
+        """,
+    ]),
+    (2, "hot_query_indexes", [
+        # close_*_trade: WHERE user_id = %s AND symbol = %s AND status = 'open'
+        """
+        CREATE INDEX IF NOT EXISTS idx_trades_open_user_symbol
+            ON trades (user_id, symbol)
+            INCLUDE (side, position_side)
+            WHERE status = 'open'
+        """,
+        # ON DELETE CASCADE при удалении пользователей с истёкшей подпиской
+        "CREATE INDEX IF NOT EXISTS idx_trades_user_id ON trades (user_id)",
+        # Выборка подписчиков в webhook: index-only scan без обращения к heap
+        """
+        CREATE INDEX IF NOT EXISTS idx_users_active_subscribers
+            ON users (subscription_end)
+            INCLUDE (user_id, api_key, secret_key, passphrase, exchange)
+            WHERE api_key IS NOT NULL
+              AND secret_key IS NOT NULL
+              AND subscription_type IN ('referral_approved', 'regular')
+        """,
+        # Старые вызовы MOVE_SL, которые ещё ищут пользователя по api_key
+        "CREATE INDEX IF NOT EXISTS idx_users_api_key ON users (api_key) WHERE api_key IS NOT NULL",
+    ]),
+    (3, "trades_exchange_order_id_index", [
+        # Журнал сделок сопоставляет строки по (exchange, order_id) вместо trade_id
+        "CREATE INDEX IF NOT EXISTS idx_trades_exchange_order_id ON trades (exchange, order_id)",
+    ]),
+    (4, "signal_jobs_queue", [
+        # Очередь шардированного исполнения: одна строка на (сигнал, шард),
+        # воркеры забирают строки через FOR UPDATE SKIP LOCKED
+        """
+        CREATE TABLE IF NOT EXISTS signal_jobs (
+            job_id BIGSERIAL PRIMARY KEY,
+            signal_id TEXT NOT NULL,
+            kind TEXT NOT NULL,
+            shard INTEGER NOT NULL,
+            shards INTEGER NOT NULL,
+            payload JSONB NOT NULL,
+            status TEXT NOT NULL DEFAULT 'pending',
+            attempts INTEGER NOT NULL DEFAULT 0,
+            claimed_by TEXT,
+            result JSONB,
+            error TEXT,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            finished_at TIMESTAMP
+        )
+        """,
+        "CREATE INDEX IF NOT EXISTS idx_signal_jobs_pending ON signal_jobs (shard, job_id) WHERE status = 'pending'",
+        "CREATE INDEX IF NOT EXISTS idx_signal_jobs_signal_id ON signal_jobs (signal_id)",
+    ]),
+    (5, "user_key_health", [
+        # Карантин пользователей с нерабочими ключами (см. user_health.py)
+        "ALTER TABLE users ADD COLUMN IF NOT EXISTS key_status TEXT NOT NULL DEFAULT 'ok'",
+        "ALTER TABLE users ADD COLUMN IF NOT EXISTS key_failure_class TEXT",
+        "ALTER TABLE users ADD COLUMN IF NOT EXISTS key_failures INTEGER NOT NULL DEFAULT 0",
+        "ALTER TABLE users ADD COLUMN IF NOT EXISTS key_quarantine_level INTEGER NOT NULL DEFAULT 0",
+        "ALTER TABLE users ADD COLUMN IF NOT EXISTS key_probe_at TIMESTAMP",
+        # Выборка подписчиков читает и состояние ключей — пересобираем покрывающий индекс
+        "DROP INDEX IF EXISTS idx_users_active_subscribers",
+        """
+        CREATE INDEX IF NOT EXISTS idx_users_active_subscribers
+            ON users (subscription_end)
+            INCLUDE (user_id, api_key, secret_key, passphrase, exchange, key_status, key_failures)
+            WHERE api_key IS NOT NULL
+              AND secret_key IS NOT NULL
+              AND subscription_type IN ('referral_approved', 'regular')
+        """,
+        "CREATE INDEX IF NOT EXISTS idx_users_key_probe ON users (key_probe_at) WHERE key_status = 'quarantined'",
+    ]),
+    (6, "account_profiles", [
+        # Возможности аккаунта, снятые при подключении ключей (см. account_profile.py)
+        """
+        CREATE TABLE IF NOT EXISTS account_profiles (
+            user_id BIGINT PRIMARY KEY REFERENCES users (user_id) ON DELETE CASCADE,
+            exchange TEXT NOT NULL,
+            position_mode TEXT,
+            margin_mode TEXT,
+            can_trade BOOLEAN,
+            futures_enabled BOOLEAN,
+            balance REAL,
+            error TEXT,
+            probed_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+        """,
+    ]),
+    (7, "dispatch_fairness", [
+        # Ярус приоритета рассылки (scheduler.dispatch_order): старший ярус обходится первым
+        "ALTER TABLE users ADD COLUMN IF NOT EXISTS priority_tier SMALLINT NOT NULL DEFAULT 0",
+        "DROP INDEX IF EXISTS idx_users_active_subscribers",
+        """
+        CREATE INDEX IF NOT EXISTS idx_users_active_subscribers
+            ON users (subscription_end)
+            INCLUDE (user_id, api_key, secret_key, passphrase, exchange, key_status, key_failures, priority_tier)
+            WHERE api_key IS NOT NULL
+              AND secret_key IS NOT NULL
+              AND subscription_type IN ('referral_approved', 'regular')
+        """,
+        # Разброс латентности входа по пользователям для каждого сигнала (и шарда)
+        """
+        CREATE TABLE IF NOT EXISTS signal_dispatch_stats (
+            id BIGSERIAL PRIMARY KEY,
+            signal_id TEXT NOT NULL,
+            shard INTEGER,
+            dispatch_order TEXT NOT NULL,
+            users INTEGER NOT NULL,
+            p50_ms REAL,
+            p95_ms REAL,
+            max_ms REAL,
+            spread_ms REAL,
+            stddev_ms REAL,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+        """,
+        "CREATE INDEX IF NOT EXISTS idx_signal_dispatch_stats_created_at ON signal_dispatch_stats (created_at)",
+    ]),
+    (8, "trade_reconciliation", [
+        # Сверка открытых сделок с биржей (см. reconciler.py): сработавшие SL/TP и остаток позиции
+        "ALTER TABLE trades ADD COLUMN IF NOT EXISTS filled_legs TEXT[] NOT NULL DEFAULT '{}'",
+        "ALTER TABLE trades ADD COLUMN IF NOT EXISTS remaining_quantity REAL",
+        "ALTER TABLE trades ADD COLUMN IF NOT EXISTS reconciled_at TIMESTAMP",
+        "ALTER TABLE trades ADD COLUMN IF NOT EXISTS closed_at TIMESTAMP",
+        # Выборка reconciler: открытые сделки, сгруппированные по бирже и пользователю
+        "CREATE INDEX IF NOT EXISTS idx_trades_open_exchange_user ON trades (exchange, user_id) WHERE status = 'open'",
+        # Курсор истории ордеров: следующая сверка запрашивает только новые исполнения
+        """
+        CREATE TABLE IF NOT EXISTS reconcile_cursors (
+            user_id BIGINT NOT NULL REFERENCES users (user_id) ON DELETE CASCADE,
+            exchange TEXT NOT NULL,
+            cursor_ms BIGINT NOT NULL,
+            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            PRIMARY KEY (user_id, exchange)
+        )
+        """,
+    ]),
+    (9, "trades_partitioning", [
+        # trades делится по tier: hot — открытые и недавно закрытые сделки, archive — история
+        # по месяцам created_at. Закрытые сделки переносит в архив trade_archive.py, так что
+        # hot остаётся маленьким, а запросы открытых сделок (tier = 'hot') не видят историю.
+        "ALTER TABLE trades RENAME TO trades_unpartitioned",
+        # Имя индекса первичного ключа освобождаем для новой таблицы
+        "ALTER TABLE trades_unpartitioned RENAME CONSTRAINT trades_pkey TO trades_unpartitioned_pkey",
+        """
+        CREATE TABLE trades (
+            trade_id INTEGER NOT NULL DEFAULT nextval('trades_trade_id_seq'),
+            user_id BIGINT NOT NULL,
+            exchange VARCHAR(20) NOT NULL,
+            order_id VARCHAR(255) NOT NULL,
+            symbol TEXT NOT NULL,
+            side TEXT NOT NULL,
+            position_side TEXT NOT NULL,
+            quantity REAL NOT NULL,
+            entry_price REAL NOT NULL,
+            stop_loss REAL,
+            take_profit_1 REAL,
+            take_profit_2 REAL,
+            take_profit_3 REAL,
+            sl_order_id VARCHAR(255),
+            tp1_order_id VARCHAR(255),
+            tp2_order_id VARCHAR(255),
+            tp3_order_id VARCHAR(255),
+            status TEXT NOT NULL,
+            created_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+            filled_legs TEXT[] NOT NULL DEFAULT '{}',
+            remaining_quantity REAL,
+            reconciled_at TIMESTAMP,
+            closed_at TIMESTAMP,
+            tier TEXT NOT NULL DEFAULT 'hot',
+            PRIMARY KEY (trade_id, tier, created_at),
+            FOREIGN KEY (user_id) REFERENCES users (user_id) ON DELETE CASCADE
+        ) PARTITION BY LIST (tier)
+        """,
+        "ALTER SEQUENCE trades_trade_id_seq OWNED BY trades.trade_id",
+        # fillfactor — место под HOT-обновления статуса и ID ордеров; частый autovacuum после переноса в архив
+        """
+        CREATE TABLE trades_hot PARTITION OF trades FOR VALUES IN ('hot')
+            WITH (fillfactor = 80, autovacuum_vacuum_scale_factor = 0.02, autovacuum_analyze_scale_factor = 0.02)
+        """,
+        # Месячные разделы trades_archive_YYYY_MM создаёт trade_archive.py перед переносом
+        "CREATE TABLE trades_archive PARTITION OF trades FOR VALUES IN ('archive') PARTITION BY RANGE (created_at)",
+        # Вся история сначала попадает в hot; первый прогон trade_archive.py разложит её по месяцам
+        """
+        INSERT INTO trades (
+            trade_id, user_id, exchange, order_id, symbol, side, position_side, quantity, entry_price,
+            stop_loss, take_profit_1, take_profit_2, take_profit_3,
+            sl_order_id, tp1_order_id, tp2_order_id, tp3_order_id, status, created_at,
+            filled_legs, remaining_quantity, reconciled_at, closed_at
+        )
+        SELECT trade_id, user_id, exchange, order_id, symbol, side, position_side, quantity, entry_price,
+               stop_loss, take_profit_1, take_profit_2, take_profit_3,
+               sl_order_id, tp1_order_id, tp2_order_id, tp3_order_id, status,
+               COALESCE(created_at, CURRENT_TIMESTAMP),
+               filled_legs, remaining_quantity, reconciled_at, closed_at
+        FROM trades_unpartitioned
+        """,
+        "DROP TABLE trades_unpartitioned",
+        # Индексы открытых сделок нужны только в hot: горячие запросы отсекают архив по tier
+        """
+        CREATE INDEX IF NOT EXISTS idx_trades_open_user_symbol
+            ON trades_hot (user_id, symbol)
+            INCLUDE (side, position_side)
+            WHERE status = 'open'
+        """,
+        "CREATE INDEX IF NOT EXISTS idx_trades_open_exchange_user ON trades_hot (exchange, user_id) WHERE status = 'open'",
+        # Кандидаты на перенос в архив
+        """
+        CREATE INDEX IF NOT EXISTS idx_trades_hot_archivable
+            ON trades_hot ((COALESCE(closed_at, created_at)))
+            WHERE status <> 'open'
+        """,
+        # ON DELETE CASCADE и журнал сделок — по всем разделам
+        "CREATE INDEX IF NOT EXISTS idx_trades_user_id ON trades (user_id)",
+        "CREATE INDEX IF NOT EXISTS idx_trades_exchange_order_id ON trades (exchange, order_id)",
+    ]),
+    (10, "analytics_export", [
+        # Исходы входа по сигналу для выгрузки в Parquet (см. analytics_export.py)
+        "ALTER TABLE signal_dispatch_stats ADD COLUMN IF NOT EXISTS symbol TEXT",
+        "ALTER TABLE signal_dispatch_stats ADD COLUMN IF NOT EXISTS action TEXT",
+        "ALTER TABLE signal_dispatch_stats ADD COLUMN IF NOT EXISTS skipped INTEGER NOT NULL DEFAULT 0",
+        "ALTER TABLE signal_dispatch_stats ADD COLUMN IF NOT EXISTS failed INTEGER NOT NULL DEFAULT 0",
+        # Выгрузка закрытых сделок идёт по времени закрытия; в hot для этого есть idx_trades_hot_archivable
+        """
+        CREATE INDEX IF NOT EXISTS idx_trades_archive_closed
+            ON trades_archive ((COALESCE(closed_at, created_at)), trade_id)
+        """,
+    ]),
+    (11, "user_stats", [
+        # Статистика пользователя для бота (см. user_stats.py): чтение — одна строка по ключу
+        """
+        CREATE TABLE IF NOT EXISTS user_stats (
+            user_id BIGINT PRIMARY KEY REFERENCES users (user_id) ON DELETE CASCADE,
+            trades_closed INTEGER NOT NULL DEFAULT 0,
+            wins INTEGER NOT NULL DEFAULT 0,
+            losses INTEGER NOT NULL DEFAULT 0,
+            realized_pnl DOUBLE PRECISION NOT NULL DEFAULT 0,
+            open_trades INTEGER NOT NULL DEFAULT 0,
+            open_notional DOUBLE PRECISION NOT NULL DEFAULT 0,
+            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+        """,
+    ]),
+    (12, "signal_job_users", [
+        # Пользователи, чей вход по заданию signal_jobs уже начался (см. worker.py):
+        # повторная выдача задания после падения воркера их пропускает
+        """
+        CREATE TABLE IF NOT EXISTS signal_job_users (
+            signal_id TEXT NOT NULL,
+            user_id BIGINT NOT NULL,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            PRIMARY KEY (signal_id, user_id)
+        )
+        """,
+        "CREATE INDEX IF NOT EXISTS idx_signal_job_users_created_at ON signal_job_users (created_at)",
+    ]),
+    (13, "trade_contract_size", [
+        # quantity OKX — в контрактах: стоимость контракта в базовой валюте пишет журнал сделок.
+        # У остальных бирж quantity уже в базовой валюте; размер старых сделок OKX неизвестен
+        "ALTER TABLE trades ADD COLUMN IF NOT EXISTS ct_val REAL DEFAULT 1",
+        "UPDATE trades SET ct_val = NULL WHERE exchange = 'okx'",
+        # Начальные значения user_stats по всей истории (и пересчёт тех, что посчитаны без ct_val);
+        # дальше таблицу ведут пути закрытия и reconciler. Копия user_stats.BACKFILL_SQL на момент
+        # миграции: формула в user_stats может меняться, а применённая миграция — нет
+        """
+        INSERT INTO user_stats AS s (user_id, trades_closed, wins, losses, realized_pnl, open_trades, open_notional,
+                                     updated_at)
+        SELECT user_id,
+               COUNT(*) FILTER (WHERE status = 'closed'),
+               COUNT(*) FILTER (WHERE status = 'closed' AND pnl > 0),
+               COUNT(*) FILTER (WHERE status = 'closed' AND pnl < 0),
+               COALESCE(SUM(pnl) FILTER (WHERE status = 'closed'), 0),
+               COUNT(*) FILTER (WHERE status = 'open' AND tier = 'hot'),
+               COALESCE(SUM(notional) FILTER (WHERE status = 'open' AND tier = 'hot'), 0),
+               CURRENT_TIMESTAMP
+        FROM (
+            SELECT t.user_id, t.status, t.tier,
+                (CASE WHEN t.side = 'BUY' THEN 1 ELSE -1 END) * t.ct_val * (
+                    t.quantity / GREATEST(num_nonnulls(t.take_profit_1, t.take_profit_2, t.take_profit_3), 1) * (
+                        CASE WHEN 'tp1' = ANY(t.filled_legs) THEN COALESCE(t.take_profit_1 - t.entry_price, 0) ELSE 0 END
+                      + CASE WHEN 'tp2' = ANY(t.filled_legs) THEN COALESCE(t.take_profit_2 - t.entry_price, 0) ELSE 0 END
+                      + CASE WHEN 'tp3' = ANY(t.filled_legs) THEN COALESCE(t.take_profit_3 - t.entry_price, 0) ELSE 0 END
+                    )
+                  + CASE WHEN 'sl' = ANY(t.filled_legs) THEN COALESCE(t.stop_loss - t.entry_price, 0) * GREATEST(
+                        t.quantity - t.quantity / GREATEST(num_nonnulls(t.take_profit_1, t.take_profit_2, t.take_profit_3), 1)
+                            * (('tp1' = ANY(t.filled_legs))::int + ('tp2' = ANY(t.filled_legs))::int
+                               + ('tp3' = ANY(t.filled_legs))::int), 0)
+                    ELSE 0 END
+                ) AS pnl,
+                t.quantity * t.ct_val * t.entry_price AS notional
+            FROM trades t
+        ) history
+        GROUP BY user_id
+        ON CONFLICT (user_id) DO UPDATE SET
+            trades_closed = EXCLUDED.trades_closed,
+            wins = EXCLUDED.wins,
+            losses = EXCLUDED.losses,
+            realized_pnl = EXCLUDED.realized_pnl,
+            open_trades = EXCLUDED.open_trades,
+            open_notional = EXCLUDED.open_notional,
+            updated_at = CURRENT_TIMESTAMP
+        """,
+    ]),
+]
+
+
+def _row_value(row, key: str, index: int = 0):
+    return row[key] if isinstance(row, dict) else row[index]
+
+
+def get_schema_version(cursor) -> int:
+    cursor.execute("SELECT COALESCE(MAX(version), 0) AS version FROM schema_migrations")
+    return _row_value(cursor.fetchone(), "version")
+
+
+def run_migrations(conn) -> int:
+    """Применяет недостающие миграции по порядку и возвращает текущую версию схемы"""
+    cursor = conn.cursor()
+    try:
+        cursor.execute("SELECT pg_advisory_lock(%s)", (MIGRATIONS_LOCK_ID,))
+        cursor.execute("""
+            CREATE TABLE IF NOT EXISTS schema_migrations (
+                version INTEGER PRIMARY KEY,
+                name TEXT NOT NULL,
+                applied_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            )
+        """)
+        conn.commit()
+
+        cursor.execute("SELECT version FROM schema_migrations")
+        applied = {_row_value(row, "version") for row in cursor.fetchall()}
+
+        for version, name, statements in MIGRATIONS:
+            if version in applied:
+                continue
+            logger.info(f"Применяется миграция {version}: {name}")
+            for statement in statements:
+                cursor.execute(statement)
+            cursor.execute(
+                "INSERT INTO schema_migrations (version, name) VALUES (%s, %s)",
+                (version, name)
+            )
+            conn.commit()
+            logger.info(f"Миграция {version} применена")
+
+        return get_schema_version(cursor)
+    except Exception as e:
+        conn.rollback()
+        logger.error(f"Ошибка применения миграций: {e}")
+        raise
+    finally:
+        try:
+            cursor.execute("SELECT pg_advisory_unlock(%s)", (MIGRATIONS_LOCK_ID,))
+            conn.commit()
+        except Exception:
+            pass
+        cursor.close()
@@ -1,16 +1,49 @@
 # models.py
-from pydantic import BaseModel
-from typing import Optional
+import math
+from pydantic import BaseModel, ConfigDict, field_validator
+from typing import List, Optional
+
+# LONG/SHORT из TradingView приводятся к BUY/SELL
+SIGNAL_ACTIONS = {"BUY": "BUY", "SELL": "SELL", "LONG": "BUY", "SHORT": "SELL", "MOVE_SL": "MOVE_SL"}
 
 class Signal(BaseModel):
+    model_config = ConfigDict(frozen=True)
+
     action: str
     symbol: str
-    price: float
+    price: Optional[float] = None
     stop_loss: Optional[float] = None
     take_profit_1: Optional[float] = None
     take_profit_2: Optional[float] = None
     take_profit_3: Optional[float] = None
 
+    @field_validator("action", mode="before")
+    @classmethod
+    def normalize_action(cls, value):
+        action = str(value or "").upper()
+        if action not in SIGNAL_ACTIONS:
+            raise ValueError("Действие должно быть BUY, SELL, LONG, SHORT или MOVE_SL")
+        return SIGNAL_ACTIONS[action]
+
+    @field_validator("symbol")
+    @classmethod
+    def non_empty_symbol(cls, value: str) -> str:
+        if not value.strip():
+            raise ValueError("Необходимо указать символ")
+        return value
+
+    @field_validator("price", "stop_loss", "take_profit_1", "take_profit_2", "take_profit_3")
+    @classmethod
+    def finite_or_none(cls, value: Optional[float]) -> Optional[float]:
+        # TradingView шлёт NaN для незаданных уровней — считаем их отсутствующими
+        if value is None or math.isnan(value) or math.isinf(value):
+            return None
+        return value
+
+    @property
+    def take_profits(self) -> list:
+        return [self.take_profit_1, self.take_profit_2, self.take_profit_3]
+
 class Trade(BaseModel):
     trade_id: Optional[int] = None
     user_id: int
@@ -36,4 +69,10 @@ class User(BaseModel):
     api_key: str
     secret_key: str
     passphrase: Optional[str] = None
-    exchange: str
\ No newline at end of file
+    exchange: str
+
+class FlattenRequest(BaseModel):
+    """Аварийное закрытие: None — все пользователи, биржи или символы"""
+    user_ids: Optional[List[int]] = None
+    exchanges: Optional[List[str]] = None
+    symbols: Optional[List[str]] = None
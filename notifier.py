@@ -0,0 +1,28 @@
+# notifier.py
+"""Telegram-клиент для уведомлений из процесса вебхука.
+
+Не тянет за собой main.py (свою БД, миграции, YooMoney и хендлеры aiogram) —
+только Bot для send_message.
+"""
+import os
+
+from aiogram import Bot
+from dotenv import load_dotenv
+
+load_dotenv()
+
+BOT_TOKEN = os.getenv("BOT_TOKEN")
+# Для нагрузочных прогонов Bot API подменяется заглушкой симулятора
+EXCHANGE_SIMULATOR_URL = os.getenv("EXCHANGE_SIMULATOR_URL")
+
+
+def create_bot() -> Bot:
+    if EXCHANGE_SIMULATOR_URL:
+        from aiogram.client.session.aiohttp import AiohttpSession
+        from aiogram.client.telegram import TelegramAPIServer
+        return Bot(token=BOT_TOKEN, session=AiohttpSession(
+            api=TelegramAPIServer.from_base(f"{EXCHANGE_SIMULATOR_URL}/telegram")))
+    return Bot(token=BOT_TOKEN)
+
+
+bot = create_bot()
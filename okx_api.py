@@ -1,11 +1,15 @@
 import json
 import logging
-from okx.PublicData import PublicAPI
-from okx.Trade import TradeAPI
-from okx.Account import AccountAPI
-from okx.MarketData import MarketAPI
+import os
+import time
 
-from database import get_cursor, commit
+from database import transaction
+from cache import instrument_cache, leverage_cache, account_key
+from ws_trading import WSTimeout, WSUnavailable, client_order_id, ws_trading
+from fill_watcher import wait_for_fill_blocking
+from deadline import request_timeout
+from exchange_errors import DuplicateOrderError, ExchangeError, NetworkError, RetryableError, classify, raise_for
+from concurrency import is_transient
 
 logger = logging.getLogger(__name__)
 
@@ -26,7 +30,78 @@ def safe_json_dumps(data):
     except UnicodeDecodeError:
         return json.dumps(data, ensure_ascii=False, default=str)
 
-APIURL = "https://www.okx.com"
+EXCHANGE_SIMULATOR_URL = os.getenv("EXCHANGE_SIMULATOR_URL")
+APIURL = f"{EXCHANGE_SIMULATOR_URL}/okx" if EXCHANGE_SIMULATOR_URL else "https://www.okx.com"
+
+# SDK okx импортируется при первом обращении к OKX, а не при старте процесса
+def _with_timeout(client):
+    # Клиенты SDK — httpx.Client без таймаута по умолчанию; берём остаток бюджета сигнала
+    client.timeout = request_timeout()
+    return client
+
+def _public_api():
+    from okx.PublicData import PublicAPI
+    return _with_timeout(PublicAPI(flag="0", domain=APIURL, debug=True))
+
+def _market_api():
+    from okx.MarketData import MarketAPI
+    return _with_timeout(MarketAPI(flag="0", domain=APIURL, debug=True))
+
+def _account_api(api_key: str, secret_key: str, passphrase: str):
+    from okx.Account import AccountAPI
+    return _with_timeout(AccountAPI(api_key, secret_key, passphrase, flag="0", domain=APIURL, debug=True))
+
+def _trade_api(api_key: str, secret_key: str, passphrase: str):
+    from okx.Trade import TradeAPI
+    return _with_timeout(TradeAPI(api_key, secret_key, passphrase, flag="0", domain=APIURL, debug=True))
+
+
+def _place_order(trade_api, params: dict, api_key: str, secret_key: str, passphrase: str) -> dict:
+    """Ордер через WS-сессию аккаунта (ws_trading), при недоступности канала — через REST.
+    По clOrdId после таймаута WS проверяем, не дошёл ли ордер, чтобы не выставить его дважды."""
+    params = dict(params)
+    params.setdefault("clOrdId", client_order_id())
+    try:
+        return ws_trading.request("okx", api_key, secret_key, passphrase, "order", params)
+    except WSTimeout as e:
+        logger.warning(f"{e}; проверяем ордер {params['clOrdId']} через REST")
+        existing = trade_api.get_order(instId=params["instId"], clOrdId=params["clOrdId"])
+        if existing.get("code") == "0" and existing.get("data"):
+            return {"code": "0", "msg": "", "data": [
+                {"ordId": existing["data"][0]["ordId"], "clOrdId": params["clOrdId"], "sCode": "0", "sMsg": ""}
+            ]}
+    except WSUnavailable as e:
+        logger.info(f"WS OKX недоступен ({e}), ордер через REST")
+    return trade_api.place_order(**params)
+
+
+def amend_order(symbol: str, order_id: str, api_key: str, secret_key: str, passphrase: str,
+                new_size: float = None, new_price: float = None) -> bool:
+    params = {"instId": symbol, "ordId": order_id}
+    if new_size is not None:
+        params["newSz"] = str(new_size)
+    if new_price is not None:
+        params["newPx"] = str(new_price)
+    try:
+        try:
+            response = ws_trading.request("okx", api_key, secret_key, passphrase, "amend-order", params)
+        except WSUnavailable as e:
+            # Повтор изменения безопасен: биржа применит те же значения
+            logger.info(f"WS OKX недоступен ({e}), изменение ордера через REST")
+            response = _trade_api(api_key, secret_key, passphrase).amend_order(**params)
+        if response.get("code") != "0":
+            raise ValueError(f"Ошибка изменения ордера: {response.get('msg')} {response.get('data')}")
+        logger.info(f"Ордер {order_id} для {symbol} изменён: {params}")
+        return True
+    except Exception as e:
+        logger.error(f"Ошибка при изменении ордера {order_id} для {symbol}: {str(e)}")
+        raise
+
+
+# posMode и acctLv из настроек аккаунта OKX -> поля профиля (account_profile.py)
+OKX_POSITION_MODES = {"long_short_mode": "hedge", "net_mode": "one_way"}
+OKX_ACCOUNT_LEVELS = {"1": "simple", "2": "single_currency_margin", "3": "multi_currency_margin",
+                      "4": "portfolio_margin"}
 
 
 def determine_position_side(side: str) -> str:
@@ -38,20 +113,50 @@ def determine_position_side(side: str) -> str:
     else:
         return "net"
 
+def _instrument_info(data: dict) -> dict:
+    return {
+        "lotSz": float(data["lotSz"]),
+        "minSz": float(data["minSz"]),
+        "ctVal": float(data["ctVal"]),
+        "lever": int(data["lever"])
+    }
+
+
+def list_symbols() -> list:
+    """Все USDT-свопы OKX; заодно кэширует их параметры для get_symbol_info"""
+    cached = instrument_cache.get(("symbols", "okx"))
+    if cached is not None:
+        return cached
+    response = _public_api().get_instruments(instType="SWAP")
+    if response.get("code") != "0":
+        raise_for("okx", response.get("code"), response.get("msg"), "Ошибка получения списка инструментов OKX")
+    symbols = []
+    for data in response["data"]:
+        if not data["instId"].endswith("-USDT-SWAP"):
+            continue
+        try:
+            instrument_cache.set(("okx", data["instId"]), _instrument_info(data))
+        except (KeyError, ValueError):
+            # У инструментов в статусе preopen часть полей пустая
+            continue
+        symbols.append(data["instId"])
+    instrument_cache.set(("symbols", "okx"), symbols)
+    return symbols
+
+
 def get_symbol_info(symbol: str, api_key: str, secret_key: str, passphrase: str) -> dict:
+    cached = instrument_cache.get(("okx", symbol))
+    if cached is not None:
+        return cached
     try:
-        pub_api = PublicAPI(flag ="0", domain=APIURL, debug=True)
+        pub_api = _public_api()
         response = pub_api.get_instruments(instType="SWAP", instId=symbol)
         logger.info(f"Ответ API инструментов OKX: {json.dumps(response, indent=2)}")
         if response.get("code") != "0":
-            raise ValueError(f"Ошибка получения информации о символе: {response.get('msg')}")
-        data = response["data"][0]
-        return {
-            "lotSz": float(data["lotSz"]),
-            "minSz": float(data["minSz"]),
-            "ctVal": float(data["ctVal"]),
-            "lever": int(data["lever"])
-        }
+            raise_for("okx", response.get("code"), response.get("msg"), "Ошибка получения информации о символе")
+        info = _instrument_info(response["data"][0])
+        instrument_cache.set(("okx", symbol), info)
+        return info
     except Exception as e:
         logger.error(f"Ошибка при получении информации о символе {symbol}: {str(e)}")
         raise
@@ -59,11 +164,11 @@ def get_symbol_info(symbol: str, api_key: str, secret_key: str, passphrase: str)
 
 def get_current_price(symbol: str, api_key: str, secret_key: str, passphrase: str) -> float:
     try:
-        market_api = MarketAPI(flag="0", domain=APIURL, debug=True)
+        market_api = _market_api()
         response = market_api.get_ticker(instId=symbol)
         logger.info(f"Ответ API цены OKX: {json.dumps(response, indent=2)}")
         if response.get("code") != "0":
-            raise ValueError(f"Ошибка получения цены: {response.get('msg')}")
+            raise_for("okx", response.get("code"), response.get("msg"), "Ошибка получения цены")
         return float(response["data"][0]["last"])
     except Exception as e:
         logger.error(f"Ошибка при получении цены для {symbol}: {str(e)}")
@@ -72,14 +177,14 @@ def get_current_price(symbol: str, api_key: str, secret_key: str, passphrase: st
 
 def get_balance(api_key: str, secret_key: str, passphrase: str) -> float:
     try:
-        account_api = AccountAPI(api_key, secret_key, passphrase, flag="0", domain=APIURL, debug=True)
+        account_api = _account_api(api_key, secret_key, passphrase)
         response = account_api.get_account_balance(ccy="USDT")
 
         # Используем безопасную сериализацию для логирования
         logger.info(f"Ответ API баланса OKX: {safe_json_dumps(response)}")
 
         if response.get("code") != "0":
-            raise ValueError(f"Ошибка получения баланса: {response.get('msg')}")
+            raise_for("okx", response.get("code"), response.get("msg"), "Ошибка получения баланса")
 
         if not response.get("data") or not response["data"][0].get("details"):
             raise ValueError("Данные баланса отсутствуют или валюта USDT не найдена")
@@ -97,10 +202,48 @@ def get_balance(api_key: str, secret_key: str, passphrase: str) -> float:
         raise
 
 
+def get_account_profile(api_key: str, secret_key: str, passphrase: str) -> dict:
+    """Возможности аккаунта для account_profile.probe_account"""
+    account_api = _account_api(api_key, secret_key, passphrase)
+    response = account_api.get_account_config()
+    if response.get("code") != "0":
+        raise_for("okx", response.get("code"), response.get("msg"), "Ошибка получения настроек аккаунта")
+    config = response["data"][0]
+    permissions = [perm.strip() for perm in (config.get("perm") or "").split(",") if perm.strip()]
+    return {
+        "position_mode": OKX_POSITION_MODES.get(config.get("posMode")),
+        "margin_mode": OKX_ACCOUNT_LEVELS.get(config.get("acctLv"), config.get("acctLv")),
+        "can_trade": "trade" in permissions if permissions else None,
+        # В режиме Simple торговать SWAP-контрактами нельзя
+        "futures_enabled": config.get("acctLv") != "1",
+        "balance": get_balance(api_key, secret_key, passphrase),
+    }
+
+
 def set_leverage(symbol: str, leverage: int = 5, tdMode: str = "isolated", api_key: str = None,
-                 secret_key: str = None, passphrase: str = None) -> bool:
+                 secret_key: str = None, passphrase: str = None, position_mode: str = None) -> bool:
+    cache_key = ("okx", account_key(api_key), symbol, leverage, tdMode)
+    if leverage_cache.get(cache_key):
+        logger.info(f"Плечо {leverage}x для {symbol} ({tdMode}) уже установлено")
+        return True
     try:
-        account_api = AccountAPI(api_key, secret_key, passphrase, flag="0", domain=APIURL, debug=True)
+        account_api = _account_api(api_key, secret_key, passphrase)
+
+        if position_mode:
+            # Режим позиции известен из профиля аккаунта: сразу нужный запрос, без перебора вариантов.
+            # В хедж-режиме изолированное плечо задаётся отдельно для long и short.
+            pos_sides = ["long", "short"] if position_mode == "hedge" and tdMode == "isolated" else [None]
+            for pos_side in pos_sides:
+                params = {"lever": str(leverage), "mgnMode": tdMode, "instId": symbol}
+                if pos_side:
+                    params["posSide"] = pos_side
+                response = account_api.set_leverage(**params)
+                if response.get("code") != "0":
+                    logger.warning(f"Не удалось установить плечо {params}: {response.get('msg')}, продолжаем...")
+                    return True
+            logger.info(f"Плечо {leverage}x установлено для {symbol} ({tdMode}, {position_mode})")
+            leverage_cache.set(cache_key, True)
+            return True
 
         # Пробуем разные варианты установки плеча
         params_variants = [
@@ -123,6 +266,7 @@ def set_leverage(symbol: str, leverage: int = 5, tdMode: str = "isolated", api_k
                 if response.get("code") == "0":
                     logger.info(f"Плечо {leverage}x успешно установлено для {symbol} ({tdMode})")
                     logger.info(f"Ответ API установки плеча OKX: {json.dumps(response, indent=2)}")
+                    leverage_cache.set(cache_key, True)
                     return True
                 else:
                     last_error = response.get('msg')
@@ -141,6 +285,7 @@ def set_leverage(symbol: str, leverage: int = 5, tdMode: str = "isolated", api_k
 
             if response.get("code") == "0":
                 logger.info(f"Плечо {leverage}x успешно установлено для {symbol} с posSide")
+                leverage_cache.set(cache_key, True)
                 return True
             else:
                 last_error = response.get('msg')
@@ -204,10 +349,133 @@ def calculate_quantity(symbol: str, leverage: int = 5, risk_percent: float = 0.1
         raise
 
 
+def _place_entry(trade_api, params: dict, api_key: str, secret_key: str, passphrase: str) -> dict:
+    """Вход через _place_order. Обрыв ответа, дубль clOrdId и временные отказы поднимаются
+    типизированной ошибкой до retry_call: вход мог уже дойти до биржи, и перебор вариантов
+    открыл бы вторую позицию. Остальные отказы возвращаются ответом — пробуем следующий вариант."""
+    try:
+        response = _place_order(trade_api, params, api_key, secret_key, passphrase)
+    except Exception as e:
+        if is_transient(e) and not isinstance(e, ExchangeError):
+            raise NetworkError("okx", None, str(e), "Ответ на вход не получен") from e
+        raise
+    if response.get("code") != "0":
+        # Код отказа конкретного ордера OKX отдаёт в data[0].sCode
+        result = (response.get("data") or [{}])[0]
+        error = classify("okx", result.get("sCode") or response.get("code"), result.get("sMsg") or response.get("msg"),
+                         "Ошибка создания ордера")
+        if error.retryable or isinstance(error, DuplicateOrderError):
+            raise error
+    return response
+
+
+def _protection_orders(side: str, quantity: float, lot_size: float, stop_loss: float, take_profits: list,
+                       tp_quantities: list = None) -> tuple:
+    """SL и TP входа в формате attachAlgoOrds и TP, отсортированные от ближнего к дальнему"""
+    quantity_str = f"{quantity:.2f}"
+    sl_side = "buy" if side == "SELL" else "sell"
+
+    algo_orders = []
+
+    # SL ордер
+    algo_orders.append({
+        "slTriggerPx": str(round(stop_loss, 4)),
+        "slOrdPx": "-1",
+        "sz": quantity_str,
+        "side": sl_side,
+        "tpTriggerPx": "",
+        "tpOrdPx": "",
+        "triggerPxType": "last"
+    })
+
+    # Распределение количества для TP ордеров (если не посчитано заранее sizing.size_cohort)
+    if tp_quantities is not None:
+        tp_quantities = [f"{qty:.2f}" for qty in tp_quantities]
+    else:
+        total_lots = int(quantity / lot_size)
+        tp_lots_base = total_lots // 3
+        tp_lots_remainder = total_lots % 3
+
+        tp_quantities = []
+        for i in range(3):
+            lots = tp_lots_base + (1 if i < tp_lots_remainder else 0)
+            tp_qty = lots * lot_size
+            tp_quantities.append(f"{tp_qty:.2f}")
+
+        total_tp_size = sum(float(qty) for qty in tp_quantities)
+        if abs(total_tp_size - float(quantity_str)) > 0.0001:
+            # Корректируем последнюю часть
+            correction = float(quantity_str) - total_tp_size
+            tp_quantities[-1] = f"{float(tp_quantities[-1]) + correction:.2f}"
+            logger.info(f"Скорректированы TP размеры: {tp_quantities}")
+
+    sorted_take_profits = sorted(take_profits) if side == "BUY" else sorted(take_profits, reverse=True)
+
+    # TP ордера
+    for tp_price, tp_qty in zip(sorted_take_profits, tp_quantities):
+        if tp_price is not None:
+            algo_orders.append({
+                "tpTriggerPx": str(round(tp_price, 4)),
+                "tpOrdPx": "-1",
+                "sz": tp_qty,
+                "side": sl_side,
+                "slTriggerPx": "",
+                "slOrdPx": "",
+                "triggerPxType": "last"
+            })
+
+    logger.info(
+        f"TP размеры: {tp_quantities}, сумма: {sum(float(q) for q in tp_quantities)}, основной ордер: {quantity_str}")
+
+    return algo_orders, sorted_take_profits
+
+
+def _place_protection(trade_api, symbol: str, tdMode: str, algo_orders: list, pos_side: str = None) -> list:
+    """Выставляет SL/TP отдельными алгоритмическими ордерами к уже исполненному входу"""
+    algo_order_ids = []
+    for algo_order in algo_orders:
+        algo_params = {
+            "instId": symbol,
+            "tdMode": tdMode,
+            "side": algo_order["side"],
+            "ordType": "conditional",
+            "sz": algo_order["sz"],
+            "triggerPxType": algo_order["triggerPxType"]
+        }
+
+        # Добавляем posSide если он был использован в основном ордере
+        if pos_side:
+            algo_params["posSide"] = pos_side
+
+        # Добавляем параметры в зависимости от типа ордера
+        if algo_order.get("slTriggerPx"):
+            algo_params["slTriggerPx"] = algo_order["slTriggerPx"]
+            algo_params["slOrdPx"] = algo_order["slOrdPx"]
+        else:
+            algo_params["tpTriggerPx"] = algo_order["tpTriggerPx"]
+            algo_params["tpOrdPx"] = algo_order["tpOrdPx"]
+
+        # Сбой одной ноги не отменяет остальные: вход уже исполнен
+        try:
+            algo_response = trade_api.place_algo_order(**algo_params)
+        except Exception as e:
+            logger.error(f"Ошибка создания алгоритмического ордера: {e}")
+            continue
+        if algo_response.get("code") == "0":
+            algo_id = algo_response["data"][0]["algoId"]
+            algo_order_ids.append(algo_id)
+            logger.info(f"Алгоритмический ордер создан: {algo_id}")
+        else:
+            logger.error(f"Ошибка создания алгоритмического ордера: {algo_response.get('msg')}")
+
+    return algo_order_ids
+
+
 def create_main_order(symbol: str, side: str, quantity: float, stop_loss: float, take_profits: list,
-                      tdMode: str = "isolated", api_key: str = None, secret_key: str = None, passphrase: str = None):
+                      tdMode: str = "isolated", api_key: str = None, secret_key: str = None, passphrase: str = None,
+                      tp_quantities: list = None, position_mode: str = None, client_id: str = None):
     try:
-        trade_api = TradeAPI(api_key, secret_key, passphrase, flag="0", domain=APIURL, debug=True)
+        trade_api = _trade_api(api_key, secret_key, passphrase)
 
         # Определяем позицию для OKX
         # Для SWAP контрактов используем net позиции, но некоторые инструменты требуют long/short
@@ -220,9 +488,6 @@ def create_main_order(symbol: str, side: str, quantity: float, stop_loss: float,
         elif side.upper() == "SELL":
             pos_side = "short"
 
-        # Определяем направление для SL/TP ордеров
-        sl_side = "buy" if side == "SELL" else "sell"
-
         symbol_info = get_symbol_info(symbol, api_key, secret_key, passphrase)
         lot_size = symbol_info["lotSz"]
 
@@ -230,54 +495,8 @@ def create_main_order(symbol: str, side: str, quantity: float, stop_loss: float,
         quantity_str = f"{quantity:.2f}"
         logger.info(f"Округленное количество для ордера: {quantity_str} контрактов")
 
-        algo_orders = []
-
-        # SL ордер
-        algo_orders.append({
-            "slTriggerPx": str(round(stop_loss, 4)),
-            "slOrdPx": "-1",
-            "sz": quantity_str,
-            "side": sl_side,
-            "tpTriggerPx": "",
-            "tpOrdPx": "",
-            "triggerPxType": "last"
-        })
-
-        # Распределение количества для TP ордеров
-        total_lots = int(quantity / lot_size)
-        tp_lots_base = total_lots // 3
-        tp_lots_remainder = total_lots % 3
-
-        tp_quantities = []
-        for i in range(3):
-            lots = tp_lots_base + (1 if i < tp_lots_remainder else 0)
-            tp_qty = lots * lot_size
-            tp_quantities.append(f"{tp_qty:.2f}")
-
-        total_tp_size = sum(float(qty) for qty in tp_quantities)
-        if abs(total_tp_size - float(quantity_str)) > 0.0001:
-            # Корректируем последнюю часть
-            correction = float(quantity_str) - total_tp_size
-            tp_quantities[-1] = f"{float(tp_quantities[-1]) + correction:.2f}"
-            logger.info(f"Скорректированы TP размеры: {tp_quantities}")
-
-        sorted_take_profits = sorted(take_profits) if side == "BUY" else sorted(take_profits, reverse=True)
-
-        # TP ордера
-        for tp_price, tp_qty in zip(sorted_take_profits, tp_quantities):
-            if tp_price is not None:
-                algo_orders.append({
-                    "tpTriggerPx": str(round(tp_price, 4)),
-                    "tpOrdPx": "-1",
-                    "sz": tp_qty,
-                    "side": sl_side,
-                    "slTriggerPx": "",
-                    "slOrdPx": "",
-                    "triggerPxType": "last"
-                })
-
-        logger.info(
-            f"TP размеры: {tp_quantities}, сумма: {sum(float(q) for q in tp_quantities)}, основной ордер: {quantity_str}")
+        algo_orders, sorted_take_profits = _protection_orders(side, quantity, lot_size, stop_loss, take_profits,
+                                                              tp_quantities)
 
         # Параметры основного ордера - ПРОБУЕМ РАЗНЫЕ ВАРИАНТЫ
         order_variants = [
@@ -312,6 +531,17 @@ def create_main_order(symbol: str, side: str, quantity: float, stop_loss: float,
             }
         ]
 
+        # Режим позиции из профиля аккаунта оставляет единственный подходящий вариант
+        if position_mode == "one_way":
+            order_variants = order_variants[:1]
+        elif position_mode == "hedge":
+            order_variants = order_variants[2:]
+
+        # Один clOrdId на все варианты: исполниться может только один, а повтор входа биржа отклонит как дубль
+        if client_id:
+            for order_params in order_variants:
+                order_params["clOrdId"] = client_id
+
         response = None
         last_error = None
 
@@ -319,7 +549,7 @@ def create_main_order(symbol: str, side: str, quantity: float, stop_loss: float,
             try:
                 logger.info(f"Попытка {i + 1}: Создание ордера с параметрами: {order_params}")
 
-                response = trade_api.place_order(**order_params)
+                response = _place_entry(trade_api, order_params, api_key, secret_key, passphrase)
                 logger.info(f"Ответ API создания ордера OKX: {json.dumps(response, indent=2)}")
 
                 if response.get("code") == "0":
@@ -332,6 +562,8 @@ def create_main_order(symbol: str, side: str, quantity: float, stop_loss: float,
                     last_error = response.get('msg')
                     logger.warning(f"Не удалось создать ордер с вариантом {i + 1}: {last_error}")
 
+            except (RetryableError, DuplicateOrderError):
+                raise
             except Exception as e:
                 last_error = str(e)
                 logger.warning(f"Ошибка при создании ордера с вариантом {i + 1}: {last_error}")
@@ -347,71 +579,96 @@ def create_main_order(symbol: str, side: str, quantity: float, stop_loss: float,
             {"instId": symbol, "tdMode": tdMode, "side": side.lower(), "ordType": "market", "sz": quantity_str,
              "posSide": pos_side}
         ]
-
-        for i, main_params in enumerate(main_order_variants):
+        if position_mode == "one_way":
+            main_order_variants = main_order_variants[:1]
+        elif position_mode == "hedge":
+            main_order_variants = main_order_variants[2:]
+        if client_id:
+            for main_params in main_order_variants:
+                main_params["clOrdId"] = client_id
+
+        main_response, main_params = None, None
+        for i, variant_params in enumerate(main_order_variants):
             try:
-                logger.info(f"Попытка основного ордера {i + 1}: {main_params}")
-                main_response = trade_api.place_order(**main_params)
-
-                if main_response.get("code") == "0":
-                    order_id = main_response["data"][0]["ordId"]
-                    logger.info(f"Основной ордер создан: {order_id}")
-
-                    # Затем создаем алгоритмические ордера отдельно
-                    algo_order_ids = []
-                    for algo_order in algo_orders:
-                        time.sleep(0.5)
-
-                        algo_params = {
-                            "instId": symbol,
-                            "tdMode": tdMode,
-                            "side": algo_order["side"],
-                            "ordType": "conditional",
-                            "sz": algo_order["sz"],
-                            "triggerPxType": algo_order["triggerPxType"]
-                        }
-
-                        # Добавляем posSide если он был использован в основном ордере
-                        if "posSide" in main_params:
-                            algo_params["posSide"] = main_params["posSide"]
-
-                        # Добавляем параметры в зависимости от типа ордера
-                        if algo_order.get("slTriggerPx"):
-                            algo_params["slTriggerPx"] = algo_order["slTriggerPx"]
-                            algo_params["slOrdPx"] = algo_order["slOrdPx"]
-                        else:
-                            algo_params["tpTriggerPx"] = algo_order["tpTriggerPx"]
-                            algo_params["tpOrdPx"] = algo_order["tpOrdPx"]
-
-                        algo_response = trade_api.place_algo_order(**algo_params)
-                        if algo_response.get("code") == "0":
-                            algo_id = algo_response["data"][0]["algoId"]
-                            algo_order_ids.append(algo_id)
-                            logger.info(f"Алгоритмический ордер создан: {algo_id}")
-                        else:
-                            logger.error(f"Ошибка создания алгоритмического ордера: {algo_response.get('msg')}")
-
-                    return main_response, sorted_take_profits, order_id, algo_order_ids, main_params.get("posSide",
-                                                                                                         "net")
-
+                logger.info(f"Попытка основного ордера {i + 1}: {variant_params}")
+                variant_response = _place_entry(trade_api, variant_params, api_key, secret_key, passphrase)
+            except (RetryableError, DuplicateOrderError):
+                raise
             except Exception as e:
-                logger.error(f"Ошибка при создании основного ордера с вариантом {i + 1}: {str(e)}")
+                last_error = str(e)
+                logger.error(f"Ошибка при создании основного ордера с вариантом {i + 1}: {last_error}")
                 continue
+            if variant_response.get("code") == "0":
+                # Биржа приняла вход — другие варианты больше не пробуем, иначе откроется вторая позиция
+                main_response, main_params = variant_response, variant_params
+                break
+            last_error = variant_response.get("msg")
+            logger.warning(f"Не удалось создать основной ордер с вариантом {i + 1}: {last_error}")
+
+        if main_response is None:
+            raise ValueError(f"Не удалось создать ордер после всех попыток. Последняя ошибка: {last_error}")
+
+        order_id = main_response["data"][0]["ordId"]
+        logger.info(f"Основной ордер создан: {order_id}")
+
+        # Затем создаем алгоритмические ордера отдельно — сразу после подтверждения исполнения входа
+        fill = wait_for_fill_blocking(
+            "okx", lambda: trade_api.get_order(instId=symbol, ordId=order_id)["data"][0]
+        )
+        if fill and fill["state"] == "dead":
+            raise ValueError(f"Основной ордер {order_id} не исполнен: {fill['status']}")
 
-        # Если ничего не помогло
-        raise ValueError(f"Не удалось создать ордер после всех попыток. Последняя ошибка: {last_error}")
+        algo_order_ids = _place_protection(trade_api, symbol, tdMode, algo_orders, main_params.get("posSide"))
+
+        return main_response, sorted_take_profits, order_id, algo_order_ids, main_params.get("posSide", "net")
 
     except Exception as e:
         logger.error(f"Ошибка при создании основного ордера для {symbol}: {str(e)}")
         raise
 
+def recover_main_order(symbol: str, side: str, quantity: float, stop_loss: float, take_profits: list,
+                       tdMode: str = "isolated", api_key: str = None, secret_key: str = None, passphrase: str = None,
+                       tp_quantities: list = None, position_mode: str = None, client_id: str = None):
+    """Вход, ответ на который потерян: ищет ордер по clOrdId и доводит его до результата create_main_order —
+    ждёт исполнения и ставит SL/TP, если они не были прикреплены к ордеру. None — биржа такого ордера не знает."""
+    if not client_id:
+        return None
+    trade_api = _trade_api(api_key, secret_key, passphrase)
+    response = trade_api.get_order(instId=symbol, clOrdId=client_id)
+    if response.get("code") != "0" or not response.get("data"):
+        return None
+    order = response["data"][0]
+    order_id = order["ordId"]
+    logger.info(f"Вход {client_id} для {symbol} уже на бирже: {order_id}")
+
+    fill = wait_for_fill_blocking(
+        "okx", lambda: trade_api.get_order(instId=symbol, ordId=order_id)["data"][0]
+    )
+    if fill and fill["state"] == "dead":
+        raise ValueError(f"Основной ордер {order_id} не исполнен: {fill['status']}")
+
+    lot_size = get_symbol_info(symbol, api_key, secret_key, passphrase)["lotSz"]
+    algo_orders, sorted_take_profits = _protection_orders(side, float(order["sz"]), lot_size, stop_loss,
+                                                          take_profits, tp_quantities)
+    pos_side = order.get("posSide") or "net"
+    if order.get("attachAlgoOrds"):
+        # SL/TP ушли вместе со входом — берём их id из списка алгоритмических ордеров
+        sl_side = algo_orders[0]["side"]
+        algos = trade_api.order_algos_list(ordType="conditional", instId=symbol)
+        algo_order_ids = [algo["algoId"] for algo in algos.get("data") or [] if algo.get("side") == sl_side]
+    else:
+        algo_order_ids = _place_protection(trade_api, symbol, tdMode, algo_orders,
+                                           pos_side if pos_side != "net" else None)
+    response = {"code": "0", "msg": "", "data": [{"ordId": order_id, "clOrdId": client_id, "sCode": "0", "sMsg": ""}]}
+    return response, sorted_take_profits, order_id, algo_order_ids, pos_side
+
 def get_order_status(symbol: str, order_id: str, api_key: str, secret_key: str, passphrase: str) -> dict:
     try:
-        trade_api = TradeAPI(api_key, secret_key, passphrase, flag="0", domain=APIURL, debug=True)
+        trade_api = _trade_api(api_key, secret_key, passphrase)
         response = trade_api.get_order(instId=symbol, ordId=order_id)
         logger.info(f"Ответ API статуса ордера OKX: {json.dumps(response, indent=2)}")
         if response.get("code") != "0":
-            raise ValueError(f"Ошибка получения статуса ордера: {response.get('msg')}")
+            raise_for("okx", response.get("code"), response.get("msg"), "Ошибка получения статуса ордера")
         return response["data"][0]
     except Exception as e:
         logger.error(f"Ошибка при получении статуса ордера {order_id} для {symbol}: {str(e)}")
@@ -419,7 +676,7 @@ def get_order_status(symbol: str, order_id: str, api_key: str, secret_key: str,
 
 def close_position(symbol: str, posSide: str, api_key: str, secret_key: str, passphrase: str) -> bool:
     try:
-        trade_api = TradeAPI(api_key, secret_key, passphrase, flag="0", domain=APIURL, debug=True)
+        trade_api = _trade_api(api_key, secret_key, passphrase)
         response = trade_api.close_positions(
             instId=symbol,
             mgnMode="isolated",
@@ -427,7 +684,7 @@ def close_position(symbol: str, posSide: str, api_key: str, secret_key: str, pas
         )
         logger.info(f"Ответ API закрытия позиции OKX: {json.dumps(response, indent=2)}")
         if response.get("code") != "0":
-            raise ValueError(f"Ошибка закрытия позиции: {response.get('msg')}")
+            raise_for("okx", response.get("code"), response.get("msg"), "Ошибка закрытия позиции")
         logger.info(f"Позиция {posSide} для {symbol} успешно закрыта")
         return True
     except Exception as e:
@@ -436,11 +693,15 @@ def close_position(symbol: str, posSide: str, api_key: str, secret_key: str, pas
 
 def cancel_order(symbol: str, order_id: str, api_key: str, secret_key: str, passphrase: str) -> bool:
     try:
-        trade_api = TradeAPI(api_key, secret_key, passphrase, flag="0", domain=APIURL, debug=True)
-        response = trade_api.cancel_order(instId=symbol, ordId=order_id)
+        params = {"instId": symbol, "ordId": order_id}
+        try:
+            response = ws_trading.request("okx", api_key, secret_key, passphrase, "cancel-order", params)
+        except WSUnavailable as e:
+            logger.info(f"WS OKX недоступен ({e}), отмена через REST")
+            response = _trade_api(api_key, secret_key, passphrase).cancel_order(**params)
         logger.info(f"Ответ API отмены ордера OKX: {json.dumps(response, indent=2)}")
         if response.get("code") != "0":
-            raise ValueError(f"Ошибка отмены ордера: {response.get('msg')}")
+            raise_for("okx", response.get("code"), response.get("msg"), "Ошибка отмены ордера")
         logger.info(f"Ордер {order_id} для {symbol} успешно отменён")
         return True
     except Exception as e:
@@ -448,16 +709,85 @@ def cancel_order(symbol: str, order_id: str, api_key: str, secret_key: str, pass
         raise
 
 
-def move_sl_to_breakeven(symbol: str, api_key: str, secret_key: str, passphrase: str) -> bool:
+def get_live_state(api_key: str, secret_key: str, passphrase: str, symbols: list = (), since_ms: int = None) -> dict:
+    """Позиции, живые ордера и ордера, исполненные с since_ms, по всему аккаунту (для reconciler.py).
+    SL/TP у OKX — алгоритмические ордера, их ID (algoId) проверяются вместе с обычными."""
+    trade_api = _trade_api(api_key, secret_key, passphrase)
+    account_api = _account_api(api_key, secret_key, passphrase)
+
+    def data(response: dict) -> list:
+        if response.get("code") != "0":
+            raise_for("okx", response.get("code"), response.get("msg"))
+        return response.get("data", [])
+
+    now_ms = int(time.time() * 1000)
+    positions = {}
+    for position in data(account_api.get_positions(instType="SWAP")):
+        amount = float(position.get("pos") or 0)
+        if amount:
+            side = position.get("posSide", "net")
+            if side == "net":
+                side = "long" if amount > 0 else "short"
+            positions[(position["instId"], side)] = abs(amount)
+
+    live = {order["ordId"] for order in data(trade_api.get_order_list(instType="SWAP"))}
+    filled = {order["ordId"] for order in data(trade_api.get_orders_history(
+        instType="SWAP", state="filled", begin=str(since_ms or now_ms - 24 * 3600 * 1000)
+    ))}
+    for ord_type in ("conditional", "oco"):
+        live |= {order["algoId"] for order in data(trade_api.order_algos_list(ordType=ord_type, instType="SWAP"))}
+        # У истории алгоритмических ордеров нет фильтра по времени — берём последние 100 сработавших
+        filled |= {order["algoId"] for order in data(trade_api.order_algos_history(
+            ordType=ord_type, state="effective", instType="SWAP"
+        ))}
+    return {"positions": positions, "live_order_ids": live, "filled_order_ids": filled, "cursor": now_ms}
+
+
+def flatten(api_key: str, secret_key: str, passphrase: str, symbols: list = None) -> dict:
+    """Отменяет все ордера (вместе с алгоритмическими SL/TP) и закрывает все позиции по symbols
+    (None — по всему аккаунту). Для flatten.py"""
+    trade_api = _trade_api(api_key, secret_key, passphrase)
+    account_api = _account_api(api_key, secret_key, passphrase)
+
+    def data(response: dict) -> list:
+        if response.get("code") != "0":
+            raise_for("okx", response.get("code"), response.get("msg"))
+        return response.get("data", [])
+
+    def wanted(inst_id: str) -> bool:
+        return not symbols or inst_id in symbols
+
+    orders = [{"instId": order["instId"], "ordId": order["ordId"]}
+              for order in data(trade_api.get_order_list(instType="SWAP")) if wanted(order["instId"])]
+    # Пакетная отмена: до 20 обычных и до 10 алгоритмических ордеров за запрос
+    for i in range(0, len(orders), 20):
+        data(trade_api.cancel_multiple_orders(orders[i:i + 20]))
+    algo_orders = []
+    for ord_type in ("conditional", "oco"):
+        algo_orders += [{"instId": order["instId"], "algoId": order["algoId"]}
+                        for order in data(trade_api.order_algos_list(ordType=ord_type, instType="SWAP"))
+                        if wanted(order["instId"])]
+    for i in range(0, len(algo_orders), 10):
+        data(trade_api.cancel_algo_order(algo_orders[i:i + 10]))
+
+    closed = []
+    for position in data(account_api.get_positions(instType="SWAP")):
+        if float(position.get("pos") or 0) and wanted(position["instId"]):
+            data(trade_api.close_positions(instId=position["instId"], mgnMode=position["mgnMode"],
+                                           posSide=position.get("posSide", "net")))
+            closed.append(f"{position['instId']} {position.get('posSide', 'net')}")
+    return {"canceled": len(orders) + len(algo_orders), "closed": closed}
+
+def move_sl_to_breakeven(symbol: str, api_key: str, secret_key: str, passphrase: str, user_id: int = None) -> bool:
 
     try:
-        trade_api = TradeAPI(api_key, secret_key, passphrase, flag="0", domain=APIURL, debug=True)
-        account_api = AccountAPI(api_key, secret_key, passphrase, flag="0", domain=APIURL, debug=True)
+        trade_api = _trade_api(api_key, secret_key, passphrase)
+        account_api = _account_api(api_key, secret_key, passphrase)
 
         # Получаем открытые позиции
         response = account_api.get_positions(instType="SWAP", instId=symbol)
         if response.get("code") != "0":
-            raise ValueError(f"Ошибка получения позиций: {response.get('msg')}")
+            raise_for("okx", response.get("code"), response.get("msg"), "Ошибка получения позиций")
 
         positions = response.get("data", [])
 
@@ -470,7 +800,7 @@ def move_sl_to_breakeven(symbol: str, api_key: str, secret_key: str, passphrase:
                 # Получаем pending ордера (включая алгоритмические)
                 orders_response = trade_api.get_order_list(instType="SWAP", instId=symbol, state="live")
                 if orders_response.get("code") != "0":
-                    raise ValueError(f"Ошибка получения ордеров: {orders_response.get('msg')}")
+                    raise_for("okx", orders_response.get("code"), orders_response.get("msg"), "Ошибка получения ордеров")
 
                 # Получаем алгоритмические ордера отдельно
                 algo_response = trade_api.get_order_list(
@@ -538,22 +868,21 @@ def move_sl_to_breakeven(symbol: str, api_key: str, secret_key: str, passphrase:
                     new_sl_algo_id = create_response["data"][0]["algoId"]
                     logger.info(f"Новый SL ордер {new_sl_algo_id} создан по цене {new_sl_price}")
 
-                    # Обновляем базу данных
-                    cursor = get_cursor()
-                    cursor.execute(
-                        """
-                        UPDATE trades 
-                        SET stop_loss = %s, sl_order_id = %s 
-                        WHERE user_id = (SELECT user_id FROM users WHERE api_key = %s) 
-                        AND symbol = %s AND status = 'open'
-                        """,
-                        (new_sl_price, new_sl_algo_id, api_key, symbol)
-                    )
-                    commit()
+                    # Обновляем базу данных на своём соединении из пула: вызов идёт из потока отсека
+                    with transaction() as cursor:
+                        cursor.execute(
+                            """
+                            UPDATE trades 
+                            SET stop_loss = %s, sl_order_id = %s 
+                            WHERE user_id = COALESCE(%s, (SELECT user_id FROM users WHERE api_key = %s))
+                            AND symbol = %s AND status = 'open' AND tier = 'hot'
+                            """,
+                            (new_sl_price, new_sl_algo_id, user_id, api_key, symbol)
+                        )
 
                     return True
                 else:
-                    raise ValueError(f"Ошибка создания нового SL ордера: {create_response.get('msg')}")
+                    raise_for("okx", create_response.get("code"), create_response.get("msg"), "Ошибка создания нового SL ордера")
 
         logger.info(f"Нет открытых позиций для {symbol} или позиция уже закрыта")
         return True
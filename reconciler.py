@@ -0,0 +1,226 @@
+# reconciler.py
+import asyncio
+import logging
+import math
+import os
+from collections import defaultdict
+from datetime import datetime, timedelta
+from typing import Dict, List, Optional, Tuple
+
+from psycopg2.extras import execute_values
+
+from bulkheads import run_on
+from database import transaction
+from user_stats import record_closed, refresh_open_exposure
+import metrics
+
+logger = logging.getLogger(__name__)
+
+RECONCILE_INTERVAL = float(os.getenv("RECONCILE_INTERVAL", "30"))
+RECONCILE_CONCURRENCY = int(os.getenv("RECONCILE_CONCURRENCY", "8"))
+# Свежие сделки не сверяем: позиция и ордера могут ещё не появиться в ответах биржи
+RECONCILE_GRACE = float(os.getenv("RECONCILE_GRACE", "60"))
+# Окно истории ордеров перекрывается с прошлым, чтобы не потерять исполнения на границе
+RECONCILE_OVERLAP_MS = 60_000
+
+LEGS = ("sl", "tp1", "tp2", "tp3")
+
+_OPEN_TRADES_SQL = """
+    SELECT t.trade_id, t.user_id, t.exchange, t.order_id, t.symbol, t.side,
+           t.sl_order_id, t.tp1_order_id, t.tp2_order_id, t.tp3_order_id,
+           t.filled_legs, t.remaining_quantity, t.reconciled_at,
+           u.api_key, u.secret_key, u.passphrase, c.cursor_ms
+    FROM trades t
+    JOIN users u ON u.user_id = t.user_id
+    LEFT JOIN reconcile_cursors c ON c.user_id = t.user_id AND c.exchange = t.exchange
+    WHERE t.status = 'open' AND t.tier = 'hot'
+      AND t.created_at < %s
+      AND u.api_key IS NOT NULL
+      AND u.secret_key IS NOT NULL
+      AND u.key_status = 'ok'
+    ORDER BY t.exchange, t.user_id
+"""
+
+# status = 'open' в условии: сделку могли закрыть по сигналу, пока шла сверка
+_UPDATE_SQL = """
+    UPDATE trades SET
+        status = v.status,
+        filled_legs = v.filled_legs,
+        remaining_quantity = v.remaining_quantity,
+        reconciled_at = CURRENT_TIMESTAMP,
+        closed_at = CASE WHEN v.status = 'closed' THEN CURRENT_TIMESTAMP ELSE trades.closed_at END
+    FROM (VALUES %s) AS v (trade_id, status, filled_legs, remaining_quantity)
+    WHERE trades.trade_id = v.trade_id AND trades.status = 'open' AND trades.tier = 'hot'
+    RETURNING trades.trade_id, trades.status
+"""
+_UPDATE_TEMPLATE = "(%s::integer, %s::text, %s::text[], %s::real)"
+
+_CURSOR_SQL = """
+    INSERT INTO reconcile_cursors (user_id, exchange, cursor_ms) VALUES %s
+    ON CONFLICT (user_id, exchange) DO UPDATE SET cursor_ms = EXCLUDED.cursor_ms, updated_at = CURRENT_TIMESTAMP
+"""
+
+
+def cancellable_order_ids(trade: Dict) -> List[str]:
+    """ID ордеров сделки, которые ещё могут быть живы на бирже.
+
+    Без сработавших SL/TP и без входа, если сделку уже сверяли: рыночный вход к тому времени исполнен.
+    """
+    filled = set(trade.get('filled_legs') or [])
+    order_ids = [] if trade.get('reconciled_at') else [trade['order_id']]
+    order_ids += [trade[f"{leg}_order_id"] for leg in LEGS if leg not in filled and trade.get(f"{leg}_order_id")]
+    return order_ids
+
+
+def fetch_live_state(exchange: str, account: Dict, symbols: List[str], since_ms: Optional[int]) -> Dict:
+    """Позиции {(symbol, long|short): объём}, живые и исполненные ID ордеров аккаунта, новый курсор истории"""
+    api_key, secret_key, passphrase = account['api_key'], account['secret_key'], account.get('passphrase')
+    if exchange == "bingx":
+        from bingx_api import get_live_state
+        return get_live_state(api_key, secret_key, symbols, since_ms)
+    if exchange == "okx":
+        from okx_api import get_live_state
+    elif exchange == "bybit":
+        from bybit_api import get_live_state
+    elif exchange == "bitget":
+        from bitget_api import get_live_state
+    else:
+        raise ValueError(f"Неизвестная биржа: {exchange}")
+    return get_live_state(api_key, secret_key, passphrase, symbols, since_ms)
+
+
+def reconcile_trade(trade: Dict, state: Dict) -> Tuple[str, List[str], float]:
+    """(статус, сработавшие ноги, остаток позиции) сделки по состоянию аккаунта на бирже.
+
+    Нога считается сработавшей, если её ордера больше нет среди живых и он есть в истории
+    исполнений; если биржа историю не отдаёт (filled_order_ids = None) — просто по исчезновению.
+    """
+    direction = "long" if trade['side'] == "BUY" else "short"
+    position = state["positions"].get((trade['symbol'], direction), 0.0)
+
+    filled = set(trade['filled_legs'] or [])
+    for leg in LEGS:
+        order_id = trade[f"{leg}_order_id"]
+        if not order_id or leg in filled or str(order_id) in state["live_order_ids"]:
+            continue
+        if state["filled_order_ids"] is None or str(order_id) in state["filled_order_ids"]:
+            filled.add(leg)
+
+    return ("open" if position else "closed"), sorted(filled), position
+
+
+class Reconciler:
+    """Фоновая сверка открытых сделок trades с позициями и ордерами на биржах.
+
+    Одним запросом на аккаунт снимает позиции, живые ордера и историю исполнений
+    с прошлого курсора; сделки без позиции закрывает, сработавшие SL/TP записывает
+    в filled_legs. close_*_trade после этого не трогает уже мёртвые ордера.
+    """
+
+    def __init__(self, interval: float = RECONCILE_INTERVAL, concurrency: int = RECONCILE_CONCURRENCY):
+        self.interval = interval
+        self.concurrency = concurrency
+        self._task: Optional[asyncio.Task] = None
+        # Сделки, позиции которых не было на прошлой сверке: закрываем только при повторном
+        # подтверждении, чтобы разовый пустой ответ биржи не закрыл живую сделку
+        self._missing: set = set()
+
+    def open_trades(self, now: datetime) -> Dict[Tuple[str, int], List[Dict]]:
+        with transaction() as cursor:
+            cursor.execute(_OPEN_TRADES_SQL, (now - timedelta(seconds=RECONCILE_GRACE),))
+            trades = cursor.fetchall()
+        accounts = defaultdict(list)
+        for trade in trades:
+            accounts[(trade['exchange'], trade['user_id'])].append(trade)
+        return accounts
+
+    @staticmethod
+    def save(rows: List[tuple], cursors: List[tuple]) -> None:
+        """Результат сверки одной транзакцией на соединении пула (database.transaction):
+        её откат не задевает незафиксированную работу общего соединения"""
+        with transaction() as cursor:
+            if rows:
+                updated = execute_values(cursor, _UPDATE_SQL, rows, template=_UPDATE_TEMPLATE,
+                                         page_size=1000, fetch=True)
+                record_closed(cursor, [row['trade_id'] for row in updated if row['status'] == "closed"])
+            if cursors:
+                execute_values(cursor, _CURSOR_SQL, cursors, page_size=1000)
+            # Открытая позиция в user_stats — по рабочему набору trades_hot, раз в цикл сверки
+            refresh_open_exposure(cursor)
+
+    async def reconcile_account(self, exchange: str, trades: List[Dict],
+                                semaphore: asyncio.Semaphore) -> Tuple[List[tuple], Optional[int]]:
+        """Строки для _UPDATE_SQL и новый курсор; при ошибке биржи — ([], None), курсор не двигается"""
+        account = trades[0]
+        since_ms = account['cursor_ms'] - RECONCILE_OVERLAP_MS if account['cursor_ms'] else None
+        symbols = sorted({trade['symbol'] for trade in trades})
+        async with semaphore:
+            try:
+                state = await run_on(exchange, fetch_live_state, exchange, account, symbols, since_ms)
+            except Exception as e:
+                logger.warning(f"Сверка {exchange} для пользователя {account['user_id']} пропущена: {e}")
+                return [], None
+
+        rows = []
+        for trade in trades:
+            status, filled_legs, remaining = reconcile_trade(trade, state)
+            if status == "closed" and trade['trade_id'] not in self._missing:
+                self._missing.add(trade['trade_id'])
+                status = "open"
+            elif status == "open":
+                self._missing.discard(trade['trade_id'])
+            # remaining_quantity хранится как REAL — сравниваем с допуском
+            if (status == "open" and trade['reconciled_at'] and filled_legs == sorted(trade['filled_legs'] or [])
+                    and math.isclose(remaining, trade['remaining_quantity'] or 0.0, rel_tol=1e-6)):
+                continue
+            if status == "closed":
+                self._missing.discard(trade['trade_id'])
+                logger.info(f"Сделка {trade['trade_id']} ({exchange} {trade['symbol']}) закрыта на бирже, "
+                            f"сработали: {filled_legs or 'нет'}")
+            rows.append((trade['trade_id'], status, filled_legs, remaining))
+        return rows, state["cursor"]
+
+    async def run_once(self) -> Dict[str, int]:
+        """Одна сверка всех аккаунтов с открытыми сделками; возвращает число обновлённых и закрытых сделок"""
+        started = asyncio.get_running_loop().time()
+        accounts = await asyncio.to_thread(self.open_trades, datetime.now())
+        semaphore = asyncio.Semaphore(self.concurrency)
+        results = await asyncio.gather(*(
+            self.reconcile_account(exchange, trades, semaphore) for (exchange, _), trades in accounts.items()
+        ))
+
+        rows = [row for account_rows, _ in results for row in account_rows]
+        cursors = [(user_id, exchange, cursor_ms)
+                   for ((exchange, user_id), _), (_, cursor_ms) in zip(accounts.items(), results) if cursor_ms]
+        await asyncio.to_thread(self.save, rows, cursors)
+
+        closed = sum(1 for row in rows if row[1] == "closed")
+        metrics.record("reconcile", asyncio.get_running_loop().time() - started,
+                       error=len(cursors) < len(accounts))
+        if rows:
+            logger.info(f"Сверка сделок: аккаунтов {len(accounts)}, обновлено {len(rows)}, закрыто {closed}")
+        return {"accounts": len(accounts), "updated": len(rows), "closed": closed}
+
+    async def _run(self) -> None:
+        while True:
+            await asyncio.sleep(self.interval)
+            try:
+                await self.run_once()
+            except Exception as e:
+                logger.error(f"Ошибка фоновой сверки сделок: {e}")
+
+    def start(self) -> None:
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self) -> None:
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+
+reconciler = Reconciler()
@@ -0,0 +1,93 @@
+# retry.py
+import asyncio
+import hashlib
+import logging
+import os
+import random
+import time
+from typing import Callable, Optional
+
+from bulkheads import run_order
+from deadline import remaining
+from exchange_errors import DuplicateOrderError, ExchangeError, NetworkError
+
+logger = logging.getLogger(__name__)
+
+RETRY_ATTEMPTS = int(os.getenv("RETRY_ATTEMPTS", "3"))
+RETRY_BASE_DELAY = float(os.getenv("RETRY_BASE_DELAY", "0.2"))
+RETRY_MAX_DELAY = float(os.getenv("RETRY_MAX_DELAY", "2"))
+
+
+def client_order_id(signal_id: str, user_id: int, leg: str) -> str:
+    """Клиентский id ордера из (сигнал, пользователь, нога: entry, sl, tp1…).
+    Повтор того же ордера получает тот же id, и биржа не примет его второй раз.
+    32 символа [0-9a-f] подходят всем четырём биржам."""
+    return hashlib.sha1(f"{signal_id}:{user_id}:{leg}".encode()).hexdigest()[:32]
+
+
+def backoff_delay(attempt: int) -> Optional[float]:
+    """Пауза перед повтором номер attempt: экспонента с полным джиттером.
+    None — пауза не укладывается в дедлайн сигнала (deadline.py), повторять поздно."""
+    delay = random.uniform(0, min(RETRY_MAX_DELAY, RETRY_BASE_DELAY * 2 ** attempt))
+    left = remaining()
+    if left is not None and delay >= left:
+        return None
+    return delay
+
+
+def _should_recover(error: Exception, recover: Optional[Callable]) -> bool:
+    return recover is not None and isinstance(error, (NetworkError, DuplicateOrderError))
+
+
+def _retry_delay(error: Exception, attempt: int, attempts: int) -> Optional[float]:
+    if not isinstance(error, ExchangeError) or not error.retryable or attempt >= attempts:
+        return None
+    return backoff_delay(attempt)
+
+
+async def retry_call(fn: Callable, *args, recover: Callable = None, attempts: int = RETRY_ATTEMPTS,
+                     exchange: str = None, **kwargs):
+    """Выставляет ордер синхронной функцией API в потоке отсека exchange (bulkheads.py,
+    группа order) и повторяет её при временных ошибках (RetryableError).
+
+    recover ищет на бирже ордер по клиентскому id: после обрыва (NetworkError) или отказа
+    из-за дубля id найденный ордер возвращается вместо повторной отправки.
+    """
+    for attempt in range(1, attempts + 1):
+        try:
+            return await run_order(exchange, fn, *args, **kwargs)
+        except Exception as e:
+            if _should_recover(e, recover):
+                found = await run_order(exchange, _recover, recover)
+                if found is not None:
+                    return found
+            delay = _retry_delay(e, attempt, attempts)
+            if delay is None:
+                raise
+            logger.warning(f"{getattr(fn, '__name__', fn)}: {e}; повтор {attempt}/{attempts - 1} через {delay:.2f} с")
+            await asyncio.sleep(delay)
+
+
+def retry_blocking(fn: Callable, *args, recover: Callable = None, attempts: int = RETRY_ATTEMPTS, **kwargs):
+    """То же для кода, который уже выполняется в рабочем потоке (asyncio.to_thread)"""
+    for attempt in range(1, attempts + 1):
+        try:
+            return fn(*args, **kwargs)
+        except Exception as e:
+            if _should_recover(e, recover):
+                found = _recover(recover)
+                if found is not None:
+                    return found
+            delay = _retry_delay(e, attempt, attempts)
+            if delay is None:
+                raise
+            logger.warning(f"{getattr(fn, '__name__', fn)}: {e}; повтор {attempt}/{attempts - 1} через {delay:.2f} с")
+            time.sleep(delay)
+
+
+def _recover(recover: Callable):
+    try:
+        return recover()
+    except Exception as e:
+        logger.warning(f"Не удалось найти ордер по клиентскому id: {e}")
+        return None
@@ -0,0 +1,161 @@
+# scheduler.py
+import hashlib
+import logging
+import math
+import os
+import random
+import threading
+import time
+from collections import Counter, defaultdict, deque
+from typing import Dict, List, Optional
+
+from database import transaction
+import metrics
+
+logger = logging.getLogger(__name__)
+
+# rotate — стартовая позиция сдвигается от сигнала к сигналу; random — перемешивание на каждый сигнал;
+# fixed — прежний порядок (по user_id), для сравнения в бенчмарках
+DISPATCH_ORDER = os.getenv("DISPATCH_ORDER", "rotate")
+# Шаг сдвига — дробная часть золотого сечения: последовательные сигналы
+# равномерно покрывают все стартовые позиции, не повторяя соседние
+ROTATION_STRIDE = (math.sqrt(5) - 1) / 2
+
+_rotation_lock = threading.Lock()
+_rotation_counter = 0
+
+
+def _next_rotation() -> float:
+    global _rotation_counter
+    with _rotation_lock:
+        _rotation_counter += 1
+        return (_rotation_counter * ROTATION_STRIDE) % 1.0
+
+
+def _signal_seed(signal_id: str) -> int:
+    return int(hashlib.sha1(signal_id.encode()).hexdigest()[:16], 16)
+
+
+def _rotate(items: list, fraction: float) -> list:
+    if not items:
+        return items
+    offset = int(fraction * len(items))
+    return items[offset:] + items[:offset]
+
+
+def _interleave(groups: List[list]) -> list:
+    """Round-robin по группам: a1 b1 c1 a2 b2 c2 ..."""
+    result = []
+    for position in range(max((len(group) for group in groups), default=0)):
+        for group in groups:
+            if position < len(group):
+                result.append(group[position])
+    return result
+
+
+def dispatch_order(users: List[Dict], signal_id: str, mode: str = None) -> List[Dict]:
+    """Порядок рассылки сигнала.
+
+    Сначала старший priority_tier; внутри яруса пользователи разных бирж чередуются,
+    а стартовая позиция каждой биржи меняется от сигнала к сигналу (mode=rotate)
+    или порядок перемешивается заново (mode=random). Так одни и те же пользователи
+    не оказываются всегда в конце цикла с худшим входом.
+    """
+    mode = mode or DISPATCH_ORDER
+    ordered = sorted(users, key=lambda user: user['user_id'])
+    if mode == "fixed":
+        return sorted(ordered, key=lambda user: -(user.get('priority_tier') or 0))
+
+    rng = random.Random(_signal_seed(signal_id)) if mode == "random" else None
+    rotation = _next_rotation() if rng is None else 0.0
+
+    tiers: Dict[int, Dict[str, list]] = defaultdict(lambda: defaultdict(list))
+    for user in ordered:
+        tiers[user.get('priority_tier') or 0][user.get('exchange') or 'bingx'].append(user)
+
+    result = []
+    for tier in sorted(tiers, reverse=True):
+        groups = [tiers[tier][exchange] for exchange in sorted(tiers[tier])]
+        if rng:
+            for group in groups:
+                rng.shuffle(group)
+            rng.shuffle(groups)
+        else:
+            groups = [_rotate(group, rotation) for group in groups]
+            groups = _rotate(groups, rotation)
+        result.extend(_interleave(groups))
+    return result
+
+
+class DispatchStats:
+    """Латентность входа каждого пользователя в рамках одного сигнала.
+
+    Замер — от начала рассылки до завершения обработки пользователя (вход и TP/SL).
+    Разброс между пользователями и есть мера справедливости порядка рассылки.
+    Исходы входа (skipped, failed) считаются отдельно — для выгрузки в аналитику.
+    """
+
+    def __init__(self, signal_id: str, mode: str = None, shard: Optional[int] = None,
+                 symbol: str = None, action: str = None):
+        self.signal_id = signal_id
+        self.mode = mode or DISPATCH_ORDER
+        self.shard = shard
+        self.symbol = symbol
+        self.action = action
+        self.started = time.perf_counter()
+        self.latencies: Dict[int, float] = {}
+        self.outcomes: Counter = Counter()
+
+    def record(self, user_id: int) -> None:
+        self.latencies[user_id] = time.perf_counter() - self.started
+
+    def record_outcome(self, outcome: str) -> None:
+        """Пользователь без входа: skipped — вход заблокирован, failed — ошибка обработки"""
+        self.outcomes[outcome] += 1
+
+    def summary(self) -> Dict:
+        values = sorted(self.latencies.values())
+        if not values:
+            return {"users": 0}
+        mean = sum(values) / len(values)
+        stddev = math.sqrt(sum((value - mean) ** 2 for value in values) / len(values))
+        return {
+            "users": len(values),
+            "p50_ms": round(metrics.percentile(values, 0.50) * 1000, 3),
+            "p95_ms": round(metrics.percentile(values, 0.95) * 1000, 3),
+            "max_ms": round(values[-1] * 1000, 3),
+            "spread_ms": round((values[-1] - values[0]) * 1000, 3),
+            "stddev_ms": round(stddev * 1000, 3),
+        }
+
+    def save(self) -> Dict:
+        """Пишет сводку в лог, metrics и signal_dispatch_stats; возвращает её"""
+        summary = self.summary()
+        if not summary["users"] and not self.outcomes:
+            return summary
+        logger.info(f"Сигнал {self.signal_id}: порядок {self.mode}, латентность входа {summary}")
+        if summary["users"]:
+            metrics.record("dispatch_spread", summary["spread_ms"] / 1000)
+        recent_dispatches.append({"signal_id": self.signal_id, "mode": self.mode, "shard": self.shard,
+                                  **summary, **self.outcomes})
+
+        try:
+            with transaction() as cursor:
+                cursor.execute(
+                    """
+                    INSERT INTO signal_dispatch_stats
+                        (signal_id, shard, dispatch_order, users, p50_ms, p95_ms, max_ms, spread_ms, stddev_ms,
+                         symbol, action, skipped, failed)
+                    VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s)
+                    """,
+                    (self.signal_id, self.shard, self.mode, summary["users"], summary.get("p50_ms"),
+                     summary.get("p95_ms"), summary.get("max_ms"), summary.get("spread_ms"), summary.get("stddev_ms"),
+                     self.symbol, self.action, self.outcomes["skipped"], self.outcomes["failed"])
+                )
+        except Exception as e:
+            logger.error(f"Не удалось записать статистику рассылки сигнала {self.signal_id}: {e}")
+        return summary
+
+
+# Последние сводки для /control/metrics (webhook.py)
+recent_dispatches = deque(maxlen=20)
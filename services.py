@@ -1,20 +1,29 @@
 import os
 import logging
 import json
-import time
 import asyncio
 from typing import Dict, Optional
 from aiogram import types
-from main import bot
-from database import get_cursor, commit
+from notifier import bot
+from database import transaction
+from models import Signal
+from trade_journal import trade_journal
+from fill_watcher import wait_for_fill, record_fill_price
+from reconciler import LEGS, cancellable_order_ids
+from exchange_errors import ExchangeError, NotFoundError
+from retry import client_order_id, retry_call
+from sizing import instrument_spec
+from bulkheads import run_on, run_order
+from user_health import record_success, report_failure
+from user_stats import record_closed
 from utils import send_signal_notification
-from main import bot
 from bingx_api import (
     get_balance as bingx_get_balance,
     set_leverage as bingx_set_leverage,
     calculate_quantity as bingx_calculate_quantity,
     create_main_order as bingx_create_main_order,
     create_tp_sl_orders as bingx_create_tp_sl_orders,
+    find_order as bingx_find_order,
     get_open_orders as bingx_get_open_orders,
     cancel_order as bingx_cancel_order,
     close_position as bingx_close_position,
@@ -26,6 +35,7 @@ from okx_api import (
     set_leverage as okx_set_leverage,
     calculate_quantity as okx_calculate_quantity,
     create_main_order as okx_create_main_order,
+    recover_main_order as okx_recover_main_order,
     cancel_order as okx_cancel_order,
     get_order_status as okx_get_order_status,
     close_position as okx_close_position,
@@ -36,6 +46,7 @@ from bybit_api import (
     set_leverage as bybit_set_leverage,
     calculate_quantity as bybit_calculate_quantity,
     create_main_order as bybit_create_main_order,
+    recover_main_order as bybit_recover_main_order,
     cancel_order as bybit_cancel_order,
     get_order_status as bybit_get_order_status,
     close_position as bybit_close_position,
@@ -46,6 +57,7 @@ from bitget_api import (
     set_leverage as bitget_set_leverage,
     calculate_quantity as bitget_calculate_quantity,
     create_main_order as bitget_create_main_order,
+    recover_main_order as bitget_recover_main_order,
     cancel_order as bitget_cancel_order,
     get_order_status as bitget_get_order_status,
     close_position as bitget_close_position,
@@ -54,74 +66,81 @@ from bitget_api import (
 
 logger = logging.getLogger(__name__)
 
-async def close_bingx_trade(user: Dict, symbol: str, current_side: str) -> bool:
-    user_id = user['user_id']
-    api_key = user['api_key']
-    secret_key = user['secret_key']
-
-    try:
-        cursor = get_cursor()
-
-        # Начинаем транзакцию
-        cursor.execute("BEGIN")
-
-        # Получаем открытые сделки
+def open_trades_for(user_id: int, symbol: str) -> list:
+    """Открытые сделки пользователя по символу. Чтение и запись close_*_trade идут через
+    database.transaction(): сбой запроса откатывает только свою транзакцию, а не общее соединение"""
+    with transaction() as cursor:
         cursor.execute(
             """
-            SELECT trade_id, order_id, sl_order_id, tp1_order_id, tp2_order_id, tp3_order_id, side
+            SELECT trade_id, order_id, sl_order_id, tp1_order_id, tp2_order_id, tp3_order_id, side,
+                   filled_legs, reconciled_at, position_side
             FROM trades
-            WHERE user_id = %s AND symbol = %s AND status = %s
+            WHERE user_id = %s AND symbol = %s AND status = %s AND tier = 'hot'
             """,
             (user_id, symbol, 'open')
         )
-        open_trades = cursor.fetchall()
+        return cursor.fetchall()
+
+def mark_closed(trade_ids: list) -> None:
+    """Закрывает сделки и учитывает их в user_stats одной транзакцией"""
+    with transaction() as cursor:
+        cursor.execute(
+            "UPDATE trades SET status = %s, closed_at = CURRENT_TIMESTAMP "
+            "WHERE trade_id = ANY(%s) AND tier = 'hot' AND status = 'open' RETURNING trade_id",
+            ('closed', trade_ids)
+        )
+        record_closed(cursor, [row['trade_id'] for row in cursor.fetchall()])
+
+async def close_bingx_trade(user: Dict, symbol: str, current_side: str) -> bool:
+    user_id = user['user_id']
+    api_key = user['api_key']
+    secret_key = user['secret_key']
+
+    try:
+        # Сделка могла ещё не доехать из журнала до БД
+        await trade_journal.flush_pending(user_id, symbol)
+        open_trades = await asyncio.to_thread(open_trades_for, user_id, symbol)
 
         if not open_trades:
-            cursor.execute("ROLLBACK")
             logger.info(f"Нет открытых сделок для пользователя {user_id} по символу {symbol}")
             return True
 
         closed = False
+        closing_trade_ids = []
         position_side = "LONG" if current_side == "SELL" else "SHORT"
 
         for trade in open_trades:
             if trade['side'] != current_side:
                 # Отменяем все связанные ордера
-                order_ids = [trade['order_id'], trade['sl_order_id'], trade['tp1_order_id'],
-                             trade['tp2_order_id'], trade['tp3_order_id']]
+                # Сработавшие SL/TP и исполненный вход (по данным reconciler) не отменяем
+                order_ids = cancellable_order_ids(trade)
 
                 for order_id in order_ids:
                     if order_id:
                         try:
-                            bingx_cancel_order(symbol, order_id, api_key, secret_key)
+                            await run_order("bingx", bingx_cancel_order, symbol, order_id, api_key, secret_key)
                             logger.info(f"Ордер {order_id} для {symbol} успешно отменён")
                             closed = True
+                        except NotFoundError:
+                            logger.info(f"Ордер {order_id} для {symbol} уже не существует")
                         except Exception as e:
-                            if "order not exist" in str(e).lower():
-                                logger.info(f"Ордер {order_id} для {symbol} уже не существует")
-                            else:
-                                logger.error(f"Ошибка при отмене ордера {order_id} для {symbol}: {str(e)}")
-                                continue
+                            logger.error(f"Ошибка при отмене ордера {order_id} для {symbol}: {str(e)}")
+                            continue
 
                 # Закрываем позицию
                 try:
-                    bingx_close_position(symbol, position_side, api_key, secret_key)
+                    await run_order("bingx", bingx_close_position, symbol, position_side, api_key, secret_key)
                     logger.info(f"Позиция {position_side} для {symbol} закрыта")
                     closed = True
+                except NotFoundError:
+                    logger.info(f"Позиция {position_side} для {symbol} уже не существует")
                 except Exception as e:
-                    if "position not exist" in str(e).lower() or "order not exist" in str(e).lower():
-                        logger.info(f"Позиция {position_side} для {symbol} уже не существует")
-                    else:
-                        logger.error(f"Ошибка при закрытии позиции {position_side} для {symbol}: {str(e)}")
+                    logger.error(f"Ошибка при закрытии позиции {position_side} для {symbol}: {str(e)}")
 
-                # Обновляем статус в базе данных
-                cursor.execute(
-                    "UPDATE trades SET status = %s WHERE trade_id = %s",
-                    ('closed', trade['trade_id'])
-                )
+                closing_trade_ids.append(trade['trade_id'])
 
         if closed:
-            commit()
+            await asyncio.to_thread(mark_closed, closing_trade_ids)
             logger.info(f"Транзакция завершена для пользователя {user_id}")
 
             # Отправляем уведомление
@@ -139,17 +158,11 @@ async def close_bingx_trade(user: Dict, symbol: str, current_side: str) -> bool:
             except Exception as notify_error:
                 logger.error(f"Ошибка отправки уведомления о закрытии для {user_id}: {notify_error}")
         else:
-            cursor.execute("ROLLBACK")
             logger.info(f"Не было закрытых сделок для пользователя {user_id}")
 
         return closed
 
     except Exception as e:
-        # Откатываем транзакцию при ошибке
-        try:
-            cursor.execute("ROLLBACK")
-        except:
-            pass
         logger.error(f"Ошибка при закрытии сделки BingX для пользователя {user_id}: {str(e)}")
 
         # Отправляем сообщение об ошибке
@@ -174,16 +187,9 @@ async def close_okx_trade(user: Dict, symbol: str, current_side: str) -> bool:
     passphrase = user['passphrase']
 
     try:
-        cursor = get_cursor()
-        cursor.execute(
-            """
-            SELECT trade_id, order_id, sl_order_id, tp1_order_id, tp2_order_id, tp3_order_id, side
-            FROM trades
-            WHERE user_id = %s AND symbol = %s AND status = %s
-            """,
-            (user_id, symbol, 'open')
-        )
-        open_trades = cursor.fetchall()
+        # Сделка могла ещё не доехать из журнала до БД
+        await trade_journal.flush_pending(user_id, symbol)
+        open_trades = await asyncio.to_thread(open_trades_for, user_id, symbol)
 
         if not open_trades:
             logger.info(f"Нет открытых сделок для пользователя {user_id} по символу {symbol}")
@@ -193,19 +199,21 @@ async def close_okx_trade(user: Dict, symbol: str, current_side: str) -> bool:
         for trade in open_trades:
             if trade['side'] != current_side:  # Проверяем противоположную сторону
                 pos_side = "long" if trade['side'] == "BUY" else "short"
-                order_ids = [trade['order_id'], trade['sl_order_id'], trade['tp1_order_id'],
-                             trade['tp2_order_id'], trade['tp3_order_id']]
+                # Сработавшие SL/TP и исполненный вход (по данным reconciler) не отменяем
+                order_ids = cancellable_order_ids(trade)
 
                 # Проверяем статус ордеров
                 for order_id in order_ids:
                     if order_id:
                         try:
-                            order_status = okx_get_order_status(symbol, order_id, api_key, secret_key, passphrase)
+                            order_status = await run_on("okx", okx_get_order_status, symbol, order_id,
+                                                        api_key, secret_key, passphrase)
                             if order_status['state'] in ['canceled', 'filled']:
                                 logger.info(
                                     f"Ордер {order_id} для {symbol} уже закрыт (статус: {order_status['state']})")
                             else:
-                                okx_cancel_order(symbol, order_id, api_key, secret_key, passphrase)
+                                await run_order("okx", okx_cancel_order, symbol, order_id,
+                                             api_key, secret_key, passphrase)
                                 closed = True
                         except Exception as e:
                             logger.error(f"Ошибка при проверке/отмене ордера {order_id} для {symbol}: {str(e)}")
@@ -213,16 +221,12 @@ async def close_okx_trade(user: Dict, symbol: str, current_side: str) -> bool:
 
                 # Закрываем позицию
                 try:
-                    okx_close_position(symbol, pos_side, api_key, secret_key, passphrase)
+                    await run_order("okx", okx_close_position, symbol, pos_side, api_key, secret_key, passphrase)
                     closed = True
                 except Exception as e:
                     logger.warning(f"Не удалось закрыть позицию {pos_side} для {symbol}: {str(e)}")
 
-                cursor.execute(
-                    "UPDATE trades SET status = %s WHERE trade_id = %s",
-                    ('closed', trade['trade_id'])
-                )
-                commit()
+                await asyncio.to_thread(mark_closed, [trade['trade_id']])
 
                 # Отправляем уведомление о закрытии сделки
                 try:
@@ -265,16 +269,9 @@ async def close_bybit_trade(user: Dict, symbol: str, current_side: str) -> bool:
     secret_key = user['secret_key']
 
     try:
-        cursor = get_cursor()
-        cursor.execute(
-            """
-            SELECT trade_id, order_id, sl_order_id, tp1_order_id, tp2_order_id, tp3_order_id, side
-            FROM trades
-            WHERE user_id = %s AND symbol = %s AND status = %s
-            """,
-            (user_id, symbol, 'open')
-        )
-        open_trades = cursor.fetchall()
+        # Сделка могла ещё не доехать из журнала до БД
+        await trade_journal.flush_pending(user_id, symbol)
+        open_trades = await asyncio.to_thread(open_trades_for, user_id, symbol)
 
         if not open_trades:
             logger.info(f"Нет открытых сделок для пользователя {user_id} по символу {symbol}")
@@ -284,14 +281,14 @@ async def close_bybit_trade(user: Dict, symbol: str, current_side: str) -> bool:
         pos_side = "net"  # Bybit использует хедж-режим по умолчанию
         for trade in open_trades:
             if trade['side'] != current_side:
-                order_ids = [trade['order_id'], trade['sl_order_id'], trade['tp1_order_id'],
-                             trade['tp2_order_id'], trade['tp3_order_id']]
+                # Сработавшие SL/TP и исполненный вход (по данным reconciler) не отменяем
+                order_ids = cancellable_order_ids(trade)
 
                 # Отменяем ордера
                 for order_id in order_ids:
                     if order_id:
                         try:
-                            bybit_cancel_order(symbol, order_id, api_key, secret_key)
+                            await run_order("bybit", bybit_cancel_order, symbol, order_id, api_key, secret_key)
                             closed = True
                         except Exception as e:
                             logger.error(f"Ошибка при отмене ордера {order_id} для {symbol}: {str(e)}")
@@ -299,16 +296,12 @@ async def close_bybit_trade(user: Dict, symbol: str, current_side: str) -> bool:
 
                 # Закрываем позицию
                 try:
-                    bybit_close_position(symbol, pos_side, api_key, secret_key)
+                    await run_order("bybit", bybit_close_position, symbol, pos_side, api_key, secret_key)
                     closed = True
                 except Exception as e:
                     logger.warning(f"Не удалось закрыть позицию для {symbol}: {str(e)}")
 
-                cursor.execute(
-                    "UPDATE trades SET status = %s WHERE trade_id = %s",
-                    ('closed', trade['trade_id'])
-                )
-                commit()
+                await asyncio.to_thread(mark_closed, [trade['trade_id']])
 
                 # Отправляем уведомление
                 try:
@@ -351,16 +344,9 @@ async def close_bitget_trade(user: Dict, symbol: str, current_side: str) -> bool
     passphrase = user['passphrase']
 
     try:
-        cursor = get_cursor()
-        cursor.execute(
-            """
-            SELECT trade_id, order_id, sl_order_id, tp1_order_id, tp2_order_id, tp3_order_id, side, position_side
-            FROM trades
-            WHERE user_id = %s AND symbol = %s AND status = %s
-            """,
-            (user_id, symbol, 'open')
-        )
-        open_trades = cursor.fetchall()
+        # Сделка могла ещё не доехать из журнала до БД
+        await trade_journal.flush_pending(user_id, symbol)
+        open_trades = await asyncio.to_thread(open_trades_for, user_id, symbol)
 
         if not open_trades:
             logger.info(f"Нет открытых сделок для пользователя {user_id} по символу {symbol}")
@@ -370,39 +356,34 @@ async def close_bitget_trade(user: Dict, symbol: str, current_side: str) -> bool
         for trade in open_trades:
             if trade['side'] != current_side:
                 pos_side = trade['position_side']  # Используем position_side из базы
-                order_ids = [trade['order_id'], trade['sl_order_id'], trade['tp1_order_id'],
-                             trade['tp2_order_id'], trade['tp3_order_id']]
+                # Сработавшие SL/TP и исполненный вход (по данным reconciler) не отменяем
+                order_ids = cancellable_order_ids(trade)
 
                 # Отменяем ордера
                 for order_id in order_ids:
                     if order_id:
                         try:
-                            bitget_cancel_order(symbol, order_id, api_key, secret_key, passphrase)
+                            await run_order("bitget", bitget_cancel_order, symbol, order_id,
+                                         api_key, secret_key, passphrase)
                             logger.info(f"Ордер {order_id} для {symbol} успешно отменён")
                             closed = True
+                        except NotFoundError:
+                            logger.info(f"Ордер {order_id} для {symbol} уже не существует")
                         except Exception as e:
-                            if "order not exist" in str(e).lower():
-                                logger.info(f"Ордер {order_id} для {symbol} уже не существует")
-                            else:
-                                logger.error(f"Ошибка при отмене ордера {order_id} для {symbol}: {str(e)}")
-                                continue
+                            logger.error(f"Ошибка при отмене ордера {order_id} для {symbol}: {str(e)}")
+                            continue
 
                 # Закрываем позицию
                 try:
-                    bitget_close_position(symbol, pos_side, api_key, secret_key, passphrase)
+                    await run_order("bitget", bitget_close_position, symbol, pos_side, api_key, secret_key, passphrase)
                     logger.info(f"Позиция {pos_side} для {symbol} закрыта")
                     closed = True
+                except NotFoundError:
+                    logger.info(f"Позиция {pos_side} для {symbol} уже не существует")
                 except Exception as e:
-                    if "position not exist" in str(e).lower():
-                        logger.info(f"Позиция {pos_side} для {symbol} уже не существует")
-                    else:
-                        logger.error(f"Ошибка при закрытии позиции {pos_side} для {symbol}: {str(e)}")
+                    logger.error(f"Ошибка при закрытии позиции {pos_side} для {symbol}: {str(e)}")
 
-                cursor.execute(
-                    "UPDATE trades SET status = %s WHERE trade_id = %s",
-                    ('closed', trade['trade_id'])
-                )
-                commit()
+                await asyncio.to_thread(mark_closed, [trade['trade_id']])
 
                 # Отправляем уведомление
                 try:
@@ -438,16 +419,17 @@ async def close_bitget_trade(user: Dict, symbol: str, current_side: str) -> bool
             logger.error(f"Ошибка отправки уведомления об ошибке закрытия для {user_id}: {notify_error}")
         return False
 
-async def process_bingx_signal(user: Dict, signal: Dict) -> Optional[Dict]:
+async def process_bingx_signal(user: Dict, signal: Signal, sizing: Optional[Dict] = None,
+                             signal_id: str = None) -> Optional[Dict]:
     user_id = user['user_id']
     api_key = user['api_key']
     secret_key = user['secret_key']
 
-    action = signal['action']
-    symbol = signal['symbol']
-    price = signal['price']
-    stop_loss = signal['stop_loss']
-    take_profits = [signal['take_profit_1'], signal['take_profit_2'], signal['take_profit_3']]
+    action = signal.action
+    symbol = signal.symbol
+    price = signal.price
+    stop_loss = signal.stop_loss
+    take_profits = signal.take_profits
     position_side = "LONG" if action == "BUY" else "SHORT"
 
     try:
@@ -455,62 +437,80 @@ async def process_bingx_signal(user: Dict, signal: Dict) -> Optional[Dict]:
         await close_bingx_trade(user, symbol, action)
 
         # Проверяем открытые позиции
-        open_positions = bingx_get_open_positions(symbol, api_key, secret_key)
+        open_positions = await run_on("bingx", bingx_get_open_positions, symbol, api_key, secret_key)
         for position in open_positions:
             pos_side = position.get("positionSide")
             if pos_side and pos_side != position_side:
                 try:
-                    bingx_close_position(symbol, pos_side, api_key, secret_key)
+                    await run_order("bingx", bingx_close_position, symbol, pos_side, api_key, secret_key)
                     logger.info(f"Закрыта существующая позиция {pos_side} для {symbol}")
                 except Exception as e:
                     logger.error(f"Ошибка при закрытии существующей позиции {pos_side} для {symbol}: {str(e)}")
 
-        balance_response = bingx_get_balance(api_key, secret_key)
-        balance_data = json.loads(balance_response)
-        usdt_balance = float(balance_data["data"]["balance"]["availableMargin"])
+        if sizing:
+            usdt_balance = sizing["balance"]
+        else:
+            balance_response = await run_on("bingx", bingx_get_balance, api_key, secret_key)
+            balance_data = json.loads(balance_response)
+            usdt_balance = float(balance_data["data"]["balance"]["availableMargin"])
 
         if usdt_balance < 0.1:
             logger.error(f"Недостаточный баланс для пользователя {user_id}: {usdt_balance} USDT")
+            await report_failure(user, f"insufficient balance: {usdt_balance} USDT")
             return None
 
-        bingx_set_leverage(symbol, leverage=10, position_side=position_side, api_key=api_key, secret_key=secret_key)
+        await run_on("bingx", bingx_set_leverage, symbol, leverage=10, position_side=position_side,
+                     api_key=api_key, secret_key=secret_key)
 
-        quantity = bingx_calculate_quantity(symbol, leverage=10, risk_percent=0.05, api_key=api_key,
-                                            secret_key=secret_key)
-
-        main_order = bingx_create_main_order(symbol, action, quantity, api_key, secret_key)
-        main_order_data = json.loads(main_order)
+        if sizing:
+            quantity = sizing["quantity"]
+        else:
+            quantity = await run_on("bingx", bingx_calculate_quantity, symbol, leverage=10, risk_percent=0.05,
+                                    api_key=api_key, secret_key=secret_key)
 
-        if main_order_data.get("code") != 0:
-            logger.error(f"Ошибка создания основного ордера для пользователя {user_id}: {main_order_data.get('msg')}")
+        # Клиентский id из (сигнал, пользователь, нога): повтор после обрыва найдёт уже выставленный вход
+        entry_id = client_order_id(signal_id, user_id, "entry") if signal_id else None
+        try:
+            main_order = await retry_call(
+                bingx_create_main_order, symbol, action, quantity, api_key, secret_key, client_id=entry_id,
+                exchange="bingx",
+                recover=(lambda: bingx_find_order(symbol, entry_id, api_key, secret_key)) if entry_id else None
+            )
+        except ExchangeError as e:
+            logger.error(f"Ошибка создания основного ордера для пользователя {user_id}: {e}")
+            await report_failure(user, e)
             return None
+        main_order_data = json.loads(main_order)
 
         order_id = main_order_data["data"]["order"]["orderId"]
         logger.info(f"Main order for user {user_id}: {main_order}")
 
-        cursor = get_cursor()
-        cursor.execute(
-            """
-            INSERT INTO trades (user_id, exchange, order_id, symbol, side, position_side, quantity, entry_price, stop_loss, take_profit_1, take_profit_2, take_profit_3, status)
-            VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s)
-            RETURNING trade_id
-            """,
-            (user_id, 'bingx', order_id, symbol, action, position_side, quantity, price, stop_loss,
-             take_profits[0], take_profits[1], take_profits[2], 'open')
-        )
-        trade_id = cursor.fetchone()['trade_id']
-        commit()
-
-        time.sleep(2)
-
-        tp_sl_results, sorted_take_profits, order_ids = bingx_create_tp_sl_orders(
+        await trade_journal.record_trade({
+            "user_id": user_id, "exchange": "bingx", "order_id": order_id, "symbol": symbol,
+            "side": action, "position_side": position_side, "quantity": quantity, "entry_price": price,
+            "stop_loss": stop_loss, "take_profit_1": take_profits[0], "take_profit_2": take_profits[1],
+            "take_profit_3": take_profits[2], "status": "open"
+        })
+
+        # TP/SL выставляем, как только биржа подтвердит исполнение входа
+        fill = await wait_for_fill("bingx", symbol, order_id, user)
+        if fill and fill["state"] == "dead":
+            await trade_journal.update_trade("bingx", order_id, status="canceled")
+            raise ValueError(f"Основной ордер {order_id} не исполнен: {fill['status']}")
+        if fill and fill["avg_price"]:
+            await trade_journal.update_trade("bingx", order_id, entry_price=fill["avg_price"])
+
+        tp_sl_results, sorted_take_profits, order_ids = await run_order(
+            "bingx", bingx_create_tp_sl_orders,
             symbol=symbol,
             side=action,
             quantity=quantity,
             stop_loss=stop_loss,
             take_profits=take_profits,
             api_key=api_key,
-            secret_key=secret_key
+            secret_key=secret_key,
+            tp_quantities=sizing["tp_quantities"] if sizing else None,
+            client_ids={leg: client_order_id(signal_id, user_id, leg) for leg in LEGS} if signal_id else None
         )
 
         sl_order_id = order_ids[0] if order_ids else None
@@ -518,14 +518,10 @@ async def process_bingx_signal(user: Dict, signal: Dict) -> Optional[Dict]:
         tp2_order_id = order_ids[2] if len(order_ids) > 2 else None
         tp3_order_id = order_ids[3] if len(order_ids) > 3 else None
 
-        cursor.execute(
-            """
-            UPDATE trades SET sl_order_id = %s, tp1_order_id = %s, tp2_order_id = %s, tp3_order_id = %s
-            WHERE trade_id = %s
-            """,
-            (sl_order_id, tp1_order_id, tp2_order_id, tp3_order_id, trade_id)
+        await trade_journal.update_trade(
+            "bingx", order_id,
+            sl_order_id=sl_order_id, tp1_order_id=tp1_order_id, tp2_order_id=tp2_order_id, tp3_order_id=tp3_order_id
         )
-        commit()
 
         try:
             await send_signal_notification(signal, user_id, bot)
@@ -533,16 +529,20 @@ async def process_bingx_signal(user: Dict, signal: Dict) -> Optional[Dict]:
         except Exception as notify_error:
             logger.error(f"Ошибка отправки уведомления для user {user_id}: {notify_error}")
 
+        await record_success(user)
         return {
             "user_id": user_id,
             "exchange": "bingx",
-            "trade_id": trade_id,
+            "order_id": order_id,
             "main_order": main_order_data,
             "tp_sl_orders": [json.loads(res) for res in tp_sl_results]
         }
 
     except Exception as e:
         logger.error(f"Ошибка обработки сигнала BingX для пользователя {user_id}: {str(e)}")
+        # Ключи или счёт пользователя неисправны — вместо общей ошибки он получит просьбу их исправить
+        if await report_failure(user, e):
+            return None
         SUPPORT_CONTACT = os.getenv("SUPPORT_CONTACT", "@SupportBot")
         try:
             keyboard = types.InlineKeyboardMarkup(inline_keyboard=[
@@ -557,39 +557,52 @@ async def process_bingx_signal(user: Dict, signal: Dict) -> Optional[Dict]:
             logger.error(f"Ошибка отправки уведомления об ошибке для {user_id}: {notify_error}")
         return None
 
-async def process_okx_signal(user: Dict, signal: Dict) -> Optional[Dict]:
+async def process_okx_signal(user: Dict, signal: Signal, sizing: Optional[Dict] = None,
+                             signal_id: str = None) -> Optional[Dict]:
     user_id = user['user_id']
     api_key = user['api_key']
     secret_key = user['secret_key']
     passphrase = user['passphrase']
 
-    action = signal['action']
-    symbol = signal['symbol']
-    price = signal['price']
-    stop_loss = signal['stop_loss']
-    take_profits = [signal['take_profit_1'], signal['take_profit_2'], signal['take_profit_3']]
+    action = signal.action
+    symbol = signal.symbol
+    price = signal.price
+    stop_loss = signal.stop_loss
+    take_profits = signal.take_profits
 
     try:
         # Проверяем и закрываем противоположные открытые сделки
         await close_okx_trade(user, symbol, action)
 
-        usdt_balance = okx_get_balance(api_key, secret_key, passphrase)
+        usdt_balance = sizing["balance"] if sizing else await run_on(
+            "okx", okx_get_balance, api_key, secret_key, passphrase)
 
         if usdt_balance < 10:
             logger.error(f"Недостаточный баланс для пользователя {user_id}: {usdt_balance} USDT")
+            await report_failure(user, f"insufficient balance: {usdt_balance} USDT")
             return None
 
+        # Режим позиции из профиля аккаунта (account_profile.py); None — профиля нет, OKX подбирает вариант сам
+        position_mode = user.get('position_mode')
+
         # Устанавливаем плечо
-        leverage_set = okx_set_leverage(symbol, leverage=10, tdMode="isolated",
-                                        api_key=api_key, secret_key=secret_key, passphrase=passphrase)
+        leverage_set = await run_on("okx", okx_set_leverage, symbol, leverage=10, tdMode="isolated", api_key=api_key,
+                                    secret_key=secret_key, passphrase=passphrase, position_mode=position_mode)
 
         if not leverage_set:
             logger.warning(f"Не удалось установить плечо для {symbol}, продолжаем...")
 
-        quantity = okx_calculate_quantity(symbol, leverage=10, risk_percent=0.05,
-                                          api_key=api_key, secret_key=secret_key, passphrase=passphrase)
-
-        main_order_response, sorted_take_profits, order_id, algo_order_ids, position_side = okx_create_main_order(
+        if sizing:
+            quantity = sizing["quantity"]
+        else:
+            quantity = await run_on("okx", okx_calculate_quantity, symbol, leverage=10, risk_percent=0.05,
+                                    api_key=api_key, secret_key=secret_key, passphrase=passphrase)
+        # quantity OKX — в контрактах; размер контракта нужен статистике (user_stats.py)
+        ct_val = (await run_on("okx", instrument_spec, "okx", symbol))["ct_val"]
+
+        # Потерянный ответ на вход: recover найдёт ордер по клиентскому id и доставит к нему SL/TP
+        entry_id = client_order_id(signal_id, user_id, "entry") if signal_id else None
+        entry_kwargs = dict(
             symbol=symbol,
             side=action,
             quantity=quantity,
@@ -598,7 +611,14 @@ async def process_okx_signal(user: Dict, signal: Dict) -> Optional[Dict]:
             tdMode="isolated",
             api_key=api_key,
             secret_key=secret_key,
-            passphrase=passphrase
+            passphrase=passphrase,
+            tp_quantities=sizing["tp_quantities"] if sizing else None,
+            position_mode=position_mode,
+            client_id=entry_id
+        )
+        main_order_response, sorted_take_profits, order_id, algo_order_ids, position_side = await retry_call(
+            okx_create_main_order, exchange="okx",
+            recover=(lambda: okx_recover_main_order(**entry_kwargs)) if entry_id else None, **entry_kwargs
         )
 
         sl_order_id = algo_order_ids[0] if algo_order_ids else None
@@ -606,19 +626,17 @@ async def process_okx_signal(user: Dict, signal: Dict) -> Optional[Dict]:
         tp2_order_id = algo_order_ids[2] if len(algo_order_ids) > 2 else None
         tp3_order_id = algo_order_ids[3] if len(algo_order_ids) > 3 else None
 
-        cursor = get_cursor()
-        cursor.execute(
-            """
-            INSERT INTO trades (user_id, exchange, order_id, symbol, side, position_side, quantity, entry_price, stop_loss, take_profit_1, take_profit_2, take_profit_3, sl_order_id, tp1_order_id, tp2_order_id, tp3_order_id, status)
-            VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s)
-            RETURNING trade_id
-            """,
-            (user_id, 'okx', order_id, symbol, action, position_side, quantity, price, stop_loss,
-             take_profits[0], take_profits[1], take_profits[2], sl_order_id, tp1_order_id, tp2_order_id, tp3_order_id,
-             'open')
-        )
-        trade_id = cursor.fetchone()['trade_id']
-        commit()
+        await trade_journal.record_trade({
+            "user_id": user_id, "exchange": "okx", "order_id": order_id, "symbol": symbol,
+            "side": action, "position_side": position_side, "quantity": quantity, "ct_val": ct_val,
+            "entry_price": price, "stop_loss": stop_loss, "take_profit_1": take_profits[0],
+            "take_profit_2": take_profits[1], "take_profit_3": take_profits[2], "sl_order_id": sl_order_id,
+            "tp1_order_id": tp1_order_id, "tp2_order_id": tp2_order_id, "tp3_order_id": tp3_order_id,
+            "status": "open"
+        })
+
+        # Цена из сигнала — лишь ориентир; фактическую среднюю цену входа допишем, не задерживая рассылку
+        asyncio.create_task(record_fill_price("okx", symbol, order_id, user))
 
         try:
             await send_signal_notification(signal, user_id, bot)
@@ -626,10 +644,11 @@ async def process_okx_signal(user: Dict, signal: Dict) -> Optional[Dict]:
         except Exception as notify_error:
             logger.error(f"Ошибка отправки уведомления для user {user_id}: {notify_error}")
 
+        await record_success(user)
         return {
             "user_id": user_id,
             "exchange": "okx",
-            "trade_id": trade_id,
+            "order_id": order_id,
             "position_side": position_side,
             "main_order": main_order_response,
             "sl_order_id": sl_order_id,
@@ -640,6 +659,8 @@ async def process_okx_signal(user: Dict, signal: Dict) -> Optional[Dict]:
 
     except Exception as e:
         logger.error(f"Ошибка обработки сигнала OKX для пользователя {user_id}: {str(e)}")
+        if await report_failure(user, e):
+            return None
         SUPPORT_CONTACT = os.getenv("SUPPORT_CONTACT", "@SupportBot")
         try:
             keyboard = types.InlineKeyboardMarkup(inline_keyboard=[
@@ -654,36 +675,42 @@ async def process_okx_signal(user: Dict, signal: Dict) -> Optional[Dict]:
             logger.error(f"Ошибка отправки уведомления об ошибке для {user_id}: {notify_error}")
         return None
 
-async def process_bybit_signal(user: Dict, signal: Dict) -> Optional[Dict]:
+async def process_bybit_signal(user: Dict, signal: Signal, sizing: Optional[Dict] = None,
+                             signal_id: str = None) -> Optional[Dict]:
     user_id = user['user_id']
     api_key = user['api_key']
     secret_key = user['secret_key']
 
-    action = signal['action']
-    symbol = signal['symbol']
-    price = signal['price']
-    stop_loss = signal['stop_loss']
-    take_profits = [signal['take_profit_1'], signal['take_profit_2'], signal['take_profit_3']]
+    action = signal.action
+    symbol = signal.symbol
+    price = signal.price
+    stop_loss = signal.stop_loss
+    take_profits = signal.take_profits
 
     try:
         # Закрываем противоположные сделки
         await close_bybit_trade(user, symbol, action)
 
-        usdt_balance = bybit_get_balance(api_key, secret_key)
+        usdt_balance = sizing["balance"] if sizing else await run_on("bybit", bybit_get_balance, api_key, secret_key)
         if usdt_balance < 10:
             logger.error(f"Недостаточный баланс для пользователя {user_id}: {usdt_balance} USDT")
+            await report_failure(user, f"insufficient balance: {usdt_balance} USDT")
             return None
 
         # Устанавливаем плечо
-        leverage_set = bybit_set_leverage(symbol, leverage=10, tdMode="isolated",
-                                         api_key=api_key, secret_key=secret_key)
+        leverage_set = await run_on("bybit", bybit_set_leverage, symbol, leverage=10, tdMode="isolated",
+                                    api_key=api_key, secret_key=secret_key)
         if not leverage_set:
             logger.warning(f"Не удалось установить плечо для {symbol}, продолжаем...")
 
-        quantity = bybit_calculate_quantity(symbol, leverage=10, risk_percent=0.05,
-                                           api_key=api_key, secret_key=secret_key)
+        if sizing:
+            quantity = sizing["quantity"]
+        else:
+            quantity = await run_on("bybit", bybit_calculate_quantity, symbol, leverage=10, risk_percent=0.05,
+                                    api_key=api_key, secret_key=secret_key)
 
-        main_order_response, sorted_take_profits, order_id, algo_order_ids, position_side = bybit_create_main_order(
+        entry_id = client_order_id(signal_id, user_id, "entry") if signal_id else None
+        entry_kwargs = dict(
             symbol=symbol,
             side=action,
             quantity=quantity,
@@ -691,7 +718,14 @@ async def process_bybit_signal(user: Dict, signal: Dict) -> Optional[Dict]:
             take_profits=take_profits,
             tdMode="isolated",
             api_key=api_key,
-            secret_key=secret_key
+            secret_key=secret_key,
+            tp_quantities=sizing["tp_quantities"] if sizing else None,
+            position_mode=user.get('position_mode'),
+            client_id=entry_id
+        )
+        main_order_response, sorted_take_profits, order_id, algo_order_ids, position_side = await retry_call(
+            bybit_create_main_order, exchange="bybit",
+            recover=(lambda: bybit_recover_main_order(**entry_kwargs)) if entry_id else None, **entry_kwargs
         )
 
         sl_order_id = algo_order_ids[0] if algo_order_ids else None
@@ -699,19 +733,16 @@ async def process_bybit_signal(user: Dict, signal: Dict) -> Optional[Dict]:
         tp2_order_id = algo_order_ids[2] if len(algo_order_ids) > 2 else None
         tp3_order_id = algo_order_ids[3] if len(algo_order_ids) > 3 else None
 
-        cursor = get_cursor()
-        cursor.execute(
-            """
-            INSERT INTO trades (user_id, exchange, order_id, symbol, side, position_side, quantity, entry_price, stop_loss, take_profit_1, take_profit_2, take_profit_3, sl_order_id, tp1_order_id, tp2_order_id, tp3_order_id, status)
-            VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s)
-            RETURNING trade_id
-            """,
-            (user_id, 'bybit', order_id, symbol, action, position_side, quantity, price, stop_loss,
-             take_profits[0], take_profits[1], take_profits[2], sl_order_id, tp1_order_id, tp2_order_id, tp3_order_id,
-             'open')
-        )
-        trade_id = cursor.fetchone()['trade_id']
-        commit()
+        await trade_journal.record_trade({
+            "user_id": user_id, "exchange": "bybit", "order_id": order_id, "symbol": symbol,
+            "side": action, "position_side": position_side, "quantity": quantity, "entry_price": price,
+            "stop_loss": stop_loss, "take_profit_1": take_profits[0], "take_profit_2": take_profits[1],
+            "take_profit_3": take_profits[2], "sl_order_id": sl_order_id, "tp1_order_id": tp1_order_id,
+            "tp2_order_id": tp2_order_id, "tp3_order_id": tp3_order_id, "status": "open"
+        })
+
+        # Цена из сигнала — лишь ориентир; фактическую среднюю цену входа допишем, не задерживая рассылку
+        asyncio.create_task(record_fill_price("bybit", symbol, order_id, user))
 
         try:
             await send_signal_notification(signal, user_id, bot)
@@ -719,10 +750,11 @@ async def process_bybit_signal(user: Dict, signal: Dict) -> Optional[Dict]:
         except Exception as notify_error:
             logger.error(f"Ошибка отправки уведомления для user {user_id}: {notify_error}")
 
+        await record_success(user)
         return {
             "user_id": user_id,
             "exchange": "bybit",
-            "trade_id": trade_id,
+            "order_id": order_id,
             "position_side": position_side,
             "main_order": main_order_response,
             "sl_order_id": sl_order_id,
@@ -733,6 +765,8 @@ async def process_bybit_signal(user: Dict, signal: Dict) -> Optional[Dict]:
 
     except Exception as e:
         logger.error(f"Ошибка обработки сигнала Bybit для пользователя {user_id}: {str(e)}")
+        if await report_failure(user, e):
+            return None
         SUPPORT_CONTACT = os.getenv("SUPPORT_CONTACT", "@SupportBot")
         try:
             keyboard = types.InlineKeyboardMarkup(inline_keyboard=[
@@ -747,37 +781,45 @@ async def process_bybit_signal(user: Dict, signal: Dict) -> Optional[Dict]:
             logger.error(f"Ошибка отправки уведомления об ошибке для {user_id}: {notify_error}")
         return None
 
-async def process_bitget_signal(user: Dict, signal: Dict) -> Optional[Dict]:
+async def process_bitget_signal(user: Dict, signal: Signal, sizing: Optional[Dict] = None,
+                             signal_id: str = None) -> Optional[Dict]:
     user_id = user['user_id']
     api_key = user['api_key']
     secret_key = user['secret_key']
     passphrase = user['passphrase']
 
-    action = signal['action']
-    symbol = signal['symbol']
-    price = signal['price']
-    stop_loss = signal['stop_loss']
-    take_profits = [signal['take_profit_1'], signal['take_profit_2'], signal['take_profit_3']]
+    action = signal.action
+    symbol = signal.symbol
+    price = signal.price
+    stop_loss = signal.stop_loss
+    take_profits = signal.take_profits
 
     try:
         # Закрываем противоположные сделки
         await close_bitget_trade(user, symbol, action)
 
-        usdt_balance = bitget_get_balance(api_key, secret_key, passphrase)
+        usdt_balance = sizing["balance"] if sizing else await run_on(
+            "bitget", bitget_get_balance, api_key, secret_key, passphrase)
         if usdt_balance < 10:
             logger.error(f"Недостаточный баланс для пользователя {user_id}: {usdt_balance} USDT")
+            await report_failure(user, f"insufficient balance: {usdt_balance} USDT")
             return None
 
         # Устанавливаем плечо
-        leverage_set = bitget_set_leverage(symbol, leverage=10, tdMode="isolated",
-                                          api_key=api_key, secret_key=secret_key, passphrase=passphrase)
+        leverage_set = await run_on("bitget", bitget_set_leverage, symbol, leverage=10, tdMode="isolated",
+                                    api_key=api_key, secret_key=secret_key, passphrase=passphrase,
+                                    position_mode=user.get('position_mode'))
         if not leverage_set:
             logger.warning(f"Не удалось установить плечо для {symbol}, продолжаем...")
 
-        quantity = bitget_calculate_quantity(symbol, leverage=10, risk_percent=0.05,
-                                            api_key=api_key, secret_key=secret_key, passphrase=passphrase)
+        if sizing:
+            quantity = sizing["quantity"]
+        else:
+            quantity = await run_on("bitget", bitget_calculate_quantity, symbol, leverage=10, risk_percent=0.05,
+                                    api_key=api_key, secret_key=secret_key, passphrase=passphrase)
 
-        main_order_response, sorted_take_profits, order_id, algo_order_ids, position_side = bitget_create_main_order(
+        entry_id = client_order_id(signal_id, user_id, "entry") if signal_id else None
+        entry_kwargs = dict(
             symbol=symbol,
             side=action,
             quantity=quantity,
@@ -786,7 +828,13 @@ async def process_bitget_signal(user: Dict, signal: Dict) -> Optional[Dict]:
             tdMode="isolated",
             api_key=api_key,
             secret_key=secret_key,
-            passphrase=passphrase
+            passphrase=passphrase,
+            tp_quantities=sizing["tp_quantities"] if sizing else None,
+            client_id=entry_id
+        )
+        main_order_response, sorted_take_profits, order_id, algo_order_ids, position_side = await retry_call(
+            bitget_create_main_order, exchange="bitget",
+            recover=(lambda: bitget_recover_main_order(**entry_kwargs)) if entry_id else None, **entry_kwargs
         )
 
         sl_order_id = algo_order_ids[0] if algo_order_ids else None
@@ -794,19 +842,16 @@ async def process_bitget_signal(user: Dict, signal: Dict) -> Optional[Dict]:
         tp2_order_id = algo_order_ids[2] if len(algo_order_ids) > 2 else None
         tp3_order_id = algo_order_ids[3] if len(algo_order_ids) > 3 else None
 
-        cursor = get_cursor()
-        cursor.execute(
-            """
-            INSERT INTO trades (user_id, exchange, order_id, symbol, side, position_side, quantity, entry_price, stop_loss, take_profit_1, take_profit_2, take_profit_3, sl_order_id, tp1_order_id, tp2_order_id, tp3_order_id, status)
-            VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s)
-            RETURNING trade_id
-            """,
-            (user_id, 'bitget', order_id, symbol, action, position_side, quantity, price, stop_loss,
-             take_profits[0], take_profits[1], take_profits[2], sl_order_id, tp1_order_id, tp2_order_id, tp3_order_id,
-             'open')
-        )
-        trade_id = cursor.fetchone()['trade_id']
-        commit()
+        await trade_journal.record_trade({
+            "user_id": user_id, "exchange": "bitget", "order_id": order_id, "symbol": symbol,
+            "side": action, "position_side": position_side, "quantity": quantity, "entry_price": price,
+            "stop_loss": stop_loss, "take_profit_1": take_profits[0], "take_profit_2": take_profits[1],
+            "take_profit_3": take_profits[2], "sl_order_id": sl_order_id, "tp1_order_id": tp1_order_id,
+            "tp2_order_id": tp2_order_id, "tp3_order_id": tp3_order_id, "status": "open"
+        })
+
+        # Цена из сигнала — лишь ориентир; фактическую среднюю цену входа допишем, не задерживая рассылку
+        asyncio.create_task(record_fill_price("bitget", symbol, order_id, user))
 
         try:
             await send_signal_notification(signal, user_id, bot)
@@ -814,10 +859,11 @@ async def process_bitget_signal(user: Dict, signal: Dict) -> Optional[Dict]:
         except Exception as notify_error:
             logger.error(f"Ошибка отправки уведомления для user {user_id}: {notify_error}")
 
+        await record_success(user)
         return {
             "user_id": user_id,
             "exchange": "bitget",
-            "trade_id": trade_id,
+            "order_id": order_id,
             "position_side": position_side,
             "main_order": main_order_response,
             "sl_order_id": sl_order_id,
@@ -828,6 +874,8 @@ async def process_bitget_signal(user: Dict, signal: Dict) -> Optional[Dict]:
 
     except Exception as e:
         logger.error(f"Ошибка обработки сигнала Bitget для пользователя {user_id}: {str(e)}")
+        if await report_failure(user, e):
+            return None
         SUPPORT_CONTACT = os.getenv("SUPPORT_CONTACT", "@SupportBot")
         try:
             keyboard = types.InlineKeyboardMarkup(inline_keyboard=[
@@ -848,7 +896,7 @@ async def process_bingx_move_sl(user: Dict, symbol: str) -> Optional[Dict]:
     secret_key = user['secret_key']
 
     try:
-        success = bingx_move_sl_to_breakeven(symbol, api_key, secret_key)
+        success = await run_order("bingx", bingx_move_sl_to_breakeven, symbol, api_key, secret_key, user_id=user_id)
 
         if success:
             # Отправляем уведомление
@@ -878,7 +926,8 @@ async def process_okx_move_sl(user: Dict, symbol: str) -> Optional[Dict]:
     passphrase = user['passphrase']
 
     try:
-        success = okx_move_sl_to_breakeven(symbol, api_key, secret_key, passphrase)
+        success = await run_order("okx", okx_move_sl_to_breakeven, symbol, api_key, secret_key, passphrase,
+                                  user_id=user_id)
 
         if success:
             # Отправляем уведомление
@@ -907,7 +956,7 @@ async def process_bybit_move_sl(user: Dict, symbol: str) -> Optional[Dict]:
     secret_key = user['secret_key']
 
     try:
-        success = bybit_move_sl_to_breakeven(symbol, api_key, secret_key)
+        success = await run_order("bybit", bybit_move_sl_to_breakeven, symbol, api_key, secret_key, user_id=user_id)
 
         if success:
             # Отправляем уведомление
@@ -937,7 +986,8 @@ async def process_bitget_move_sl(user: Dict, symbol: str) -> Optional[Dict]:
     passphrase = user['passphrase']
 
     try:
-        success = bitget_move_sl_to_breakeven(symbol, api_key, secret_key, passphrase)
+        success = await run_order("bitget", bitget_move_sl_to_breakeven, symbol, api_key, secret_key, passphrase,
+                                  user_id=user_id)
 
         if success:
             # Отправляем уведомление
@@ -0,0 +1,71 @@
+# signal_parser.py
+import json
+import logging
+
+import orjson
+from pydantic import ValidationError
+
+from models import Signal
+
+logger = logging.getLogger(__name__)
+
+ACCEPTED_CONTENT_TYPES = ("application/json", "text/plain")
+
+
+class SignalValidationError(ValueError):
+    """Сигнал отклонён; code — машиночитаемая причина для ответа и метрик"""
+
+    def __init__(self, code: str, message: str):
+        super().__init__(message)
+        self.code = code
+        self.message = message
+
+
+def _nan_to_none(constant: str):
+    return None
+
+
+def decode_json(body: bytes):
+    """Один разбор тела: orjson, а если в теле NaN/Infinity (orjson их не принимает) — json с заменой на None"""
+    try:
+        return orjson.loads(body)
+    except orjson.JSONDecodeError:
+        pass
+    try:
+        return json.loads(body, parse_constant=_nan_to_none)
+    except (ValueError, UnicodeDecodeError) as e:
+        raise SignalValidationError("invalid_json", f"Неверный формат JSON: {e}")
+
+
+def parse_signal(body: bytes, content_type: str) -> Signal:
+    """Проверяет Content-Type, разбирает тело и строит валидный Signal"""
+    content_type = (content_type or "").lower()
+    if not any(accepted in content_type for accepted in ACCEPTED_CONTENT_TYPES):
+        raise SignalValidationError("content_type", "Ожидается Content-Type: application/json или text/plain")
+
+    data = decode_json(body)
+    if not data:
+        raise SignalValidationError("empty", "Пустой JSON")
+    if not isinstance(data, dict):
+        raise SignalValidationError("invalid_json", "Ожидается JSON-объект")
+
+    try:
+        signal = Signal.model_validate(data)
+    except ValidationError as e:
+        error = e.errors()[0]
+        field = error["loc"][0] if error["loc"] else "signal"
+        message = error["msg"].removeprefix("Value error, ")
+        raise SignalValidationError(f"invalid_{field}", message)
+
+    if signal.action == "MOVE_SL":
+        return signal
+
+    if not signal.price or signal.price <= 0:
+        raise SignalValidationError("invalid_price", "Неверный формат цены")
+    if not signal.stop_loss or not all(signal.take_profits):
+        raise SignalValidationError(
+            "missing_sl_tp",
+            f"Необходимо указать stop_loss и все три take_profit: SL={signal.stop_loss}, "
+            f"TP1={signal.take_profit_1}, TP2={signal.take_profit_2}, TP3={signal.take_profit_3}"
+        )
+    return signal
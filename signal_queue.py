@@ -0,0 +1,108 @@
+# signal_queue.py
+import json
+import logging
+import os
+import socket
+import uuid
+from typing import Dict, List, Optional
+
+from psycopg2.extras import Json, execute_values
+
+from database import get_cursor, commit
+
+logger = logging.getLogger(__name__)
+
+# inline — webhook сам рассылает сигнал; sharded — кладёт задания в signal_jobs для worker.py
+EXECUTION_MODE = os.getenv("EXECUTION_MODE", "inline")
+SIGNAL_SHARDS = int(os.getenv("SIGNAL_SHARDS", "1"))
+# Задание старше этого не исполняется: цена уже ушла, пока воркеры были недоступны
+SIGNAL_JOB_MAX_AGE = float(os.getenv("SIGNAL_JOB_MAX_AGE", "60"))
+SIGNAL_JOBS_CHANNEL = "signal_jobs"
+
+WORKER_ID = f"{socket.gethostname()}:{os.getpid()}"
+
+
+def sharded_mode() -> bool:
+    return EXECUTION_MODE == "sharded"
+
+
+def enqueue_signal(kind: str, payload: Dict, shards: int = SIGNAL_SHARDS) -> str:
+    """Ставит сигнал в очередь — по одному заданию на шард — и будит воркеры"""
+    signal_id = uuid.uuid4().hex
+    cursor = get_cursor()
+    try:
+        execute_values(
+            cursor,
+            "INSERT INTO signal_jobs (signal_id, kind, shard, shards, payload) VALUES %s",
+            [(signal_id, kind, shard, shards, Json(payload)) for shard in range(shards)]
+        )
+        cursor.execute(f"NOTIFY {SIGNAL_JOBS_CHANNEL}")
+        commit()
+    except Exception:
+        cursor.connection.rollback()
+        raise
+    logger.info(f"Сигнал {signal_id} ({kind}) поставлен в очередь на {shards} шардов")
+    return signal_id
+
+
+def claim_job(conn, shards: List[int]) -> Optional[Dict]:
+    """Забирает старейшее задание своих шардов.
+
+    Транзакция остаётся открытой до finish_job: блокировка строки держится,
+    пока идёт рассылка, и если воркер упадёт, задание вернётся в очередь.
+    """
+    cursor = conn.cursor()
+    cursor.execute("""
+        SELECT job_id, signal_id, kind, shard, shards, payload, attempts,
+               EXTRACT(EPOCH FROM (CURRENT_TIMESTAMP - created_at)) AS age
+        FROM signal_jobs
+        WHERE status = 'pending' AND shard = ANY(%s)
+        ORDER BY job_id
+        LIMIT 1
+        FOR UPDATE SKIP LOCKED
+    """, (shards,))
+    job = cursor.fetchone()
+    if job is None:
+        conn.rollback()
+        return None
+    cursor.execute(
+        "UPDATE signal_jobs SET attempts = attempts + 1, claimed_by = %s WHERE job_id = %s",
+        (WORKER_ID, job["job_id"])
+    )
+    return job
+
+
+def started_user_ids(conn, signal_id: str) -> set:
+    """Пользователи, чей вход по сигналу уже начинался: при повторной выдаче задания
+    после падения воркера они пропускаются, чтобы не открыть вторую позицию"""
+    cursor = conn.cursor()
+    cursor.execute("SELECT user_id FROM signal_job_users WHERE signal_id = %s", (signal_id,))
+    return {row["user_id"] for row in cursor.fetchall()}
+
+
+def mark_user_started(conn, signal_id: str, user_id: int) -> None:
+    """Отмечает вход пользователя до отправки ордера; conn — в autocommit,
+    чтобы отметка была зафиксирована раньше, чем ордер уйдёт на биржу"""
+    with conn.cursor() as cursor:
+        cursor.execute(
+            "INSERT INTO signal_job_users (signal_id, user_id) VALUES (%s, %s) ON CONFLICT DO NOTHING",
+            (signal_id, user_id)
+        )
+
+
+def purge_started_users(conn, older_than_seconds: float) -> None:
+    with conn.cursor() as cursor:
+        cursor.execute(
+            "DELETE FROM signal_job_users WHERE created_at < CURRENT_TIMESTAMP - make_interval(secs => %s)",
+            (older_than_seconds,)
+        )
+
+
+def finish_job(conn, job_id: int, status: str, result: Optional[List] = None, error: str = None) -> None:
+    cursor = conn.cursor()
+    cursor.execute("""
+        UPDATE signal_jobs
+        SET status = %s, result = %s, error = %s, finished_at = CURRENT_TIMESTAMP
+        WHERE job_id = %s
+    """, (status, json.dumps(result, default=str) if result is not None else None, error, job_id))
+    conn.commit()
@@ -0,0 +1,192 @@
+# sizing.py
+import asyncio
+import json
+import logging
+import math
+from decimal import Decimal
+from typing import Dict, List
+
+import numpy as np
+
+from bulkheads import run_on
+from cache import price_cache
+import deadline
+
+logger = logging.getLogger(__name__)
+
+# Те же параметры, что services.process_*_signal передаёт в calculate_quantity
+LEVERAGE = 10
+RISK_PERCENT = 0.05
+MIN_BALANCE = {"bingx": 0.1, "okx": 10.0, "bybit": 10.0, "bitget": 10.0}
+# Минимальная сумма ордера в USDT (OKX отклоняет меньшие)
+MIN_NOTIONAL = {"okx": 5.0}
+TP_LEGS = 3
+
+
+def instrument_spec(exchange: str, symbol: str) -> Dict:
+    """Шаг лота, минимальный объём и стоимость контракта из кэшированных инструментов"""
+    if exchange == "bingx":
+        from bingx_api import get_symbol_info
+        info = get_symbol_info(symbol)
+        return {"step": float(info["stepSize"]), "min_qty": float(info["minQty"]), "ct_val": 1.0}
+    if exchange == "okx":
+        from okx_api import get_symbol_info
+        info = get_symbol_info(symbol, None, None, None)
+        return {"step": info["lotSz"], "min_qty": info["minSz"], "ct_val": info["ctVal"]}
+    if exchange == "bybit":
+        from bybit_api import get_symbol_info
+        info = get_symbol_info(symbol, None, None)
+        return {"step": info["lotSizeFilter"]["qtyStep"], "min_qty": info["lotSizeFilter"]["minOrderQty"],
+                "ct_val": 1.0}
+    if exchange == "bitget":
+        from bitget_api import get_symbol_info
+        info = get_symbol_info(symbol, "", "", "")
+        return {"step": info["qtyStep"], "min_qty": info["minQty"], "ct_val": 1.0}
+    raise ValueError(f"Неизвестная биржа: {exchange}")
+
+
+def fetch_price(exchange: str, symbol: str) -> float:
+    if exchange == "bingx":
+        from bingx_api import get_current_price
+        return get_current_price(symbol)
+    if exchange == "okx":
+        from okx_api import get_current_price
+        return get_current_price(symbol, None, None, None)
+    if exchange == "bybit":
+        from bybit_api import get_current_price
+        return get_current_price(symbol, None, None)
+    if exchange == "bitget":
+        from bitget_api import get_current_price
+        return get_current_price(symbol, "", "", "")
+    raise ValueError(f"Неизвестная биржа: {exchange}")
+
+
+def cached_price(exchange: str, symbol: str) -> float:
+    """fetch_price через price_cache: за одну рассылку цена запрашивается раз в PRICE_CACHE_TTL"""
+    price = price_cache.get((exchange, symbol))
+    if price is None:
+        price = fetch_price(exchange, symbol)
+        price_cache.set((exchange, symbol), price)
+    return price
+
+
+# Запросы цены в полёте: пользователи, упёршиеся в истёкший кэш одновременно, ждут один запрос
+_price_requests: Dict[tuple, asyncio.Future] = {}
+
+
+async def current_price(exchange: str, symbol: str) -> float:
+    """cached_price для event loop: промах кэша идёт в отсек биржи (bulkheads.py), не блокируя loop"""
+    price = price_cache.get((exchange, symbol))
+    if price is not None:
+        return price
+    key = (exchange, symbol)
+    request = _price_requests.get(key)
+    if request is None:
+        request = asyncio.ensure_future(run_on(exchange, cached_price, exchange, symbol))
+        _price_requests[key] = request
+        request.add_done_callback(lambda _: _price_requests.pop(key, None))
+    return await asyncio.shield(request)
+
+
+def fetch_balance(exchange: str, user: Dict) -> float:
+    api_key, secret_key, passphrase = user['api_key'], user['secret_key'], user.get('passphrase')
+    if exchange == "bingx":
+        from bingx_api import get_balance
+        return float(json.loads(get_balance(api_key, secret_key))["data"]["balance"]["availableMargin"])
+    if exchange == "okx":
+        from okx_api import get_balance
+        return get_balance(api_key, secret_key, passphrase)
+    if exchange == "bybit":
+        from bybit_api import get_balance
+        return get_balance(api_key, secret_key)
+    if exchange == "bitget":
+        from bitget_api import get_balance
+        return get_balance(api_key, secret_key, passphrase)
+    raise ValueError(f"Неизвестная биржа: {exchange}")
+
+
+def step_decimals(step: float) -> int:
+    exponent = Decimal(str(step)).normalize().as_tuple().exponent
+    return max(0, -exponent)
+
+
+def size_batch(balances: np.ndarray, price: float, step: float, min_qty: float, ct_val: float = 1.0,
+               leverage: int = LEVERAGE, risk_percent: float = RISK_PERCENT, min_notional: float = 0.0,
+               min_balance: float = 0.0) -> Dict[str, np.ndarray]:
+    """Размеры входа и TP для всей когорты в лотах (целые числа шагов).
+
+    valid — у пользователя достаточно баланса; lots — объём входа;
+    tp_lots — разбиение входа на TP_LEGS ног, сумма ног всегда равна lots.
+    """
+    balances = np.asarray(balances, dtype=np.float64)
+    valid = np.isfinite(balances) & (balances >= min_balance) & (balances > 0)
+
+    raw_lots = np.where(valid, balances, 0.0) * (risk_percent * leverage) / (price * ct_val * step)
+    lots = np.rint(raw_lots).astype(np.int64)
+
+    min_lots = max(1, math.ceil(min_qty / step - 1e-9))
+    if min_notional:
+        min_lots = max(min_lots, math.ceil(min_notional / (price * ct_val * step) - 1e-9))
+    lots = np.where(valid, np.maximum(lots, min_lots), 0)
+
+    # Остаток от деления на три уходит в первые ноги, как в create_main_order
+    base, remainder = np.divmod(lots, TP_LEGS)
+    tp_lots = np.stack([base + (remainder > leg) for leg in range(TP_LEGS)], axis=1)
+    # Если на три ноги не хватает минимального объёма — один TP на всю позицию
+    single = lots < TP_LEGS * min_lots
+    tp_lots[single] = 0
+    tp_lots[single, 0] = lots[single]
+
+    return {"valid": valid, "lots": lots, "tp_lots": tp_lots}
+
+
+async def fetch_balances(exchange: str, users: List[Dict]) -> np.ndarray:
+    """Балансы когорты параллельно в отсеке биржи (bulkheads.py, группа account).
+    Не успевшие до дедлайна сигнала и с ошибкой — NaN."""
+    tasks = [asyncio.create_task(run_on(exchange, fetch_balance, exchange, user)) for user in users]
+    _, pending = await asyncio.wait(tasks, timeout=deadline.remaining())
+    for task in pending:
+        task.cancel()
+    if pending:
+        logger.warning(f"Балансы {exchange}: {len(pending)} из {len(users)} не получены до дедлайна сигнала")
+
+    balances = np.full(len(users), np.nan)
+    for i, (user, task) in enumerate(zip(users, tasks)):
+        if task in pending:
+            continue
+        try:
+            balances[i] = task.result()
+        except Exception as e:
+            logger.error(f"Не удалось получить баланс пользователя {user['user_id']} на {exchange}: {e}")
+    return balances
+
+
+async def size_cohort(exchange: str, symbol: str, users: List[Dict]) -> Dict[int, Dict]:
+    """Баланс, объём входа и TP для каждого пользователя биржи по одному сигналу.
+
+    Пользователи, чей баланс получить не удалось, в результат не попадают —
+    process_*_signal посчитает их объём сам, как раньше.
+    """
+    spec = await run_on(exchange, instrument_spec, exchange, symbol)
+    price = await current_price(exchange, symbol)
+    balances = await fetch_balances(exchange, users)
+
+    batch = size_batch(
+        balances, price, spec["step"], spec["min_qty"], spec["ct_val"],
+        min_notional=MIN_NOTIONAL.get(exchange, 0.0), min_balance=MIN_BALANCE.get(exchange, 0.0)
+    )
+    decimals = step_decimals(spec["step"])
+    quantities = np.round(batch["lots"] * spec["step"], decimals)
+    tp_quantities = np.round(batch["tp_lots"] * spec["step"], decimals)
+
+    sizes = {}
+    for i, user in enumerate(users):
+        if np.isnan(balances[i]):
+            continue
+        sizes[user['user_id']] = {
+            "balance": float(balances[i]),
+            "quantity": float(quantities[i]),
+            "tp_quantities": [float(qty) for qty in tp_quantities[i] if qty > 0],
+        }
+    logger.info(f"Рассчитаны объёмы {exchange} {symbol}: {len(sizes)} из {len(users)} пользователей, цена {price}")
+    return sizes
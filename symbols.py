@@ -0,0 +1,102 @@
+# symbols.py
+import asyncio
+import logging
+import os
+import re
+from typing import Dict, Iterable, Optional
+
+from bulkheads import run_on
+from cache import get_cache, INSTRUMENT_CACHE_TTL
+from utils import normalize_symbol
+
+logger = logging.getLogger(__name__)
+
+SUPPORTED_EXCHANGES = ("bingx", "okx", "bybit", "bitget")
+
+# Суффиксы и разделители, которые отличают символ биржи от канонического BTCUSDT
+_EXCHANGE_SUFFIX = re.compile(r"(-SWAP|_UMCBL)$")
+_TRADINGVIEW_SUFFIX = re.compile(r"\.P$")
+_SEPARATORS = re.compile(r"[-/_]")
+
+# Таблицы трансляции по бирже: канонический символ -> символ биржи
+symbol_tables = get_cache("symbol_tables", INSTRUMENT_CACHE_TTL)
+
+# Биржа, список инструментов которой не загрузился, не опрашивается повторно SYMBOL_TABLE_RETRY секунд:
+# иначе каждый сигнал во время её сбоя ждал бы таймаута запроса
+SYMBOL_TABLE_RETRY = float(os.getenv("SYMBOL_TABLE_RETRY", "30"))
+symbol_table_failures = get_cache("symbol_table_failures", SYMBOL_TABLE_RETRY, persistent=False)
+
+# Загрузки таблиц в полёте: сигналы, упёршиеся в промах кэша одновременно, ждут один запрос
+_table_requests: Dict[str, asyncio.Future] = {}
+
+
+def canonical_symbol(symbol: str) -> str:
+    """BINANCE:BTCUSDT.P, BTC/USDT, BTC-USDT-SWAP, BTCUSDT_UMCBL -> BTCUSDT"""
+    symbol = symbol.upper().rsplit(":", 1)[-1]
+    symbol = _TRADINGVIEW_SUFFIX.sub("", symbol)
+    symbol = _EXCHANGE_SUFFIX.sub("", symbol)
+    return _SEPARATORS.sub("", symbol)
+
+
+def _list_symbols(exchange: str) -> list:
+    if exchange == "bingx":
+        from bingx_api import list_symbols
+    elif exchange == "okx":
+        from okx_api import list_symbols
+    elif exchange == "bybit":
+        from bybit_api import list_symbols
+    elif exchange == "bitget":
+        from bitget_api import list_symbols
+    else:
+        raise ValueError(f"Неизвестная биржа: {exchange}")
+    return list_symbols()
+
+
+def get_symbol_table(exchange: str) -> Optional[Dict[str, str]]:
+    """Таблица трансляции биржи из кэшированного списка инструментов; None, если биржа недоступна.
+    Блокирует на запрос к бирже — из event loop вызывается symbol_table."""
+    table = symbol_tables.get(exchange)
+    if table is not None:
+        return table
+    if symbol_table_failures.get(exchange):
+        return None
+    try:
+        table = {canonical_symbol(symbol): symbol for symbol in _list_symbols(exchange)}
+    except Exception as e:
+        logger.error(f"Не удалось построить таблицу символов {exchange}: {e}")
+        symbol_table_failures.set(exchange, True)
+        return None
+    symbol_tables.set(exchange, table)
+    logger.info(f"Таблица символов {exchange}: {len(table)} инструментов")
+    return table
+
+
+async def symbol_table(exchange: str) -> Optional[Dict[str, str]]:
+    """get_symbol_table для event loop: промах кэша идёт в отсек биржи (bulkheads.py), не блокируя loop"""
+    table = symbol_tables.get(exchange)
+    if table is not None:
+        return table
+    request = _table_requests.get(exchange)
+    if request is None:
+        request = asyncio.ensure_future(run_on(exchange, get_symbol_table, exchange))
+        _table_requests[exchange] = request
+        request.add_done_callback(lambda _: _table_requests.pop(exchange, None))
+    return await asyncio.shield(request)
+
+
+async def resolve_symbol(symbol: str, exchanges: Iterable[str] = SUPPORTED_EXCHANGES) -> Dict[str, Optional[str]]:
+    """Символ сигнала для каждой биржи; None — инструмента на бирже нет.
+
+    Если список инструментов биржи получить не удалось, символ строится
+    по старым правилам normalize_symbol, чтобы сбой справочника не останавливал торговлю.
+    """
+    canonical = canonical_symbol(symbol)
+    exchanges = list(exchanges)
+    tables = await asyncio.gather(*(symbol_table(exchange) for exchange in exchanges))
+    resolved = {}
+    for exchange, table in zip(exchanges, tables):
+        if table is None:
+            resolved[exchange] = normalize_symbol(symbol, exchange)
+        else:
+            resolved[exchange] = table.get(canonical)
+    return resolved
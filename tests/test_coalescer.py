@@ -0,0 +1,120 @@
+"""Склейка сигналов по символу: входы не теряются, повторы рассылаются один раз, MOVE_SL не обгоняет вход (coalescer.py)."""
+import asyncio
+import os
+import sys
+
+import pytest
+
+pytest.importorskip("pydantic")
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from coalescer import SignalCoalescer, merge_signals  # noqa: E402
+from models import Signal  # noqa: E402
+
+BUY = Signal(action="BUY", symbol="BTCUSDT", price=60000, stop_loss=59000, take_profit_1=61000)
+SELL = Signal(action="SELL", symbol="BTCUSDT", price=60500, stop_loss=61500, take_profit_1=59500)
+MOVE_SL = Signal(action="MOVE_SL", symbol="BTCUSDT")
+
+
+# ------------------- merge_signals -------------------
+
+def test_merge_keeps_every_entry_in_order():
+    groups = merge_signals([BUY, SELL, BUY.model_copy(update={"stop_loss": 58000})])
+    assert [[signal.action for signal in group] for group in groups] == [["BUY"], ["SELL"], ["BUY"]]
+
+
+def test_merge_folds_exact_repeats():
+    repeat = Signal(**BUY.model_dump())
+    groups = merge_signals([BUY, repeat, SELL])
+    assert groups == [[BUY, repeat], [SELL]]
+    assert groups[0][1] is repeat
+
+
+def test_merge_keeps_repeat_after_other_signal():
+    # BUY, SELL, BUY — разворот и обратный вход, а не повтор алерта
+    assert len(merge_signals([BUY, SELL, Signal(**BUY.model_dump())])) == 3
+
+
+# ------------------- SignalCoalescer -------------------
+
+def recorder(log: list, delay: float = 0.0):
+    async def dispatch(signal: Signal):
+        log.append(("start", signal.action))
+        await asyncio.sleep(delay)
+        log.append(("end", signal.action))
+        return {"status": "success", "signal_id": f"id-{len(log)}"}
+    return dispatch
+
+
+def test_burst_dispatches_every_entry_and_repeat_once():
+    log = []
+
+    async def burst():
+        coalescer = SignalCoalescer(window=0.05)
+        dispatch = recorder(log)
+        return await asyncio.gather(
+            coalescer.submit(BUY, dispatch),
+            coalescer.submit(Signal(**BUY.model_dump()), dispatch),
+            coalescer.submit(SELL, dispatch),
+        )
+
+    first, repeat, sell = asyncio.run(burst())
+    assert [action for event, action in log if event == "start"] == ["BUY", "SELL"]
+    assert first["status"] == "success" and first["coalesced"] == 2
+    assert repeat["status"] == "superseded" and repeat["superseded_by"] == first["signal_id"]
+    assert sell["status"] == "success" and "coalesced" not in sell
+
+
+def test_move_sl_waits_for_pending_entry():
+    log = []
+
+    async def entry_then_move():
+        coalescer = SignalCoalescer(window=0.05)
+        entry = asyncio.ensure_future(coalescer.submit(BUY, recorder(log, delay=0.05)))
+        await asyncio.sleep(0)
+        move = asyncio.ensure_future(coalescer.submit(MOVE_SL, recorder(log)))
+        await asyncio.gather(entry, move)
+
+    asyncio.run(entry_then_move())
+    assert log == [("start", "BUY"), ("end", "BUY"), ("start", "MOVE_SL"), ("end", "MOVE_SL")]
+
+
+def test_move_sl_waits_for_running_dispatch():
+    log = []
+
+    async def dispatching_then_move():
+        coalescer = SignalCoalescer(window=0.01)
+        entry = asyncio.ensure_future(coalescer.submit(BUY, recorder(log, delay=0.1)))
+        # Окно закрылось, рассылка входа идёт
+        await asyncio.sleep(0.05)
+        await coalescer.submit(MOVE_SL, recorder(log))
+        await entry
+
+    asyncio.run(dispatching_then_move())
+    assert log == [("start", "BUY"), ("end", "BUY"), ("start", "MOVE_SL"), ("end", "MOVE_SL")]
+
+
+def test_move_sl_without_pending_entry_runs_immediately():
+    log = []
+
+    async def move_only():
+        coalescer = SignalCoalescer(window=10)
+        return await asyncio.wait_for(coalescer.submit(MOVE_SL, recorder(log)), timeout=1)
+
+    assert asyncio.run(move_only())["status"] == "success"
+    assert log == [("start", "MOVE_SL"), ("end", "MOVE_SL")]
+
+
+def test_failed_dispatch_reaches_its_caller_only():
+    async def failing(signal: Signal):
+        raise RuntimeError("биржа недоступна")
+
+    async def burst():
+        coalescer = SignalCoalescer(window=0.01)
+        return await asyncio.gather(coalescer.submit(BUY, failing),
+                                    coalescer.submit(Signal(**BUY.model_dump()), failing), return_exceptions=True)
+
+    error, repeat = asyncio.run(burst())
+    assert isinstance(error, RuntimeError)
+    assert repeat["status"] == "superseded" and repeat["superseded_by"] is None
@@ -0,0 +1,173 @@
+"""AIMD-лимит запросов к бирже: рост при насыщении, снижение на 429, рост p99 и всплеск сбоев (concurrency.py)."""
+import asyncio
+import os
+import sys
+
+import pytest
+
+for module in ("requests", "dotenv"):
+    pytest.importorskip(module)
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import requests  # noqa: E402
+
+import concurrency  # noqa: E402
+from concurrency import AIMDController, is_rate_limited, is_transient  # noqa: E402
+from exchange_errors import NetworkError, RateLimitError, RejectedError, ServerError  # noqa: E402
+
+
+class Clock:
+    def __init__(self):
+        self.now = 0.0
+
+    def monotonic(self) -> float:
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(concurrency, "time", clock)
+    return clock
+
+
+def interval(controller: AIMDController, clock: Clock, seconds=0.1, count=10, error=None, errors=0):
+    """Один интервал AIMD: count замеров, из них errors с ошибкой; последний замер пересматривает лимит"""
+    for i in range(count):
+        if i == count - 1:
+            clock.now += concurrency.AIMD_INTERVAL
+        controller.observe(seconds, error if i < errors else None)
+
+
+def saturate(controller: AIMDController):
+    controller.peak_in_flight = controller.current
+
+
+# ------------------- is_transient / is_rate_limited -------------------
+
+def test_transient_errors():
+    assert is_transient(NetworkError("okx", None, "reset"))
+    assert is_transient(ServerError("bybit", 503, "unavailable"))
+    assert is_transient(requests.exceptions.ReadTimeout("read"))
+    assert is_transient(asyncio.TimeoutError())
+
+
+def test_request_rejections_are_not_transient():
+    # Нет средств или ошибка в коде — не признак перегрузки биржи
+    assert not is_transient(RejectedError("bingx", 80001, "insufficient margin"))
+    assert not is_transient(KeyError("orderId"))
+    assert not is_transient(None)
+
+
+def test_rate_limit_by_type_and_text():
+    assert is_rate_limited(RateLimitError("okx", 50011, "Too Many Requests"))
+    assert not is_rate_limited(ServerError("okx", 500, "429 в тексте не считается"))
+    assert is_rate_limited(RuntimeError("HTTP 429: too many requests"))
+    assert not is_rate_limited(None)
+
+
+# ------------------- AIMDController -------------------
+
+def test_limit_grows_when_saturated(clock):
+    controller = AIMDController("okx", initial=4)
+    saturate(controller)
+    interval(controller, clock)
+    assert controller.current == 5 and controller.increases == 1
+
+
+def test_limit_holds_when_not_saturated(clock):
+    controller = AIMDController("okx", initial=4)
+    interval(controller, clock)
+    assert controller.current == 4 and controller.increases == 0
+    assert controller.baseline_p99 == pytest.approx(0.1)
+
+
+def test_limit_capped_at_maximum(clock):
+    controller = AIMDController("okx", initial=4, maximum=4)
+    saturate(controller)
+    interval(controller, clock)
+    assert controller.current == 4
+
+
+def test_rate_limit_wave_cuts_once_per_interval(clock):
+    controller = AIMDController("bybit", initial=8)
+    for _ in range(5):
+        controller.observe(0.1, RateLimitError("bybit", 10006, "Too many visits"))
+    assert controller.current == 4 and controller.decreases == 1 and controller.rate_limited == 5
+
+    # Интервал с 429 не наращивает лимит, следующий — снова может снизить
+    saturate(controller)
+    interval(controller, clock)
+    assert controller.current == 4
+    controller.observe(0.1, RateLimitError("bybit", 10006, "Too many visits"))
+    assert controller.current == 2
+
+
+def test_error_spike_cuts_limit(clock):
+    controller = AIMDController("bitget", initial=8)
+    interval(controller, clock, error=ServerError("bitget", 502, "bad gateway"), errors=2)
+    assert controller.current == 4
+
+
+def test_rejections_do_not_cut_limit(clock):
+    controller = AIMDController("bitget", initial=8)
+    interval(controller, clock, error=RejectedError("bitget", 40762, "insufficient balance"), errors=10)
+    assert controller.current == 8 and controller.decreases == 0
+
+
+def test_p99_rise_cuts_limit(clock):
+    controller = AIMDController("bingx", initial=8)
+    interval(controller, clock, seconds=0.1)
+    interval(controller, clock, seconds=0.5)
+    assert controller.current == 4
+    assert controller.stats()["p99_ms"] == pytest.approx(500)
+
+
+def test_few_samples_are_not_trusted(clock):
+    controller = AIMDController("bingx", initial=8)
+    interval(controller, clock, count=concurrency.AIMD_MIN_SAMPLES - 1,
+             error=NetworkError("bingx", None, "reset"), errors=concurrency.AIMD_MIN_SAMPLES - 1)
+    assert controller.current == 8 and controller.baseline_p99 is None
+
+
+def test_limit_never_below_minimum(clock):
+    controller = AIMDController("okx", initial=2, minimum=2)
+    controller.observe(0.1, RateLimitError("okx", 50011, "Too Many Requests"))
+    assert controller.current == 2
+
+
+def test_slots_wait_for_release():
+    async def run():
+        controller = AIMDController("okx", initial=2)
+        running, peak = 0, 0
+
+        async def request():
+            nonlocal running, peak
+            async with controller.slot():
+                running += 1
+                peak = max(peak, running)
+                await asyncio.sleep(0.01)
+                running -= 1
+
+        await asyncio.gather(*(request() for _ in range(6)))
+        return controller, peak
+
+    controller, peak = asyncio.run(run())
+    assert peak == 2
+    assert controller.in_flight == 0 and controller.stats()["waiting"] == 0
+
+
+def test_cancelled_waiter_passes_its_turn():
+    async def run():
+        controller = AIMDController("okx", initial=1)
+        await controller.acquire()
+        cancelled = asyncio.ensure_future(controller.acquire())
+        waiting = asyncio.ensure_future(controller.acquire())
+        await asyncio.sleep(0)
+        controller.release()
+        cancelled.cancel()
+        await asyncio.wait_for(waiting, timeout=1)
+        return controller
+
+    assert asyncio.run(run()).in_flight == 1
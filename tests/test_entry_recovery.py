@@ -0,0 +1,97 @@
+"""Вход OKX с потерянным ответом: ошибки доходят до retry_call, recover находит ордер по clOrdId (okx_api.py)."""
+import os
+import sys
+from unittest import mock
+
+import pytest
+
+for module in ("requests", "psycopg2", "dotenv"):
+    pytest.importorskip(module)
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import requests  # noqa: E402
+
+import okx_api  # noqa: E402
+from exchange_errors import DuplicateOrderError, NetworkError  # noqa: E402
+
+ENTRY = dict(symbol="BTC-USDT-SWAP", side="BUY", quantity=3.0, stop_loss=59000.0,
+             take_profits=[61000.0, 62000.0, 63000.0], api_key="k", secret_key="s", passphrase="p",
+             client_id="entry-1")
+
+
+@pytest.fixture
+def trade_api(monkeypatch):
+    trade_api = mock.MagicMock()
+    trade_api.place_algo_order.side_effect = [
+        {"code": "0", "data": [{"algoId": f"algo-{i}"}]} for i in range(4)
+    ]
+    monkeypatch.setattr(okx_api, "_trade_api", mock.MagicMock(return_value=trade_api))
+    monkeypatch.setattr(okx_api, "get_symbol_info", mock.MagicMock(return_value={"lotSz": 1.0}))
+    monkeypatch.setattr(okx_api, "wait_for_fill_blocking", mock.MagicMock(return_value={"state": "filled"}))
+    return trade_api
+
+
+def test_duplicate_client_id_stops_variant_search(monkeypatch, trade_api):
+    place_order = mock.MagicMock(return_value={"code": "1", "msg": "All operations failed", "data": [
+        {"ordId": "", "sCode": "51016", "sMsg": "Duplicated clOrdId"}
+    ]})
+    monkeypatch.setattr(okx_api, "_place_order", place_order)
+
+    with pytest.raises(DuplicateOrderError):
+        okx_api.create_main_order(**ENTRY)
+    # Другой вариант с тем же входом открыл бы вторую позицию
+    place_order.assert_called_once()
+
+
+def test_lost_response_is_network_error(monkeypatch, trade_api):
+    monkeypatch.setattr(okx_api, "_place_order", mock.MagicMock(side_effect=requests.exceptions.ReadTimeout("read")))
+
+    with pytest.raises(NetworkError):
+        okx_api.create_main_order(**ENTRY)
+
+
+def test_rejected_variant_tries_next(monkeypatch, trade_api):
+    place_order = mock.MagicMock(side_effect=[
+        {"code": "1", "msg": "", "data": [{"sCode": "51000", "sMsg": "Parameter posSide error"}]},
+        {"code": "0", "msg": "", "data": [{"ordId": "42", "sCode": "0"}]},
+    ])
+    monkeypatch.setattr(okx_api, "_place_order", place_order)
+
+    response, _, order_id, _, pos_side = okx_api.create_main_order(**ENTRY)
+    assert order_id == "42" and pos_side == "net"
+    assert place_order.call_count == 2
+
+
+def test_recover_places_protection_for_plain_entry(trade_api):
+    trade_api.get_order.return_value = {"code": "0", "data": [
+        {"ordId": "42", "clOrdId": "entry-1", "sz": "3", "posSide": "net", "state": "filled", "attachAlgoOrds": []}
+    ]}
+
+    _, sorted_take_profits, order_id, algo_order_ids, pos_side = okx_api.recover_main_order(**ENTRY)
+
+    trade_api.get_order.assert_any_call(instId="BTC-USDT-SWAP", clOrdId="entry-1")
+    assert order_id == "42" and pos_side == "net"
+    assert sorted_take_profits == [61000.0, 62000.0, 63000.0]
+    # SL и три TP отдельными алгоритмическими ордерами, без posSide в режиме net
+    assert algo_order_ids == ["algo-0", "algo-1", "algo-2", "algo-3"]
+    assert "posSide" not in trade_api.place_algo_order.call_args.kwargs
+
+
+def test_recover_keeps_attached_protection(trade_api):
+    trade_api.get_order.return_value = {"code": "0", "data": [
+        {"ordId": "42", "sz": "3", "posSide": "long", "state": "filled", "attachAlgoOrds": [{"attachAlgoId": "a"}]}
+    ]}
+    trade_api.order_algos_list.return_value = {"code": "0", "data": [
+        {"algoId": "sl-1", "side": "sell"}, {"algoId": "other", "side": "buy"}
+    ]}
+
+    _, _, _, algo_order_ids, pos_side = okx_api.recover_main_order(**ENTRY)
+
+    assert algo_order_ids == ["sl-1"] and pos_side == "long"
+    trade_api.place_algo_order.assert_not_called()
+
+
+def test_recover_unknown_order(trade_api):
+    trade_api.get_order.return_value = {"code": "51603", "msg": "Order does not exist", "data": []}
+    assert okx_api.recover_main_order(**ENTRY) is None
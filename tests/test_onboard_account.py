@@ -0,0 +1,41 @@
+"""Ответ пользователю, если проверка ключей при подключении не удалась (main.onboard_account)."""
+import asyncio
+import importlib
+import os
+import sys
+from unittest import mock
+
+import pytest
+
+for module in ("aiogram", "psycopg2", "yoomoney", "dotenv", "aiohttp"):
+    pytest.importorskip(module)
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+@pytest.fixture
+def main_module(monkeypatch):
+    """main.py без БД и миграций: соединение подменено, схема не накатывается"""
+    monkeypatch.setenv("GROUP_ID", "-1")
+    monkeypatch.setenv("MODERATOR_GROUP_ID", "-2")
+    monkeypatch.setenv("BOT_TOKEN", "123456:TEST-token-for-onboard-account-call")
+    monkeypatch.setattr("psycopg2.connect", mock.MagicMock())
+    monkeypatch.setattr("migrations.run_migrations", mock.MagicMock(return_value=0))
+    sys.modules.pop("main", None)
+    return importlib.import_module("main")
+
+
+def test_unverified_keys_get_support_reply(main_module, monkeypatch):
+    monkeypatch.setattr(main_module, "probe_account", mock.MagicMock(side_effect=RuntimeError("timeout")))
+    monkeypatch.setattr(main_module, "classify_failure", mock.MagicMock(return_value="other"))
+    monkeypatch.setattr(main_module, "save_profile", mock.MagicMock())
+    send_message = mock.AsyncMock()
+    monkeypatch.setattr(main_module.bot, "send_message", send_message)
+
+    asyncio.run(main_module.onboard_account(42, "bingx", "key", "secret"))
+
+    send_message.assert_awaited_once()
+    args, kwargs = send_message.call_args
+    assert args[0] == 42
+    assert "Не удалось проверить ключи" in args[1]
+    assert kwargs["reply_markup"] == main_module.get_support_kb()
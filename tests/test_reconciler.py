@@ -0,0 +1,111 @@
+"""Сверка сделок с биржей: сработавшие ноги, закрытие и запись результата в отдельной транзакции (reconciler.py)."""
+import asyncio
+import os
+import sys
+from contextlib import contextmanager
+from unittest import mock
+
+import pytest
+
+for module in ("requests", "psycopg2", "dotenv"):
+    pytest.importorskip(module)
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import reconciler  # noqa: E402
+from reconciler import Reconciler, cancellable_order_ids, reconcile_trade  # noqa: E402
+
+TRADE = {
+    "trade_id": 1, "user_id": 7, "exchange": "bybit", "order_id": "100", "symbol": "BTCUSDT", "side": "BUY",
+    "sl_order_id": "101", "tp1_order_id": "102", "tp2_order_id": "103", "tp3_order_id": None,
+    "filled_legs": None, "remaining_quantity": 0.03, "reconciled_at": None, "cursor_ms": None,
+    "api_key": "k", "secret_key": "s", "passphrase": None,
+}
+
+
+def state(positions=None, live=(), filled=()):
+    return {"positions": positions or {}, "live_order_ids": set(live),
+            "filled_order_ids": None if filled is None else set(filled), "cursor": 1000}
+
+
+# ------------------- reconcile_trade -------------------
+
+def test_open_position_with_filled_tp():
+    result = reconcile_trade(TRADE, state({("BTCUSDT", "long"): 0.02}, live={"101", "103"}, filled={"102"}))
+    assert result == ("open", ["tp1"], 0.02)
+
+
+def test_vanished_order_without_fill_is_not_a_fill():
+    # Ордер пропал из живых, но в истории исполнений его нет — отменён, а не сработал
+    result = reconcile_trade(TRADE, state({("BTCUSDT", "long"): 0.03}, live={"101"}, filled=set()))
+    assert result == ("open", [], 0.03)
+
+
+def test_no_history_counts_vanished_as_filled():
+    result = reconcile_trade(TRADE, state({}, live=set(), filled=None))
+    assert result == ("closed", ["sl", "tp1", "tp2"], 0.0)
+
+
+def test_position_on_other_side_does_not_keep_trade_open():
+    result = reconcile_trade(TRADE, state({("BTCUSDT", "short"): 0.03}, live={"101", "102", "103"}))
+    assert result[0] == "closed"
+
+
+def test_known_filled_legs_are_kept():
+    trade = {**TRADE, "filled_legs": ["tp1"]}
+    result = reconcile_trade(trade, state({("BTCUSDT", "long"): 0.02}, live={"101", "102", "103"}))
+    assert result == ("open", ["tp1"], 0.02)
+
+
+def test_cancellable_order_ids_skip_filled_legs_and_entry():
+    assert cancellable_order_ids(TRADE) == ["100", "101", "102", "103"]
+    reconciled = {**TRADE, "filled_legs": ["tp1"], "reconciled_at": "2026-01-01"}
+    assert cancellable_order_ids(reconciled) == ["101", "103"]
+
+
+# ------------------- Reconciler.run_once -------------------
+
+@pytest.fixture
+def pooled_cursor(monkeypatch):
+    """transaction() подменён: сверка не должна трогать общее соединение (get_cursor)"""
+    cursor = mock.MagicMock()
+    cursor.fetchall.return_value = [TRADE]
+
+    @contextmanager
+    def transaction():
+        yield cursor
+    monkeypatch.setattr(reconciler, "transaction", transaction)
+    execute_values = mock.MagicMock(return_value=[{"trade_id": 1, "status": "closed"}])
+    monkeypatch.setattr(reconciler, "execute_values", execute_values)
+    monkeypatch.setattr(reconciler, "record_closed", mock.MagicMock())
+    monkeypatch.setattr(reconciler, "refresh_open_exposure", mock.MagicMock())
+    return cursor, execute_values
+
+
+def test_trade_closes_after_second_missing_position(monkeypatch, pooled_cursor):
+    _, execute_values = pooled_cursor
+
+    async def live_state(exchange, fn, *args):
+        return state({}, live=set(), filled={"101"})
+    monkeypatch.setattr(reconciler, "run_on", live_state)
+
+    sweep = Reconciler(concurrency=1)
+    # Разовый пустой ответ биржи сделку не закрывает
+    first = asyncio.run(sweep.run_once())
+    assert first["closed"] == 0
+    assert execute_values.call_args_list[0].args[2] == [(1, "open", ["sl"], 0.0)]
+
+    second = asyncio.run(sweep.run_once())
+    assert second["closed"] == 1
+    reconciler.record_closed.assert_called_with(pooled_cursor[0], [1])
+
+
+def test_exchange_error_keeps_cursor(monkeypatch, pooled_cursor):
+    _, execute_values = pooled_cursor
+
+    async def failing(exchange, fn, *args):
+        raise RuntimeError("timeout")
+    monkeypatch.setattr(reconciler, "run_on", failing)
+
+    assert asyncio.run(Reconciler().run_once()) == {"accounts": 1, "updated": 0, "closed": 0}
+    execute_values.assert_not_called()
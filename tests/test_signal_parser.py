@@ -0,0 +1,89 @@
+"""Разбор сигнала вебхука: Content-Type, JSON с NaN, нормализация действия и коды отказов (signal_parser.py)."""
+import json
+import os
+import sys
+
+import pytest
+
+for module in ("orjson", "pydantic"):
+    pytest.importorskip(module)
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from models import Signal  # noqa: E402
+from signal_parser import SignalValidationError, decode_json, parse_signal  # noqa: E402
+
+ENTRY = {"action": "buy", "symbol": "BINANCE:BTCUSDT.P", "price": 60000, "stop_loss": 59000,
+         "take_profit_1": 61000, "take_profit_2": 62000, "take_profit_3": 63000}
+
+
+def body(data) -> bytes:
+    return json.dumps(data).encode()
+
+
+def rejection(raw: bytes, content_type: str = "application/json") -> str:
+    with pytest.raises(SignalValidationError) as error:
+        parse_signal(raw, content_type)
+    return error.value.code
+
+
+# ------------------- models.Signal -------------------
+
+@pytest.mark.parametrize("action, expected", [
+    ("LONG", "BUY"), ("short", "SELL"), ("Buy", "BUY"), ("move_sl", "MOVE_SL"),
+])
+def test_action_is_normalized(action, expected):
+    assert Signal(action=action, symbol="BTCUSDT").action == expected
+
+
+def test_nan_and_infinity_levels_are_missing():
+    signal = Signal(action="BUY", symbol="BTCUSDT", price=60000, stop_loss=float("nan"),
+                    take_profit_1=float("inf"))
+    assert signal.stop_loss is None and signal.take_profit_1 is None
+
+
+# ------------------- parse_signal -------------------
+
+def test_valid_entry():
+    signal = parse_signal(body(ENTRY), "application/json; charset=utf-8")
+    assert signal.action == "BUY" and signal.symbol == "BINANCE:BTCUSDT.P"
+    assert signal.take_profits == [61000.0, 62000.0, 63000.0]
+
+
+def test_text_plain_is_accepted():
+    # TradingView шлёт тело алерта как text/plain
+    assert parse_signal(body(ENTRY), "text/plain").action == "BUY"
+
+
+def test_tradingview_nan_is_parsed():
+    raw = body({**ENTRY, "take_profit_3": 0}).replace(b"0}", b"NaN}")
+    assert decode_json(raw)["take_profit_3"] is None
+    assert rejection(raw) == "missing_sl_tp"
+
+
+def test_move_sl_needs_no_levels():
+    signal = parse_signal(body({"action": "MOVE_SL", "symbol": "BTCUSDT"}), "application/json")
+    assert signal.action == "MOVE_SL" and signal.price is None
+
+
+@pytest.mark.parametrize("raw, content_type, code", [
+    (body(ENTRY), "application/x-www-form-urlencoded", "content_type"),
+    (body(ENTRY), None, "content_type"),
+    (b"{action: BUY", "application/json", "invalid_json"),
+    (b"[1, 2]", "application/json", "invalid_json"),
+    (b"{}", "application/json", "empty"),
+    (body({**ENTRY, "action": "HOLD"}), "application/json", "invalid_action"),
+    (body({**ENTRY, "symbol": "  "}), "application/json", "invalid_symbol"),
+    (body({key: value for key, value in ENTRY.items() if key != "symbol"}), "application/json", "invalid_symbol"),
+    (body({**ENTRY, "price": -1}), "application/json", "invalid_price"),
+    (body({**ENTRY, "price": "дорого"}), "application/json", "invalid_price"),
+    (body({**ENTRY, "stop_loss": None}), "application/json", "missing_sl_tp"),
+])
+def test_rejection_codes(raw, content_type, code):
+    assert rejection(raw, content_type) == code
+
+
+def test_rejection_message_is_readable():
+    with pytest.raises(SignalValidationError) as error:
+        parse_signal(body({**ENTRY, "action": "HOLD"}), "application/json")
+    assert error.value.message == "Действие должно быть BUY, SELL, LONG, SHORT или MOVE_SL"
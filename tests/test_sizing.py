@@ -0,0 +1,121 @@
+"""Объёмы когорты (sizing.size_batch) и шаг лота из форматов инструментов каждой биржи (sizing.instrument_spec)."""
+import os
+import sys
+import types
+from unittest import mock
+
+import pytest
+
+for module in ("numpy", "requests", "psycopg2", "dotenv"):
+    pytest.importorskip(module)
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import numpy as np  # noqa: E402
+
+import sizing  # noqa: E402
+from cache import instrument_cache  # noqa: E402
+
+
+@pytest.fixture(autouse=True)
+def clear_instruments():
+    instrument_cache.invalidate()
+    yield
+    instrument_cache.invalidate()
+
+
+# ------------------- size_batch -------------------
+
+def test_size_batch_rounds_to_step():
+    # 1000 USDT * 5% * 10x = 500 USDT по 50000 -> 0.01 BTC = 10 лотов по 0.001
+    batch = sizing.size_batch(np.array([1000.0]), price=50000.0, step=0.001, min_qty=0.001)
+    assert batch["valid"].tolist() == [True]
+    assert batch["lots"].tolist() == [10]
+    assert batch["tp_lots"].tolist() == [[4, 3, 3]]
+
+
+def test_size_batch_tp_legs_sum_to_entry():
+    balances = np.array([37.0, 123.0, 999.0, 4321.0])
+    batch = sizing.size_batch(balances, price=3000.0, step=0.01, min_qty=0.01)
+    assert (batch["tp_lots"].sum(axis=1) == batch["lots"]).all()
+
+
+def test_size_batch_raises_to_min_qty_and_single_tp():
+    batch = sizing.size_batch(np.array([1.0]), price=50000.0, step=0.001, min_qty=0.002)
+    assert batch["lots"].tolist() == [2]
+    # На три ноги по минимальному объёму не хватает — один TP на всю позицию
+    assert batch["tp_lots"].tolist() == [[2, 0, 0]]
+
+
+def test_size_batch_min_notional_in_contracts():
+    # OKX: 1 контракт = 0.01 BTC = 500 USDT, минимум 5 USDT укладывается в один лот
+    batch = sizing.size_batch(np.array([100.0]), price=50000.0, step=1.0, min_qty=1.0, ct_val=0.01,
+                              min_notional=5.0)
+    assert batch["lots"].tolist() == [1]
+
+
+def test_size_batch_skips_invalid_balances():
+    batch = sizing.size_batch(np.array([np.nan, 0.0, 5.0, 100.0]), price=100.0, step=0.1, min_qty=0.1,
+                              min_balance=10.0)
+    assert batch["valid"].tolist() == [False, False, False, True]
+    assert batch["lots"].tolist()[:3] == [0, 0, 0]
+    assert batch["tp_lots"][:3].sum() == 0
+
+
+def test_step_decimals():
+    assert sizing.step_decimals(0.001) == 3
+    assert sizing.step_decimals(1e-08) == 8
+    assert sizing.step_decimals(1.0) == 0
+
+
+# ------------------- instrument_spec -------------------
+# Ответы в том виде, в каком их отдают биржи: у BingX и Bitget точность объёма — число знаков
+
+def test_instrument_spec_bingx_precision_is_decimal_places(monkeypatch):
+    import bingx_api
+    response = mock.MagicMock()
+    response.json.return_value = {"code": 0, "data": [
+        {"symbol": "BTC-USDT", "minTradeVolume": 0.0001, "volumePrecision": 4},
+    ]}
+    monkeypatch.setattr(bingx_api.http_session, "get", mock.MagicMock(return_value=response))
+
+    spec = sizing.instrument_spec("bingx", "BTC-USDT")
+    assert spec == {"step": pytest.approx(0.0001), "min_qty": 0.0001, "ct_val": 1.0}
+    assert sizing.step_decimals(spec["step"]) == 4
+
+
+def test_instrument_spec_bitget_volume_place_is_decimal_places(monkeypatch):
+    client = mock.MagicMock()
+    client.mix_get_symbols.return_value = {"code": "00000", "data": [
+        {"symbol": "BTCUSDT_UMCBL", "minTradeAmount": "0.001", "volumePlace": "3", "maxLeverage": "125"},
+    ]}
+    monkeypatch.setitem(sys.modules, "pybitget", types.SimpleNamespace(Bitget=mock.MagicMock(return_value=client)))
+
+    spec = sizing.instrument_spec("bitget", "BTCUSDT_UMCBL")
+    assert spec == {"step": pytest.approx(0.001), "min_qty": 0.001, "ct_val": 1.0}
+    assert sizing.step_decimals(spec["step"]) == 3
+
+
+def test_instrument_spec_okx_lot_size_and_contract_value(monkeypatch):
+    import okx_api
+    public_api = mock.MagicMock()
+    public_api.get_instruments.return_value = {"code": "0", "data": [
+        {"instId": "BTC-USDT-SWAP", "lotSz": "0.1", "minSz": "0.1", "ctVal": "0.01", "lever": "100"},
+    ]}
+    monkeypatch.setattr(okx_api, "_public_api", mock.MagicMock(return_value=public_api))
+
+    assert sizing.instrument_spec("okx", "BTC-USDT-SWAP") == {"step": 0.1, "min_qty": 0.1, "ct_val": 0.01}
+
+
+def test_instrument_spec_bybit_qty_step(monkeypatch):
+    session = mock.MagicMock()
+    session.get_instruments_info.return_value = {"retCode": 0, "retMsg": "OK", "result": {"list": [
+        {"symbol": "BTCUSDT", "lotSizeFilter": {"qtyStep": "0.001", "minOrderQty": "0.001"},
+         "leverageFilter": {"maxLeverage": "100.00"}},
+    ]}}
+    pybit = types.ModuleType("pybit")
+    pybit.unified_trading = types.SimpleNamespace(HTTP=mock.MagicMock(return_value=session))
+    monkeypatch.setitem(sys.modules, "pybit", pybit)
+    monkeypatch.setitem(sys.modules, "pybit.unified_trading", pybit.unified_trading)
+
+    assert sizing.instrument_spec("bybit", "BTCUSDT") == {"step": 0.001, "min_qty": 0.001, "ct_val": 1.0}
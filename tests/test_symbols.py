@@ -0,0 +1,63 @@
+"""Таблицы символов: одна загрузка на биржу при одновременных промахах, короткий кэш сбоев (symbols.py)."""
+import asyncio
+import os
+import sys
+import threading
+from unittest import mock
+
+import pytest
+
+for module in ("requests", "dotenv"):
+    pytest.importorskip(module)
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import symbols  # noqa: E402
+
+
+@pytest.fixture(autouse=True)
+def clear_tables():
+    symbols.symbol_tables.invalidate()
+    symbols.symbol_table_failures.invalidate()
+    yield
+    symbols.symbol_tables.invalidate()
+    symbols.symbol_table_failures.invalidate()
+
+
+def test_concurrent_misses_share_one_request(monkeypatch):
+    released = threading.Event()
+
+    def slow_list(exchange):
+        released.wait(5)
+        return ["BTC-USDT-SWAP", "ETH-USDT-SWAP"]
+    list_symbols = mock.MagicMock(side_effect=slow_list)
+    monkeypatch.setattr(symbols, "_list_symbols", list_symbols)
+
+    async def resolve_many():
+        lookups = [asyncio.ensure_future(symbols.resolve_symbol("BINANCE:BTCUSDT.P", ["okx"])) for _ in range(5)]
+        await asyncio.sleep(0.05)
+        released.set()
+        return await asyncio.gather(*lookups)
+
+    assert asyncio.run(resolve_many()) == [{"okx": "BTC-USDT-SWAP"}] * 5
+    list_symbols.assert_called_once_with("okx")
+
+
+def test_failed_load_is_cached_briefly(monkeypatch):
+    list_symbols = mock.MagicMock(side_effect=RuntimeError("timeout"))
+    monkeypatch.setattr(symbols, "_list_symbols", list_symbols)
+
+    assert symbols.get_symbol_table("bybit") is None
+    assert symbols.get_symbol_table("bybit") is None
+    list_symbols.assert_called_once()
+
+    symbols.symbol_table_failures.invalidate()
+    assert symbols.get_symbol_table("bybit") is None
+    assert list_symbols.call_count == 2
+
+
+def test_unavailable_exchange_falls_back_to_normalize(monkeypatch):
+    monkeypatch.setattr(symbols, "_list_symbols", mock.MagicMock(side_effect=RuntimeError("timeout")))
+    monkeypatch.setattr(symbols, "normalize_symbol", lambda symbol, exchange: f"{exchange}:{symbol}")
+
+    assert asyncio.run(symbols.resolve_symbol("BTCUSDT", ["bingx"])) == {"bingx": "bingx:BTCUSDT"}
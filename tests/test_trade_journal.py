@@ -0,0 +1,145 @@
+"""Журнал сделок: восстановление из outbox и слияние обновлений, пришедших во время сброса (trade_journal.py)."""
+import asyncio
+import json
+import os
+import sys
+from unittest import mock
+
+import pytest
+
+for module in ("psycopg2", "dotenv"):
+    pytest.importorskip(module)
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import trade_journal as trade_journal_module  # noqa: E402
+from trade_journal import TradeJournal  # noqa: E402
+
+TRADE = {
+    "user_id": 1, "exchange": "bingx", "order_id": 1001, "symbol": "BTC-USDT", "side": "BUY",
+    "position_side": "LONG", "quantity": 0.01, "entry_price": 60000.0, "stop_loss": 59000.0,
+    "take_profit_1": 61000.0, "take_profit_2": 62000.0, "take_profit_3": 63000.0,
+}
+
+
+@pytest.fixture
+def outbox_path(tmp_path):
+    return str(tmp_path / "trade_outbox.ndjson")
+
+
+@pytest.fixture
+def journal(outbox_path):
+    journal = TradeJournal(outbox_path=outbox_path)
+    yield journal
+    journal.close_outbox()
+
+
+@pytest.fixture
+def database(monkeypatch):
+    """Соединение журнала и execute_values подменены: проверяем, что и когда журнал пишет"""
+    connection = mock.MagicMock(closed=False)
+    execute_values = mock.MagicMock()
+    monkeypatch.setattr(trade_journal_module, "connect", mock.MagicMock(return_value=connection))
+    monkeypatch.setattr(trade_journal_module, "execute_values", execute_values)
+    return connection, execute_values
+
+
+def read_outbox(path: str) -> list:
+    with open(path, encoding="utf-8") as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def test_record_trade_is_on_disk_when_awaited(journal, outbox_path):
+    asyncio.run(journal.record_trade(TRADE))
+
+    entries = read_outbox(outbox_path)
+    assert [entry["op"] for entry in entries] == ["insert"]
+    assert entries[0]["row"]["order_id"] == "1001"
+    assert entries[0]["row"]["ct_val"] == 1.0
+
+
+def test_recover_replays_outbox_in_order(outbox_path):
+    entries = [
+        {"op": "insert", "row": {**TRADE, "order_id": "1001", "status": "open"}},
+        {"op": "update", "exchange": "bingx", "order_id": "1001", "fields": {"sl_order_id": 7}},
+        {"op": "update", "exchange": "okx", "order_id": "2002", "fields": {"status": "closed"}},
+    ]
+    with open(outbox_path, "w", encoding="utf-8") as f:
+        for entry in entries:
+            f.write(json.dumps(entry) + "\n")
+        f.write("{повреждённая строка\n")
+
+    journal = TradeJournal(outbox_path=outbox_path)
+    assert journal.recover() == 3
+    # Обновление ещё не записанной сделки вливается в её вставку
+    assert journal._inserts[("bingx", "1001")]["sl_order_id"] == "7"
+    assert journal._updates == {("okx", "2002"): {"status": "closed"}}
+    assert journal.pending_user_ids("bingx", "BTC-USDT") == {1}
+
+
+def test_recover_round_trip(journal, outbox_path):
+    asyncio.run(journal.record_trade(TRADE))
+    asyncio.run(journal.update_trade("bingx", "1001", entry_price=60100.0))
+    journal.close_outbox()
+
+    restarted = TradeJournal(outbox_path=outbox_path)
+    assert restarted.recover() == 2
+    assert restarted._inserts == journal._inserts
+
+
+def test_flush_writes_batch_and_truncates_outbox(journal, outbox_path, database):
+    connection, execute_values = database
+    asyncio.run(journal.record_trade(TRADE))
+
+    assert journal.flush() == 1
+    connection.commit.assert_called_once()
+    rows = execute_values.call_args.args[2]
+    assert len(rows) == 1 and rows[0][2] == "1001"
+    assert journal.pending_count() == 0
+    journal.close_outbox()
+    assert read_outbox(outbox_path) == []
+
+
+def test_flush_keeps_update_that_arrives_during_write(journal, outbox_path, database):
+    _, execute_values = database
+    asyncio.run(journal.record_trade(TRADE))
+
+    def order_ids_arrive(*args, **kwargs):
+        execute_values.side_effect = None
+        asyncio.run(journal.update_trade("bingx", "1001", sl_order_id="sl-1", tp1_order_id="tp-1"))
+    execute_values.side_effect = order_ids_arrive
+
+    assert journal.flush() == 1
+    # Вставка ушла без ID ордеров — они досылаются отдельным обновлением
+    assert journal._inserts == {}
+    assert journal._updates == {("bingx", "1001"): {"sl_order_id": "sl-1", "tp1_order_id": "tp-1"}}
+    journal.close_outbox()
+    assert read_outbox(outbox_path) == [{"op": "update", "exchange": "bingx", "order_id": "1001",
+                                         "fields": {"sl_order_id": "sl-1", "tp1_order_id": "tp-1"}}]
+
+    assert journal.flush() == 1
+    update_rows = execute_values.call_args.args[2]
+    assert update_rows[0][:4] == ("bingx", "1001", "sl-1", "tp-1")
+    assert journal.pending_count() == 0
+
+
+def test_flush_failure_keeps_rows_for_retry(journal, outbox_path, database):
+    connection, execute_values = database
+    execute_values.side_effect = RuntimeError("connection reset")
+    asyncio.run(journal.record_trade(TRADE))
+
+    assert journal.flush() == 0
+    connection.rollback.assert_called_once()
+    assert journal.pending_count() == 1
+    journal.close_outbox()
+    assert [entry["op"] for entry in read_outbox(outbox_path)] == ["insert"]
+
+
+def test_outbox_cannot_be_shared(journal, outbox_path):
+    journal._lock_outbox()
+    other = TradeJournal(outbox_path=outbox_path)
+    with pytest.raises(RuntimeError, match="уже используется"):
+        other._lock_outbox()
+    journal._unlock_outbox()
+    other._lock_outbox()
+    other._unlock_outbox()
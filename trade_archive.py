@@ -0,0 +1,152 @@
+# trade_archive.py
+import asyncio
+import logging
+import os
+import time
+from datetime import datetime, timedelta
+from typing import Optional
+
+from database import connect, set_statement_timeout
+import metrics
+
+logger = logging.getLogger(__name__)
+
+# Как часто закрытые сделки переносятся из trades_hot в архив, с
+ARCHIVE_INTERVAL = float(os.getenv("ARCHIVE_INTERVAL", "3600"))
+# Сколько дней закрытая сделка остаётся в hot: её ещё читают сверка, журнал и статистика
+ARCHIVE_AFTER_DAYS = float(os.getenv("ARCHIVE_AFTER_DAYS", "7"))
+# Строк за транзакцию: перенос не держит долгих блокировок на hot
+ARCHIVE_BATCH = int(os.getenv("ARCHIVE_BATCH", "5000"))
+# Ключ advisory lock: при нескольких роутерах архив обслуживает один
+ARCHIVE_LOCK_ID = 7_310_048
+
+_MONTHS_SQL = """
+    SELECT DISTINCT date_trunc('month', created_at) AS month
+    FROM trades
+    WHERE tier = 'hot' AND status <> 'open' AND COALESCE(closed_at, created_at) < %s
+    ORDER BY month
+"""
+
+_PARTITION_SQL = """
+    CREATE TABLE IF NOT EXISTS trades_archive_{month:%Y_%m} PARTITION OF trades_archive
+        FOR VALUES FROM ('{month:%Y-%m-%d}') TO ('{next_month:%Y-%m-%d}')
+"""
+
+# Смена tier переносит строку в раздел архива (row movement)
+_ARCHIVE_SQL = """
+    UPDATE trades SET tier = 'archive'
+    WHERE tier = 'hot' AND (trade_id, created_at) IN (
+        SELECT trade_id, created_at FROM trades
+        WHERE tier = 'hot' AND status <> 'open' AND COALESCE(closed_at, created_at) < %s
+          AND created_at >= %s AND created_at < %s
+        LIMIT %s
+    )
+"""
+
+
+def next_month(month: datetime) -> datetime:
+    return (month.replace(day=1) + timedelta(days=32)).replace(day=1)
+
+
+def archive_closed(connection, older_than: datetime, batch: int = ARCHIVE_BATCH) -> int:
+    """Переносит закрытые до older_than сделки из trades_hot в месячные разделы архива,
+    создавая недостающие разделы. Возвращает число перенесённых строк."""
+    cursor = connection.cursor()
+    try:
+        cursor.execute(_MONTHS_SQL, (older_than,))
+        months = [row['month'] for row in cursor.fetchall()]
+        connection.commit()
+
+        moved = 0
+        for month in months:
+            end = next_month(month)
+            cursor.execute(_PARTITION_SQL.format(month=month, next_month=end))
+            connection.commit()
+            while True:
+                cursor.execute(_ARCHIVE_SQL, (older_than, month, end, batch))
+                count = cursor.rowcount
+                connection.commit()
+                moved += count
+                if count < batch:
+                    break
+        return moved
+    except Exception:
+        connection.rollback()
+        raise
+    finally:
+        cursor.close()
+
+
+def vacuum_hot(connection) -> None:
+    """VACUUM вне транзакции: место перенесённых строк сразу идёт под новые сделки"""
+    connection.autocommit = True
+    try:
+        with connection.cursor() as cursor:
+            cursor.execute("VACUUM (ANALYZE) trades_hot")
+    finally:
+        connection.autocommit = False
+
+
+class TradeArchiver:
+    """Фоновый перенос закрытых сделок в архив.
+
+    В trades_hot остаются открытые сделки и закрытые за последние ARCHIVE_AFTER_DAYS дней,
+    поэтому индексы открытых сделок и сам раздел помещаются в кэш, и запросы services.py
+    не замедляются по мере роста истории. Работает на отдельном соединении в потоке,
+    общее соединение бота не занимает.
+    """
+
+    def __init__(self, interval: float = ARCHIVE_INTERVAL):
+        self.interval = interval
+        self._task: Optional[asyncio.Task] = None
+
+    def run_once(self) -> int:
+        started = time.perf_counter()
+        connection = connect()
+        try:
+            cursor = connection.cursor()
+            cursor.execute("SELECT pg_try_advisory_lock(%s) AS locked", (ARCHIVE_LOCK_ID,))
+            locked = cursor.fetchone()['locked']
+            connection.commit()
+            if not locked:
+                return 0
+            try:
+                moved = archive_closed(connection, datetime.now() - timedelta(days=ARCHIVE_AFTER_DAYS))
+                if moved:
+                    # VACUUM большого числа мёртвых строк может идти дольше DB_STATEMENT_TIMEOUT
+                    set_statement_timeout(connection, 0)
+                    vacuum_hot(connection)
+            finally:
+                cursor.execute("SELECT pg_advisory_unlock(%s)", (ARCHIVE_LOCK_ID,))
+                connection.commit()
+        finally:
+            connection.close()
+
+        metrics.record("trade_archive", time.perf_counter() - started)
+        if moved:
+            logger.info(f"В архив перенесено {moved} закрытых сделок за {time.perf_counter() - started:.1f} с")
+        return moved
+
+    async def _run(self) -> None:
+        while True:
+            try:
+                await asyncio.to_thread(self.run_once)
+            except Exception as e:
+                logger.error(f"Ошибка переноса сделок в архив: {e}")
+            await asyncio.sleep(self.interval)
+
+    def start(self) -> None:
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self) -> None:
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+
+trade_archiver = TradeArchiver()
@@ -0,0 +1,377 @@
+# trade_journal.py
+import asyncio
+import fcntl
+import json
+import logging
+import os
+import threading
+from concurrent.futures import Future
+from datetime import datetime
+from typing import Dict, List, Optional, Tuple
+
+from psycopg2.extras import execute_values
+
+from database import connect
+
+logger = logging.getLogger(__name__)
+
+TRADE_OUTBOX_PATH = os.getenv("TRADE_OUTBOX_PATH", "trade_outbox.ndjson")
+TRADE_JOURNAL_FLUSH_INTERVAL = float(os.getenv("TRADE_JOURNAL_FLUSH_INTERVAL", "0.2"))
+
+
+def outbox_path_for(name: str) -> str:
+    """Свой outbox процесса рядом с TRADE_OUTBOX_PATH: trade_outbox.<name>.ndjson"""
+    root, ext = os.path.splitext(TRADE_OUTBOX_PATH)
+    return f"{root}.{name}{ext}"
+
+# Колонки trades, которые пишет журнал, и приведение типов для VALUES:
+# без явных ::type столбец из одних NULL получает тип text и INSERT падает.
+TRADE_COLUMNS = [
+    ("user_id", "bigint"),
+    ("exchange", "varchar"),
+    ("order_id", "varchar"),
+    ("symbol", "text"),
+    ("side", "text"),
+    ("position_side", "text"),
+    ("quantity", "real"),
+    ("ct_val", "real"),
+    ("entry_price", "real"),
+    ("stop_loss", "real"),
+    ("take_profit_1", "real"),
+    ("take_profit_2", "real"),
+    ("take_profit_3", "real"),
+    ("sl_order_id", "varchar"),
+    ("tp1_order_id", "varchar"),
+    ("tp2_order_id", "varchar"),
+    ("tp3_order_id", "varchar"),
+    ("status", "text"),
+    ("created_at", "timestamp"),
+]
+UPDATABLE_COLUMNS = [
+    ("sl_order_id", "varchar"),
+    ("tp1_order_id", "varchar"),
+    ("tp2_order_id", "varchar"),
+    ("tp3_order_id", "varchar"),
+    ("entry_price", "real"),
+    ("status", "text"),
+]
+
+_INSERT_SQL = """
+    INSERT INTO trades ({columns})
+    SELECT {columns} FROM (VALUES %s) AS v ({columns})
+    WHERE NOT EXISTS (
+        SELECT 1 FROM trades t WHERE t.exchange = v.exchange AND t.order_id = v.order_id AND t.tier = 'hot'
+    )
+    -- пользователь мог быть удалён, пока строка ждала в журнале; иначе FK сорвёт всю пачку
+    AND EXISTS (SELECT 1 FROM users u WHERE u.user_id = v.user_id)
+""".format(columns=", ".join(name for name, _ in TRADE_COLUMNS))
+_INSERT_TEMPLATE = "(" + ", ".join(f"%s::{sql_type}" for _, sql_type in TRADE_COLUMNS) + ")"
+
+_UPDATE_SQL = """
+    UPDATE trades SET {assignments}
+    FROM (VALUES %s) AS v (exchange, order_id, {columns})
+    WHERE trades.exchange = v.exchange AND trades.order_id = v.order_id AND trades.tier = 'hot'
+""".format(
+    assignments=", ".join(f"{name} = COALESCE(v.{name}, trades.{name})" for name, _ in UPDATABLE_COLUMNS),
+    columns=", ".join(name for name, _ in UPDATABLE_COLUMNS),
+)
+_UPDATE_TEMPLATE = "(%s::varchar, %s::varchar, " + ", ".join(f"%s::{t}" for _, t in UPDATABLE_COLUMNS) + ")"
+
+
+class TradeJournal:
+    """Write-behind журнал сделок: копит строки trades в памяти и локальном outbox
+    и пишет их в Postgres пачками, чтобы размещение ордеров не ждало commit.
+    Пачки пишутся на собственном соединении в потоке: event loop и общее соединение не ждут их.
+    Outbox ведёт один поток-писатель: записи, накопившиеся за время fsync, уходят на диск
+    следующим одним fsync (group commit)."""
+
+    def __init__(self, outbox_path: Optional[str] = TRADE_OUTBOX_PATH,
+                 flush_interval: float = TRADE_JOURNAL_FLUSH_INTERVAL):
+        self.outbox_path = outbox_path
+        self.flush_interval = flush_interval
+        self._lock = threading.Lock()
+        # Один сброс за раз: соединение журнала не делится между потоками
+        self._flush_lock = threading.Lock()
+        self._connection = None
+        self._inserts: Dict[Tuple[str, str], Dict] = {}
+        self._updates: Dict[Tuple[str, str], Dict] = {}
+        self._task: Optional[asyncio.Task] = None
+        # Очередь писателя outbox: ("append", запись, Future) или ("rewrite", записи, None)
+        self._outbox_queue: List[tuple] = []
+        self._outbox_ready = threading.Condition(threading.Lock())
+        self._outbox_writer: Optional[threading.Thread] = None
+        self._outbox_lock_file = None
+
+    # ------------------- Запись -------------------
+    async def record_trade(self, trade: Dict) -> None:
+        """Ставит новую сделку в очередь на вставку; возвращается, когда запись outbox на диске"""
+        row = {name: trade.get(name) for name, _ in TRADE_COLUMNS}
+        row["order_id"] = str(row["order_id"])
+        row["status"] = row["status"] or "open"
+        # Размер контракта не указывают биржи, где quantity уже в базовой валюте
+        row["ct_val"] = row["ct_val"] or 1.0
+        row["created_at"] = row["created_at"] or datetime.now().isoformat()
+        with self._lock:
+            self._apply({"op": "insert", "row": row})
+            written = self._append_outbox({"op": "insert", "row": row})
+        await asyncio.wrap_future(written)
+
+    async def update_trade(self, exchange: str, order_id: str, **fields) -> None:
+        """Ставит в очередь обновление сделки: ID ордеров SL/TP, фактическая цена входа, статус"""
+        allowed = {name for name, _ in UPDATABLE_COLUMNS}
+        unknown = set(fields) - allowed
+        if unknown:
+            raise ValueError(f"Журнал не обновляет колонки: {sorted(unknown)}")
+        entry = {"op": "update", "exchange": exchange, "order_id": str(order_id), "fields": fields}
+        with self._lock:
+            self._apply(entry)
+            written = self._append_outbox(entry)
+        await asyncio.wrap_future(written)
+
+    def has_pending(self, user_id: int, symbol: str) -> bool:
+        with self._lock:
+            return any(row["user_id"] == user_id and row["symbol"] == symbol for row in self._inserts.values())
+
+    def pending_user_ids(self, exchange: str, symbol: str) -> set:
+        with self._lock:
+            return {row["user_id"] for row in self._inserts.values()
+                    if row["exchange"] == exchange and row["symbol"] == symbol}
+
+    async def flush_pending(self, user_id: int, symbol: str) -> None:
+        """Сбрасывает журнал, если в нём есть несохранённые сделки пользователя по символу"""
+        if self.has_pending(user_id, symbol):
+            await asyncio.to_thread(self.flush)
+
+    def pending_count(self) -> int:
+        with self._lock:
+            return len(self._inserts) + len(self._updates)
+
+    def _apply(self, entry: Dict) -> None:
+        if entry["op"] == "insert":
+            row = entry["row"]
+            key = (row["exchange"], row["order_id"])
+            self._inserts[key] = dict(row)
+            return
+
+        key = (entry["exchange"], entry["order_id"])
+        fields = {k: (str(v) if v is not None else None) for k, v in entry["fields"].items()}
+        if key in self._inserts:
+            # Сделка ещё не записана — просто дополняем строку вставки
+            self._inserts[key].update(fields)
+        else:
+            self._updates.setdefault(key, {}).update(fields)
+
+    # ------------------- Outbox -------------------
+    def _append_outbox(self, entry: Dict) -> Future:
+        """Ставит запись в очередь писателя outbox. Вызывается под _lock: порядок записей
+        в очереди совпадает с порядком их применения в памяти. Future завершится после fsync."""
+        written = Future()
+        if not self.outbox_path:
+            written.set_result(None)
+            return written
+        self._enqueue_outbox(("append", entry, written))
+        return written
+
+    def _rewrite_outbox(self) -> None:
+        """Ставит в очередь перезапись outbox несохранёнными записями. Вызывается под _lock,
+        но сам файл пишет писатель: всё, что поставлено в очередь раньше, уже есть в снимке"""
+        if not self.outbox_path:
+            return
+        entries = [{"op": "insert", "row": dict(row)} for row in self._inserts.values()]
+        entries += [
+            {"op": "update", "exchange": exchange, "order_id": order_id, "fields": dict(fields)}
+            for (exchange, order_id), fields in self._updates.items()
+        ]
+        self._enqueue_outbox(("rewrite", entries, None))
+
+    def _enqueue_outbox(self, job: tuple) -> None:
+        with self._outbox_ready:
+            if self._outbox_writer is None:
+                self._outbox_writer = threading.Thread(target=self._write_outbox, name="trade-outbox",
+                                                       daemon=True)
+                self._outbox_writer.start()
+            self._outbox_queue.append(job)
+            self._outbox_ready.notify()
+
+    def _write_outbox(self) -> None:
+        while True:
+            with self._outbox_ready:
+                while not self._outbox_queue:
+                    self._outbox_ready.wait()
+                jobs, self._outbox_queue = self._outbox_queue, []
+
+            # Перезапись покрывает всё, что стояло в очереди до неё
+            last_rewrite = max((i for i, job in enumerate(jobs) if job[0] == "rewrite"), default=-1)
+            try:
+                if last_rewrite >= 0:
+                    self._replace_outbox(jobs[last_rewrite][1])
+                appends = [job[1] for job in jobs[last_rewrite + 1:] if job[0] == "append"]
+                if appends:
+                    with open(self.outbox_path, "a", encoding="utf-8") as f:
+                        f.write("".join(json.dumps(entry, ensure_ascii=False) + "\n" for entry in appends))
+                        # Запись считается принятой, только когда она на диске: сделка уже открыта на бирже
+                        f.flush()
+                        os.fsync(f.fileno())
+            except OSError as e:
+                logger.error(f"Не удалось записать в outbox {self.outbox_path}: {e}")
+            for job in jobs:
+                if job[2] is not None:
+                    job[2].set_result(None)
+            if any(job[0] == "stop" for job in jobs):
+                return
+
+    def _replace_outbox(self, entries: List[Dict]) -> None:
+        tmp_path = f"{self.outbox_path}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            for entry in entries:
+                f.write(json.dumps(entry, ensure_ascii=False) + "\n")
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.outbox_path)
+
+    def close_outbox(self) -> None:
+        """Дожидается записи всей очереди outbox и останавливает писателя (блокирует)"""
+        with self._outbox_ready:
+            writer = self._outbox_writer
+            if writer is None:
+                return
+            self._outbox_queue.append(("stop", None, None))
+            self._outbox_ready.notify()
+        writer.join()
+        with self._outbox_ready:
+            self._outbox_writer = None
+
+    def _lock_outbox(self) -> None:
+        """Outbox принадлежит одному процессу: чужой перезапись стёрла бы его записи,
+        а recover() переиграл бы его сделки. Второй процесс на том же пути не стартует."""
+        if not self.outbox_path or self._outbox_lock_file is not None:
+            return
+        lock_file = open(f"{self.outbox_path}.lock", "a")
+        try:
+            fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            lock_file.close()
+            raise RuntimeError(f"Outbox {self.outbox_path} уже используется другим процессом: "
+                               f"задайте каждому процессу свой путь outbox")
+        self._outbox_lock_file = lock_file
+
+    def _unlock_outbox(self) -> None:
+        if self._outbox_lock_file is not None:
+            self._outbox_lock_file.close()
+            self._outbox_lock_file = None
+
+    def recover(self) -> int:
+        """Загружает несохранённые записи из outbox после перезапуска"""
+        if not self.outbox_path or not os.path.exists(self.outbox_path):
+            return 0
+        recovered = 0
+        with self._lock, open(self.outbox_path, encoding="utf-8") as f:
+            for line in f:
+                line = line.strip()
+                if not line:
+                    continue
+                try:
+                    self._apply(json.loads(line))
+                    recovered += 1
+                except (ValueError, KeyError) as e:
+                    logger.error(f"Пропущена повреждённая запись outbox: {e}")
+        if recovered:
+            logger.info(f"Восстановлено {recovered} записей журнала сделок из {self.outbox_path}")
+        return recovered
+
+    # ------------------- Сброс в БД -------------------
+    def flush(self) -> int:
+        """Записывает накопленные строки одной транзакцией, возвращает число записей.
+        Блокирует на время записи — из event loop вызывается через asyncio.to_thread"""
+        with self._flush_lock:
+            return self._flush()
+
+    def _flush(self) -> int:
+        with self._lock:
+            inserts = {key: dict(row) for key, row in self._inserts.items()}
+            updates = {key: dict(fields) for key, fields in self._updates.items()}
+        if not inserts and not updates:
+            return 0
+
+        try:
+            if self._connection is None or self._connection.closed:
+                self._connection = connect()
+            cursor = self._connection.cursor()
+        except Exception as e:
+            logger.error(f"Нет соединения для сброса журнала сделок, повторим позже: {e}")
+            return 0
+        try:
+            if inserts:
+                execute_values(
+                    cursor, _INSERT_SQL,
+                    # get: строки outbox, записанные до появления колонки, её не содержат
+                    [tuple(row.get(name) for name, _ in TRADE_COLUMNS) for row in inserts.values()],
+                    template=_INSERT_TEMPLATE, page_size=1000
+                )
+            if updates:
+                execute_values(
+                    cursor, _UPDATE_SQL,
+                    [(exchange, order_id, *(fields.get(name) for name, _ in UPDATABLE_COLUMNS))
+                     for (exchange, order_id), fields in updates.items()],
+                    template=_UPDATE_TEMPLATE, page_size=1000
+                )
+            self._connection.commit()
+        except Exception as e:
+            if not self._connection.closed:
+                self._connection.rollback()
+            logger.error(f"Ошибка сброса журнала сделок, повторим позже: {e}")
+            return 0
+        finally:
+            cursor.close()
+
+        with self._lock:
+            for key, row in inserts.items():
+                if self._inserts.get(key) == row:
+                    del self._inserts[key]
+                elif key in self._inserts:
+                    # Пока шла запись, пришло обновление ID ордеров — досылаем его отдельно
+                    current = self._inserts.pop(key)
+                    changed = {name: current[name] for name, _ in UPDATABLE_COLUMNS if current[name] != row[name]}
+                    self._updates.setdefault(key, {}).update(changed)
+            for key, fields in updates.items():
+                if self._updates.get(key) == fields:
+                    del self._updates[key]
+            self._rewrite_outbox()
+
+        written = len(inserts) + len(updates)
+        logger.info(f"Журнал сделок: записано {len(inserts)} новых сделок и {len(updates)} обновлений")
+        return written
+
+    async def _run(self) -> None:
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            try:
+                await asyncio.to_thread(self.flush)
+            except Exception as e:
+                logger.error(f"Ошибка фонового сброса журнала сделок: {e}")
+
+    async def start(self) -> None:
+        self._lock_outbox()
+        self.recover()
+        await asyncio.to_thread(self.flush)
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self) -> None:
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        await asyncio.to_thread(self.flush)
+        await asyncio.to_thread(self.close_outbox)
+        self._unlock_outbox()
+        with self._flush_lock:
+            if self._connection is not None:
+                self._connection.close()
+                self._connection = None
+
+
+trade_journal = TradeJournal()
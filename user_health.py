@@ -0,0 +1,284 @@
+# user_health.py
+import asyncio
+import logging
+import os
+from datetime import datetime, timedelta
+from typing import Dict, List, Optional
+
+from aiogram import types
+
+from cache import subscribers_cache
+from database import transaction
+from notifier import bot
+from account_profile import probe_account, profile_problem, save_profile
+from exchange_errors import ERROR_CODES, AccountError, ExchangeError
+from sizing import MIN_BALANCE
+
+logger = logging.getLogger(__name__)
+
+SUPPORT_CONTACT = os.getenv("SUPPORT_CONTACT", "@SupportBot")
+# Сколько подряд ошибок одного класса переводят пользователя в карантин
+QUARANTINE_THRESHOLD = {"auth": 2, "ip": 2, "funds": 3}
+KEY_PROBE_BASE_DELAY = float(os.getenv("KEY_PROBE_BASE_DELAY", "300"))
+KEY_PROBE_MAX_DELAY = float(os.getenv("KEY_PROBE_MAX_DELAY", "86400"))
+KEY_PROBE_INTERVAL = float(os.getenv("KEY_PROBE_INTERVAL", "60"))
+
+# Фрагменты текста ответов бирж (в нижнем регистре) по классам ошибок — для ошибок без типа
+# exchange_errors.AccountError. Коды сверяются только с разобранным ExchangeError.code по таблице
+# exchange_errors.ERROR_CODES: как подстрока текста число совпадёт с ID ордера или суммой.
+# Всё, что сюда не попало, считается временным сбоем и в карантин не ведёт.
+FAILURE_PATTERNS = {
+    "ip": [
+        "ip whitelist", "not in the api key's ip", "unmatched ip", "invalid ip", "ip not allowed",
+    ],
+    "auth": [
+        "invalid api", "api key is invalid", "incorrect apikey", "null apikey", "invalid ok-access-key",
+        "invalid access_key", "apikey does not exist", "api key expired", "permission denied",
+        "signature",
+    ],
+    "funds": [
+        "insufficient", "not enough", "exceeds balance",
+    ],
+}
+
+FAILURE_MESSAGES = {
+    "auth": "биржа отклоняет ваши API-ключи (ключ удалён, истёк или без прав на торговлю)",
+    "ip": "биржа отклоняет запросы: IP сервера не входит в белый список API-ключа",
+    "funds": "на фьючерсном счёте недостаточно средств для входа в сделку",
+}
+
+_QUARANTINE_SQL = """
+    UPDATE users SET
+        key_failure_class = %(failure_class)s,
+        key_failures = CASE WHEN key_failure_class = %(failure_class)s THEN key_failures + 1 ELSE 1 END
+    WHERE user_id = %(user_id)s
+    RETURNING key_failures, key_status, key_quarantine_level
+"""
+
+
+def classify_failure(error) -> str:
+    """Класс ошибки: auth, ip, funds или other"""
+    if isinstance(error, AccountError):
+        return error.kind
+    if isinstance(error, ExchangeError):
+        kind = ERROR_CODES.get(error.exchange, {}).get(error.code)
+        if kind in FAILURE_PATTERNS:
+            return kind
+        text = str(error.message).lower()
+    else:
+        text = str(error).lower()
+    for failure_class, patterns in FAILURE_PATTERNS.items():
+        if any(pattern in text for pattern in patterns):
+            return failure_class
+    return "other"
+
+
+def probe_delay(level: int) -> float:
+    """Пауза до следующей проверки ключей: удваивается с каждой неудачной попыткой"""
+    return min(KEY_PROBE_MAX_DELAY, KEY_PROBE_BASE_DELAY * (2 ** level))
+
+
+def is_quarantined(user: Dict) -> bool:
+    return user.get('key_status') == 'quarantined'
+
+
+async def record_success(user: Dict) -> None:
+    """Сбрасывает счётчик ошибок; в БД пишет только если он был ненулевым"""
+    if not user.get('key_failures'):
+        return
+    try:
+        await asyncio.to_thread(_reset_failures, user['user_id'])
+        user['key_failures'] = 0
+    except Exception as e:
+        logger.error(f"Не удалось сбросить счётчик ошибок ключей пользователя {user['user_id']}: {e}")
+
+
+def _reset_failures(user_id: int) -> None:
+    with transaction() as cursor:
+        cursor.execute(
+            "UPDATE users SET key_failures = 0, key_failure_class = NULL WHERE user_id = %s AND key_failures > 0",
+            (user_id,)
+        )
+
+
+def record_failure(user: Dict, error) -> Optional[str]:
+    """Учитывает ошибку исполнения. Возвращает класс ошибки, если пользователь
+    только что переведён в карантин, иначе None. Пишет через database.transaction() —
+    из event loop вызывается в потоке (report_failure)."""
+    user_id = user['user_id']
+    failure_class = classify_failure(error)
+    if failure_class == "other":
+        return None
+
+    try:
+        with transaction() as cursor:
+            cursor.execute(_QUARANTINE_SQL, {"failure_class": failure_class, "user_id": user_id})
+            row = cursor.fetchone()
+            if not row:
+                return None
+            user['key_failures'] = row['key_failures']
+            if row['key_status'] == 'quarantined' or row['key_failures'] < QUARANTINE_THRESHOLD[failure_class]:
+                return None
+
+            level = row['key_quarantine_level']
+            cursor.execute(
+                """
+                UPDATE users SET key_status = 'quarantined', key_probe_at = %s
+                WHERE user_id = %s
+                """,
+                (datetime.now() + timedelta(seconds=probe_delay(level)), user_id)
+            )
+    except Exception as e:
+        logger.error(f"Не удалось записать ошибку ключей пользователя {user_id}: {e}")
+        return None
+
+    user['key_status'] = 'quarantined'
+    # Кэш подписчиков ещё содержит пользователя как здорового
+    subscribers_cache.invalidate()
+    logger.warning(f"Пользователь {user_id} переведён в карантин: {failure_class} ({error})")
+    return failure_class
+
+
+async def report_failure(user: Dict, error) -> bool:
+    """record_failure + сообщение пользователю о карантине.
+    True — пользователь уведомлён, общее сообщение об ошибке слать не нужно."""
+    failure_class = await asyncio.to_thread(record_failure, user, error)
+    if not failure_class:
+        return False
+    try:
+        await notify_quarantine(user['user_id'], failure_class)
+    except Exception as e:
+        logger.error(f"Ошибка отправки уведомления о карантине для {user['user_id']}: {e}")
+    return True
+
+
+def fix_keys_keyboard() -> types.InlineKeyboardMarkup:
+    return types.InlineKeyboardMarkup(inline_keyboard=[
+        [types.InlineKeyboardButton(text="🔑 Обновить API-ключи", callback_data="fix_keys")],
+        [types.InlineKeyboardButton(text="📞 Поддержка", url=f"https://t.me/{SUPPORT_CONTACT.lstrip('@')}")]
+    ])
+
+
+async def notify_quarantine(user_id: int, failure_class: str) -> None:
+    await bot.send_message(
+        chat_id=user_id,
+        text=(
+            f"⚠️ Сигналы приостановлены: {FAILURE_MESSAGES[failure_class]}.\n\n"
+            f"Исправьте ключи или пополните счёт — мы периодически проверяем аккаунт "
+            f"и возобновим торговлю автоматически."
+        ),
+        reply_markup=fix_keys_keyboard()
+    )
+
+
+class KeyHealthProbe:
+    """Фоновая повторная проверка пользователей в карантине (account_profile.probe_account).
+    Заодно обновляет профиль аккаунта. При неудаче пауза до следующей проверки удваивается."""
+
+    def __init__(self, interval: float = KEY_PROBE_INTERVAL):
+        self.interval = interval
+        self._task: Optional[asyncio.Task] = None
+
+    def due_users(self, now: datetime) -> List[Dict]:
+        with transaction() as cursor:
+            cursor.execute(
+                """
+                SELECT user_id, api_key, secret_key, passphrase, exchange, key_failure_class, key_quarantine_level
+                FROM users
+                WHERE key_status = 'quarantined'
+                  AND key_probe_at <= %s
+                  AND subscription_end > %s
+                  AND api_key IS NOT NULL
+                  AND secret_key IS NOT NULL
+                """,
+                (now, now)
+            )
+            return cursor.fetchall()
+
+    @staticmethod
+    def save_profile(user_id: int, exchange: str, profile: Dict) -> None:
+        with transaction() as cursor:
+            save_profile(cursor, user_id, exchange, profile)
+
+    async def probe(self, user: Dict) -> bool:
+        exchange = user.get('exchange') or 'bingx'
+        try:
+            profile = await asyncio.to_thread(
+                probe_account, exchange, user['api_key'], user['secret_key'], user.get('passphrase')
+            )
+        except Exception as e:
+            logger.info(f"Ключи пользователя {user['user_id']} всё ещё не работают: {e}")
+            return False
+
+        await asyncio.to_thread(self.save_profile, user['user_id'], exchange, profile)
+
+        problem = profile_problem(profile)
+        if problem:
+            logger.info(f"Аккаунт пользователя {user['user_id']} всё ещё не готов к торговле: {problem[1]}")
+            return False
+        balance = profile.get("balance")
+        if balance is not None and balance < MIN_BALANCE.get(exchange, 0.0):
+            logger.info(f"У пользователя {user['user_id']} всё ещё недостаточно средств: {balance} USDT")
+            return False
+        return True
+
+    def restore(self, user_id: int) -> None:
+        with transaction() as cursor:
+            cursor.execute(
+                """
+                UPDATE users SET key_status = 'ok', key_failures = 0, key_failure_class = NULL,
+                    key_quarantine_level = 0, key_probe_at = NULL
+                WHERE user_id = %s
+                """,
+                (user_id,)
+            )
+        subscribers_cache.invalidate()
+
+    def postpone(self, user: Dict) -> None:
+        level = user['key_quarantine_level'] + 1
+        with transaction() as cursor:
+            cursor.execute(
+                "UPDATE users SET key_quarantine_level = %s, key_probe_at = %s WHERE user_id = %s",
+                (level, datetime.now() + timedelta(seconds=probe_delay(level)), user['user_id'])
+            )
+
+    async def run_once(self) -> int:
+        """Проверяет пользователей, у которых подошло время; возвращает число восстановленных"""
+        restored = 0
+        # Запросы к БД — на соединениях пула (database.transaction) в потоке: сбой не откатывает общее соединение
+        for user in await asyncio.to_thread(self.due_users, datetime.now()):
+            if await self.probe(user):
+                await asyncio.to_thread(self.restore, user['user_id'])
+                restored += 1
+                logger.info(f"Пользователь {user['user_id']} выведен из карантина")
+                try:
+                    await bot.send_message(user['user_id'], "✅ Ключи снова работают, сигналы возобновлены.")
+                except Exception as e:
+                    logger.error(f"Ошибка отправки уведомления для {user['user_id']}: {e}")
+            else:
+                await asyncio.to_thread(self.postpone, user)
+        return restored
+
+    async def _run(self) -> None:
+        while True:
+            await asyncio.sleep(self.interval)
+            try:
+                await self.run_once()
+            except Exception as e:
+                logger.error(f"Ошибка фоновой проверки ключей: {e}")
+
+    def start(self) -> None:
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self) -> None:
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+
+key_health_probe = KeyHealthProbe()
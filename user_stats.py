@@ -0,0 +1,126 @@
+# user_stats.py
+from typing import Dict, List, Optional
+
+# P&L сделки по сработавшим ногам: каждый TP закрывает равную долю позиции по своей цене,
+# SL — остаток по стопу. Остаток, закрытый по рынку (сигналом или flatten), не оценивается:
+# цену выхода пути закрытия не получают. quantity OKX — в контрактах, поэтому всё умножается
+# на ct_val; у старых сделок OKX он неизвестен (NULL), и они не оцениваются.
+PNL_SQL = """
+    (CASE WHEN t.side = 'BUY' THEN 1 ELSE -1 END) * t.ct_val * (
+        t.quantity / GREATEST(num_nonnulls(t.take_profit_1, t.take_profit_2, t.take_profit_3), 1) * (
+            CASE WHEN 'tp1' = ANY(t.filled_legs) THEN COALESCE(t.take_profit_1 - t.entry_price, 0) ELSE 0 END
+          + CASE WHEN 'tp2' = ANY(t.filled_legs) THEN COALESCE(t.take_profit_2 - t.entry_price, 0) ELSE 0 END
+          + CASE WHEN 'tp3' = ANY(t.filled_legs) THEN COALESCE(t.take_profit_3 - t.entry_price, 0) ELSE 0 END
+        )
+      + CASE WHEN 'sl' = ANY(t.filled_legs) THEN COALESCE(t.stop_loss - t.entry_price, 0) * GREATEST(
+            t.quantity - t.quantity / GREATEST(num_nonnulls(t.take_profit_1, t.take_profit_2, t.take_profit_3), 1)
+                * (('tp1' = ANY(t.filled_legs))::int + ('tp2' = ANY(t.filled_legs))::int
+                   + ('tp3' = ANY(t.filled_legs))::int), 0)
+        ELSE 0 END
+    )
+"""
+NOTIONAL_SQL = "t.quantity * t.ct_val * t.entry_price"
+
+# Прибавляет к статистике только что закрытые сделки. Вызывается в транзакции,
+# которая перевела их из open в closed, — каждая сделка учитывается ровно один раз
+_RECORD_CLOSED_SQL = """
+    INSERT INTO user_stats AS s (user_id, trades_closed, wins, losses, realized_pnl, updated_at)
+    SELECT user_id, COUNT(*), COUNT(*) FILTER (WHERE pnl > 0), COUNT(*) FILTER (WHERE pnl < 0),
+           COALESCE(SUM(pnl), 0), CURRENT_TIMESTAMP
+    FROM (
+        SELECT t.user_id, {pnl} AS pnl
+        FROM trades t
+        WHERE t.trade_id = ANY(%s) AND t.tier = 'hot' AND t.status = 'closed'
+    ) closed
+    GROUP BY user_id
+    ON CONFLICT (user_id) DO UPDATE SET
+        trades_closed = s.trades_closed + EXCLUDED.trades_closed,
+        wins = s.wins + EXCLUDED.wins,
+        losses = s.losses + EXCLUDED.losses,
+        realized_pnl = s.realized_pnl + EXCLUDED.realized_pnl,
+        updated_at = CURRENT_TIMESTAMP
+""".format(pnl=PNL_SQL)
+
+# Открытая позиция пересчитывается по trades_hot — там только рабочий набор, не история.
+# Пишутся лишь изменившиеся строки
+_REFRESH_OPEN_SQL = """
+    INSERT INTO user_stats AS s (user_id, open_trades, open_notional, updated_at)
+    SELECT t.user_id, COUNT(*), COALESCE(SUM({notional}), 0), CURRENT_TIMESTAMP
+    FROM trades t
+    WHERE t.tier = 'hot' AND t.status = 'open'
+    GROUP BY t.user_id
+    ON CONFLICT (user_id) DO UPDATE SET
+        open_trades = EXCLUDED.open_trades,
+        open_notional = EXCLUDED.open_notional,
+        updated_at = CURRENT_TIMESTAMP
+    WHERE (s.open_trades, s.open_notional) IS DISTINCT FROM (EXCLUDED.open_trades, EXCLUDED.open_notional)
+""".format(notional=NOTIONAL_SQL)
+_CLEAR_OPEN_SQL = """
+    UPDATE user_stats s SET open_trades = 0, open_notional = 0, updated_at = CURRENT_TIMESTAMP
+    WHERE s.open_trades > 0
+      AND NOT EXISTS (SELECT 1 FROM trades t WHERE t.user_id = s.user_id AND t.tier = 'hot' AND t.status = 'open')
+"""
+
+# Статистика по всей истории trades, поверх накопленной: начальное заполнение и пересчёт
+# после смены формулы. Смена формулы — новая миграция со своей копией запроса (как 13 в migrations.py)
+BACKFILL_SQL = """
+    INSERT INTO user_stats AS s (user_id, trades_closed, wins, losses, realized_pnl, open_trades, open_notional,
+                                 updated_at)
+    SELECT user_id,
+           COUNT(*) FILTER (WHERE status = 'closed'),
+           COUNT(*) FILTER (WHERE status = 'closed' AND pnl > 0),
+           COUNT(*) FILTER (WHERE status = 'closed' AND pnl < 0),
+           COALESCE(SUM(pnl) FILTER (WHERE status = 'closed'), 0),
+           COUNT(*) FILTER (WHERE status = 'open' AND tier = 'hot'),
+           COALESCE(SUM(notional) FILTER (WHERE status = 'open' AND tier = 'hot'), 0),
+           CURRENT_TIMESTAMP
+    FROM (
+        SELECT t.user_id, t.status, t.tier, {pnl} AS pnl, {notional} AS notional
+        FROM trades t
+    ) history
+    GROUP BY user_id
+    ON CONFLICT (user_id) DO UPDATE SET
+        trades_closed = EXCLUDED.trades_closed,
+        wins = EXCLUDED.wins,
+        losses = EXCLUDED.losses,
+        realized_pnl = EXCLUDED.realized_pnl,
+        open_trades = EXCLUDED.open_trades,
+        open_notional = EXCLUDED.open_notional,
+        updated_at = CURRENT_TIMESTAMP
+""".format(pnl=PNL_SQL, notional=NOTIONAL_SQL)
+
+_GET_SQL = """
+    SELECT trades_closed, wins, losses, realized_pnl, open_trades, open_notional, updated_at
+    FROM user_stats WHERE user_id = %s
+"""
+
+
+def record_closed(cursor, trade_ids: List[int]) -> None:
+    """Учитывает закрытые сделки; commit — за вызывающим, в той же транзакции, что и закрытие"""
+    if trade_ids:
+        cursor.execute(_RECORD_CLOSED_SQL, (list(trade_ids),))
+
+
+def refresh_open_exposure(cursor) -> None:
+    cursor.execute(_REFRESH_OPEN_SQL)
+    cursor.execute(_CLEAR_OPEN_SQL)
+
+
+def get_user_stats(cursor, user_id: int) -> Optional[Dict]:
+    cursor.execute(_GET_SQL, (user_id,))
+    return cursor.fetchone()
+
+
+def format_user_stats(stats: Optional[Dict]) -> str:
+    if not stats or not (stats['trades_closed'] or stats['open_trades']):
+        return "**Статистика**\n\nСделок пока нет."
+    decided = stats['wins'] + stats['losses']
+    win_rate = f"{stats['wins'] / decided * 100:.0f}%" if decided else "—"
+    return (
+        f"**Статистика**\n\n"
+        f"**Закрыто сделок:** {stats['trades_closed']}\n"
+        f"**Прибыльных:** {win_rate} ({stats['wins']} из {decided})\n"
+        f"**Реализованный P&L:** {stats['realized_pnl']:+.2f} USDT\n"
+        f"**Открыто сделок:** {stats['open_trades']} на {stats['open_notional']:.2f} USDT\n\n"
+        f"_P&L оценивается по ценам сработавших SL/TP; данные на {stats['updated_at']:%d.%m.%Y %H:%M}_"
+    )
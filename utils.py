@@ -2,13 +2,14 @@
 import re
 import logging
 from aiogram import Bot
+from pydantic import BaseModel
 
 logger = logging.getLogger(__name__)
 
 
 def normalize_symbol(symbol: str, exchange: str) -> str:
     symbol = symbol.upper()
-    logger.info(f"Нормализация символа: входной символ={symbol}, биржа={exchange}")
+    logger.debug(f"Нормализация символа: входной символ={symbol}, биржа={exchange}")
 
     if exchange == 'bingx':
         symbol = symbol.replace(':', '/').replace('-', '/')
@@ -18,7 +19,7 @@ def normalize_symbol(symbol: str, exchange: str) -> str:
             normalized = f"{base}-{quote}"
         else:
             normalized = symbol.replace("USDT", "-USDT")
-        logger.info(f"Нормализованный символ для BingX: {normalized}")
+        logger.debug(f"Нормализованный символ для BingX: {normalized}")
         return normalized
 
     elif exchange == 'okx':
@@ -29,20 +30,24 @@ def normalize_symbol(symbol: str, exchange: str) -> str:
         if not symbol.endswith('-SWAP'):
             symbol = f"{symbol}-SWAP"
         normalized = symbol
-        logger.info(f"Нормализованный символ для OKX: {normalized}")
+        logger.debug(f"Нормализованный символ для OKX: {normalized}")
         return normalized
     elif exchange == "bitget":
+        symbol = re.sub(r'\.P$', '', symbol).replace('-', '').replace('/', '')
         if not symbol.endswith("_UMCBL"):
             symbol = f"{symbol}_UMCBL"
-            normalized = symbol
-            return normalized
-    return symbol
+        return symbol
+
+    elif exchange == "bybit":
+        return re.sub(r'\.P$', '', symbol).replace('-', '').replace('/', '')
 
     logger.warning(f"Неизвестная биржа: {exchange}, возвращаем исходный символ: {symbol}")
     return symbol
 
-async def send_signal_notification(signal: dict, user_id: int, bot: Bot) -> None:
+async def send_signal_notification(signal, user_id: int, bot: Bot) -> None:
     try:
+        if isinstance(signal, BaseModel):
+            signal = signal.model_dump()
         action = signal.get('action', 'N/A')
         symbol = signal.get('symbol', 'N/A')
         price = signal.get('price', 'N/A')
@@ -0,0 +1,117 @@
+# warm_state.py
+import asyncio
+import logging
+import os
+import pickle
+import time
+from datetime import datetime
+from typing import Optional
+
+from cache import CACHES
+from database import get_active_users
+from symbols import SUPPORTED_EXCHANGES, get_symbol_table
+from ws_trading import ws_trading
+
+logger = logging.getLogger(__name__)
+
+WARM_STATE_PATH = os.getenv("WARM_STATE_PATH", "warm_state.pickle")
+WARM_STATE_INTERVAL = float(os.getenv("WARM_STATE_INTERVAL", "60"))
+# Снимок старше этого не загружается целиком: слишком многое могло поменяться на биржах
+WARM_STATE_MAX_AGE = float(os.getenv("WARM_STATE_MAX_AGE", "900"))
+# 2: шаг лота BingX/Bitget считается из числа знаков — снимки со старым шагом не загружаем
+WARM_STATE_FORMAT = 2
+
+
+class WarmState:
+    """Снимок прогретых кэшей (cache.CACHES): пишется по таймеру и при остановке,
+    читается при старте, чтобы перезапущенный воркер не исполнял первый сигнал холодным."""
+
+    def __init__(self, path: Optional[str] = WARM_STATE_PATH, interval: float = WARM_STATE_INTERVAL,
+                 max_age: float = WARM_STATE_MAX_AGE):
+        self.path = path
+        self.interval = interval
+        self.max_age = max_age
+        self._task: Optional[asyncio.Task] = None
+
+    def save(self) -> int:
+        if not self.path:
+            return 0
+        caches = {name: cache.dump() for name, cache in CACHES.items() if cache.persistent}
+        snapshot = {"format": WARM_STATE_FORMAT, "written_at": time.time(), "caches": caches}
+        tmp_path = f"{self.path}.tmp"
+        try:
+            # 0600: в снимке служебные данные аккаунтов, другим пользователям хоста он ни к чему
+            fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+            with os.fdopen(fd, "wb") as f:
+                pickle.dump(snapshot, f, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(tmp_path, self.path)
+        except OSError as e:
+            logger.error(f"Не удалось записать снимок состояния {self.path}: {e}")
+            return 0
+        return sum(len(entries) for entries in caches.values())
+
+    def load(self) -> int:
+        if not self.path or not os.path.exists(self.path):
+            return 0
+        try:
+            with open(self.path, "rb") as f:
+                snapshot = pickle.load(f)
+        except Exception as e:
+            logger.error(f"Снимок состояния {self.path} повреждён, начинаем с холодного кэша: {e}")
+            return 0
+
+        if snapshot.get("format") != WARM_STATE_FORMAT:
+            logger.warning(f"Снимок состояния другого формата ({snapshot.get('format')}), пропускаем")
+            return 0
+        age = time.time() - snapshot["written_at"]
+        if age > self.max_age:
+            logger.warning(f"Снимок состояния устарел ({age:.0f} с), пропускаем")
+            return 0
+
+        loaded = 0
+        for name, entries in snapshot["caches"].items():
+            cache = CACHES.get(name)
+            if cache is not None and cache.persistent:
+                loaded += cache.load(entries)
+        logger.info(f"Загружено {loaded} записей из снимка состояния возрастом {age:.0f} с")
+        return loaded
+
+    def prewarm(self) -> None:
+        """Прогрев того, что не хранится на диске"""
+        try:
+            users = get_active_users(datetime.now())
+            logger.info(f"Прогрет список подписчиков: {len(users)}")
+            logger.info(f"Открываются торговые WS-сессии: {ws_trading.prewarm(users)}")
+        except Exception as e:
+            logger.error(f"Ошибка прогрева списка подписчиков: {e}")
+        # Таблицы символов обычно уже пришли из снимка; недостающие строятся до первого сигнала
+        for exchange in SUPPORTED_EXCHANGES:
+            get_symbol_table(exchange)
+
+    async def _run(self) -> None:
+        while True:
+            await asyncio.sleep(self.interval)
+            try:
+                self.save()
+            except Exception as e:
+                logger.error(f"Ошибка фоновой записи снимка состояния: {e}")
+
+    async def start(self) -> None:
+        self.load()
+        self.prewarm()
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self) -> None:
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        saved = self.save()
+        logger.info(f"Снимок состояния записан: {saved} записей")
+
+
+warm_state = WarmState()
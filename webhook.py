@@ -1,73 +1,46 @@
 # webhook.py
-import json
-import math
 from fastapi import APIRouter, Request, HTTPException
 import logging
+import time
+import uuid
 from datetime import datetime
-from database import get_cursor
-from utils import normalize_symbol
+from database import get_active_users
+from fanout import dispatch_signal, dispatch_move_sl
+from models import FlattenRequest, Signal
+from signal_parser import SignalValidationError, parse_signal
+from signal_queue import sharded_mode, enqueue_signal
+from coalescer import signal_coalescer
+from deadline import signal_deadline
+from symbols import resolve_symbol
+import bulkheads
+import flatten
+import metrics
+import scheduler
 
 logger = logging.getLogger(__name__)
 
 router = APIRouter()
 
-def clean_json_data(data_str: str) -> dict:
-    """Очищает JSON данные от NaN и других невалидных значений"""
-    try:
-        cleaned_str = data_str.replace(': NaN', ': null').replace(':NaN', ':null')
-        return json.loads(cleaned_str)
-    except json.JSONDecodeError as e:
-        logger.error(f"Ошибка парсинга JSON: {str(e)}")
-        raise
-
-async def handle_move_sl_signal(data: dict):
+async def handle_move_sl_signal(signal: Signal):
     """Обработка сигнала MOVE_SL"""
-    symbol = data.get('symbol')
-    if not symbol:
-        logger.error("Не указан символ для MOVE_SL")
-        raise HTTPException(status_code=400, detail="Необходимо указать символ для MOVE_SL")
-
-    cursor = get_cursor()
-    cursor.execute(
-        "SELECT user_id, api_key, secret_key, passphrase, exchange FROM users WHERE subscription_end > %s AND api_key IS NOT NULL AND secret_key IS NOT NULL AND subscription_type IN ('referral_approved', 'regular')",
-        (datetime.now(),)
-    )
-    active_users = cursor.fetchall()
+    symbol = signal.symbol
+
+    if sharded_mode():
+        signal_id = enqueue_signal("move_sl", signal.model_dump())
+        return {
+            "status": "accepted",
+            "message": "MOVE_SL сигнал поставлен в очередь",
+            "signal_id": signal_id,
+            "symbol": symbol
+        }
+
+    active_users = get_active_users(datetime.now())
 
     if not active_users:
         logger.error("Нет пользователей с активной подпиской и API-ключами")
         raise HTTPException(status_code=400, detail="Нет пользователей с активной подпиской и API-ключами")
 
-    results = []
-    for user in active_users:
-        user_id = user['user_id']
-        exchange = user.get('exchange', 'bingx')
-        normalized_symbol = normalize_symbol(symbol, exchange)
-
-        try:
-            if exchange == 'bingx':
-                from services import process_bingx_move_sl
-                result = await process_bingx_move_sl(user, normalized_symbol)
-            elif exchange == 'okx':
-                from services import process_okx_move_sl
-                result = await process_okx_move_sl(user, normalized_symbol)
-            elif exchange == 'bybit':
-                from services import process_bybit_move_sl
-                result = await process_bybit_move_sl(user, normalized_symbol)
-            elif exchange == "bitget":
-                from services import process_bitget_move_sl
-                result = await process_bitget_move_sl(user, normalized_symbol)
-            else:
-                logger.error(f"Неизвестная биржа: {exchange} для пользователя {user_id}")
-                continue
-
-            if result:
-                results.append(result)
-                logger.info(f"MOVE_SL обработан для пользователя {user_id} на бирже {exchange}")
-
-        except Exception as e:
-            logger.error(f"Ошибка обработки MOVE_SL для пользователя {user_id} на бирже {exchange}: {str(e)}")
-            continue
+    results = await dispatch_move_sl(active_users, symbol)
 
     if not results:
         raise HTTPException(status_code=500, detail="Не удалось обработать MOVE_SL ни для одного пользователя")
@@ -79,154 +52,95 @@ async def handle_move_sl_signal(data: dict):
         "results": results
     }
 
-@router.post("/webhook")
-async def webhook(request: Request):
-    """Основной webhook endpoint для торговых сигналов"""
-    try:
-        raw_data = await request.body()
-        raw_data_str = raw_data.decode('utf-8')
-        logger.info(f"Получен webhook запрос: {raw_data_str}")
-
-        content_type = request.headers.get('Content-Type', '').lower()
-
-        if not content_type or ('application/json' not in content_type and 'text/plain' not in content_type):
-            logger.error(f"Неверный Content-Type: {content_type}")
-            raise HTTPException(status_code=400, detail="Ожидается Content-Type: application/json или text/plain")
-
-        try:
-            data = clean_json_data(raw_data_str)
-        except Exception as e:
-            logger.error(f"Ошибка парсинга JSON: {str(e)}")
-            raise HTTPException(status_code=400, detail=f"Неверный формат JSON: {str(e)}")
-
-        if not data:
-            logger.error("Получен пустой JSON")
-            raise HTTPException(status_code=400, detail="Пустой JSON")
-
-        raw_action = data.get('action', '').upper()
+async def dispatch_entry_signal(signal: Signal):
+    """Рассылка итогового BUY/SELL сигнала: в очередь воркеров или сразу по пользователям"""
+    if sharded_mode():
+        signal_id = enqueue_signal("signal", signal.model_dump())
+        return {
+            "status": "accepted",
+            "message": "Фьючерсный сигнал поставлен в очередь",
+            "signal_id": signal_id,
+            "symbol": signal.symbol
+        }
 
-        if raw_action not in ['BUY', 'SELL', 'LONG', 'SHORT', 'MOVE_SL']:
-            logger.error(f"Некорректное действие: {raw_action}")
-            raise HTTPException(status_code=400, detail="Действие должно быть BUY, SELL, LONG, SHORT или MOVE_SL")
+    # Получаем активных пользователей
+    active_users = get_active_users(datetime.now())
 
-        # Обработка MOVE_SL (немедленно)
-        if raw_action == 'MOVE_SL':
-            return await handle_move_sl_signal(data)
+    if not active_users:
+        logger.error("Нет пользователей с активной подпиской и API-ключами")
+        raise HTTPException(status_code=400, detail="Нет пользователей с активной подпиской и API-ключами")
 
-        # Обработка торговых сигналов BUY/SELL
-        action = raw_action if raw_action in ['BUY', 'SELL'] else ('BUY' if raw_action == 'LONG' else 'SELL')
-        symbol = data.get('symbol')
+    signal_id = uuid.uuid4().hex
+    results = await dispatch_signal(active_users, signal, signal_id)
 
-        if not symbol:
-            logger.error("Не указан символ")
-            raise HTTPException(status_code=400, detail="Необходимо указать символ")
+    if not results:
+        raise HTTPException(status_code=500, detail="Не удалось обработать сигнал ни для одного пользователя")
 
-        try:
-            price = float(data.get('price', 0))
-            if price <= 0:
-                raise ValueError("Цена должна быть положительной")
-        except (TypeError, ValueError) as e:
-            logger.error(f"Ошибка в цене: {str(e)}")
-            raise HTTPException(status_code=400, detail="Неверный формат цены")
-
-        stop_loss = data.get('stop_loss')
-        take_profit_1 = data.get('take_profit_1')
-        take_profit_2 = data.get('take_profit_2')
-        take_profit_3 = data.get('take_profit_3')
-
-        # Обрабатываем возможные NaN значения
-        try:
-            stop_loss = float(stop_loss) if stop_loss is not None and not math.isnan(float(stop_loss)) else None
-        except (TypeError, ValueError):
-            stop_loss = None
+    return {
+        "status": "success",
+        "message": "Фьючерсный сигнал обработан для активных пользователей",
+        "signal_id": signal_id,
+        "symbol": signal.symbol,
+        "results": results
+    }
 
-        try:
-            take_profit_1 = float(take_profit_1) if take_profit_1 is not None and not math.isnan(
-                float(take_profit_1)) else None
-        except (TypeError, ValueError):
-            take_profit_1 = None
+@router.post("/webhook")
+async def webhook(request: Request):
+    """Основной webhook endpoint для торговых сигналов"""
+    # Бюджет сигнала отсчитывается от прихода запроса и действует на всю рассылку
+    with signal_deadline(time.time()):
+        return await handle_webhook(request)
 
-        try:
-            take_profit_2 = float(take_profit_2) if take_profit_2 is not None and not math.isnan(
-                float(take_profit_2)) else None
-        except (TypeError, ValueError):
-            take_profit_2 = None
+async def handle_webhook(request: Request):
+    try:
+        raw_data = await request.body()
+        logger.info(f"Получен webhook запрос: {raw_data.decode('utf-8', errors='replace')}")
 
         try:
-            take_profit_3 = float(take_profit_3) if take_profit_3 is not None and not math.isnan(
-                float(take_profit_3)) else None
-        except (TypeError, ValueError):
-            take_profit_3 = None
-
-        if not stop_loss or not all([take_profit_1, take_profit_2, take_profit_3]):
-            logger.error(
-                f"Не указаны все SL/TP: SL={stop_loss}, TP1={take_profit_1}, TP2={take_profit_2}, TP3={take_profit_3}")
-            raise HTTPException(status_code=400, detail="Необходимо указать stop_loss и все три take_profit")
-
-        # Получаем активных пользователей
-        cursor = get_cursor()
-        cursor.execute(
-            "SELECT user_id, api_key, secret_key, passphrase, exchange FROM users WHERE subscription_end > %s AND api_key IS NOT NULL AND secret_key IS NOT NULL AND subscription_type IN ('referral_approved', 'regular')",
-            (datetime.now(),)
-        )
-        active_users = cursor.fetchall()
-
-        if not active_users:
-            logger.error("Нет пользователей с активной подпиской и API-ключами")
-            raise HTTPException(status_code=400, detail="Нет пользователей с активной подпиской и API-ключами")
-
-        results = []
-        for user in active_users:
-            user_id = user['user_id']
-            exchange = user.get('exchange', 'bingx')
-            normalized_symbol = normalize_symbol(symbol, exchange)
-
-            signal = {
-                "action": action,
-                "symbol": normalized_symbol,
-                "price": price,
-                "stop_loss": stop_loss,
-                "take_profit_1": take_profit_1,
-                "take_profit_2": take_profit_2,
-                "take_profit_3": take_profit_3,
-            }
-
-            try:
-                if exchange == 'bingx':
-                    from services import process_bingx_signal
-                    result = await process_bingx_signal(user, signal)
-                elif exchange == 'okx':
-                    from services import process_okx_signal
-                    result = await process_okx_signal(user, signal)
-                elif exchange == 'bybit':
-                    from services import process_bybit_signal
-                    result = await process_bybit_signal(user, signal)
-                elif exchange == "bitget":
-                    from services import process_bitget_signal
-                    result = await process_bitget_signal(user, signal)
-                else:
-                    logger.error(f"Неизвестная биржа: {exchange} для пользователя {user_id}")
-                    continue
-
-                if result:
-                    results.append(result)
-                    logger.info(f"Сигнал обработан для пользователя {user_id} на бирже {exchange}")
-
-            except Exception as e:
-                logger.error(f"Ошибка обработки сигнала для пользователя {user_id} на бирже {exchange}: {str(e)}")
-                continue
-
-        if not results:
-            raise HTTPException(status_code=500, detail="Не удалось обработать сигнал ни для одного пользователя")
-
-        return {
-            "status": "success",
-            "message": "Фьючерсный сигнал обработан для активных пользователей",
-            "signal_id": "webhook_signal",
-            "symbol": symbol,
-            "results": results
-        }
-
+            signal = parse_signal(raw_data, request.headers.get('Content-Type', ''))
+            # Таблица символов закэширована, так что проверка не стоит запросов к биржам;
+            # промах кэша грузит её в отсеке биржи, не блокируя event loop
+            if not any((await resolve_symbol(signal.symbol)).values()):
+                raise SignalValidationError("unknown_symbol", f"Инструмент {signal.symbol} не торгуется ни на одной бирже")
+        except SignalValidationError as e:
+            logger.error(f"Сигнал отклонён ({e.code}): {e.message}")
+            raise HTTPException(status_code=400, detail={"code": e.code, "message": e.message})
+
+        # Сигналы по символу рассылаются по очереди, повторы склеиваются (coalescer.py);
+        # MOVE_SL не ждёт окна склейки, но не обгоняет ещё не разосланный вход
+        if signal.action == 'MOVE_SL':
+            return await signal_coalescer.submit(signal, handle_move_sl_signal)
+        return await signal_coalescer.submit(signal, dispatch_entry_signal)
+
+    except HTTPException:
+        raise
     except Exception as e:
         logger.error(f"Ошибка обработки webhook: {str(e)}")
-        raise HTTPException(status_code=500, detail=str(e))
\ No newline at end of file
+        raise HTTPException(status_code=500, detail=str(e))
+
+def require_control_token(request: Request, action: str) -> None:
+    """Служебные маршруты /control/* — только с токеном FLATTEN_TOKEN в заголовке X-Flatten-Token"""
+    if not flatten.FLATTEN_TOKEN:
+        raise HTTPException(status_code=404, detail="Not Found")
+    if not flatten.authorized(request.headers.get("X-Flatten-Token")):
+        logger.warning(f"Отклонён запрос {action} с {request.client.host if request.client else '?'}")
+        raise HTTPException(status_code=403, detail="Forbidden")
+
+@router.post("/control/flatten")
+async def flatten_all(payload: FlattenRequest, request: Request):
+    """Аварийная отмена всех ордеров и закрытие позиций; токен в заголовке X-Flatten-Token"""
+    require_control_token(request, "аварийного закрытия")
+    logger.warning(f"Аварийное закрытие: пользователи {payload.user_ids or 'все'}, "
+                   f"биржи {payload.exchanges or 'все'}, символы {payload.symbols or 'все'}")
+    return {"status": "success", **await flatten.flatten(payload.user_ids, payload.exchanges, payload.symbols)}
+
+@router.post("/control/metrics")
+async def control_metrics(request: Request):
+    """Серверные метрики, отсеки бирж и последние рассылки; токен в заголовке X-Flatten-Token.
+    POST: middleware пропускает GET только к / и /health"""
+    require_control_token(request, "метрик")
+    return {
+        "metrics": metrics.snapshot(),
+        "bulkheads": bulkheads.snapshot(),
+        "dispatch": list(scheduler.recent_dispatches)
+    }
@@ -0,0 +1,140 @@
+# worker.py
+"""
+Воркер шардированного исполнения сигналов (EXECUTION_MODE=sharded).
+
+Забирает задания из signal_jobs для своих шардов и рассылает сигнал
+подписчикам с user_id % shards == shard. На один шард можно запустить
+несколько воркеров на разных машинах — SKIP LOCKED не даст им взять
+одно задание дважды. Outbox журнала сделок у каждого воркера свой
+(trade_outbox.shard-<шарды>.ndjson); второму воркеру тех же шардов на той же
+машине нужен --outbox.
+
+    python worker.py --shard 0 1
+"""
+import argparse
+import asyncio
+import logging
+import signal
+import time
+from datetime import datetime
+
+from database import init_db, close_db, connect, get_active_users
+from deadline import signal_deadline
+from fanout import dispatch_signal, dispatch_move_sl
+from models import Signal
+from signal_queue import (
+    SIGNAL_JOB_MAX_AGE, SIGNAL_JOBS_CHANNEL, WORKER_ID, claim_job, finish_job,
+    mark_user_started, purge_started_users, started_user_ids,
+)
+from trade_journal import outbox_path_for, trade_journal
+
+logging.basicConfig(
+    level=logging.INFO,
+    format="%(asctime)s - %(name)s - %(levelname)s - %(message)s"
+)
+logger = logging.getLogger(__name__)
+
+# Сколько хранить отметки начатых входов: с запасом больше SIGNAL_JOB_MAX_AGE, с
+STARTED_USERS_RETENTION = max(SIGNAL_JOB_MAX_AGE * 10, 3600)
+
+
+async def process_job(job, progress_conn) -> list:
+    signal = Signal.model_validate(job["payload"])
+    users = get_active_users(datetime.now(), job["shard"], job["shards"])
+    logger.info(f"Задание {job['job_id']} ({job['kind']}): шард {job['shard']}/{job['shards']}, {len(users)} пользователей")
+    if job["kind"] == "move_sl":
+        return await dispatch_move_sl(users, signal.symbol, job["signal_id"])
+
+    if job["attempts"]:
+        # Задание выдано повторно: прошлый воркер упал посреди рассылки
+        started = await asyncio.to_thread(started_user_ids, progress_conn, job["signal_id"])
+        if started:
+            logger.warning(f"Задание {job['job_id']}: пропускаем {len(started)} пользователей, "
+                           f"чей вход уже начинался")
+            users = [user for user in users if user["user_id"] not in started]
+
+    async def on_user_start(user_id: int) -> None:
+        await asyncio.to_thread(mark_user_started, progress_conn, job["signal_id"], user_id)
+
+    return await dispatch_signal(users, signal, job["signal_id"], job["shard"], on_user_start)
+
+
+async def run(shards: list, poll_interval: float, outbox: str) -> None:
+    init_db()
+    # Outbox у каждого воркера свой: общий файл перезаписывался бы чужими сделками
+    trade_journal.outbox_path = outbox
+    await trade_journal.start()
+    queue_conn = connect()
+    # Отметки о начатых входах пишутся сразу, вне транзакции задания
+    progress_conn = connect()
+    progress_conn.autocommit = True
+    purged_at = 0.0
+    listen_conn = connect()
+    listen_conn.autocommit = True
+    listen_conn.cursor().execute(f"LISTEN {SIGNAL_JOBS_CHANNEL}")
+
+    loop = asyncio.get_running_loop()
+    wake = asyncio.Event()
+    stopping = asyncio.Event()
+
+    def on_notify():
+        listen_conn.poll()
+        listen_conn.notifies.clear()
+        wake.set()
+
+    loop.add_reader(listen_conn.fileno(), on_notify)
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stopping.set)
+
+    logger.info(f"Воркер {WORKER_ID} запущен, шарды {shards}")
+    try:
+        while not stopping.is_set():
+            job = claim_job(queue_conn, shards)
+            if job is None:
+                # Отметки нужны, только пока задание может быть выдано повторно
+                if time.monotonic() - purged_at > STARTED_USERS_RETENTION:
+                    purge_started_users(progress_conn, STARTED_USERS_RETENTION)
+                    purged_at = time.monotonic()
+                wake.clear()
+                try:
+                    await asyncio.wait_for(wake.wait(), poll_interval)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+
+            if job["age"] > SIGNAL_JOB_MAX_AGE:
+                logger.warning(f"Задание {job['job_id']} устарело ({job['age']:.1f} с), пропускаем")
+                finish_job(queue_conn, job["job_id"], "expired")
+                continue
+
+            try:
+                # Дедлайн считается от постановки сигнала в очередь, а не от взятия задания
+                with signal_deadline(time.time() - float(job["age"])):
+                    results = await process_job(job, progress_conn)
+                finish_job(queue_conn, job["job_id"], "done" if results else "failed", results)
+            except Exception as e:
+                logger.error(f"Ошибка задания {job['job_id']}: {e}")
+                finish_job(queue_conn, job["job_id"], "failed", error=str(e))
+    finally:
+        loop.remove_reader(listen_conn.fileno())
+        listen_conn.close()
+        queue_conn.close()
+        progress_conn.close()
+        await trade_journal.stop()
+        close_db()
+        logger.info(f"Воркер {WORKER_ID} остановлен")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Воркер шардированного исполнения сигналов")
+    parser.add_argument("--shard", type=int, nargs="+", required=True, help="номера шардов, которые обслуживает воркер")
+    parser.add_argument("--poll-interval", type=float, default=1.0,
+                        help="как часто проверять очередь, если не пришёл NOTIFY, с")
+    parser.add_argument("--outbox", help="outbox журнала сделок; по умолчанию свой для набора шардов")
+    args = parser.parse_args()
+    outbox = args.outbox or outbox_path_for("shard-" + "-".join(str(shard) for shard in sorted(args.shard)))
+    asyncio.run(run(args.shard, args.poll_interval, outbox))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,403 @@
+# ws_trading.py
+"""
+Постоянные WebSocket-сессии для выставления, изменения и отмены ордеров на OKX и Bybit.
+
+Каждый аккаунт получает свою авторизованную сессию: логин, heartbeat,
+переподключение с экспоненциальной паузой и сопоставление ответов по id запроса.
+Сессии живут в отдельном потоке со своим event loop, поэтому синхронный код
+okx_api/bybit_api вызывает request() так же, как REST SDK. Если канал недоступен,
+request() бросает WSUnavailable и вызывающий идёт через REST.
+"""
+import asyncio
+import base64
+import hashlib
+import hmac
+import json
+import logging
+import os
+import threading
+import time
+import uuid
+from typing import Dict, Optional, Tuple
+
+from cache import account_key
+from deadline import request_timeout
+import metrics
+
+logger = logging.getLogger(__name__)
+
+# Симулятор бирж (benchmarks/exchange_simulator.py) WebSocket не поддерживает
+WS_TRADING = os.getenv("WS_TRADING", "1") == "1" and not os.getenv("EXCHANGE_SIMULATOR_URL")
+OKX_WS_TRADE_URL = os.getenv("OKX_WS_TRADE_URL", "wss://ws.okx.com:8443/ws/v5/private")
+BYBIT_WS_TRADE_URL = os.getenv("BYBIT_WS_TRADE_URL", "wss://stream.bybit.com/v5/trade")
+WS_REQUEST_TIMEOUT = float(os.getenv("WS_REQUEST_TIMEOUT", "5"))
+WS_CONNECT_TIMEOUT = float(os.getenv("WS_CONNECT_TIMEOUT", "5"))
+WS_HEARTBEAT_INTERVAL = float(os.getenv("WS_HEARTBEAT_INTERVAL", "20"))
+# Сессия без запросов дольше этого закрывается
+WS_IDLE_TIMEOUT = float(os.getenv("WS_IDLE_TIMEOUT", "3600"))
+WS_RECONNECT_MAX_DELAY = 60.0
+
+
+class WSUnavailable(Exception):
+    """Канал недоступен, запрос до биржи не дошёл — можно идти через REST"""
+
+
+class WSTimeout(WSUnavailable):
+    """Запрос отправлен, но ответа нет: перед повтором через REST нужно проверить,
+    не исполнился ли ордер (по clOrdId / orderLinkId)"""
+
+
+def client_order_id() -> str:
+    """Клиентский id ордера: 32 символа [0-9a-f] подходят и OKX, и Bybit"""
+    return uuid.uuid4().hex
+
+
+class TradingSession:
+    """Одна авторизованная WS-сессия аккаунта"""
+
+    exchange = ""
+    url = ""
+
+    def __init__(self, api_key: str, secret_key: str, passphrase: str = None):
+        self.api_key = api_key
+        self.secret_key = secret_key
+        self.passphrase = passphrase
+        self.last_used = time.monotonic()
+        self.reconnects = 0
+        self.closed = False
+        self.error: Optional[str] = None
+        self._ws = None
+        self._http = None
+        self._connected = asyncio.Event()
+        self._pending: Dict[str, asyncio.Future] = {}
+        self._last_message = time.monotonic()
+        self._task: Optional[asyncio.Task] = None
+
+    # ------------------- Протокол биржи -------------------
+    def login_message(self) -> Dict:
+        raise NotImplementedError
+
+    def request_message(self, request_id: str, op: str, args: Dict) -> Dict:
+        raise NotImplementedError
+
+    def ping_message(self):
+        raise NotImplementedError
+
+    def parse(self, raw: str) -> Tuple[str, Optional[str], Optional[Dict]]:
+        """(тип, id запроса, сообщение); тип — login, response, pong или other"""
+        raise NotImplementedError
+
+    def login_error(self, message: Dict) -> Optional[str]:
+        raise NotImplementedError
+
+    # ------------------- Соединение -------------------
+    def start(self) -> None:
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def _connect(self) -> None:
+        import aiohttp
+        if self._http is None:
+            self._http = aiohttp.ClientSession()
+        self._ws = await self._http.ws_connect(self.url, timeout=WS_CONNECT_TIMEOUT, autoping=False)
+        await self._send(self.login_message())
+        ack = await asyncio.wait_for(self._reader_until_login(), WS_CONNECT_TIMEOUT)
+        error = self.login_error(ack)
+        if error:
+            # Ключи не принимаются — переподключаться бессмысленно, ошибку покажет REST
+            self.closed = True
+            self.error = error
+            raise WSUnavailable(f"Логин {self.exchange} WS отклонён: {error}")
+        self._connected.set()
+        logger.info(f"WS-сессия {self.exchange} {account_key(self.api_key)} подключена")
+
+    async def _reader_until_login(self) -> Dict:
+        while True:
+            message = await self._ws.receive()
+            if message.type.name != "TEXT":
+                raise WSUnavailable(f"Соединение закрыто до логина: {message.type.name}")
+            kind, _, data = self.parse(message.data)
+            if kind == "login":
+                return data
+
+    async def _send(self, message) -> None:
+        await self._ws.send_str(message if isinstance(message, str) else json.dumps(message))
+
+    async def _read_loop(self) -> None:
+        heartbeat = asyncio.create_task(self._heartbeat())
+        try:
+            async for message in self._ws:
+                if message.type.name != "TEXT":
+                    break
+                self._last_message = time.monotonic()
+                kind, request_id, data = self.parse(message.data)
+                if kind == "response":
+                    future = self._pending.pop(request_id, None)
+                    if future and not future.done():
+                        future.set_result(data)
+        finally:
+            heartbeat.cancel()
+
+    async def _heartbeat(self) -> None:
+        while True:
+            await asyncio.sleep(WS_HEARTBEAT_INTERVAL)
+            if time.monotonic() - self._last_message > 3 * WS_HEARTBEAT_INTERVAL:
+                logger.warning(f"WS-сессия {self.exchange} молчит, переподключаемся")
+                await self._ws.close()
+                return
+            await self._send(self.ping_message())
+
+    def _fail_pending(self, error: Exception) -> None:
+        for future in self._pending.values():
+            if not future.done():
+                future.set_exception(error)
+        self._pending.clear()
+
+    async def _run(self) -> None:
+        delay = 1.0
+        while not self.closed:
+            try:
+                await self._connect()
+                delay = 1.0
+                await self._read_loop()
+            except asyncio.CancelledError:
+                break
+            except Exception as e:
+                logger.warning(f"WS-сессия {self.exchange} {account_key(self.api_key)}: {e}")
+            self._connected.clear()
+            self._fail_pending(WSUnavailable("WS-соединение потеряно"))
+            if self.closed:
+                break
+            self.reconnects += 1
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, WS_RECONNECT_MAX_DELAY)
+        await self._close_transport()
+
+    async def _close_transport(self) -> None:
+        if self._ws is not None and not self._ws.closed:
+            await self._ws.close()
+        if self._http is not None:
+            await self._http.close()
+            self._http = None
+
+    async def close(self) -> None:
+        self.closed = True
+        self._connected.clear()
+        self._fail_pending(WSUnavailable("WS-сессия закрыта"))
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        await self._close_transport()
+
+    # ------------------- Запросы -------------------
+    async def request(self, op: str, args: Dict, timeout: float = WS_REQUEST_TIMEOUT) -> Dict:
+        self.last_used = time.monotonic()
+        if self.closed:
+            raise WSUnavailable(self.error or "WS-сессия закрыта")
+        self.start()
+        try:
+            await asyncio.wait_for(self._connected.wait(), WS_CONNECT_TIMEOUT)
+        except asyncio.TimeoutError:
+            raise WSUnavailable(f"WS-сессия {self.exchange} не подключена")
+
+        request_id = uuid.uuid4().hex
+        future = asyncio.get_running_loop().create_future()
+        self._pending[request_id] = future
+        try:
+            await self._send(self.request_message(request_id, op, args))
+        except Exception as e:
+            self._pending.pop(request_id, None)
+            raise WSUnavailable(f"Не удалось отправить запрос: {e}")
+        try:
+            return await asyncio.wait_for(future, timeout)
+        except asyncio.TimeoutError:
+            self._pending.pop(request_id, None)
+            raise WSTimeout(f"Нет ответа {self.exchange} WS на {op} за {timeout} с")
+
+
+class OkxSession(TradingSession):
+    """wss://ws.okx.com:8443/ws/v5/private: op order / amend-order / cancel-order"""
+
+    exchange = "okx"
+    url = OKX_WS_TRADE_URL
+
+    def login_message(self) -> Dict:
+        timestamp = str(int(time.time()))
+        sign = base64.b64encode(hmac.new(
+            self.secret_key.encode(), f"{timestamp}GET/users/self/verify".encode(), hashlib.sha256
+        ).digest()).decode()
+        return {"op": "login", "args": [{
+            "apiKey": self.api_key, "passphrase": self.passphrase, "timestamp": timestamp, "sign": sign
+        }]}
+
+    def request_message(self, request_id: str, op: str, args: Dict) -> Dict:
+        return {"id": request_id, "op": op, "args": [args]}
+
+    def ping_message(self) -> str:
+        return "ping"
+
+    def parse(self, raw: str):
+        if raw == "pong":
+            return "pong", None, None
+        message = json.loads(raw)
+        if message.get("event") in ("login", "error") and "id" not in message:
+            return "login", None, message
+        if "id" in message:
+            return "response", message["id"], message
+        return "other", None, message
+
+    def login_error(self, message: Dict) -> Optional[str]:
+        if message.get("event") == "login" and message.get("code") == "0":
+            return None
+        return f"{message.get('code')} {message.get('msg')}"
+
+
+class BybitSession(TradingSession):
+    """wss://stream.bybit.com/v5/trade: op order.create / order.amend / order.cancel"""
+
+    exchange = "bybit"
+    url = BYBIT_WS_TRADE_URL
+
+    def login_message(self) -> Dict:
+        expires = int((time.time() + 10) * 1000)
+        signature = hmac.new(self.secret_key.encode(), f"GET/realtime{expires}".encode(), hashlib.sha256).hexdigest()
+        return {"op": "auth", "args": [self.api_key, expires, signature]}
+
+    def request_message(self, request_id: str, op: str, args: Dict) -> Dict:
+        return {
+            "reqId": request_id,
+            "header": {"X-BAPI-TIMESTAMP": str(int(time.time() * 1000)), "X-BAPI-RECV-WINDOW": "8000"},
+            "op": op,
+            "args": [args],
+        }
+
+    def ping_message(self) -> Dict:
+        return {"op": "ping"}
+
+    def parse(self, raw: str):
+        message = json.loads(raw)
+        op = message.get("op")
+        if op == "auth":
+            return "login", None, message
+        if op in ("ping", "pong"):
+            return "pong", None, None
+        if message.get("reqId"):
+            return "response", message["reqId"], message
+        return "other", None, message
+
+    def login_error(self, message: Dict) -> Optional[str]:
+        if message.get("retCode") == 0:
+            return None
+        return f"{message.get('retCode')} {message.get('retMsg')}"
+
+
+SESSION_TYPES = {"okx": OkxSession, "bybit": BybitSession}
+
+
+class WSTradingPool:
+    """Сессии всех аккаунтов в отдельном потоке со своим event loop"""
+
+    def __init__(self):
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._thread: Optional[threading.Thread] = None
+        self._lock = threading.Lock()
+        self._sessions: Dict[Tuple[str, str], TradingSession] = {}
+
+    def _ensure_loop(self) -> asyncio.AbstractEventLoop:
+        with self._lock:
+            if self._loop is None:
+                self._loop = asyncio.new_event_loop()
+                self._thread = threading.Thread(target=self._loop.run_forever, name="ws-trading", daemon=True)
+                self._thread.start()
+                asyncio.run_coroutine_threadsafe(self._reap_idle(), self._loop)
+            return self._loop
+
+    def _session(self, exchange: str, api_key: str, secret_key: str, passphrase: str = None) -> TradingSession:
+        key = (exchange, account_key(api_key))
+        with self._lock:
+            session = self._sessions.get(key)
+            # Сессия, закрытая после отказа в логине, живёт до очистки в _reap_idle или смены ключей:
+            # пока она есть, запросы сразу уходят в REST
+            if session is None or (session.closed and session.secret_key != secret_key):
+                session = SESSION_TYPES[exchange](api_key, secret_key, passphrase)
+                self._sessions[key] = session
+            return session
+
+    async def _request(self, exchange: str, api_key: str, secret_key: str, passphrase: str, op: str,
+                       args: Dict, timeout: float) -> Dict:
+        return await self._session(exchange, api_key, secret_key, passphrase).request(op, args, timeout)
+
+    def request(self, exchange: str, api_key: str, secret_key: str, passphrase: str, op: str, args: Dict) -> Dict:
+        """Синхронный запрос через WS-сессию аккаунта; WSUnavailable — идти через REST"""
+        if not WS_TRADING or exchange not in SESSION_TYPES:
+            raise WSUnavailable("WS-торговля отключена")
+        started = time.perf_counter()
+        # Дедлайн сигнала живёт в ContextVar вызывающего потока — в цикл WS передаём уже готовый таймаут
+        timeout = request_timeout(WS_REQUEST_TIMEOUT)
+        future = asyncio.run_coroutine_threadsafe(
+            self._request(exchange, api_key, secret_key, passphrase, op, args, timeout), self._ensure_loop()
+        )
+        try:
+            response = future.result(WS_CONNECT_TIMEOUT + timeout + 1)
+        except WSUnavailable:
+            metrics.record(f"ws_{exchange}_{op}", time.perf_counter() - started, error=True)
+            raise
+        except Exception as e:
+            future.cancel()
+            metrics.record(f"ws_{exchange}_{op}", time.perf_counter() - started, error=True)
+            raise WSTimeout(f"WS-запрос {exchange} {op} не завершился: {e}")
+        metrics.record(f"ws_{exchange}_{op}", time.perf_counter() - started)
+        return response
+
+    def prewarm(self, users: list) -> int:
+        """Открывает сессии заранее, чтобы первый сигнал не ждал логина"""
+        if not WS_TRADING:
+            return 0
+        loop = self._ensure_loop()
+        opened = 0
+        for user in users:
+            exchange = user.get('exchange')
+            if exchange in SESSION_TYPES and user.get('api_key') and user.get('secret_key'):
+                session = self._session(exchange, user['api_key'], user['secret_key'], user.get('passphrase'))
+                loop.call_soon_threadsafe(session.start)
+                opened += 1
+        return opened
+
+    async def _reap_idle(self) -> None:
+        while True:
+            await asyncio.sleep(60)
+            now = time.monotonic()
+            with self._lock:
+                idle = [(key, session) for key, session in self._sessions.items()
+                        if session.closed or now - session.last_used > WS_IDLE_TIMEOUT]
+                for key, _ in idle:
+                    del self._sessions[key]
+            for _, session in idle:
+                await session.close()
+
+    def stop(self) -> None:
+        if self._loop is None:
+            return
+
+        async def close_all():
+            with self._lock:
+                sessions = list(self._sessions.values())
+                self._sessions.clear()
+            for session in sessions:
+                await session.close()
+
+        try:
+            asyncio.run_coroutine_threadsafe(close_all(), self._loop).result(10)
+        except Exception as e:
+            logger.error(f"Ошибка закрытия WS-сессий: {e}")
+        self._loop.call_soon_threadsafe(self._loop.stop)
+        self._thread.join(timeout=5)
+        self._loop = None
+        self._thread = None
+
+
+ws_trading = WSTradingPool()